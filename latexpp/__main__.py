@@ -1,6 +1,7 @@
 import os.path
 import sys
 import argparse
+import json
 import logging
 
 import colorlog
@@ -19,6 +20,16 @@ _LATEXPP_FIXES_DOC_URL = 'https://latexpp.readthedocs.io/en/latest/fixes/'
 
 
 from .preprocessor import LatexPreprocessor
+from .metrics import MetricsRecorder
+from .memprofile import MemoryProfiler
+from .profiler import Profiler
+from .manifest import ManifestRecorder, RunManifest, hash_config
+from .dependencies import DependencyTracker
+from .incremental import IncrementalBuild
+from .parse_cache import (
+    PersistentParseCache, get_default_cache_dir as get_default_parse_cache_dir,
+    DEFAULT_MAX_SIZE as DEFAULT_PARSE_CACHE_MAX_SIZE,
+)
 
 
 
@@ -200,6 +211,90 @@ def main(argv=None, omit_processed_by=False):
                         action='store_const', const=(logging.DEBUG - 2),
                         help='most likely way way way too verbose for your needs')
 
+    parser.add_argument('--fuse-fixes', dest='fuse_fixes', action='store_true',
+                        default=False,
+                        help='apply consecutive fixes together in a single walk '
+                        'through the document where possible (faster, same output '
+                        'with the built-in fixes)')
+
+    parser.add_argument('--parse-cache', dest='parse_cache', action='store',
+                        nargs='?', const=True, default=None, metavar='DIR',
+                        help='store the parsed documents in the cache directory DIR '
+                        '(default: {}) and reuse them in later runs if the '
+                        'documents and the fixes did not change'
+                        .format(get_default_parse_cache_dir()))
+
+    parser.add_argument('--parse-cache-max-size', dest='parse_cache_max_size',
+                        type=float, default=DEFAULT_PARSE_CACHE_MAX_SIZE / 2**20,
+                        metavar='MB',
+                        help='remove the least recently used entries of the '
+                        '--parse-cache directory when it grows larger than this '
+                        '(in MiB, default: %(default)s)')
+
+    parser.add_argument('--manifest', dest='manifest_file', action='store',
+                        default=None, metavar='FILE',
+                        help='after the run, write to FILE a manifest of the files '
+                        'that were read (with their hashes), of the configuration '
+                        'and of the fixes that were applied')
+
+    parser.add_argument('--if-changed', dest='if_changed', action='store_true',
+                        default=False,
+                        help='do nothing if the --manifest file (default: '
+                        '<output_dir>.manifest.json) shows that the input files, '
+                        'the configuration and the fixes did not change since the '
+                        'last run, and that the output files are still in place')
+
+    parser.add_argument('--incremental', dest='incremental_file', action='store',
+                        nargs='?', const=True, default=None, metavar='FILE',
+                        help='record in FILE (default: '
+                        '<output_dir>.incremental.pickle) the output that each '
+                        '\\input file of the main document produced; on the next '
+                        'run, process only the \\input files that changed and '
+                        'splice their output into the previous output, if they '
+                        "don't affect the rest of the document")
+
+    parser.add_argument('--depfile', dest='depfile', action='store',
+                        default=None, metavar='FILE',
+                        help='write the source files that the output depends on, '
+                        'including files that were looked for but not found, to '
+                        'FILE as a make rule (to include in a Makefile)')
+
+    parser.add_argument('--depfile-json', dest='depfile_json', action='store',
+                        default=None, metavar='FILE',
+                        help='write the source files that the output depends on '
+                        'to FILE in JSON format')
+
+    parser.add_argument('--metrics', dest='metrics_file', action='store',
+                        default=None, metavar='FILE',
+                        help='record the time spent in each fix, the number of '
+                        'nodes visited, etc., write these metrics to FILE in JSON '
+                        'format and print a summary table')
+
+    parser.add_argument('--profiler-output', dest='profiler_output', action='store',
+                        default=None, metavar='PREFIX',
+                        help='profile the run and write the results to PREFIX.prof '
+                        '(cProfile statistics) and PREFIX.collapsed (sampled call '
+                        'stacks, tagged with the running fix, for flamegraph tools)')
+    parser.add_argument('--profiler-interval', dest='profiler_interval',
+                        type=float, default=0.001, metavar='SECONDS',
+                        help='sampling interval for --profiler-output (default: '
+                        '%(default)s)')
+
+    parser.add_argument('--memory-profile', dest='memory_profile', action='store',
+                        nargs='?', const=True, default=None, metavar='FILE',
+                        help='trace memory allocations (slow) and report the peak '
+                        'and retained memory of each fix, sub-preprocessor run and '
+                        'input file, with the top allocation sites.  The report is '
+                        'added to the --metrics file if given, otherwise it is '
+                        'written to FILE (default: latexpp-memory.json)')
+    parser.add_argument('--memory-profile-sites', dest='memory_profile_sites',
+                        type=int, default=10, metavar='N',
+                        help='number of top allocation sites that --memory-profile '
+                        'records for each call of a fix, sub-preprocessor run and '
+                        'input file; 0 turns off the comparison of memory snapshots '
+                        'that finds them, which is slow on large documents '
+                        '(default: %(default)s)')
+
     parser.add_argument('--new', action=NewLppconfigTemplate)
 
     parser.add_argument('--version', action='version',
@@ -252,6 +347,33 @@ def main(argv=None, omit_processed_by=False):
     if args.output_fname:
         output_fname = args.output_fname
 
+    manifest_file = args.manifest_file
+    if args.if_changed and not manifest_file:
+        manifest_file = output_dir.rstrip('/') + '.manifest.json'
+
+    incremental_file = args.incremental_file
+    if incremental_file is True:
+        incremental_file = output_dir.rstrip('/') + '.incremental.pickle'
+
+    config_hash = None
+    if manifest_file or incremental_file:
+        config_hash = hash_config(lppconfig, fname=fname, output_fname=output_fname,
+                                  config_dir=config_dir)
+    if manifest_file:
+        if args.if_changed:
+            manifest = RunManifest.load(manifest_file)
+            if manifest is not None:
+                reasons = manifest.check(manifest_file, config_hash=config_hash,
+                                         output_dir=output_dir)
+                if not reasons:
+                    logger.info("Output in %s is up to date, nothing to do",
+                                output_dir.rstrip('/') + '/')
+                    return
+                logger.info("Running latexpp: %s", "; ".join(reasons))
+        # remove any stale manifest, in case the run fails
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+
     pp = LatexPreprocessor(
         output_dir=output_dir,
         main_doc_fname=fname,
@@ -263,21 +385,128 @@ def main(argv=None, omit_processed_by=False):
     if omit_processed_by:
         pp.omit_processed_by = omit_processed_by
 
+    pp.fuse_fixes = args.fuse_fixes
+
+    if args.parse_cache:
+        pp.persistent_parse_cache = PersistentParseCache(
+            args.parse_cache if args.parse_cache is not True else None,
+            max_size=int(args.parse_cache_max_size * 2**20),
+        )
+
+    if args.metrics_file:
+        pp.metrics = MetricsRecorder()
+
     pp.install_fixes_from_config(lppconfig['fixes'])
 
+    manifest_recorder = None
+    if manifest_file:
+        manifest_recorder = ManifestRecorder(pp, manifest_file)
+        manifest_recorder.start()
+
+    incremental_build = None
+    if incremental_file:
+        incremental_build = IncrementalBuild(pp, incremental_file,
+                                             config_hash=config_hash)
+        incremental_build.start()
+
+    dependency_tracker = None
+    if args.depfile or args.depfile_json:
+        dependency_tracker = DependencyTracker(pp)
+        dependency_tracker.add_input(lppconfigyml)
+        dependency_tracker.start()
+
+    profiler = None
+    if args.profiler_output:
+        profiler = Profiler(pp, interval=args.profiler_interval)
+        profiler.start()
+
+    memory_profiler = None
+    if args.memory_profile:
+        memory_profiler = MemoryProfiler(
+            pp,
+            snapshots=(args.memory_profile_sites > 0),
+            top_sites=args.memory_profile_sites,
+        )
+        memory_profiler.start()
+
     try:
 
         pp.initialize()
 
-        pp.execute_main()
+        if incremental_build is not None:
+            incremental_build.execute_main()
+        else:
+            pp.execute_main()
 
         pp.finalize()
 
+        if incremental_build is not None:
+            incremental_build.stop()
+            incremental_build.save()
+
+        if manifest_recorder is not None:
+            manifest_recorder.stop()
+            manifest_recorder.get_manifest(config_hash).save(manifest_file)
+            logger.debug("Wrote manifest to %s", manifest_file)
+
+        if dependency_tracker is not None:
+            dependency_tracker.stop()
+            if args.depfile:
+                dependency_tracker.write_makefile(args.depfile,
+                                                  relative_to=os.getcwd())
+            if args.depfile_json:
+                dependency_tracker.write_json(args.depfile_json,
+                                              relative_to=os.getcwd())
+
     except latexwalker.LatexWalkerParseError as e:
         logger.error("Parse error! %s", e)
         #sys.exit(1)
         raise # will cause error code exit
 
+    finally:
+        if memory_profiler is not None:
+            memory_profiler.stop()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profiler_output)
+            logger.info("Wrote profiling results to %s.prof and %s.collapsed",
+                        args.profiler_output, args.profiler_output)
+        if args.metrics_file:
+            _write_metrics(pp.metrics, args.metrics_file,
+                           memory_profiler=memory_profiler)
+        elif memory_profiler is not None:
+            memory_file = args.memory_profile
+            if memory_file is True:
+                memory_file = 'latexpp-memory.json'
+            _write_memory_profile(memory_profiler, memory_file)
+
+
+def _write_metrics(metrics, metrics_file, memory_profiler=None):
+    d = metrics.to_json()
+    if memory_profiler is not None:
+        d['memory'] = memory_profiler.to_json()
+    with open(metrics_file, 'w') as f:
+        json.dump(d, f, indent=2)
+        f.write('\n')
+    sys.stderr.write(
+        "\nPer-fix metrics (times in seconds, sorted by self wall time; "
+        "written to {}):\n\n{}\n\n".format(metrics_file, metrics.format_table())
+    )
+    if memory_profiler is not None:
+        _print_memory_table(memory_profiler, metrics_file)
+
+def _write_memory_profile(memory_profiler, memory_file):
+    with open(memory_file, 'w') as f:
+        json.dump({'memory': memory_profiler.to_json()}, f, indent=2)
+        f.write('\n')
+    _print_memory_table(memory_profiler, memory_file)
+
+def _print_memory_table(memory_profiler, fname):
+    sys.stderr.write(
+        "\nMemory usage (sorted by peak; written to {}):\n\n{}\n\n"
+        .format(fname, memory_profiler.format_table())
+    )
+
 
 
 def run_main():
@@ -289,11 +518,22 @@ def run_main():
     except Exception as e:
         import traceback
         traceback.print_exc()
-        import pdb
-        pdb.post_mortem()
+        if _can_run_debugger():
+            import pdb
+            pdb.post_mortem()
         sys.exit(255)
 
 
+def _can_run_debugger():
+    # Only start the post-mortem debugger in an interactive session, not in
+    # batch jobs (no terminal, or the LATEXPP_NO_PDB environment variable is
+    # set to a non-empty value).
+    if os.environ.get('LATEXPP_NO_PDB', ''):
+        return False
+    return sys.stdin is not None and sys.stdin.isatty() \
+        and sys.stderr is not None and sys.stderr.isatty()
+
+
 if __name__ == "__main__":
 
     run_main() # easier to debug
@@ -0,0 +1,388 @@
+r"""
+Run several fixes in a single walk over the document tree.
+
+Normally each fix walks the full document separately (see
+:py:meth:`latexpp.fix.BaseFix.preprocess()`).  When consecutive fixes only
+rely on the standard :py:meth:`~latexpp.fix.BaseFix.fix_node()` mechanism,
+they can be applied together during a single walk.  For each node, the fixes
+are applied in order, with the guarantee that whenever a fix's `fix_node()` is
+called on a node, the node's children have already been processed by all
+preceding fixes and not by any subsequent fixes.  Replacement nodes returned by
+a fix are handed over to the remaining fixes only.  Each fix is given as
+`prev_node` the last node that it left in place or returned in the same node
+list, as when the fixes are run one after the other, and each fix checks the
+post-space of the macros it leaves in front of other nodes (see
+:py:meth:`latexpp.fix.BaseFix.preprocess()`).
+
+The fused walk is not exactly equivalent to running the fixes one after the
+other in the following respects, since each node goes through all the fixes
+of the group before the next node is looked at:
+
+- `prev_node` was already handed over to the subsequent fixes of the group,
+  which might have modified it in place or processed its children;
+
+- `next_node` is the following node as it is before being processed by any
+  fix of the group.
+
+Fixes that don't look at `prev_node` or `next_node`, or only at attributes
+that the other fixes of the group don't modify, give the same result whether
+they are fused or not.  This is the case of all built-in fixes that can be
+fused; e.g., :py:class:`latexpp.fixes.comments.RemoveComments` looks at and
+updates the post-space of a macro in front of a comment, which the other
+built-in fixes never change in place.
+
+Fixes that need to see the whole document (those that reimplement
+:py:meth:`~latexpp.fix.BaseFix.preprocess()` or
+:py:meth:`~latexpp.fix.BaseFix.fix_nodelist()`, such as multi-stage fixes,
+pragma fixes or :py:class:`latexpp.fixes.ref.ExpandRefs`) are not fused; they
+act as barriers and run separately on the full document.
+
+Like :py:mod:`latexpp._lpp_traversal`, the fused walk keeps the work for each
+node list in a generator ("frame") on an explicit stack, so that the nesting
+depth of the document is not limited by Python's recursion limit.
+"""
+
+import logging
+
+from pylatexenc import latexwalker
+
+from .fix import BaseFix, DontFixThisNode, LatexNodeList
+from ._lpp_parsing import (
+    node_name_key, node_subtree_names, node_changed, update_node_state
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def fix_is_fusable(fix):
+    r"""
+    Return `True` if the given fix can be run in a fused walk, i.e., if it only
+    relies on :py:meth:`~latexpp.fix.BaseFix.fix_node()` to do its job.
+    """
+    fixcls = type(fix)
+    return (
+        fixcls.preprocess is BaseFix.preprocess
+        and fixcls.fix_nodelist is BaseFix.fix_nodelist
+    )
+
+
+def split_fix_groups(fixes):
+    r"""
+    Split the list of `fixes` into consecutive groups.  Returns a list of tuples
+    `(is_fused, fixes_in_group)`.  Groups with `is_fused=True` contain one or
+    more fixes that can be run in a single walk; other groups contain a single
+    fix that must be run separately.
+    """
+    groups = []
+    for fix in fixes:
+        if fix_is_fusable(fix):
+            if groups and groups[-1][0]:
+                groups[-1][1].append(fix)
+            else:
+                groups.append( (True, [fix]) )
+        else:
+            groups.append( (False, [fix]) )
+    return groups
+
+
+
+class FusedFixRunner:
+    r"""
+    Apply the given list of `fixes` in a single walk through a node list.  All
+    the fixes must be fusable (see :py:func:`fix_is_fusable()`).
+
+    Use :py:meth:`preprocess()` to process a node list.
+    """
+    def __init__(self, fixes):
+        super().__init__()
+        self.fixes = list(fixes)
+        # None (all nodes) or frozenset of name keys (see BaseFix.triggers())
+        self.trigger_keys = [ fix._get_trigger_keys() for fix in self.fixes ]
+        # handler maps for fixes that use BaseFix.handlers()
+        self.dispatch = [ fix._get_fix_node_dispatch() for fix in self.fixes ]
+
+    def preprocess(self, nodelist):
+        r"""
+        Apply all fixes to the given `nodelist` and return the new node list.
+        """
+        events = getattr(self.fixes[0].lpp, '_events', None)
+        if events is not None:
+            # somebody is listening, use the instrumented walk
+            runner = ObservedFusedFixRunner(self.fixes, events)
+        else:
+            runner = self
+        return runner._run(runner._list_frame(nodelist, 0, len(self.fixes)))
+
+    def _run(self, frame):
+        # Run the frame generator `frame` until it returns, along with all the
+        # frames that it requests, and return its return value (see
+        # latexpp._lpp_traversal.FixTraversal._run()).  Frames request that a
+        # node list be processed by the fixes [i0:i1] by yielding a tuple
+        # (nodelist, i0, i1).
+        stack = [ frame ]
+        value = None
+        while True:
+            try:
+                nodelist, i0, i1 = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if not stack:
+                    return e.value
+                value = e.value
+                continue
+            stack.append(self._list_frame(nodelist, i0, i1))
+            value = None
+
+    def _get_fix_node(self, i, n):
+        # return the callable that fix #i wants to be called on node n (its
+        # fix_node() method or the relevant handler), or None
+        keys = self.trigger_keys[i]
+        if keys is None:
+            return self.fixes[i].fix_node
+        key = node_name_key(n)
+        if key not in keys:
+            return None
+        if self.dispatch[i] is not None:
+            return self.dispatch[i][key]
+        return self.fixes[i].fix_node
+
+    def _subtree_is_relevant(self, n, i0, i1):
+        # whether any of the fixes [i0:i1] might act on any node in the subtree
+        # rooted at n
+        names = node_subtree_names(n)
+        if names is None:
+            return True
+        for i in range(i0, i1):
+            keys = self.trigger_keys[i]
+            if keys is None or not keys.isdisjoint(names):
+                return True
+        return False
+
+    #
+    # Frames.  In the following generators, "yield (nodelist, i0, i1)"
+    # evaluates to the version of nodelist processed by the fixes [i0:i1].
+    #
+
+    def _list_frame(self, nodelist, i0, i1):
+        # apply fixes self.fixes[i0:i1] on the given node list
+
+        if i0 >= i1:
+            return nodelist
+
+        fixes = self.fixes
+
+        # prev_nodes[i] is the last node that fix #i left in place or returned
+        # in this list, i.e., what fix #i would see as `prev_node` when run on
+        # its own
+        prev_nodes = [ None ] * i1
+
+        def output(i, n):
+            # fix #i leaves the node n after the previous ones.  Same post-space
+            # protection as in BaseFix.preprocess(), for the output of each fix
+            p = prev_nodes[i]
+            if p is not None and p.isNodeType(latexwalker.LatexMacroNode):
+                fixes[i]._ensure_macro_node_maybe_post_space([p, n], 0)
+            prev_nodes[i] = n
+
+        newnodelist = []
+        for j, n in enumerate(nodelist):
+            if n is None:
+                continue
+
+            next_node = nodelist[j+1] if j+1 < len(nodelist) else None
+
+            # nodes that still need to be processed, as tuples (node, i,
+            # children_done): the node is to be processed by the fixes
+            # [i:i1], and its children were processed by the fixes
+            # [i0:children_done].  Replacement nodes returned by a fix go
+            # through the remaining fixes before the nodes that follow.
+            pending = [ (n, i0, i0) ]
+            while pending:
+                node, istart, children_done = pending.pop()
+                nn_next = pending[-1][0] if pending else next_node
+
+                if not self._subtree_is_relevant(node, istart, i1):
+                    for i in range(istart, i1):
+                        output(i, node)
+                    newnodelist.append(node)
+                    continue
+
+                replaced = False
+                for i in range(istart, i1):
+                    fix_node = self._get_fix_node(i, node)
+                    if fix_node is None:
+                        output(i, node)
+                        continue
+
+                    fix = fixes[i]
+
+                    # bring children up to date before calling this fix
+                    if children_done < i:
+                        yield from self._children_frame(node, children_done, i)
+                        children_done = i
+
+                    nn = self._call_fix_node(i, fix_node, node,
+                                             prev_nodes[i], nn_next)
+                    if nn is None:
+                        output(i, node)
+                        continue
+
+                    # this fix replaced the node.  Fix #i took care of
+                    # processing the children of the replacement; have the
+                    # replacement nodes processed by the remaining fixes.
+                    if nn is node:
+                        # the fix modified the node in place
+                        node_changed(node)
+                    if isinstance(nn, str):
+                        nn = fix.parse_nodes(nn, parsing_state=node.parsing_state)
+                    if not isinstance(nn, (LatexNodeList, list)):
+                        nn = [nn]
+                    for nnn in nn:
+                        update_node_state(nnn)
+                        output(i, nnn)
+                    pending.extend( (nnn, i+1, i+1) for nnn in reversed(nn) )
+                    replaced = True
+                    break
+
+                if replaced:
+                    continue
+
+                if children_done < i1:
+                    yield from self._children_frame(node, children_done, i1)
+                newnodelist.append(node)
+
+        return newnodelist
+
+    def _children_frame(self, n, i0, i1):
+        # same as BaseFix.preprocess_child_nodes(), for fixes self.fixes[i0:i1]
+
+        if n.isNodeType(latexwalker.LatexGroupNode) \
+           or n.isNodeType(latexwalker.LatexMathNode):
+            n.nodelist = yield (n.nodelist, i0, i1)
+            update_node_state(n)
+            return
+
+        if n.isNodeType(latexwalker.LatexMacroNode) \
+           or n.isNodeType(latexwalker.LatexEnvironmentNode) \
+           or n.isNodeType(latexwalker.LatexSpecialsNode):
+            if n.nodeargd is not None and n.nodeargd.argnlist is not None:
+                argnlist = n.nodeargd.argnlist
+                for j in range(len(argnlist)):
+                    argnlist[j] = yield from self._argnode_frame(argnlist[j], i0, i1)
+
+        if n.isNodeType(latexwalker.LatexEnvironmentNode):
+            n.nodelist = yield (n.nodelist, i0, i1)
+
+        update_node_state(n)
+
+    def _argnode_frame(self, node, i0, i1):
+        # same as BaseFix.preprocess_argnode(), for fixes self.fixes[i0:i1]
+
+        if node is None:
+            return None
+
+        if not self._subtree_is_relevant(node, i0, i1):
+            return node
+
+        # contents of node (if it is a group) are processed by all fixes in
+        # [i0:contents_done]
+        contents_done = i0
+
+        for i in range(i0, i1):
+            fix_node = self._get_fix_node(i, node)
+            if fix_node is None:
+                continue
+
+            fix = self.fixes[i]
+
+            if contents_done < i and node.isNodeType(latexwalker.LatexGroupNode):
+                node.nodelist = yield (node.nodelist, contents_done, i)
+                contents_done = i
+
+            newnode = self._call_fix_argnode(i, fix_node, node)
+            if newnode is None:
+                continue
+            if newnode is node:
+                # the fix modified the node in place
+                node_changed(node)
+
+            if isinstance(newnode, str):
+                newnode = fix.parse_nodes(newnode, node.parsing_state)
+            if isinstance(newnode, (LatexNodeList, list)):
+                nx = newnode
+                delimiters = ('{', '}')
+                if len(nx) == 1 and nx[0].isNodeType(latexwalker.LatexGroupNode):
+                    delimiters = ('', '')
+                newnode = node.parsing_state.lpp_latex_walker.make_node(
+                    latexwalker.LatexGroupNode,
+                    nodelist=nx,
+                    delimiters=delimiters,
+                    parsing_state=node.parsing_state,
+                    pos=None, len=None
+                )
+
+            # BaseFix.preprocess_argnode() has the same fix process the
+            # contents of a replacement group again
+            node = newnode
+            contents_done = i
+
+        if node.isNodeType(latexwalker.LatexGroupNode) and contents_done < i1:
+            node.nodelist = yield (node.nodelist, contents_done, i1)
+
+        update_node_state(node)
+
+        return node
+
+    def _call_fix_node(self, i, fix_node, n, prev_node, next_node):
+        try:
+            return fix_node(n, prev_node=prev_node, next_node=next_node)
+        except DontFixThisNode:
+            return None
+
+    def _call_fix_argnode(self, i, fix_node, node):
+        try:
+            return fix_node(node, is_single_token_arg=True)
+        except DontFixThisNode:
+            return None
+
+
+class ObservedFusedFixRunner(FusedFixRunner):
+    r"""
+    A :py:class:`FusedFixRunner` that reports the nodes it visits and replaces
+    to `events` (see :py:mod:`latexpp.events`).  The nodes visited are
+    attributed to the first fix of the group.
+    """
+    def __init__(self, fixes, events):
+        super().__init__(fixes)
+        self.events = events
+
+    def preprocess(self, nodelist):
+        return self._run(self._list_frame(nodelist, 0, len(self.fixes)))
+
+    def _list_frame(self, nodelist, i0, i1):
+        if i0 < i1:
+            fix = self.fixes[i0]
+            self.events.nodes_visited(fix.lpp, fix, len(nodelist))
+        return (yield from super()._list_frame(nodelist, i0, i1))
+
+    def _argnode_frame(self, node, i0, i1):
+        if node is not None:
+            fix = self.fixes[i0]
+            self.events.nodes_visited(fix.lpp, fix, 1)
+        return (yield from super()._argnode_frame(node, i0, i1))
+
+    def _call_fix_node(self, i, fix_node, n, prev_node, next_node):
+        nn = super()._call_fix_node(i, fix_node, n, prev_node, next_node)
+        if nn is not None:
+            fix = self.fixes[i]
+            self.events.node_replaced(fix.lpp, fix, n, nn)
+        return nn
+
+    def _call_fix_argnode(self, i, fix_node, node):
+        newnode = super()._call_fix_argnode(i, fix_node, node)
+        if newnode is not None:
+            fix = self.fixes[i]
+            self.events.node_replaced(fix.lpp, fix, node, newnode)
+        return newnode
@@ -1,5 +1,8 @@
 #import re
 import functools
+import itertools
+import collections
+import copy
 
 import logging
 
@@ -13,60 +16,814 @@ def _no_latex_verbatim(*args, **kwargs):
     raise RuntimeError("Cannot use latex_verbatim() because the nodes might change.")
 
 
+class LatexVerbatimSpliceNode(latexwalker.LatexNode):
+    r"""
+    An opaque node that holds a piece of LaTeX code, given as the string
+    `latex`, which is inserted in the output exactly as is.
+
+    The code is never parsed, and fixes never look inside this node: it has no
+    children, and it does not match any fix triggers (see
+    :py:meth:`latexpp.fix.BaseFix.triggers()`).  Use it to splice large chunks
+    of code that should not be processed further (e.g., a ``.bbl`` file's
+    contents) into the document without paying the cost of parsing them and
+    having all subsequent fixes walk through the resulting nodes.  Create these
+    nodes with :py:meth:`latexpp.node_builder.LatexNodesBuilder.verbatim()`.
+    """
+    def __init__(self, latex, **kwargs):
+        super().__init__(_fields=('latex',), **kwargs)
+        self.latex = latex
+
+
+class LatexSegmentMarkerNode(LatexVerbatimSpliceNode):
+    r"""
+    Marks the beginning (`kind='begin'`) or the end (`kind='end'`) of the
+    nodes that replaced the ``\input`` directive number `segment` of the main
+    document, when recording the output of each input file separately (see
+    :py:mod:`latexpp.incremental`).  The marker is written out as a sentinel
+    string that is removed from the output again.
+
+    Markers are not created by our latex walker, so they carry no summary of
+    names: fixes never skip a subtree that contains a marker (see
+    :py:meth:`latexpp.fix.BaseFix.triggers()`), and thus always see it.
+    """
+    def __init__(self, segment, kind, **kwargs):
+        super().__init__(segment_marker_sentinel(segment, kind), **kwargs)
+        self.segment = segment
+        self.kind = kind
+
+def segment_marker_sentinel(segment, kind):
+    r"""
+    Return the string that the :py:class:`LatexSegmentMarkerNode` with the
+    given `segment` and `kind` is written out as.
+    """
+    return '\x00lpp-segment:{}:{}\x00'.format(segment, kind)
+
+
 class LatexCodeRecomposer:
+    r"""
+    Recompose latex code from a node structure.
+
+    The node tree is walked with an explicit stack rather than by recursion
+    (so that deeply nested structures do not hit Python's recursion limit), and
+    all the pieces of latex code are written into a single output buffer.  The
+    code for each node type is produced by an "emitter" method, looked up in a
+    dispatch table by node type.  An emitter returns the sequence of pieces
+    (strings or child nodes, `None` entries are skipped) that make up the node.
+
+    A single instance can be reused for any number of calls.  Subclasses may
+    reimplement :py:meth:`node_to_latex()` to customize the output for some
+    nodes, and call the base class implementation for other nodes; in that case
+    child nodes are recomposed by calling :py:meth:`node_to_latex()` on them.
+    """
     def __init__(self):
         super().__init__()
 
+        # Subclasses that customize node_to_latex() need to see all nodes; in
+        # that case don't use the verbatim source of unmodified nodes, and
+        # recompose child nodes via self.node_to_latex()
+        self.node_to_latex_customized = \
+            (type(self).node_to_latex is not LatexCodeRecomposer.node_to_latex)
+        self.use_known_latex = not self.node_to_latex_customized
+
+        self.emitters = {
+            latexwalker.LatexGroupNode: self.emit_group,
+            latexwalker.LatexCharsNode: self.emit_chars,
+            latexwalker.LatexCommentNode: self.emit_comment,
+            latexwalker.LatexMacroNode: self.emit_macro,
+            latexwalker.LatexEnvironmentNode: self.emit_environment,
+            latexwalker.LatexSpecialsNode: self.emit_specials,
+            latexwalker.LatexMathNode: self.emit_math,
+            LatexVerbatimSpliceNode: self.emit_verbatim_splice,
+        }
+        # emitters by concrete node class, filled in as we go
+        self._emitters_by_class = {}
+
     def node_to_latex(self, n):
+        r"""
+        Return the latex code for the node `n`.
+        """
         #print("*** node_to_latex: ", repr(n))
+        buf = []
+        self._write(n, buf.append, not self.node_to_latex_customized)
+        return ''.join(buf)
 
-        if n.isNodeType(latexwalker.LatexGroupNode):
-            return n.delimiters[0] + "".join(self.node_to_latex(n) for n in n.nodelist) \
-                + n.delimiters[1]
-
-        elif n.isNodeType(latexwalker.LatexCharsNode):
-            return n.chars
+    def nodelist_to_latex(self, nodelist):
+        r"""
+        Return the latex code for all the nodes in `nodelist`.
+        """
+        buf = []
+        self.write_nodes(nodelist, buf.append)
+        return ''.join(buf)
+
+    def write_nodes(self, nodelist, write):
+        r"""
+        Write the latex code for all the nodes in `nodelist` by calling `write`
+        with successive chunks of latex code.
+        """
+        if self.node_to_latex_customized:
+            for n in nodelist:
+                if n is not None:
+                    write(self.node_to_latex(n))
+            return
+        for n in nodelist:
+            if n is not None:
+                self._write(n, write, True)
 
-        elif n.isNodeType(latexwalker.LatexCommentNode):
-            return '%' + n.comment + n.comment_post_space
+    def args_to_latex(self, n):
+        r"""
+        Return the latex code for the arguments of the node `n`.
+        """
+        return ''.join( (self.node_to_latex(x) if isinstance(x, latexwalker.LatexNode)
+                         else x)
+                        for x in self._args_pieces(n)
+                        if x )
+
+    def get_emitter(self, n):
+        r"""
+        Return the emitter method for the given node `n`.
+        """
+        cls = type(n)
+        emitter = self._emitters_by_class.get(cls, None)
+        if emitter is not None:
+            return emitter
+        for c in cls.__mro__:
+            emitter = self.emitters.get(c, None)
+            if emitter is not None:
+                self._emitters_by_class[cls] = emitter
+                return emitter
+        raise ValueError("Unknown node type: {}".format(n.__class__.__name__))
+
+    def _write(self, root, write, walk_children):
+        # Write the latex code for `root` into `write`.  If `walk_children` is
+        # False, then child nodes are recomposed via self.node_to_latex()
+        # (customized by a subclass) instead of being walked by us.
+
+        use_known_latex = self.use_known_latex
+        emitters_by_class = self._emitters_by_class
+        get_emitter = self.get_emitter
+        node_to_latex = self.node_to_latex
+
+        stack = [root]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            x = pop()
+            if x is None:
+                continue
+            if type(x) is str:
+                if x:
+                    write(x)
+                continue
+            if x is not root and not walk_children:
+                write(node_to_latex(x))
+                continue
+            if use_known_latex:
+                # unmodified nodes & cached recompositions
+                s = node_latex_if_known(x)
+                if s is not None:
+                    write(s)
+                    continue
+            emitter = emitters_by_class.get(type(x), None)
+            if emitter is None:
+                emitter = get_emitter(x)
+            extend(reversed(emitter(x)))
+
+    def _args_pieces(self, n):
+        nodeargd = n.nodeargd
+        if nodeargd and hasattr(nodeargd, 'args_to_latex'):
+            return [ nodeargd.args_to_latex(recomposer=self) ]
+        if nodeargd is None or nodeargd.argspec is None \
+           or nodeargd.argnlist is None:
+            # no arguments or unknown argument structure
+            return []
+        return nodeargd.argnlist
+
+    def emit_group(self, n):
+        return [n.delimiters[0], *n.nodelist, n.delimiters[1]]
+
+    def emit_chars(self, n):
+        return [n.chars]
+
+    def emit_comment(self, n):
+        return ['%', n.comment, n.comment_post_space]
+
+    def emit_macro(self, n):
+        # macro maybe with arguments
+        return ['\\', n.macroname, n.macro_post_space, *self._args_pieces(n)]
+
+    def emit_environment(self, n):
+        return [r'\begin{', n.environmentname, '}', *self._args_pieces(n),
+                *n.nodelist,
+                r'\end{', n.environmentname, '}']
+
+    def emit_specials(self, n):
+        # specials maybe with arguments
+        return [n.specials_chars, *self._args_pieces(n)]
+
+    def emit_math(self, n):
+        return [n.delimiters[0], *n.nodelist, n.delimiters[1]]
+
+    def emit_verbatim_splice(self, n):
+        return [n.latex]
+
+
+#
+# Per-subtree summaries of the macro, environment, specials and comment nodes
+# that appear in a node's subtree.  These are attached to the nodes as the
+# attribute `_lpp_names` when they are created by our latex walker, and are
+# used to skip entire subtrees that a fix is not interested in (see
+# BaseFix.triggers()).  A summary is a frozenset of keys as returned by
+# node_name_key().  Summaries are allowed to be out of date as long as they
+# are a superset of the actual names in the subtree; nodes that were not
+# created by our latex walker do not have a summary (`None`), meaning that
+# nothing is known about them.
+#
+
+_empty_names = frozenset()
+
+_leaf_names_cache = {}
+
+def node_name_key(n):
+    r"""
+    Return the key under which the node `n` itself is recorded in subtree
+    summaries, e.g. ``('macros', 'textbf')``, or `None` for nodes that carry no
+    name (chars, groups, math).
+    """
+    if n.isNodeType(latexwalker.LatexMacroNode):
+        return ('macros', n.macroname)
+    if n.isNodeType(latexwalker.LatexEnvironmentNode):
+        return ('environments', n.environmentname)
+    if n.isNodeType(latexwalker.LatexSpecialsNode):
+        return ('specials', n.specials_chars)
+    if n.isNodeType(latexwalker.LatexCommentNode):
+        return ('comments', True)
+    return None
+
+def triggers_to_name_keys(triggers):
+    r"""
+    Convert a return value of :py:meth:`latexpp.fix.BaseFix.triggers()` into a
+    frozenset of keys that can be compared with subtree summaries.
+    """
+    keys = set()
+    for what in ('macros', 'environments', 'specials'):
+        keys.update( (what, name) for name in triggers.get(what, ()) )
+    if triggers.get('comments', False):
+        keys.add( ('comments', True) )
+    return frozenset(keys)
+
+def _iter_child_nodes(n):
+    nodeargd = getattr(n, 'nodeargd', None)
+    if nodeargd is not None:
+        argnlist = getattr(nodeargd, 'argnlist', None)
+        if argnlist:
+            for a in argnlist:
+                if a is not None:
+                    yield a
+    nodelist = getattr(n, 'nodelist', None)
+    if nodelist:
+        for c in nodelist:
+            if c is not None:
+                yield c
+
+def node_subtree_names(n):
+    r"""
+    Return the summary of names in the subtree rooted at `n`, or `None` if it is
+    not known.
+    """
+    return getattr(n, '_lpp_names', None)
+
+def update_node_subtree_names(n):
+    r"""
+    Recompute the summary of names of the node `n` from its own name and from
+    the summaries of its direct children.  Call this after modifying the
+    children of `n`.  Returns the new summary.  The argument `n` may also be a
+    node list object created by our latex walker.
+    """
+    names = None
+    for c in _iter_child_nodes(n):
+        cnames = getattr(c, '_lpp_names', None)
+        if cnames is None:
+            # we don't know what's in there
+            n._lpp_names = None
+            return None
+        if cnames:
+            if names is None:
+                names = set(cnames)
+            else:
+                names.update(cnames)
+
+    key = node_name_key(n) if hasattr(n, 'isNodeType') else None # or node list
+    if names is None:
+        if key is None:
+            n._lpp_names = _empty_names
+        else:
+            leafnames = _leaf_names_cache.get(key, None)
+            if leafnames is None:
+                leafnames = frozenset([key])
+                _leaf_names_cache[key] = leafnames
+            n._lpp_names = leafnames
+        return n._lpp_names
+
+    if key is not None:
+        names.add(key)
+    n._lpp_names = frozenset(names)
+    return n._lpp_names
+
+
+
+#
+# Modification tracking.  Each node created by our latex walker carries an
+# attribute `_lpp_gen` which is 0 if the node and its entire subtree are
+# unmodified since they were parsed, in which case the latex code of the node
+# is simply the corresponding slice of the parsed string.  Otherwise,
+# `_lpp_gen` is the value of a global counter at the time the node (or
+# something in its subtree) was last modified, and the latex code needs to be
+# recomposed from the node attributes.  Recomposed latex code requested via
+# `node.to_latex()` is cached in the attribute `_lpp_latex` until the node is
+# modified again.
+#
+# Assigning to a node attribute that affects its latex code marks the node as
+# modified.  Modifications propagate up to parent nodes via
+# update_node_state(), which is called whenever the children of a node were
+# preprocessed (just like update_node_subtree_names()).
+#
+
+_generation_counter = itertools.count(1)
+
+# node attributes that determine the latex code of a node
+_node_latex_fields = frozenset([
+    'pos', 'pos_end', 'latex_walker',
+    'chars', 'comment', 'comment_post_space', 'delimiters', 'nodelist',
+    'macroname', 'macro_post_space', 'nodeargd', 'environmentname',
+    'specials_chars', 'displaytype', 'latex',
+])
+
+_object_setattr = object.__setattr__
+
+def node_changed(n):
+    r"""
+    Mark the node `n` as modified, invalidating its verbatim latex code and any
+    cached recomposed latex code.  This is done automatically when node
+    attributes are assigned to, when the children of a node are preprocessed,
+    and when a fix returns the node it was given as its own replacement.  Call
+    this function if you modify a node's child lists in place by other means.
+    """
+    _object_setattr(n, '_lpp_gen', next(_generation_counter))
+    _object_setattr(n, '_lpp_latex', None)
+
+def node_is_unmodified(n):
+    r"""
+    Return `True` if the node `n` was created by our latex walker and neither
+    the node nor anything in its subtree was modified since it was parsed.
+    """
+    return getattr(n, '_lpp_gen', None) == 0
+
+def node_latex_if_known(n):
+    r"""
+    Return the latex code of `n` if it can be determined without recomposing it
+    from the node attributes (the node is unmodified or has a valid cached
+    recomposition), otherwise return `None`.
+    """
+    gen = getattr(n, '_lpp_gen', None)
+    if gen is None:
+        return None
+    if gen == 0:
+        return n.latex_walker.s[n.pos:n.pos_end]
+    return n._lpp_latex
+
+def node_to_latex(n):
+    r"""
+    Return the latex code of the node `n`, recomposing it if necessary.  For
+    nodes created by our latex walker, this is what `n.to_latex()` does.
+    """
+    s = node_latex_if_known(n)
+    if s is not None:
+        return s
+    s = _recomposer.node_to_latex(n)
+    if getattr(n, '_lpp_gen', None) is not None:
+        # cache until the node is modified again
+        _object_setattr(n, '_lpp_latex', s)
+    return s
+
+def _init_node_state(n):
+    # determine whether a freshly created node can be emitted verbatim
+    _object_setattr(n, '_lpp_latex', None)
+    if n.pos is None or n.pos_end is None or n.latex_walker is None \
+       or hasattr(getattr(n, 'nodeargd', None), 'args_to_latex'):
+        # no source position, or arguments that are recomposed in a custom way
+        _object_setattr(n, '_lpp_gen', next(_generation_counter))
+        return
+    for c in _iter_child_nodes(n):
+        if getattr(c, '_lpp_gen', None) != 0 or c.latex_walker is not n.latex_walker:
+            _object_setattr(n, '_lpp_gen', next(_generation_counter))
+            return
+    _object_setattr(n, '_lpp_gen', 0)
+
+def update_node_state(n):
+    r"""
+    Recompute the information that we attach to the node `n` after its
+    children might have changed: the summary of names in its subtree (see
+    :py:func:`update_node_subtree_names()`), and whether the node is modified
+    (if any child was modified after the node itself was last marked as
+    modified, then the node is marked as modified).  The argument `n` may also
+    be a node list object created by our latex walker.
+    """
+    update_node_subtree_names(n)
+    gen = getattr(n, '_lpp_gen', None)
+    if gen is None:
+        return
+    for c in _iter_child_nodes(n):
+        cgen = getattr(c, '_lpp_gen', None)
+        if cgen is None or cgen > gen \
+           or (gen == 0 and c.latex_walker is not n.latex_walker):
+            node_changed(n)
+            return
+
+def renew_node_generations(nodes):
+    r"""
+    Give fresh modification generations to all nodes in `nodes` (a node list
+    or a list of nodes) that are not unmodified.  Call this on nodes that were
+    restored from a serialized form (e.g., by
+    :py:mod:`latexpp.parse_cache`), whose generation numbers come from another
+    process and can't be compared with those of this process.  Children are
+    renewed before their parents, so parents remain newer than their
+    children.
+    """
+    # iterative post-order walk, node trees can be deep
+    stack = [ (n, False) for n in reversed(list(nodes)) if n is not None ]
+    while stack:
+        n, children_done = stack.pop()
+        if not children_done:
+            stack.append( (n, True) )
+            stack.extend( (c, False) for c in reversed(list(_iter_child_nodes(n))) )
+            continue
+        gen = getattr(n, '_lpp_gen', None)
+        if gen is not None and gen != 0:
+            node_changed(n)
+
+def _same_nodes(a, b):
+    if a is b:
+        # possibly modified in place, we can't tell
+        return False
+    if a is None or b is None or len(a) != len(b):
+        return False
+    return all( x is y for x, y in zip(a, b) )
+
+
+# Per-instance tuples of field names that pylatexenc stores on each node; we
+# share a single copy of each distinct tuple
+_node_interned_fields = frozenset(['_fields', '_redundant_fields'])
+_interned_tuples = {}
+
+
+class _LPPNodeMixin:
+    # Mix-in for the node classes that our latex walker creates.  Keeps track
+    # of modifications of node attributes, stores our own per-node information
+    # in slots, and provides to_latex() as a method.
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        # don't track modifications while the node is being constructed
+        _object_setattr(self, '_lpp_gen', None)
+        super().__init__(*args, **kwargs)
+
+    def __setattr__(self, name, value):
+        if name == 'nodelist' and isinstance(value, _LPPNodeList):
+            # in-place modifications of the list mark this node as modified
+            _object_setattr(value, '_lpp_owner', self)
+        if name in _node_latex_fields:
+            if self._lpp_gen is not None:
+                oldvalue = self.__dict__.get(name, None)
+                if name == 'nodelist':
+                    # a new list object with the same nodes is not a change
+                    changed = not _same_nodes(oldvalue, value)
+                elif isinstance(value, str):
+                    changed = (oldvalue != value)
+                else:
+                    changed = (oldvalue is not value)
+                _object_setattr(self, name, value)
+                if changed:
+                    node_changed(self)
+                return
+        elif name in _node_interned_fields:
+            value = _interned_tuples.setdefault(value, value)
+        _object_setattr(self, name, value)
+
+    def to_latex(self):
+        r"""
+        Return the latex code for this node, reflecting any modifications made
+        to the node structure.
+        """
+        return node_to_latex(self)
+
+    def latex_verbatim(self):
+        _no_latex_verbatim()
+
+
+_lpp_node_classes = {
+    cls: type(cls.__name__, (_LPPNodeMixin, cls), {
+        '__module__': __name__,
+        '__doc__': cls.__doc__,
+        '__slots__': ('_lpp_gen', '_lpp_latex', '_lpp_names'),
+    })
+    for cls in (latexwalker.LatexCharsNode,
+                latexwalker.LatexGroupNode,
+                latexwalker.LatexCommentNode,
+                latexwalker.LatexMacroNode,
+                latexwalker.LatexEnvironmentNode,
+                latexwalker.LatexSpecialsNode,
+                latexwalker.LatexMathNode,
+                LatexVerbatimSpliceNode)
+}
+
+
+class _LPPNodeList(getattr(latexwalker, 'LatexNodeList', list)):
+    # Node list class used by our latex walker (make_nodelist() is only called
+    # by pylatexenc 3, which provides LatexNodeList)
+
+    #
+    # Fixes return node lists unchanged when they don't replace any nodes (see
+    # BaseFix.preprocess()), so node lists of parsed nodes remain in place
+    # after being processed.  Support in-place modifications like a python
+    # list, as fixes may expect.  After a modification, the summary of names is
+    # no longer known, and the node whose `nodelist` this is (the owner, set by
+    # _LPPNodeMixin) is marked as modified so that it is no longer emitted as
+    # its verbatim source code.
+    #
+
+    __slots__ = ('_lpp_names', '_lpp_owner')
+
+    def _lpp_modified(self):
+        self._lpp_names = None
+        owner = getattr(self, '_lpp_owner', None)
+        if owner is not None and owner.__dict__.get('nodelist', None) is self:
+            node_changed(owner)
+
+    def __setitem__(self, index, value):
+        self.nodelist[index] = value
+        self._lpp_modified()
+
+    def __delitem__(self, index):
+        del self.nodelist[index]
+        self._lpp_modified()
+
+    def append(self, node):
+        self.nodelist.append(node)
+        self._lpp_modified()
+
+    def extend(self, nodes):
+        self.nodelist.extend(nodes)
+        self._lpp_modified()
+
+    def insert(self, index, node):
+        self.nodelist.insert(index, node)
+        self._lpp_modified()
+
+    def pop(self, index=-1):
+        node = self.nodelist.pop(index)
+        self._lpp_modified()
+        return node
 
-        elif n.isNodeType(latexwalker.LatexMacroNode):
-            # macro maybe with arguments
-            return '\\'+n.macroname+n.macro_post_space + self.args_to_latex(n)
+    def remove(self, node):
+        self.nodelist.remove(node)
+        self._lpp_modified()
+
+    def clear(self):
+        self.nodelist.clear()
+        self._lpp_modified()
+
+    def to_latex(self):
+        return _recomposer.nodelist_to_latex(self)
+
+    def latex_verbatim(self):
+        _no_latex_verbatim()
+
+
+def copy_nodes(x):
+    r"""
+    Return a copy of the node, node list, or list of nodes `x`.  All nodes in
+    the tree are copied, along with their child lists and parsed macro
+    arguments, so that the copy can be modified without affecting the original.
+    Other objects referenced by the nodes (parsing states, latex walker, macro
+    specs) are shared with the original.
+    """
+    if x is None:
+        return None
+    if isinstance(x, list):
+        return [ _copy_value(y) for y in x ]
+
+    cls = type(x)
+    c = cls.__new__(cls)
+    d = getattr(x, '__dict__', None)
+    if d is not None:
+        cd = c.__dict__
+        cd.update(d)
+        for k in _node_child_fields:
+            v = d.get(k, None)
+            if v is not None:
+                cd[k] = _copy_value(v)
+        if isinstance(cd.get('nodelist', None), _LPPNodeList):
+            _object_setattr(cd['nodelist'], '_lpp_owner', c)
+        if 'to_latex' in d:
+            # per-instance method set up by _LPPLatexWalker.make_node()
+            c.__dict__['to_latex'] = functools.partial(node_to_latex, c)
+    for slot in _get_lpp_slots(cls):
+        v = getattr(x, slot, _missing)
+        if v is not _missing:
+            _object_setattr(c, slot, v)
+    return c
+
+_missing = object()
+_lpp_slots_cache = {}
+
+def _get_lpp_slots(cls):
+    slots = _lpp_slots_cache.get(cls, None)
+    if slots is None:
+        slots = tuple(
+            slot
+            for cl in cls.__mro__
+            for slot in cl.__dict__.get('__slots__', ())
+            if slot.startswith('_lpp_')
+        )
+        _lpp_slots_cache[cls] = slots
+    return slots
+
+# node attributes that can contain child nodes
+_node_child_fields = ('nodelist', 'nodeargd')
+
+def _copy_value(v):
+    # copy the node structures in a node attribute
+    if isinstance(v, (latexwalker.LatexNode, _LPPNodeList)):
+        return copy_nodes(v)
+    if isinstance(v, list):
+        return [ _copy_value(y) for y in v ]
+    argnlist = getattr(v, 'argnlist', None)
+    if argnlist is not None:
+        # parsed macro arguments
+        v = copy.copy(v)
+        v.argnlist = copy_nodes(argnlist)
+    return v
+
+
+def _hashable_field_value(v):
+    if isinstance(v, list):
+        return tuple( _hashable_field_value(y) for y in v )
+    return v
+
+def latex_context_version(latex_context):
+    r"""
+    Return a value that changes whenever categories are added to or removed from
+    the given latex context database (or when macros, environments or specials
+    are added to its existing categories).
+    """
+    d = latex_context.d
+    return (
+        tuple(latex_context.category_list),
+        tuple( tuple(len(x) for x in d[cat].values()) if isinstance(d[cat], dict)
+               else None
+               for cat in latex_context.category_list ),
+        id(getattr(latex_context, 'unknown_macro_spec', None)),
+        id(getattr(latex_context, 'unknown_environment_spec', None)),
+        id(getattr(latex_context, 'unknown_specials_spec', None)),
+    )
+
+
+class FragmentParseCache:
+    r"""
+    Bounded LRU cache of parsed LaTeX code fragments, used to avoid reparsing
+    the same replacement code that fixes return again and again (see
+    :py:meth:`latexpp.preprocessor.LatexPreprocessor.parse_fragment()`).
+
+    Entries are keyed by the LaTeX code, the parsing state used to parse it,
+    and the state of the parsing state's latex context database.  Each lookup
+    returns a fresh copy of the node list (see :py:func:`copy_nodes()`), so
+    callers are free to modify the nodes.  When the categories of a latex
+    context change, all cached entries are dropped.
+
+    - `maxsize` is the maximum number of fragments that are kept in the cache.
+      Use `maxsize=0` to disable caching.
+
+    Attributes `hits`, `misses` and `invalidations` count cache hits, misses,
+    and the number of times the cache was cleared because a latex context
+    changed.
+    """
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._context_versions = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        r"""
+        Drop all cached entries.  (The counters are not reset.)
+        """
+        self._entries.clear()
+        self._context_versions.clear()
+
+    def get_nodes(self, s, parsing_state, parse_fn):
+        r"""
+        Return the node list obtained by parsing `s` with the given
+        `parsing_state`.  If the result is not in the cache, `parse_fn(s,
+        parsing_state)` is called to parse the code.
+        """
+        key = self._make_key(s, parsing_state)
+        if key is None:
+            return parse_fn(s, parsing_state)
+
+        nodes = self._entries.get(key, None)
+        if nodes is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return copy_nodes(nodes)
+
+        self.misses += 1
+        nodes = parse_fn(s, parsing_state)
+        self._entries[key] = copy_nodes(nodes)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return nodes
+
+    def _make_key(self, s, parsing_state):
+        if self.maxsize <= 0:
+            return None
+
+        latex_context = parsing_state.latex_context
+        if latex_context is not None:
+            version = latex_context_version(latex_context)
+            oldversion = self._context_versions.get(latex_context, None)
+            if oldversion is not None and oldversion != version:
+                logger.debug("Latex context changed, clearing fragment parse cache")
+                self.invalidations += 1
+                self.clear()
+            self._context_versions[latex_context] = version
+
+        pskey = parsing_state_key(parsing_state)
+        if pskey is None:
+            return None
+        return (s, pskey)
+
+
+def parsing_state_key(parsing_state):
+    r"""
+    Return a hashable value made of the fields of `parsing_state` (other than
+    the string `s` that is being parsed), or `None` if some field values can't
+    be hashed.  Parsing states with the same key parse code in the same way.
+    """
+    # parsing states are not modified once created, remember their key
+    pskey = getattr(parsing_state, '_lpp_fragment_cache_key', None)
+    if pskey is None:
+        try:
+            pskey = tuple(
+                (fld, _hashable_field_value(v))
+                for fld, v in parsing_state.get_fields().items()
+                if fld != 's'
+            )
+            hash(pskey)
+        except TypeError:
+            pskey = False
+        parsing_state._lpp_fragment_cache_key = pskey
+    if pskey is False:
+        return None
+    return pskey
 
-        elif n.isNodeType(latexwalker.LatexEnvironmentNode):
-            # get environment behavior definition.
-            return (r'\begin{' + n.environmentname + '}' + self.args_to_latex(n) +
-                     "".join( self.node_to_latex(n) for n in n.nodelist ) +
-                     r'\end{' + n.environmentname + '}')
 
-        elif n.isNodeType(latexwalker.LatexSpecialsNode):
-            # specials maybe with arguments
-            return n.specials_chars + self.args_to_latex(n)
+# shared instance used to recompose latex code of nodes
+_recomposer = LatexCodeRecomposer()
 
-        elif n.isNodeType(latexwalker.LatexMathNode):
-            return n.delimiters[0] + "".join( self.node_to_latex(n) for n in n.nodelist ) \
-                + n.delimiters[1]
 
-        else:
-            raise ValueError("Unknown node type: {}".format(n.__class__.__name__))
-        
-    def args_to_latex(self, n):
-        if n.nodeargd and hasattr(n.nodeargd, 'args_to_latex'):
-            return n.nodeargd.args_to_latex(recomposer=self)
-        if n.nodeargd is None or n.nodeargd.argspec is None \
-           or n.nodeargd.argnlist is None:
-            # no arguments or unknown argument structure
-            return ''
-        return ''.join( (self.node_to_latex(n) if n else '')
-                        for n in n.nodeargd.argnlist )
+class _LPPParsingState(latexwalker.ParsingState):
 
+    _fields = tuple(list(latexwalker.ParsingState._fields)+['lpp_latex_walker'])
 
-class _LPPParsingState(latexwalker.ParsingState):
     def __init__(self, lpp_latex_walker, **kwargs):
         super().__init__(**kwargs)
         self.lpp_latex_walker = lpp_latex_walker
-        self._fields = tuple(list(self._fields)+['lpp_latex_walker'])
+        # interned sub-contexts, see sub_context()
+        self._lpp_sub_contexts = {}
+
+    def sub_context(self, **kwargs):
+        # Parsing states are not modified after they are created, so we can
+        # share a single instance for all sub-contexts of this parsing state
+        # with the same properties.  (The parser otherwise creates a new
+        # sub-context e.g. for each math environment or macro argument.)
+        try:
+            key = tuple(sorted(kwargs.items()))
+            hash(key)
+        except TypeError:
+            # unhashable property values
+            return super().sub_context(**kwargs)
+        p = self._lpp_sub_contexts.get(key, None)
+        if p is None:
+            p = super().sub_context(**kwargs)
+            self._lpp_sub_contexts[key] = p
+        return p
 
 
 
@@ -86,45 +843,55 @@ class _LPPLatexWalker(latexwalker.LatexWalker):
         )
 
 
-    def make_node(self, *args, **kwargs):
-        node = super().make_node(*args, **kwargs)
+    def make_node(self, node_class, **kwargs):
+        # use our subclass that tracks modifications of the node
+        node_class = _lpp_node_classes.get(node_class, node_class)
+
+        node = super().make_node(node_class, **kwargs)
 
-        # forbid method latex_verbatim()
-        node.latex_verbatim = _no_latex_verbatim
+        if not isinstance(node, _LPPNodeMixin):
+            # some other node class, not one of our own (which forbid
+            # latex_verbatim() and provide to_latex())
+            node.latex_verbatim = _no_latex_verbatim
+            node.to_latex = functools.partial(node_to_latex, node)
 
-        # add method to_latex() that reconstructs the latex dynamically from the
-        # node structure
-        node.to_latex = functools.partial(self.node_to_latex, node)
+        # summary of names found in this subtree, and whether the node can be
+        # emitted verbatim -- children nodes have already been created at this
+        # point
+        update_node_subtree_names(node)
+        if isinstance(node, _LPPNodeMixin):
+            _init_node_state(node)
 
         #print("*** debug -> made node ", node)
 
         return node
 
-    def make_nodelist(self, nodelist, *args, **kwargs):
-        try:
-            nodelist = super().make_nodelist(nodelist, *args, **kwargs)
-        except Exception:
-            nodelist = list(nodelist)
+    def make_nodelist(self, nodelist, **kwargs):
+        # mandatory keyword-only argument:
+        parsing_state = kwargs.pop('parsing_state')
 
-        # forbid method latex_verbatim()
-        nodelist.latex_verbatim = _no_latex_verbatim
+        # our node list class provides to_latex() and forbids latex_verbatim()
+        nodelist = _LPPNodeList(
+            nodelist=nodelist,
+            parsing_state=parsing_state,
+            latex_walker=self,
+            **kwargs
+        )
 
-        # add method to_latex() that reconstructs the latex dynamically from the
-        # node structure
-        nodelist.to_latex = functools.partial(self.nodelist_to_latex, nodelist)
+        update_node_subtree_names(nodelist)
 
         #print("*** debug -> made node list ", nodelist)
 
         return nodelist
 
-
-
-
     def node_to_latex(self, n):
-        return LatexCodeRecomposer().node_to_latex(n)
+        return node_to_latex(n)
 
     def nodelist_to_latex(self, nodelist):
-        return ''.join(self.node_to_latex(n) for n in nodelist)
+        return _recomposer.nodelist_to_latex(nodelist)
+
+    def write_nodes(self, nodelist, write):
+        _recomposer.write_nodes(nodelist, write)
 
     def pos_to_lineno_colno(self, pos, **kwargs):
         if pos is None:
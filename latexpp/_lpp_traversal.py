@@ -0,0 +1,496 @@
+r"""
+Walk the document tree to apply a fix, without recursion.
+
+This module implements what :py:meth:`latexpp.fix.BaseFix.preprocess()`,
+:py:meth:`~latexpp.fix.BaseFix.preprocess_child_nodes()` and friends do: call
+:py:meth:`~latexpp.fix.BaseFix.fix_nodelist()` on each node list and
+:py:meth:`~latexpp.fix.BaseFix.fix_node()` on each node, and descend into the
+child nodes of those nodes that were not replaced.  Rather than having these
+methods call each other recursively, the work for each node list is carried
+out by a generator ("frame") which yields the child node lists that need to be
+preprocessed and receives the preprocessed lists in return.  The frames are
+kept on an explicit stack, so that the nesting depth of the document is not
+limited by Python's recursion limit.
+
+(Fixes that call :py:meth:`~latexpp.fix.BaseFix.preprocess()` and friends
+themselves from within `fix_node()` still recurse through these calls, of
+course.)
+"""
+
+import itertools
+import logging
+
+from pylatexenc import latexwalker
+
+from .fix import (
+    BaseFix, DontFixThisNode, LatexNodeList, LatexWalkerParseError
+)
+from ._lpp_parsing import (
+    node_name_key, node_subtree_names, node_changed, update_node_state,
+    LatexSegmentMarkerNode
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_fix_traversal(fix, events, segments=None):
+    r"""
+    Return a :py:class:`FixTraversal` for `fix`, or an
+    :py:class:`ObservedFixTraversal` which reports the nodes it visits and
+    replaces to `events` (a :py:class:`latexpp.events.EventDispatcher`) if
+    `events` is not `None`.
+
+    If `segments` is not `None`, it is a
+    :py:class:`latexpp.incremental.SegmentRecorder` that is notified of the
+    segment markers that the walk encounters (see
+    :py:class:`SegmentTrackingMixin`).
+    """
+    if segments is not None:
+        if events is None:
+            return SegmentFixTraversal(fix, segments)
+        return ObservedSegmentFixTraversal(fix, events, segments)
+    if events is None:
+        return FixTraversal(fix)
+    return ObservedFixTraversal(fix, events)
+
+
+class FixTraversal:
+    r"""
+    Apply the given `fix` to node lists and nodes, using an explicit stack
+    instead of recursion.  Each :py:class:`~latexpp.fix.BaseFix` instance uses
+    its own instance of this class to implement
+    :py:meth:`~latexpp.fix.BaseFix.preprocess()` and
+    :py:meth:`~latexpp.fix.BaseFix.preprocess_child_nodes()`.
+    """
+
+    # no events are emitted, see ObservedFixTraversal
+    events = None
+
+    # segment markers are not reported, see SegmentTrackingMixin
+    segments = None
+
+    def __init__(self, fix):
+        super().__init__()
+        self.fix = fix
+
+        fixcls = type(fix)
+        # if these methods are reimplemented, we call them instead of
+        # processing child nodes ourselves
+        self.default_preprocess = \
+            (fixcls.preprocess is BaseFix.preprocess)
+        self.default_preprocess_child_nodes = \
+            (fixcls.preprocess_child_nodes is BaseFix.preprocess_child_nodes)
+
+    def preprocess(self, nodelist):
+        r"""
+        Same as :py:meth:`latexpp.fix.BaseFix.preprocess()`.
+        """
+        return self._run(self._nodelist_frame(nodelist))
+
+    def preprocess_child_nodes(self, node):
+        r"""
+        Same as :py:meth:`latexpp.fix.BaseFix.preprocess_child_nodes()`.
+        """
+        self._run(self._child_nodes_frame(node))
+
+    def preprocess_argnode(self, node):
+        r"""
+        Call `fix_node()` on the macro argument `node` (with
+        `is_single_token_arg=True`) and preprocess its children.  Returns the
+        new argument node.
+        """
+        return self._run(self._argnode_frame(node))
+
+    def _run(self, frame):
+        # Run the frame generator `frame` until it returns, along with all the
+        # frames that it requests, and return its return value.
+        fix = self.fix
+        stack = [ frame ]
+        value = None
+        while True:
+            try:
+                nodelist = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if not stack:
+                    return e.value
+                value = e.value
+                continue
+            # the frame requested that `nodelist` be preprocessed
+            if self.default_preprocess:
+                stack.append(self._nodelist_frame(nodelist))
+                value = None
+            else:
+                value = fix.preprocess(nodelist)
+
+    #
+    # Frames.  In the following generators, "yield nodelist" evaluates to the
+    # preprocessed version of nodelist.
+    #
+
+    def _nodelist_frame(self, nodelist):
+
+        fix = self.fix
+
+        newnodelist = fix.fix_nodelist(nodelist)
+
+        # Only continue preprocessing children nodes if fix_nodelist() returned
+        # `None`.  The rule is that if fix_node() or fix_nodelist() return
+        # something non-None, they are responsible for calling
+        # preprocess_latex() or preprocess_children() on all child nodes.
+        if isinstance(newnodelist, (LatexNodeList, list)):
+            # the nodes of the returned list might be arranged differently,
+            # e.g., a kept macro might be followed by new chars; check the
+            # whole list
+            _ensure_post_spaces(fix, newnodelist, [ (0, len(newnodelist)) ])
+            return newnodelist
+        if isinstance(newnodelist, str):
+            # re-parse with latexwalker
+            ps = None
+            if nodelist:
+                ps = nodelist[0].parsing_state
+            try:
+                newnodelist = fix.parse_nodes(newnodelist, parsing_state=ps)
+            except LatexWalkerParseError as e:
+                _log_parse_error_context(nodelist)
+                raise
+            _ensure_post_spaces(fix, newnodelist, [ (0, len(newnodelist)) ])
+            return newnodelist
+        if newnodelist is not None:
+            raise ValueError("{}.fix_nodelist() did not return a string or node list"
+                             .format(fix.fix_name()))
+
+        # Continue processing with fix_node()
+        trigger_keys = fix._get_trigger_keys()
+        dispatch = fix._get_fix_node_dispatch()
+        fix_node = fix.fix_node
+        default_preprocess_child_nodes = self.default_preprocess_child_nodes
+
+        # Copy-on-write: as long as no node was replaced, we don't build a new
+        # list; `newnodelist` is created upon the first replacement.
+        # `touched` collects ranges [jstart, jend) of positions in the result
+        # list around which the post-space of macros needs to be checked,
+        # including the boundaries before and after each range (an empty range
+        # marks the place of a removed node, whose neighbours now meet).
+        newnodelist = None
+        touched = []
+        for j, n in enumerate(nodelist):
+
+            if n is None:
+                if newnodelist is None:
+                    newnodelist = list(itertools.islice(nodelist, j))
+                touched.append( (len(newnodelist), len(newnodelist)) )
+                continue
+
+            if trigger_keys is not None:
+                names = node_subtree_names(n)
+                if names is not None and trigger_keys.isdisjoint(names):
+                    # nothing in this subtree that is of interest to us
+                    if newnodelist is not None:
+                        newnodelist.append(n)
+                    continue
+                key = node_name_key(n)
+                if key not in trigger_keys:
+                    # not interested in this node itself, but maybe in its
+                    # children
+                    nn = None
+                elif dispatch is not None:
+                    nn = self._call_fix_node(dispatch[key], n, nodelist, j,
+                                             newnodelist)
+                else:
+                    nn = self._call_fix_node(fix_node, n, nodelist, j,
+                                             newnodelist)
+            else:
+                nn = self._call_fix_node(fix_node, n, nodelist, j, newnodelist)
+
+            if nn is None:
+                # keep this node as it is; make sure child nodes are
+                # preprocessed.
+                if not default_preprocess_child_nodes:
+                    fix.preprocess_child_nodes(n)
+                elif _has_children(n):
+                    yield from self._child_nodes_frame(n)
+                else:
+                    update_node_state(n)
+                jnew = j
+                if newnodelist is not None:
+                    jnew = len(newnodelist)
+                    newnodelist.append(n)
+                if getattr(n, '_lpp_gen', None) != 0:
+                    # the node might have changed (now, or by an earlier fix)
+                    touched.append( (jnew, jnew+1) )
+                continue
+
+            if isinstance(nn, str):
+                # if it is a str then we need to re-parse output into nodes
+                try:
+                    nn = fix.parse_nodes(nn, parsing_state=n.parsing_state)
+                except LatexWalkerParseError as e:
+                    _log_parse_error_context(nodelist)
+                    raise
+                # fall through case is list ->
+            if isinstance(nn, (LatexNodeList, list)):
+                # add new nodes
+                if newnodelist is None:
+                    newnodelist = list(itertools.islice(nodelist, j))
+                for nnn in nn:
+                    update_node_state(nnn)
+                touched.append( (len(newnodelist), len(newnodelist)+len(nn)) )
+                newnodelist.extend(nn)
+                continue
+
+            if nn is n:
+                # the fix modified the node in place
+                node_changed(n)
+            elif newnodelist is None:
+                newnodelist = list(itertools.islice(nodelist, j))
+            update_node_state(nn)
+            jnew = len(newnodelist) if newnodelist is not None else j
+            touched.append( (jnew, jnew+1) )
+            if newnodelist is not None:
+                newnodelist.append(nn)
+
+        if newnodelist is None:
+            newnodelist = nodelist
+
+        _ensure_post_spaces(fix, newnodelist, touched)
+
+        return newnodelist
+
+    def _call_fix_node(self, fix_node, n, nodelist, j, newnodelist):
+        # call fix_node() (or the relevant handler)
+        if newnodelist is not None:
+            # newnodelist here (already preprocessed)
+            prev_node = newnodelist[-1] if len(newnodelist) else None
+        else:
+            prev_node = nodelist[j-1] if j > 0 else None
+        try:
+            return fix_node(
+                n,
+                prev_node=prev_node,
+                # nodelist here (not yet preprocessed)
+                next_node=(nodelist[j+1] if j+1 < len(nodelist) else None)
+            )
+        except DontFixThisNode:
+            return None
+
+    def _call_fix_argnode(self, fix_node, node):
+        try:
+            return fix_node(node, is_single_token_arg=True)
+        except DontFixThisNode:
+            return None
+
+    def _child_nodes_frame(self, n):
+
+        if n.isNodeType(latexwalker.LatexGroupNode) \
+           or n.isNodeType(latexwalker.LatexMathNode):
+            yield from self._nodelist_attr_frame(n)
+
+        elif n.isNodeType(latexwalker.LatexMacroNode) \
+             or n.isNodeType(latexwalker.LatexEnvironmentNode) \
+             or n.isNodeType(latexwalker.LatexSpecialsNode):
+            if n.nodeargd is not None and n.nodeargd.argnlist is not None:
+                argnlist = n.nodeargd.argnlist
+                for j in range(len(argnlist)):
+                    argnlist[j] = yield from self._argnode_frame(argnlist[j])
+
+            if n.isNodeType(latexwalker.LatexEnvironmentNode):
+                yield from self._nodelist_attr_frame(n)
+
+        # children might have changed
+        update_node_state(n)
+
+    def _nodelist_attr_frame(self, n):
+        # preprocess n.nodelist.  preprocess() returns the same list object if
+        # no node was replaced, in which case we leave the attribute alone (an
+        # assignment would mark the node as modified).  Changes within child
+        # nodes are picked up by update_node_state().
+        nodelist = n.nodelist
+        newnodelist = yield nodelist
+        if newnodelist is not nodelist:
+            n.nodelist = newnodelist
+
+    def _argnode_frame(self, node):
+
+        if node is None:
+            return None
+
+        fix = self.fix
+
+        trigger_keys = fix._get_trigger_keys()
+        if trigger_keys is not None:
+            names = node_subtree_names(node)
+            if names is not None and trigger_keys.isdisjoint(names):
+                return node
+
+        fix_node = fix.fix_node
+        if trigger_keys is not None:
+            key = node_name_key(node)
+            if key not in trigger_keys:
+                fix_node = None
+            else:
+                dispatch = fix._get_fix_node_dispatch()
+                if dispatch is not None:
+                    fix_node = dispatch[key]
+
+        newnode = None
+        if fix_node is not None:
+            newnode = self._call_fix_argnode(fix_node, node)
+
+        if newnode is None:
+            newnode = node
+        elif newnode is node:
+            # the fix modified the node in place
+            node_changed(node)
+
+        if isinstance(newnode, str):
+            # re-parse with latexwalker etc.
+            newnode = fix.parse_nodes(newnode, node.parsing_state)
+            # fall through to list case ->
+
+        if isinstance(newnode, (LatexNodeList, list)):
+            nx = newnode
+            # by default, ensure the contents are enclosed in curly braces to
+            # make sure the syntax of the resulting LaTeX code isn't changed
+            # (e.g., replacing ‘\rhostate’ by ‘\hat\rho’ in ‘\frac\rhostate{2}’
+            # should give ‘\frac{\hat\rho}{2}’, not ‘\frac\hat\rho{2}’.  Only
+            # omit the extra '{' delimiters if the node itself contains a single
+            # element which is a group node.
+            delimiters = ('{', '}')
+            if len(nx) == 1 and nx[0].isNodeType(latexwalker.LatexGroupNode):
+                delimiters = ('', '')
+            newnode = node.parsing_state.lpp_latex_walker.make_node(
+                latexwalker.LatexGroupNode,
+                nodelist=nx,
+                delimiters=delimiters,
+                parsing_state=node.parsing_state,
+                pos=None, len=None
+            )
+
+        if newnode.isNodeType(latexwalker.LatexGroupNode):
+            yield from self._nodelist_attr_frame(newnode)
+
+        update_node_state(newnode)
+
+        return newnode
+
+
+def _ensure_post_spaces(fix, nodelist, ranges):
+    # make sure in the nodelist that macro nodes are always protected by a
+    # post-space, e.g., avoid a situation where a macro replacement \a -> \b
+    # removed the post-space and glues the macro invokation to a subsequent
+    # string.  Only the ranges [jstart, jend) of positions where something
+    # changed need to be checked, along with their boundaries: the node before
+    # jstart is checked against the first node of the range, and the last node
+    # of the range against the node at jend.
+    for jstart, jend in ranges:
+        for jj in range(max(jstart-1, 0), min(jend, len(nodelist)-1)):
+            n = nodelist[jj]
+            if n is not None and nodelist[jj+1] is not None \
+               and n.isNodeType(latexwalker.LatexMacroNode):
+                fix._ensure_macro_node_maybe_post_space(nodelist, jj)
+
+
+class ObservedFixTraversal(FixTraversal):
+    r"""
+    A :py:class:`FixTraversal` that reports the nodes it visits and replaces
+    to `events` (see :py:mod:`latexpp.events`).  Keeping the instrumentation
+    in a separate class leaves the walk free of any event checks when nobody
+    is listening.
+    """
+    def __init__(self, fix, events):
+        super().__init__(fix)
+        self.events = events
+
+    def _nodelist_frame(self, nodelist):
+        newnodelist = yield from super()._nodelist_frame(nodelist)
+        self.events.nodes_visited(self.fix.lpp, self.fix, len(nodelist))
+        return newnodelist
+
+    def _argnode_frame(self, node):
+        if node is not None:
+            self.events.nodes_visited(self.fix.lpp, self.fix, 1)
+        return (yield from super()._argnode_frame(node))
+
+    def _call_fix_node(self, fix_node, n, nodelist, j, newnodelist):
+        nn = super()._call_fix_node(fix_node, n, nodelist, j, newnodelist)
+        if nn is not None:
+            self.events.node_replaced(self.fix.lpp, self.fix, n, nn)
+        return nn
+
+    def _call_fix_argnode(self, fix_node, node):
+        newnode = super()._call_fix_argnode(fix_node, node)
+        if newnode is not None:
+            self.events.node_replaced(self.fix.lpp, self.fix, node, newnode)
+        return newnode
+
+
+class SegmentTrackingMixin:
+    r"""
+    Mix-in for :py:class:`FixTraversal` classes that reports the segment
+    markers (see :py:class:`latexpp._lpp_parsing.LatexSegmentMarkerNode`) of
+    the node lists it walks to the recorder `self.segments`, so that it can
+    take a snapshot of the state of the fix at the boundaries of each segment
+    (see :py:mod:`latexpp.incremental`).
+
+    The nodes between two markers are processed as a node list of their own,
+    exactly as when the nodes of a single segment are processed again on their
+    own in a later incremental run.
+    """
+    def _nodelist_frame(self, nodelist):
+        if not any(isinstance(n, LatexSegmentMarkerNode) for n in nodelist):
+            return (yield from super()._nodelist_frame(nodelist))
+
+        newnodelist = []
+        piece = []
+        for n in nodelist:
+            if not isinstance(n, LatexSegmentMarkerNode):
+                piece.append(n)
+                continue
+            if piece:
+                newnodelist.extend( (yield from super()._nodelist_frame(piece)) )
+                piece = []
+            self.segments.marker_reached(self.fix, n)
+            newnodelist.append(n)
+        if piece:
+            newnodelist.extend( (yield from super()._nodelist_frame(piece)) )
+        return newnodelist
+
+
+class SegmentFixTraversal(SegmentTrackingMixin, FixTraversal):
+    r"""
+    A :py:class:`FixTraversal` that reports segment markers to `segments` (see
+    :py:class:`SegmentTrackingMixin`).
+    """
+    def __init__(self, fix, segments):
+        super().__init__(fix)
+        self.segments = segments
+
+
+class ObservedSegmentFixTraversal(SegmentTrackingMixin, ObservedFixTraversal):
+    r"""
+    An :py:class:`ObservedFixTraversal` that reports segment markers to
+    `segments` (see :py:class:`SegmentTrackingMixin`).
+    """
+    def __init__(self, fix, events, segments):
+        super().__init__(fix, events)
+        self.segments = segments
+
+
+def _has_children(n):
+    # whether _child_nodes_frame() has anything to do for n, besides updating
+    # its state
+    return getattr(n, 'nodelist', None) is not None \
+        or getattr(n, 'nodeargd', None) is not None
+
+def _log_parse_error_context(nodelist):
+    if hasattr(nodelist, 'latex_walker') and hasattr(nodelist, 'pos'):
+        latex_walker = nodelist.latex_walker
+        pos = nodelist.pos
+        logger.error(
+            "Error {}, near ‘{}’ ".format(
+                latex_walker.format_pos(pos),
+                nodelist.to_latex()
+            )
+        )
@@ -0,0 +1,21 @@
+r"""
+Package with performance benchmarks for `latexpp`.
+
+- :py:mod:`latexpp.bench.corpus` generates synthetic LaTeX projects of any
+  size;
+
+- :py:mod:`latexpp.bench.workloads` defines the benchmarks (parsing,
+  serialization, each built-in fix, full command-line runs) and runs them on a
+  generated project;
+
+- :py:mod:`latexpp.bench.scaling` runs the benchmarks on projects of
+  increasing size to find out how their cost grows with the size of the
+  document.
+
+- :py:mod:`latexpp.bench.memory` measures the memory used by the nodes of a
+  parsed document;
+
+- :py:mod:`latexpp.bench.baseline` saves the results of the benchmarks as a
+  baseline and compares later results against it; the ``latexpp-bench``
+  command (:py:mod:`latexpp.bench.__main__`) does this from the command line.
+"""
@@ -0,0 +1,150 @@
+r"""
+The ``latexpp-bench`` command: run the benchmarks, save the results as a
+baseline, and compare new results against a saved baseline.
+
+Typical use::
+
+  # before upgrading a dependency, record a baseline
+  latexpp-bench -o baseline.json
+
+  # afterwards, check for regressions of more than 10% (exits with status 1)
+  latexpp-bench --compare baseline.json --threshold 10
+
+See :py:mod:`latexpp.bench.baseline`.
+"""
+
+import sys
+import argparse
+import logging
+
+logger = logging.getLogger('latexpp.bench.__main__')
+
+from .workloads import get_benchmarks
+from .baseline import (
+    Baseline, DEFAULT_SETTINGS, DEFAULT_NOISE_FACTOR, run_baseline,
+    compare_results, format_comparisons, format_environment_changes,
+)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='latexpp-bench',
+        description="Run latexpp's benchmarks on a generated LaTeX project, save "
+        "the results as a baseline, or compare them against a saved baseline."
+    )
+
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help="Save the results of this run to this JSON file")
+
+    parser.add_argument('--compare', dest='compare', default=None, metavar='BASELINE',
+                        help="Compare the results against this baseline file, and "
+                        "exit with status 1 if any benchmark regressed.  Unless "
+                        "given explicitly, the settings of the baseline's run "
+                        "(--lines, --seed, --repeat, --warmup, --benchmarks) are "
+                        "reused.")
+
+    parser.add_argument('--current', dest='current', default=None, metavar='RESULTS',
+                        help="With --compare, compare the results saved in this "
+                        "file instead of running the benchmarks")
+
+    parser.add_argument('--threshold', dest='threshold', type=float, default=10.0,
+                        help="Regression threshold, in percent of the baseline's "
+                        "median time (default: %(default)s)")
+
+    parser.add_argument('--noise-factor', dest='noise_factor', type=float,
+                        default=DEFAULT_NOISE_FACTOR,
+                        help="Ignore changes smaller than this many times the "
+                        "combined spread of the timings (default: %(default)s)")
+
+    parser.add_argument('--lines', dest='num_lines', type=int, default=None,
+                        help="Size of the generated project, in lines (default: {})"
+                        .format(DEFAULT_SETTINGS['num_lines']))
+
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help="Seed of the project generator (default: {})"
+                        .format(DEFAULT_SETTINGS['seed']))
+
+    parser.add_argument('--repeat', dest='repeat', type=int, default=None,
+                        help="Number of timed runs of each benchmark (default: {})"
+                        .format(DEFAULT_SETTINGS['repeat']))
+
+    parser.add_argument('--warmup', dest='warmup', type=int, default=None,
+                        help="Number of untimed runs of each benchmark before the "
+                        "timed ones (default: {})".format(DEFAULT_SETTINGS['warmup']))
+
+    parser.add_argument('--benchmarks', dest='benchmarks', default=None,
+                        help="Comma-separated names of the benchmarks to run; a "
+                        "name ending with '*' selects all benchmarks with that "
+                        "prefix (default: all benchmarks)")
+
+    parser.add_argument('--list', dest='list_benchmarks', action='store_true',
+                        help="List the available benchmarks and exit")
+
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help="Report each benchmark as it completes")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(message)s')
+
+    if args.list_benchmarks:
+        for b in get_benchmarks():
+            print(b.name)
+        return 0
+
+    if args.current and not args.compare:
+        parser.error("--current requires --compare")
+
+    baseline = None
+    if args.compare:
+        baseline = Baseline.load(args.compare)
+
+    if args.current:
+        current = Baseline.load(args.current)
+    else:
+        settings = dict(baseline.settings) if baseline is not None else {}
+        if args.num_lines is not None:
+            settings['num_lines'] = args.num_lines
+        if args.seed is not None:
+            settings['seed'] = args.seed
+        if args.repeat is not None:
+            settings['repeat'] = args.repeat
+        if args.warmup is not None:
+            settings['warmup'] = args.warmup
+        if args.benchmarks is not None:
+            settings['benchmarks'] = [ x.strip() for x in args.benchmarks.split(',')
+                                       if x.strip() ]
+        try:
+            current = run_baseline(settings)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.output:
+        current.save(args.output)
+        logger.info("Saved results to %s", args.output)
+
+    if baseline is None:
+        for r in current.results:
+            print("{:<40} median {:.4f}s  best {:.4f}s".format(r.name, r.median, r.best))
+        return 0
+
+    for change in format_environment_changes(baseline, current):
+        print("Note: " + change)
+
+    comparisons = compare_results(baseline, current, threshold=args.threshold,
+                                  noise_factor=args.noise_factor)
+    print(format_comparisons(comparisons))
+
+    regressions = [ c for c in comparisons if c.status == 'regression' ]
+    if regressions:
+        print("\n{} benchmark(s) regressed by more than {}%: {}".format(
+            len(regressions), args.threshold, ", ".join(c.name for c in regressions)
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
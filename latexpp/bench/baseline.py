@@ -0,0 +1,341 @@
+r"""
+Save benchmark results as a JSON baseline and compare new results against it,
+to catch performance regressions (e.g., after upgrading `pylatexenc`).
+
+A baseline records the :py:class:`latexpp.bench.workloads.BenchmarkResult`\ s
+of a run along with the settings of the run (document size, seed, number of
+repetitions) and the versions of Python, `latexpp` and `pylatexenc` it was
+measured with.
+
+Timings are noisy.  :py:func:`compare_results()` compares the median times
+of each benchmark and only reports a change as a regression (or an
+improvement) if it is larger than the given threshold, if the best times
+changed by more than the threshold in the same direction, *and* if the change
+is larger than the spread of the individual timings of both runs, as measured
+by their median absolute deviation.
+"""
+
+import time
+import json
+import platform
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .. import __version__ as latexpp_version_str
+from .corpus import generate_corpus
+from .workloads import BenchProject, BenchmarkResult, get_benchmarks, run_benchmarks
+
+
+BASELINE_FORMAT = 1
+
+# the default settings of a benchmark run
+DEFAULT_SETTINGS = {
+    'num_lines': 1000,
+    'seed': 0,
+    'repeat': 7,
+    'warmup': 1,
+    'benchmarks': None, # all benchmarks
+}
+
+# a change is significant if it exceeds this many times the combined median
+# absolute deviations of the timings (scaled to estimate standard deviations)
+DEFAULT_NOISE_FACTOR = 3.0
+
+# the constant to scale the median absolute deviation with, to estimate the
+# standard deviation of normally distributed values
+_MAD_SCALE = 1.4826
+
+
+def get_environment():
+    r"""
+    Return a dictionary describing the environment the benchmarks run in (the
+    versions of Python, `latexpp` and `pylatexenc`, and the platform).
+    """
+    try:
+        from pylatexenc.version import version_str as pylatexenc_version_str
+    except ImportError:
+        pylatexenc_version_str = None
+    return {
+        'latexpp': latexpp_version_str,
+        'pylatexenc': pylatexenc_version_str,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
+
+
+class Baseline:
+    r"""
+    A set of benchmark results, with the settings and the environment they
+    were measured with.
+
+    .. py:attribute:: results
+
+       A list of :py:class:`latexpp.bench.workloads.BenchmarkResult`\ s.
+
+    .. py:attribute:: settings
+
+       A dictionary of the settings of the run (see
+       :py:func:`run_baseline()`), with the keys ``num_lines``, ``seed``,
+       ``repeat``, ``warmup`` and ``benchmarks``.
+
+    .. py:attribute:: environment
+
+       A dictionary as returned by :py:func:`get_environment()`.
+
+    .. py:attribute:: created
+
+       The time at which the results were measured, as an ISO 8601 string.
+    """
+    def __init__(self, results, settings, environment=None, created=None):
+        super().__init__()
+        self.results = list(results)
+        self.settings = dict(settings)
+        self.environment = environment if environment is not None else get_environment()
+        self.created = created if created is not None \
+            else time.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    def get_result(self, name):
+        r"""
+        Return the result of the benchmark `name`, or `None`.
+        """
+        for r in self.results:
+            if r.name == name:
+                return r
+        return None
+
+    def to_json(self):
+        r"""
+        Return a JSON-serializable dictionary of the baseline.
+        """
+        return {
+            'format': BASELINE_FORMAT,
+            'created': self.created,
+            'environment': self.environment,
+            'settings': self.settings,
+            'results': [ r.to_json() for r in self.results ],
+        }
+
+    @classmethod
+    def from_json(cls, d):
+        r"""
+        Create a :py:class:`Baseline` from a dictionary as returned by
+        :py:meth:`to_json()`.
+        """
+        if d.get('format', None) != BASELINE_FORMAT:
+            raise ValueError("Unsupported benchmark baseline format: {!r}"
+                             .format(d.get('format', None)))
+        return cls(
+            results=[ BenchmarkResult.from_json(r) for r in d['results'] ],
+            settings=d['settings'],
+            environment=d['environment'],
+            created=d['created'],
+        )
+
+    def save(self, fname):
+        r"""
+        Save the baseline to the JSON file `fname`.
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+            f.write('\n')
+
+    @classmethod
+    def load(cls, fname):
+        r"""
+        Load a baseline saved with :py:meth:`save()`.
+        """
+        with open(fname) as f:
+            return cls.from_json(json.load(f))
+
+
+def run_baseline(settings=None):
+    r"""
+    Run the benchmarks and return the results as a :py:class:`Baseline`.
+
+    The `settings` dictionary may override any of the :py:data:`DEFAULT_SETTINGS`:
+    the size of the generated project in lines (``num_lines``), the seed of
+    the generator (``seed``), the number of times each benchmark is timed
+    (``repeat``) after a number of untimed runs (``warmup``) and the list of benchmark names to run (``benchmarks``, see
+    :py:func:`latexpp.bench.workloads.get_benchmarks()`; `None` runs all of
+    them).
+    """
+    s = dict(DEFAULT_SETTINGS)
+    if settings:
+        s.update(settings)
+    benchmarks = get_benchmarks(s['benchmarks'])
+    with BenchProject(generate_corpus(s['num_lines'], seed=s['seed'])) as project:
+        results = []
+        for result in run_benchmarks(project, benchmarks, repeat=s['repeat'],
+                                     warmup=s['warmup']):
+            logger.info("%s: median %.4fs", result.name, result.median)
+            results.append(result)
+    return Baseline(results, s)
+
+
+class Comparison:
+    r"""
+    The comparison of the timings of one benchmark between a baseline and a new
+    run.
+
+    .. py:attribute:: name
+
+       The benchmark name.
+
+    .. py:attribute:: baseline
+
+       The baseline :py:class:`~latexpp.bench.workloads.BenchmarkResult`, or
+       `None` if the benchmark is new.
+
+    .. py:attribute:: current
+
+       The new :py:class:`~latexpp.bench.workloads.BenchmarkResult`, or `None`
+       if the benchmark didn't run.
+
+    .. py:attribute:: percent_change
+
+       The change of the median time, in percent of the baseline's median time
+       (positive if the new run is slower), or `None`.
+
+    .. py:attribute:: significant
+
+       Whether the change is larger than the noise of the timings.
+
+    .. py:attribute:: status
+
+       One of ``'regression'``, ``'improvement'``, ``'unchanged'`` (the change
+       is within the threshold or within the noise), ``'new'`` or
+       ``'missing'``.
+    """
+    def __init__(self, name, baseline, current, percent_change, significant, status):
+        super().__init__()
+        self.name = name
+        self.baseline = baseline
+        self.current = current
+        self.percent_change = percent_change
+        self.significant = significant
+        self.status = status
+
+    def to_json(self):
+        r"""
+        Return a JSON-serializable dictionary of the comparison.
+        """
+        return {
+            'name': self.name,
+            'baseline_median': self.baseline.median if self.baseline else None,
+            'current_median': self.current.median if self.current else None,
+            'percent_change': self.percent_change,
+            'significant': self.significant,
+            'status': self.status,
+        }
+
+    def __repr__(self):
+        return "{}({!r}, status={!r}, percent_change={!r})".format(
+            self.__class__.__name__, self.name, self.status, self.percent_change
+        )
+
+
+def median_abs_deviation(times):
+    r"""
+    Return the median absolute deviation of the list of `times`, scaled to
+    estimate the standard deviation of normally distributed values.
+    """
+    if len(times) < 2:
+        return 0.0
+    med = _median(times)
+    return _MAD_SCALE * _median([ abs(t - med) for t in times ])
+
+
+def compare_results(baseline, current, *, threshold=10.0,
+                    noise_factor=DEFAULT_NOISE_FACTOR):
+    r"""
+    Compare the results of the :py:class:`Baseline` `current` against those of
+    `baseline`, and return a list of :py:class:`Comparison`\ s, one per
+    benchmark in either of them.
+
+    A benchmark whose median time and best time both changed by more than
+    `threshold` percent is a regression (if it got slower) or an improvement
+    (if it got faster), unless the change of the median is smaller than
+    `noise_factor` times the combined spread (:py:func:`median_abs_deviation()`)
+    of the timings of both runs.
+    """
+    comparisons = []
+    for base in baseline.results:
+        cur = current.get_result(base.name)
+        if cur is None:
+            comparisons.append(Comparison(base.name, base, None, None, False, 'missing'))
+            continue
+        comparisons.append(_compare(base, cur, threshold, noise_factor))
+    for cur in current.results:
+        if baseline.get_result(cur.name) is None:
+            comparisons.append(Comparison(cur.name, None, cur, None, False, 'new'))
+    return comparisons
+
+
+def _compare(base, cur, threshold, noise_factor):
+    base_median = base.median
+    cur_median = cur.median
+    if base_median <= 0:
+        return Comparison(base.name, base, cur, None, False, 'unchanged')
+    diff = cur_median - base_median
+    percent_change = 100.0 * diff / base_median
+    noise = noise_factor * (median_abs_deviation(base.times)
+                            + median_abs_deviation(cur.times))
+    significant = abs(diff) > noise
+    best_change = 100.0 * (cur.best - base.best) / base.best if base.best > 0 else 0.0
+    status = 'unchanged'
+    if significant and percent_change > threshold and best_change > threshold:
+        status = 'regression'
+    elif significant and percent_change < -threshold and best_change < -threshold:
+        status = 'improvement'
+    return Comparison(base.name, base, cur, percent_change, significant, status)
+
+
+def format_comparisons(comparisons):
+    r"""
+    Return a table of the `comparisons` as a string.
+    """
+    header = ('benchmark', 'baseline', 'current', 'change', 'status')
+    rows = []
+    for c in comparisons:
+        rows.append((
+            c.name,
+            '{:.4f}s'.format(c.baseline.median) if c.baseline else '-',
+            '{:.4f}s'.format(c.current.median) if c.current else '-',
+            '{:+.1f}%'.format(c.percent_change) if c.percent_change is not None else '-',
+            c.status + ('' if c.significant or c.status != 'unchanged'
+                        or c.percent_change is None else ' (noise)'),
+        ))
+    widths = [ max(len(r[k]) for r in [header] + rows) for k in range(len(header)) ]
+    lines = []
+    for r in [header] + rows:
+        lines.append('  '.join(r[k].ljust(widths[k]) if k in (0, 4) else r[k].rjust(widths[k])
+                               for k in range(len(r))).rstrip())
+    lines.insert(1, '-' * len(lines[0]))
+    return '\n'.join(lines)
+
+
+def format_environment_changes(baseline, current):
+    r"""
+    Return a list of strings describing the differences between the
+    environments and settings of `baseline` and `current`, which may explain
+    (or invalidate) changes in the timings.
+    """
+    changes = []
+    for what, a, b in (('environment', baseline.environment, current.environment),
+                       ('settings', baseline.settings, current.settings)):
+        for key in sorted(set(a) | set(b)):
+            if a.get(key, None) != b.get(key, None):
+                changes.append("{} {}: {} -> {}".format(what, key, a.get(key, None),
+                                                        b.get(key, None)))
+    return changes
+
+
+def _median(values):
+    t = sorted(values)
+    k = len(t) // 2
+    if len(t) % 2:
+        return t[k]
+    return (t[k-1] + t[k]) / 2
@@ -0,0 +1,362 @@
+r"""
+Generate synthetic LaTeX projects for benchmarks.
+
+The generated projects look like a typical paper or thesis: a main document
+whose preamble loads packages, a library of ``\newcommand`` definitions, a
+``\newif`` switch and ``\bibalias`` declarations, and whose body is an
+``\input`` tree of chapters and sections.  The sections contain text
+paragraphs with citations and references to earlier labels (``\ref``,
+``\eqref``, ``\cref``), equations using the custom macros, figures (whose
+graphics files are generated too), ``\ifdraft ... \else ... \fi`` blocks,
+comments, and ``%%!lpp`` pragmas.
+
+The output is fully determined by the requested number of lines and the
+random `seed`::
+
+  corpus = generate_corpus(10000, seed=1)
+  corpus.write('/tmp/bench-project')
+"""
+
+import os
+import os.path
+import re
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_WORDS = (
+    "the of a state channel quantum system we show that and is for which "
+    "this in operator bound entropy measure theorem proof given any such "
+    "let be then it follows there exists an optimal protocol error rate "
+    "converges limit asymptotic regime finite dimension Hilbert space map "
+    "trace norm fidelity distance lemma property holds whenever consider "
+    "function value estimate lower upper tight analysis result"
+).split()
+
+# lines per section file and section files per chapter
+_SECTION_LINES = 200
+_SECTIONS_PER_CHAPTER = 10
+
+_PLACEHOLDER_PDF = b"%PDF-1.4\n% latexpp benchmark placeholder figure\n%%EOF\n"
+
+
+class Corpus:
+    r"""
+    A generated LaTeX project.
+
+    .. py:attribute:: main_fname
+
+       The name of the main document, ``'main.tex'``.
+
+    .. py:attribute:: files
+
+       A dictionary ``{relative file name: contents}`` of all the LaTeX files
+       of the project.
+
+    .. py:attribute:: binary_files
+
+       A dictionary ``{relative file name: bytes}`` of the other files (the
+       graphics files).
+
+    .. py:attribute:: regions
+
+       The names of the regions delimited by ``%%!lpp regional-fix`` pragmas
+       in the document.
+    """
+    def __init__(self, main_fname='main.tex'):
+        super().__init__()
+        self.main_fname = main_fname
+        self.files = {}
+        self.binary_files = {}
+        self.regions = []
+
+    @property
+    def num_lines(self):
+        r"""
+        The total number of lines of all LaTeX files.
+        """
+        return sum(s.count('\n') for s in self.files.values())
+
+    def write(self, directory):
+        r"""
+        Write all files of the project in `directory` (created if necessary).
+        """
+        for fname, contents in self.files.items():
+            path = os.path.join(directory, fname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(contents)
+        for fname, contents in self.binary_files.items():
+            path = os.path.join(directory, fname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(contents)
+
+    def flatten(self):
+        r"""
+        Return the main document with all ``\input`` directives replaced by the
+        contents of the corresponding files, as a single string.
+        """
+        rx_input = re.compile(r'\\input\{([^}]+)\}')
+
+        def expand(fname):
+            s = self.files[fname]
+            return rx_input.sub(lambda m: expand(_tex_fname(m.group(1))).rstrip('\n'), s)
+
+        return expand(self.main_fname)
+
+
+def generate_corpus(num_lines, *, seed=0):
+    r"""
+    Generate a :py:class:`Corpus` with approximately `num_lines` lines of LaTeX
+    code in total.  The same arguments always produce the same project.
+    """
+    return _CorpusGenerator(num_lines, seed).generate()
+
+
+def _tex_fname(name):
+    if name.endswith('.tex'):
+        return name
+    return name + '.tex'
+
+
+def _alpha(k):
+    # 0 -> 'a', 25 -> 'z', 26 -> 'ba', ... (macro names can't have digits)
+    s = ''
+    while True:
+        s = chr(ord('a') + k % 26) + s
+        k //= 26
+        if k == 0:
+            return s
+
+
+class _CorpusGenerator:
+    def __init__(self, num_lines, seed):
+        super().__init__()
+        self.num_lines = max(int(num_lines), 50)
+        self.rng = random.Random(seed)
+
+        self.corpus = Corpus()
+
+        self.num_macros = min(400, max(10, self.num_lines // 100))
+        self.num_bibkeys = min(2000, max(10, self.num_lines // 50))
+        self.num_aliases = max(2, self.num_bibkeys // 10)
+
+        self.labels = []
+        self.eq_counter = 0
+        self.fig_counter = 0
+        self.sec_counter = 0
+        self.region_counter = 0
+
+    def generate(self):
+        self.corpus.files['macros.tex'] = self._macros_file()
+
+        preamble = self._preamble()
+        # lines left for the chapters & sections
+        body_lines = self.num_lines - preamble.count('\n') - 4 \
+            - self.corpus.files['macros.tex'].count('\n')
+        num_sections = max(1, -(-body_lines // _SECTION_LINES))
+
+        chapter_inputs = []
+        for ch in range(-(-num_sections // _SECTIONS_PER_CHAPTER)):
+            chname = 'chapters/chap{:03}'.format(ch+1)
+            nsec = min(_SECTIONS_PER_CHAPTER, num_sections - ch * _SECTIONS_PER_CHAPTER)
+            section_inputs = []
+            for sec in range(nsec):
+                secname = 'sections/chap{:03}/sec{:02}'.format(ch+1, sec+1)
+                lines_left = body_lines - (ch * _SECTIONS_PER_CHAPTER + sec) * _SECTION_LINES
+                self.corpus.files[secname + '.tex'] = \
+                    self._section_file(min(_SECTION_LINES, max(lines_left, 10)) - 1)
+                section_inputs.append(r'\input{' + secname + '}')
+            self.corpus.files[chname + '.tex'] = (
+                r'\chapter{' + self._words(3).title() + '}' + '\n'
+                + r'\label{chap:' + str(ch+1) + '}' + '\n'
+                + '\n'.join(section_inputs) + '\n'
+            )
+            self.labels.append('chap:' + str(ch+1))
+            chapter_inputs.append(r'\input{' + chname + '}')
+
+        self.corpus.files[self.corpus.main_fname] = (
+            preamble
+            + r'\begin{document}' + '\n'
+            + '\n'.join(chapter_inputs) + '\n'
+            + r'\bibliography{refs}' + '\n'
+            + r'\end{document}' + '\n'
+        )
+        return self.corpus
+
+    def _words(self, n):
+        return ' '.join(self.rng.choice(_WORDS) for _ in range(n))
+
+    def _macros_file(self):
+        lines = [ '% custom macros' ]
+        for k in range(self.num_macros):
+            name = _alpha(k)
+            kind = k % 3
+            if kind == 0:
+                lines.append(r'\newcommand{\sym%s}{\alpha_{%d}}' % (name, k))
+            elif kind == 1:
+                lines.append(r'\newcommand{\vec%s}[1]{\mathbf{#1}_{%d}}' % (name, k))
+            else:
+                lines.append(r'\newcommand{\ip%s}[2]{\langle #1 \vert #2 \rangle_{%d}}'
+                             % (name, k))
+        return '\n'.join(lines) + '\n'
+
+    def _preamble(self):
+        lines = [
+            r'\documentclass[11pt]{book}',
+            r'\usepackage{amsmath}',
+            r'\usepackage{amssymb}',
+            r'\usepackage{graphicx}',
+            r'\usepackage[capitalize]{cleveref}',
+            r'\input{macros}',
+            r'\newif\ifdraft',
+            r'\draftfalse',
+        ]
+        for k in range(self.num_aliases):
+            lines.append(r'\bibalias{alias%d}{key%d}' % (k, self.rng.randrange(self.num_bibkeys)))
+        return '\n'.join(lines) + '\n'
+
+    def _macro_use(self):
+        k = self.rng.randrange(self.num_macros)
+        name = _alpha(k)
+        kind = k % 3
+        if kind == 0:
+            return r'\sym' + name + ' '
+        if kind == 1:
+            return r'\vec%s{x}' % (name,)
+        return r'\ip%s{\psi}{\phi}' % (name,)
+
+    def _ref(self):
+        if not self.labels:
+            return r'\ref{chap:1}'
+        lbl = self.rng.choice(self.labels)
+        cmd = self.rng.choice(['ref', 'cref', 'Cref', 'eqref' if lbl.startswith('eq:') else 'ref'])
+        return '\\' + cmd + '{' + lbl + '}'
+
+    def _cite(self):
+        keys = []
+        for _ in range(self.rng.randint(1, 3)):
+            if self.rng.random() < 0.3:
+                keys.append('alias{}'.format(self.rng.randrange(self.num_aliases)))
+            else:
+                keys.append('key{}'.format(self.rng.randrange(self.num_bibkeys)))
+        return r'\cite{' + ','.join(keys) + '}'
+
+    def _section_file(self, num_lines):
+        self.sec_counter += 1
+        lbl = 'sec:{}'.format(self.sec_counter)
+        lines = [
+            r'\section{' + self._words(4).title() + '}' + r'\label{' + lbl + '}',
+        ]
+        self.labels.append(lbl)
+        while len(lines) < num_lines:
+            lines += self._block()
+        return '\n'.join(lines) + '\n'
+
+    def _block(self):
+        r = self.rng.random()
+        if r < 0.45:
+            return self._text_paragraph()
+        if r < 0.75:
+            return self._equation()
+        if r < 0.83:
+            return self._figure()
+        if r < 0.92:
+            return self._if_block()
+        if r < 0.96:
+            return self._regional_block()
+        return self._skip_block()
+
+    def _text_paragraph(self):
+        lines = []
+        for _ in range(self.rng.randint(3, 6)):
+            parts = [ self._words(self.rng.randint(4, 10)) ]
+            r = self.rng.random()
+            if r < 0.3:
+                parts.append(self._ref())
+            elif r < 0.5:
+                parts.append(self._cite())
+            elif r < 0.7:
+                parts.append(r'\emph{' + self._words(2) + '}')
+            elif r < 0.85:
+                parts.append('$' + self._macro_use() + ' + ' + self._macro_use() + '$')
+            parts.append(self._words(self.rng.randint(2, 6)) + '.')
+            if self.rng.random() < 0.15:
+                parts.append('% ' + self._words(3))
+            lines.append(' '.join(parts))
+        lines.append('')
+        return lines
+
+    def _equation(self):
+        self.eq_counter += 1
+        lbl = 'eq:{}'.format(self.eq_counter)
+        if self.rng.random() < 0.6:
+            lines = [
+                r'\begin{equation}',
+                r'  \label{' + lbl + '}',
+                '  ' + self._macro_use() + r' = \frac{' + self._macro_use() + '}{'
+                + self._macro_use() + r'} + \sum_{k=1}^{n} x_k^{2}',
+                r'\end{equation}',
+            ]
+        else:
+            lines = [ r'\begin{align}' ]
+            for j in range(self.rng.randint(2, 4)):
+                lines.append('  ' + self._macro_use() + ' &= ' + self._macro_use()
+                             + r' + \int_0^1 f(t)\,dt \nonumber\\')
+            lines += [
+                '  ' + self._macro_use() + r' &\leq ' + self._macro_use()
+                + r'\label{' + lbl + '}',
+                r'\end{align}',
+            ]
+        self.labels.append(lbl)
+        return lines + [ '' ]
+
+    def _figure(self):
+        self.fig_counter += 1
+        fname = 'figures/fig{:04}.pdf'.format(self.fig_counter)
+        self.corpus.binary_files[fname] = _PLACEHOLDER_PDF
+        lbl = 'fig:{}'.format(self.fig_counter)
+        self.labels.append(lbl)
+        return [
+            r'\begin{figure}',
+            r'  \centering',
+            r'  \includegraphics[width=0.6\textwidth]{' + fname[:-len('.pdf')] + '}',
+            r'  \caption{' + self._words(6) + ' ' + self._ref() + '.}',
+            r'  \label{' + lbl + '}',
+            r'\end{figure}',
+            '',
+        ]
+
+    def _if_block(self):
+        return [
+            r'\ifdraft',
+            '  ' + self._words(8) + ' ' + self._ref() + '.',
+            r'\else',
+            '  ' + self._words(8) + ' ' + self._cite() + '.',
+            r'\fi',
+            '',
+        ]
+
+    def _regional_block(self):
+        self.region_counter += 1
+        region = 'Notation'
+        if region not in self.corpus.regions:
+            self.corpus.regions.append(region)
+        return [
+            '%%!lpp regional-fix ' + region + ' {',
+            r'Here we write \notation{' + self._words(2) + '} for '
+            + '$' + self._macro_use() + '$.',
+            '%%!lpp }',
+            '',
+        ]
+
+    def _skip_block(self):
+        return [
+            '%%!lpp skip {',
+            r'\typeout{' + self._words(3) + '}',
+            '%%!lpp }',
+            '',
+        ]
@@ -0,0 +1,148 @@
+r"""
+Measure the memory used by the node structure of a parsed LaTeX document, in
+bytes per node.
+
+The document is a generated project (see :py:mod:`latexpp.bench.corpus`) with
+all its ``\input`` files pasted in, or a given LaTeX file.  Run this module as
+a script to print the measurement::
+
+  python -m latexpp.bench.memory --lines 10000
+  python -m latexpp.bench.memory --file thesis.tex
+"""
+
+import sys
+import gc
+import tempfile
+import tracemalloc
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+from ..preprocessor import LatexPreprocessor
+from .corpus import generate_corpus
+from .workloads import BenchProject
+
+
+DEFAULT_NUM_LINES = 10000
+
+
+class NodeMemory:
+    r"""
+    The memory retained by the node tree of a parsed document: `num_nodes`
+    nodes using `size` bytes in total.
+    """
+    def __init__(self, size, num_nodes):
+        super().__init__()
+        self.size = size
+        self.num_nodes = num_nodes
+
+    @property
+    def bytes_per_node(self):
+        return self.size / self.num_nodes if self.num_nodes else 0.0
+
+    def to_json(self):
+        return {'size': self.size, 'num_nodes': self.num_nodes,
+                'bytes_per_node': self.bytes_per_node}
+
+
+def count_nodes(nodelist):
+    r"""
+    Return the number of nodes in the tree `nodelist`, including nodes in
+    macro arguments.
+    """
+    count = 0
+    stack = list(nodelist)
+    while stack:
+        n = stack.pop()
+        if n is None:
+            continue
+        count += 1
+        nodeargd = getattr(n, 'nodeargd', None)
+        if nodeargd is not None and getattr(nodeargd, 'argnlist', None):
+            stack.extend(nodeargd.argnlist)
+        nodelist = getattr(n, 'nodelist', None)
+        if nodelist:
+            stack.extend(nodelist)
+    return count
+
+
+def measure_node_memory(lpp, s):
+    r"""
+    Parse the LaTeX code `s` with the initialized preprocessor `lpp` and return
+    a :py:class:`NodeMemory` with the memory that the resulting node tree
+    retains, as seen by :py:mod:`tracemalloc`.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        snapshot_start = tracemalloc.take_snapshot()
+
+        lw = lpp.make_latex_walker(s)
+        nodelist, _, _ = lw.get_latex_nodes()
+
+        gc.collect()
+        snapshot_end = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    size = sum(stat.size_diff
+               for stat in snapshot_end.compare_to(snapshot_start, 'filename'))
+    return NodeMemory(size, count_nodes(nodelist))
+
+
+def measure_corpus_node_memory(num_lines=DEFAULT_NUM_LINES, *, seed=0):
+    r"""
+    Return the :py:class:`NodeMemory` of a generated document of about
+    `num_lines` lines (see :py:func:`latexpp.bench.corpus.generate_corpus()`).
+    """
+    with BenchProject(generate_corpus(num_lines, seed=seed)) as project:
+        lpp = project.make_preprocessor([])
+        return measure_node_memory(lpp, project.flat_source())
+
+
+def measure_file_node_memory(fname):
+    r"""
+    Return the :py:class:`NodeMemory` of the LaTeX file `fname`.
+    """
+    with open(fname) as f:
+        s = f.read()
+    with tempfile.TemporaryDirectory(prefix='latexpp-bench-') as output_dir:
+        lpp = LatexPreprocessor(output_dir=output_dir)
+        lpp.initialize()
+        return measure_node_memory(lpp, s)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m latexpp.bench.memory',
+        description="Measure the memory used by the nodes of a parsed "
+        "LaTeX document."
+    )
+    parser.add_argument('--lines', type=int, default=DEFAULT_NUM_LINES,
+                        help="Size of the generated document, in lines "
+                        "(default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the document generator")
+    parser.add_argument('--file', dest='fname', default=None,
+                        help="Measure this LaTeX file instead of a generated "
+                        "document")
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.fname:
+        m = measure_file_node_memory(args.fname)
+    else:
+        m = measure_corpus_node_memory(args.lines, seed=args.seed)
+
+    print("{} nodes, {} bytes total, {:.1f} bytes per node".format(
+        m.num_nodes, m.size, m.bytes_per_node
+    ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
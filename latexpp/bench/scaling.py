@@ -0,0 +1,205 @@
+r"""
+Measure how the benchmarks of :py:mod:`latexpp.bench.workloads` scale with
+the size of the document, to detect code paths whose cost grows faster than
+linearly.
+
+Each benchmark is run on generated projects of increasing sizes.  Between two
+successive sizes, the growth exponent is the slope of the timings on a
+log-log scale: a linear cost has an exponent close to 1, a quadratic one an
+exponent close to 2.  Benchmarks whose exponent between the smallest and the
+largest size exceeds a threshold are reported as super-linear.
+
+Run this module as a script to print the scaling curves::
+
+  python -m latexpp.bench.scaling --sizes 1000,10000,100000,1000000 \
+      --benchmarks 'parse,fix:*' --json scaling.json
+"""
+
+import sys
+import math
+import json
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .corpus import generate_corpus
+from .workloads import BenchProject, get_benchmarks, run_benchmark
+
+
+# the largest size takes minutes per benchmark; ask for 1000000 explicitly
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# growth exponents above this value are reported as super-linear (timings
+# are noisy, and some costs are genuinely n*log(n))
+DEFAULT_MAX_EXPONENT = 1.2
+
+
+class ScalingCurve:
+    r"""
+    The timings of one benchmark for several document sizes.
+
+    .. py:attribute:: name
+
+       The benchmark name.
+
+    .. py:attribute:: points
+
+       A list of ``(num_lines, best_time)`` tuples, by increasing
+       `num_lines`.
+    """
+    def __init__(self, name, points=None):
+        super().__init__()
+        self.name = name
+        self.points = list(points) if points else []
+
+    def exponents(self):
+        r"""
+        Return the list of growth exponents between successive points (one
+        fewer than there are points).  An exponent is `None` if one of the
+        timings is zero.
+        """
+        result = []
+        for (n1, t1), (n2, t2) in zip(self.points, self.points[1:]):
+            if t1 <= 0 or t2 <= 0 or n1 == n2:
+                result.append(None)
+                continue
+            result.append(math.log(t2 / t1) / math.log(n2 / n1))
+        return result
+
+    def overall_exponent(self):
+        r"""
+        Return the growth exponent between the smallest and the largest size,
+        which is less sensitive to timing noise than the individual
+        :py:meth:`exponents()`, or `None` if it can't be computed.
+        """
+        if len(self.points) < 2:
+            return None
+        (n1, t1), (n2, t2) = self.points[0], self.points[-1]
+        if t1 <= 0 or t2 <= 0 or n1 == n2:
+            return None
+        return math.log(t2 / t1) / math.log(n2 / n1)
+
+    def is_superlinear(self, max_exponent=DEFAULT_MAX_EXPONENT):
+        r"""
+        Return `True` if the :py:meth:`overall_exponent()` exceeds
+        `max_exponent`.
+        """
+        e = self.overall_exponent()
+        return e is not None and e > max_exponent
+
+    def to_json(self):
+        r"""
+        Return a JSON-serializable dictionary of the curve.
+        """
+        return {
+            'name': self.name,
+            'points': [ {'num_lines': n, 'time': t} for n, t in self.points ],
+            'exponents': self.exponents(),
+            'overall_exponent': self.overall_exponent(),
+        }
+
+
+def measure_scaling(benchmark_names=None, sizes=DEFAULT_SIZES, *, repeat=3, seed=0):
+    r"""
+    Run the benchmarks named in `benchmark_names` (by default, all of them; see
+    :py:func:`latexpp.bench.workloads.get_benchmarks()`) on a generated project
+    of each of the given `sizes` (in lines), and return a list of
+    :py:class:`ScalingCurve`\ s.
+    """
+    benchmarks = get_benchmarks(benchmark_names)
+    curves = { b.name: ScalingCurve(b.name) for b in benchmarks }
+    for size in sorted(sizes):
+        logger.info("Generating a project with %d lines", size)
+        with BenchProject(generate_corpus(size, seed=seed)) as project:
+            for benchmark in benchmarks:
+                result = run_benchmark(benchmark, project, repeat=repeat)
+                logger.info("%s @ %d lines: %.4fs", result.name,
+                            result.num_lines, result.best)
+                curves[benchmark.name].points.append( (result.num_lines, result.best) )
+    return list(curves.values())
+
+
+def format_curves(curves, max_exponent=DEFAULT_MAX_EXPONENT):
+    r"""
+    Return a table of the scaling `curves` as a string, with one row per
+    benchmark and one column per size, and the growth exponents.
+    """
+    sizes = [ n for n, _ in curves[0].points ] if curves else []
+    header = ['benchmark'] + [ '{} lines'.format(n) for n in sizes ] \
+        + ['exponents', 'overall', '']
+    rows = []
+    for c in curves:
+        rows.append(
+            [c.name]
+            + [ '{:.4f}s'.format(t) for _, t in c.points ]
+            + [ ' '.join(_format_exponent(e) for e in c.exponents()),
+                _format_exponent(c.overall_exponent()),
+                'SUPER-LINEAR' if c.is_superlinear(max_exponent) else '' ]
+        )
+    widths = [ max(len(r[k]) for r in [header] + rows) for k in range(len(header)) ]
+    lines = []
+    for r in [header] + rows:
+        lines.append('  '.join(r[k].ljust(widths[k]) if k == 0 else r[k].rjust(widths[k])
+                               for k in range(len(r))).rstrip())
+    lines.insert(1, '-' * len(lines[0]))
+    return '\n'.join(lines)
+
+
+def _format_exponent(e):
+    return '-' if e is None else '{:.2f}'.format(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m latexpp.bench.scaling',
+        description="Measure how latexpp's running time scales with the "
+        "document size, on generated documents."
+    )
+    parser.add_argument('--sizes', default=','.join(str(n) for n in DEFAULT_SIZES),
+                        help="Comma-separated document sizes, in lines "
+                        "(default: %(default)s)")
+    parser.add_argument('--benchmarks', default=None,
+                        help="Comma-separated benchmark names; a name ending "
+                        "with '*' selects all benchmarks with that prefix "
+                        "(default: all benchmarks)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of runs per benchmark and size; the best "
+                        "time is kept (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the document generator")
+    parser.add_argument('--max-exponent', type=float, default=DEFAULT_MAX_EXPONENT,
+                        help="Report benchmarks whose growth exponent exceeds "
+                        "this value (default: %(default)s)")
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="Also save the scaling curves to this JSON file")
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    sizes = [ int(x) for x in args.sizes.split(',') if x.strip() ]
+    names = None
+    if args.benchmarks:
+        names = [ x.strip() for x in args.benchmarks.split(',') if x.strip() ]
+
+    curves = measure_scaling(names, sizes, repeat=args.repeat, seed=args.seed)
+
+    print(format_curves(curves, args.max_exponent))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump({'sizes': sorted(sizes),
+                       'max_exponent': args.max_exponent,
+                       'curves': [ c.to_json() for c in curves ]}, f, indent=2)
+
+    superlinear = [ c.name for c in curves if c.is_superlinear(args.max_exponent) ]
+    if superlinear:
+        print("\nSuper-linear scaling: " + ", ".join(superlinear))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
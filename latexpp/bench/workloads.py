@@ -0,0 +1,368 @@
+r"""
+Benchmark workloads, run on a generated project (see
+:py:mod:`latexpp.bench.corpus`).
+
+Each :py:class:`Benchmark` prepares its input outside of the timed region
+(e.g., a freshly parsed document for the benchmarks of the fixes) and then
+times a single operation:
+
+- ``parse`` --- parse the whole document (with all ``\input`` files pasted
+  in);
+
+- ``serialize`` --- write the parsed document back to LaTeX code;
+
+- ``fix:<name>`` --- run the built-in fix `<name>` (e.g.
+  ``fix:labels.RenameLabels``) on the parsed document;
+
+- ``cli`` --- run the ``latexpp`` command on the project, with a
+  configuration that uses most built-in fixes, in a separate process.
+
+Fixes that need external tools or files that the generated projects don't
+provide (e.g. :py:class:`latexpp.fixes.ref.ExpandRefs`, which runs LaTeX) are
+not benchmarked.
+
+Run the benchmarks with :py:func:`run_benchmarks()`::
+
+  with BenchProject(generate_corpus(10000)) as project:
+    for result in run_benchmarks(project, repeat=5):
+      print(result.name, result.best)
+"""
+
+import os
+import os.path
+import io
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import contextlib
+import gc
+import logging
+
+logger = logging.getLogger(__name__)
+
+import yaml
+
+from ..preprocessor import LatexPreprocessor
+
+
+# fixes applied in the "Notation" regions of the generated documents
+_NOTATION_FIXES = [
+    {'name': 'latexpp.fixes.macro_subst.Subst',
+     'config': {'macros': {'notation': {'argspec': '{', 'repl': r'\textit{%(1)s}'}}}},
+]
+
+# (fix name relative to latexpp.fixes, config, whether it needs the
+# \input files to be kept in the document)
+FIX_WORKLOADS = [
+    ('comments.RemoveComments', {}, False),
+    ('newcommand.Expand', {}, False),
+    ('macro_subst.Subst',
+     {'macros': {'notation': {'argspec': '{', 'repl': r'\textit{%(1)s}'},
+                 'textwidth': r'\linewidth'}},
+     False),
+    ('ifsimple.ApplyIf', {}, False),
+    ('labels.RenameLabels', {}, False),
+    ('bib.ApplyAliases', {}, False),
+    ('figures.CopyAndRenameFigs', {}, False),
+    ('environment_contents.InsertPrePost',
+     {'environmentnames': ['figure'], 'pre_contents': r'\small'}, False),
+    ('usepackage.RemovePkgs', {'pkglist': ['cleveref']}, False),
+    ('preamble.AddPreamble', {'preamble': r'\usepackage{xcolor}'}, False),
+    ('regional_fix.Apply', {'region': 'Notation', 'fixes': _NOTATION_FIXES}, False),
+    ('input.EvalInput', {}, True),
+    ('input.CopyInputDeps', {}, True),
+]
+
+# configuration for the full command-line runs
+CLI_FIXES = [
+    'latexpp.fixes.input.EvalInput',
+    'latexpp.fixes.comments.RemoveComments',
+    'latexpp.fixes.ifsimple.ApplyIf',
+    'latexpp.fixes.newcommand.Expand',
+    {'name': 'latexpp.fixes.regional_fix.Apply',
+     'config': {'region': 'Notation', 'fixes': _NOTATION_FIXES}},
+    'latexpp.fixes.bib.ApplyAliases',
+    'latexpp.fixes.labels.RenameLabels',
+    'latexpp.fixes.figures.CopyAndRenameFigs',
+]
+
+
+class BenchProject:
+    r"""
+    A generated :py:class:`latexpp.bench.corpus.Corpus` written to a
+    temporary directory, to run benchmarks on.  Use it as a context manager
+    to remove the directory afterwards (or call :py:meth:`cleanup()`).
+    """
+    def __init__(self, corpus):
+        super().__init__()
+        self.corpus = corpus
+        self.directory = tempfile.mkdtemp(prefix='latexpp-bench-')
+        corpus.write(self.directory)
+
+        self._flat_source = None
+        self._output_counter = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def cleanup(self):
+        r"""
+        Remove the project's temporary directory.
+        """
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def flat_source(self):
+        r"""
+        Return the whole document as a single string (see
+        :py:meth:`latexpp.bench.corpus.Corpus.flatten()`).
+        """
+        if self._flat_source is None:
+            self._flat_source = self.corpus.flatten()
+        return self._flat_source
+
+    def new_output_dir(self):
+        r"""
+        Return the path of a new, empty output directory within the project
+        directory.
+        """
+        self._output_counter += 1
+        return os.path.join(self.directory, '_out', str(self._output_counter))
+
+    def make_preprocessor(self, fixes):
+        r"""
+        Return an initialized :py:class:`latexpp.preprocessor.LatexPreprocessor`
+        for the project, with the given `fixes` configuration (a list as in
+        the ``fixes:`` section of a `lppconfig.yml` file).
+        """
+        output_dir = self.new_output_dir()
+        os.makedirs(output_dir)
+        lpp = LatexPreprocessor(output_dir=output_dir,
+                                main_doc_fname=self.corpus.main_fname,
+                                main_doc_output_fname='main.tex',
+                                config_dir=self.directory)
+        lpp.install_fixes_from_config(fixes)
+        lpp.initialize()
+        return lpp
+
+
+class Benchmark:
+    r"""
+    A benchmark named `name`.  Calling ``prepare(project)`` must set up
+    everything that is not to be timed and return a function without
+    arguments which performs the timed operation.
+    """
+    def __init__(self, name, prepare):
+        super().__init__()
+        self.name = name
+        self.prepare = prepare
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.name)
+
+
+class BenchmarkResult:
+    r"""
+    The timings of a benchmark.
+
+    .. py:attribute:: name
+
+       The benchmark name.
+
+    .. py:attribute:: times
+
+       The list of measured times, in seconds, one per repetition.
+
+    .. py:attribute:: num_lines
+
+       The number of lines of the project the benchmark ran on.
+    """
+    def __init__(self, name, times, num_lines):
+        super().__init__()
+        self.name = name
+        self.times = list(times)
+        self.num_lines = num_lines
+
+    @property
+    def best(self):
+        r"""
+        The shortest of the measured times.
+        """
+        return min(self.times)
+
+    @property
+    def median(self):
+        r"""
+        The median of the measured times.
+        """
+        t = sorted(self.times)
+        k = len(t) // 2
+        if len(t) % 2:
+            return t[k]
+        return (t[k-1] + t[k]) / 2
+
+    def to_json(self):
+        r"""
+        Return a JSON-serializable dictionary of the results.
+        """
+        return {
+            'name': self.name,
+            'num_lines': self.num_lines,
+            'times': self.times,
+        }
+
+    @classmethod
+    def from_json(cls, d):
+        r"""
+        Create a :py:class:`BenchmarkResult` from a dictionary as returned by
+        :py:meth:`to_json()`.
+        """
+        return cls(d['name'], d['times'], d['num_lines'])
+
+    def __repr__(self):
+        return "{}({!r}, best={:.4f})".format(self.__class__.__name__,
+                                              self.name, self.best)
+
+
+def get_benchmarks(names=None):
+    r"""
+    Return the list of all :py:class:`Benchmark`\ s, or of those whose names
+    are in `names`.  A name ending with ``*`` selects all benchmarks that
+    start with the given prefix (as in ``'fix:*'``).
+    """
+    benchmarks = [
+        Benchmark('parse', _prepare_parse),
+        Benchmark('serialize', _prepare_serialize),
+    ]
+    for fixname, config, keep_inputs in FIX_WORKLOADS:
+        benchmarks.append(Benchmark('fix:' + fixname,
+                                    _fix_preparer(fixname, config, keep_inputs)))
+    benchmarks.append(Benchmark('cli', _prepare_cli))
+
+    if names is None:
+        return benchmarks
+    selected = []
+    for name in names:
+        if name.endswith('*'):
+            matches = [ b for b in benchmarks if b.name.startswith(name[:-1]) ]
+        else:
+            matches = [ b for b in benchmarks if b.name == name ]
+        if not matches:
+            raise ValueError("Unknown benchmark: {}".format(name))
+        selected += [ b for b in matches if b not in selected ]
+    return selected
+
+
+def run_benchmark(benchmark, project, *, repeat=5, warmup=0):
+    r"""
+    Run `benchmark` on `project` (a :py:class:`BenchProject`) `repeat` times,
+    and return a :py:class:`BenchmarkResult`.  The first `warmup` runs are
+    not timed (they fill caches and import modules that are loaded lazily).
+    """
+    times = []
+    with _chdir(project.directory), _quiet_logging():
+        for k in range(warmup + repeat):
+            run = benchmark.prepare(project)
+            gc.collect()
+            t0 = time.perf_counter()
+            run()
+            t = time.perf_counter() - t0
+            if k >= warmup:
+                times.append(t)
+            del run
+    return BenchmarkResult(benchmark.name, times, project.corpus.num_lines)
+
+
+def run_benchmarks(project, benchmarks=None, *, repeat=5, warmup=0):
+    r"""
+    Run the given `benchmarks` (by default, all benchmarks) on `project` and
+    yield a :py:class:`BenchmarkResult` for each one.
+    """
+    if benchmarks is None:
+        benchmarks = get_benchmarks()
+    for benchmark in benchmarks:
+        yield run_benchmark(benchmark, project, repeat=repeat, warmup=warmup)
+
+
+#
+# The benchmarks
+#
+
+def _parse(lpp, s):
+    lw = lpp.make_latex_walker(s)
+    nodelist, _, _ = lw.get_latex_nodes()
+    return lw, nodelist
+
+def _prepare_parse(project):
+    lpp = project.make_preprocessor([])
+    s = project.flat_source()
+    return lambda: _parse(lpp, s)
+
+def _prepare_serialize(project):
+    lpp = project.make_preprocessor([])
+    lw, nodelist = _parse(lpp, project.flat_source())
+    def run():
+        sink = io.StringIO()
+        lw.write_nodes(nodelist, sink.write)
+    return run
+
+def _fix_preparer(fixname, config, keep_inputs):
+    fixes = [ {'name': 'latexpp.fixes.' + fixname, 'config': config} ]
+    def prepare(project):
+        lpp = project.make_preprocessor(fixes)
+        if keep_inputs:
+            with open(project.corpus.main_fname) as f:
+                s = f.read()
+        else:
+            s = project.flat_source()
+        lw, nodelist = _parse(lpp, s)
+        return lambda: lpp.preprocess(nodelist)
+    return prepare
+
+def _prepare_cli(project):
+    output_dir = project.new_output_dir()
+    config_fname = os.path.join(project.directory, 'lppconfig.yml')
+    if not os.path.exists(config_fname):
+        with open(config_fname, 'w') as f:
+            yaml.dump({'fname': project.corpus.main_fname,
+                       'output_dir': '_latexpp_output',
+                       'fixes': CLI_FIXES}, f)
+    cmd = [sys.executable, '-m', 'latexpp', '-c', config_fname,
+           '-o', output_dir]
+    env = dict(os.environ)
+    # make sure the child process runs this copy of latexpp
+    pkgroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join([pkgroot] + [
+        p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p
+    ])
+    def run():
+        subprocess.run(cmd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return run
+
+
+@contextlib.contextmanager
+def _chdir(directory):
+    # fixes look up some files relative to the current directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+@contextlib.contextmanager
+def _quiet_logging():
+    # the fixes' logging would distort the timings
+    previous = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        yield
+    finally:
+        logging.disable(previous)
@@ -0,0 +1,202 @@
+r"""
+Module that tracks the source files a `latexpp` run depends on, so that build
+systems (make, ninja, latexmk, ...) can run `latexpp` only when one of them
+changed.
+
+A :py:class:`DependencyTracker` observes the preprocessor (see
+:py:mod:`latexpp.events`) and records:
+
+- the files that were read or copied, i.e., the main document and the files
+  processed with
+  :py:meth:`~latexpp.preprocessor.LatexPreprocessor.execute_file()`, read
+  with :py:meth:`~latexpp.preprocessor.LatexPreprocessor.open_file()` or
+  copied with :py:meth:`~latexpp.preprocessor.LatexPreprocessor.copy_file()`;
+
+- the files whose existence a fix checked (see
+  :py:meth:`~latexpp.preprocessor.LatexPreprocessor.note_file_probe()`), for
+  instance when trying the possible extensions of an ``\input`` file name or
+  of a figure, looking for a local copy of a package, or checking for an
+  ``.aux`` or ``.bbl`` file.  Files that were not found are listed separately
+  as *missing* files, since creating one of them may change the output.
+
+The dependencies can be written as a make-style ``.d`` file with
+:py:meth:`DependencyTracker.write_makefile()`, which you can ``include`` in a
+Makefile, or as JSON with :py:meth:`DependencyTracker.write_json()`.  The
+``latexpp`` command writes them with the ``--depfile FILE`` and
+``--depfile-json FILE`` options.
+
+Make can't depend on a file not existing.  In the ``.d`` file, each missing
+file is instead represented by the nearest existing directory that contains
+it: creating the file changes the directory's modification time, so that the
+targets are considered out of date.  (This is conservative, as adding or
+removing any other file in the directory does the same.)
+"""
+
+import os
+import os.path
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .events import PreprocessorObserver
+
+
+class DependencyTracker(PreprocessorObserver):
+    r"""
+    Tracks the source files the preprocessor `lpp` (and its
+    sub-preprocessors) depends on, see :py:mod:`latexpp.dependencies`.
+
+    Call :py:meth:`start()` before running the preprocessor and
+    :py:meth:`stop()` after having called its
+    :py:meth:`~latexpp.preprocessor.LatexPreprocessor.finalize()` method, then
+    export the dependencies with :py:meth:`to_json()`,
+    :py:meth:`write_makefile()` or :py:meth:`write_json()`.
+
+    .. py:attribute:: inputs
+
+       The list of the absolute paths of the source files that were read,
+       copied, or found when checking whether they exist, in the order they
+       were first seen.
+
+    .. py:attribute:: missing
+
+       The list of the absolute paths of the files that a fix looked for but
+       did not find.
+    """
+    def __init__(self, lpp):
+        super().__init__()
+        self.lpp = lpp
+        # dicts with None values keep the order of insertion
+        self._inputs = {}
+        self._missing = {}
+
+    @property
+    def inputs(self):
+        return list(self._inputs)
+
+    @property
+    def missing(self):
+        return [ path for path in self._missing if path not in self._inputs ]
+
+    def start(self):
+        r"""
+        Start observing the preprocessor.
+        """
+        self.lpp.add_observer(self)
+
+    def stop(self):
+        r"""
+        Stop observing the preprocessor.
+        """
+        self.lpp.remove_observer(self)
+
+    def add_input(self, fname):
+        r"""
+        Add a dependency on the file `fname` (relative to the current
+        directory), e.g., the `lppconfig.yml` file of the run.
+        """
+        self._inputs.setdefault(os.path.abspath(fname), None)
+
+    def get_targets(self):
+        r"""
+        Return the list of the absolute paths of the files written to the
+        output directory.
+        """
+        return [ os.path.join(self.lpp.output_dir, fname)
+                 for fname in dict.fromkeys(self.lpp.output_files) ]
+
+    def to_json(self, relative_to=None):
+        r"""
+        Return a JSON-serializable dictionary with the lists ``targets``,
+        ``inputs`` and ``missing`` (see :py:meth:`get_targets()`,
+        :py:attr:`inputs`, :py:attr:`missing`).  File names are absolute
+        paths, or relative to the directory `relative_to` if it is not `None`.
+        """
+        return {
+            'targets': _relpaths(self.get_targets(), relative_to),
+            'inputs': _relpaths(self.inputs, relative_to),
+            'missing': _relpaths(self.missing, relative_to),
+        }
+
+    def format_makefile(self, relative_to=None):
+        r"""
+        Return the dependencies as a make rule, followed by an empty rule for
+        each input so that make doesn't fail if an input file is deleted (like
+        ``gcc -MP``).  Missing files are represented by the directories that
+        would contain them (see :py:mod:`latexpp.dependencies`).  File names
+        are absolute paths, or relative to the directory `relative_to` if it
+        is not `None`.
+        """
+        targets = _relpaths(self.get_targets(), relative_to)
+        inputs = _relpaths(self.inputs, relative_to)
+        missing_dirs = _relpaths(
+            dict.fromkeys(_existing_parent_dir(path) for path in self.missing),
+            relative_to
+        )
+
+        prereqs = inputs + [ d for d in missing_dirs if d not in inputs ]
+        lines = [ ' '.join(_make_escape(t) for t in targets) + ':' ]
+        lines += [ ' ' + _make_escape(p) for p in prereqs ]
+        s = ' \\\n'.join(lines) + '\n'
+        for fname in inputs:
+            s += '\n' + _make_escape(fname) + ':\n'
+        return s
+
+    def write_makefile(self, fname, relative_to=None):
+        r"""
+        Write the dependencies to the make-style ``.d`` file `fname` (see
+        :py:meth:`format_makefile()`).
+        """
+        with open(fname, 'w') as f:
+            f.write(self.format_makefile(relative_to=relative_to))
+
+    def write_json(self, fname, relative_to=None):
+        r"""
+        Write the dependencies to the JSON file `fname` (see
+        :py:meth:`to_json()`).
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.to_json(relative_to=relative_to), f, indent=2)
+            f.write('\n')
+
+    #
+    # PreprocessorObserver events
+    #
+
+    def file_read(self, lpp, fname):
+        self._add_source(lpp, fname, True)
+
+    def file_copied(self, lpp, source, destfname):
+        self._add_source(lpp, source, True)
+
+    def file_probed(self, lpp, fname, exists):
+        self._add_source(lpp, fname, exists)
+
+    def _add_source(self, lpp, fname, exists):
+        path = os.path.abspath(lpp._resolve_source_fname(fname))
+        if exists:
+            self._inputs.setdefault(path, None)
+        else:
+            self._missing.setdefault(path, None)
+
+
+def _relpaths(paths, relative_to):
+    if relative_to is None:
+        return list(paths)
+    result = []
+    for path in paths:
+        try:
+            result.append(os.path.relpath(path, relative_to))
+        except ValueError: # e.g. on another drive on Windows
+            result.append(path)
+    return result
+
+def _existing_parent_dir(path):
+    d = os.path.dirname(path)
+    while not os.path.isdir(d) and os.path.dirname(d) != d:
+        d = os.path.dirname(d)
+    return d
+
+def _make_escape(fname):
+    return fname.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
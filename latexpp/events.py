@@ -0,0 +1,225 @@
+r"""
+Module that defines the interface for observing what the preprocessor does,
+e.g. to trace, monitor or measure a `latexpp` run.
+
+Create a subclass of :py:class:`PreprocessorObserver`, reimplement the methods
+for the events you are interested in, and register an instance with
+:py:meth:`latexpp.preprocessor.LatexPreprocessor.add_observer()`::
+
+  class ReplacementLogger(PreprocessorObserver):
+    def node_replaced(self, lpp, fix, node, replacement):
+      print(fix.fix_name(), node.to_latex(), '->', replacement)
+
+  lpp.add_observer(ReplacementLogger())
+
+Observers see the events of the preprocessor they are registered with and of
+all its sub-preprocessors (see
+:py:meth:`latexpp.preprocessor.LatexPreprocessor.create_subpreprocessor()`).
+
+When no observer is registered, the preprocessor does not emit any events and
+the document walks of the fixes are not instrumented at all: the preprocessor
+only checks for observers once per fix and per file, never per node.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PreprocessorObserver:
+    r"""
+    Base class for observers of preprocessor events.  All methods do nothing by
+    default.  In all methods, `lpp` is the preprocessor (or sub-preprocessor)
+    instance that emits the event.
+    """
+
+    def file_start(self, lpp, fname):
+        r"""
+        Called when the preprocessor starts processing the source file `fname`
+        (see :py:meth:`latexpp.preprocessor.LatexPreprocessor.execute_file()`),
+        or when a fix starts processing a file whose contents it pastes into
+        the document (e.g. :py:class:`latexpp.fixes.input.EvalInput`).
+        """
+        pass
+
+    def file_end(self, lpp, fname):
+        r"""
+        Called after the preprocessor processed the file given to
+        :py:meth:`file_start()` and wrote the output, also if an exception was
+        raised.
+        """
+        pass
+
+    def preprocess_start(self, lpp):
+        r"""
+        Called when the preprocessor `lpp` starts running all its fixes on a
+        document (see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.preprocess()`).  If
+        `lpp` has a `parent_preprocessor`, this is a sub-preprocessor run.
+        """
+        pass
+
+    def preprocess_end(self, lpp):
+        r"""
+        Called after the run given to :py:meth:`preprocess_start()` is
+        finished, also if an exception was raised.
+        """
+        pass
+
+    def fix_start(self, lpp, fixes, name):
+        r"""
+        Called immediately before the preprocessor runs a fix on a document.
+        The argument `fixes` is the list of fixes that are run (several fixes
+        if they are run together in a single walk, see
+        :py:attr:`latexpp.preprocessor.LatexPreprocessor.fuse_fixes`) and
+        `name` is a descriptive name for them.  This event is also emitted for
+        the preprocessor's built-in fixes that handle pragmas.
+        """
+        pass
+
+    def fix_end(self, lpp, fixes, name):
+        r"""
+        Called after the fix(es) given to :py:meth:`fix_start()` have run,
+        also if an exception was raised.
+        """
+        pass
+
+    def stage_start(self, lpp, fix, stage):
+        r"""
+        Called immediately before a stage `stage` of the multi-stage fix `fix`
+        is run (see :py:class:`latexpp.fix.BaseMultiStageFix`).
+        """
+        pass
+
+    def stage_end(self, lpp, fix, stage):
+        r"""
+        Called after the stage given to :py:meth:`stage_start()` has run,
+        also if an exception was raised.
+        """
+        pass
+
+    def step_start(self, lpp, name):
+        r"""
+        Called immediately before the preprocessor carries out a processing
+        step that is not a fix, namely parsing the input (`name` is
+        ``'<parse>'``) and writing the output (`name` is ``'<output>'``).
+        """
+        pass
+
+    def step_end(self, lpp, name):
+        r"""
+        Called after the step given to :py:meth:`step_start()` is finished,
+        also if an exception was raised.
+        """
+        pass
+
+    def nodes_visited(self, lpp, fix, count):
+        r"""
+        Called when the walk of the fix `fix` through the document examined
+        `count` more nodes.
+        """
+        pass
+
+    def node_replaced(self, lpp, fix, node, replacement):
+        r"""
+        Called when `fix` replaced `node` during its walk through the document.
+        The `replacement` is what the fix returned, i.e., a node (possibly
+        `node` itself if it was modified in place), a list of nodes, or a
+        string of LaTeX code that is going to be parsed.
+        """
+        pass
+
+    def reparse(self, lpp, latex):
+        r"""
+        Called when the LaTeX code `latex` returned by a fix needs to be parsed
+        (see :py:meth:`latexpp.preprocessor.LatexPreprocessor.parse_fragment()`).
+        """
+        pass
+
+    def file_read(self, lpp, fname):
+        r"""
+        Called when the preprocessor reads the source file `fname`, either to
+        process it or because a fix opens it (see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.open_file()`).
+        """
+        pass
+
+    def file_copied(self, lpp, source, destfname):
+        r"""
+        Called after the file `source` was copied to `destfname` (relative to
+        the output directory), see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.copy_file()`.
+        """
+        pass
+
+    def file_probed(self, lpp, fname, exists):
+        r"""
+        Called when a fix checked whether the source file `fname` exists, e.g.,
+        to find the file of an ``\input`` among several possible file
+        extensions (see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.note_file_probe()`).
+        The result of the check is `exists`.  A file that was not found matters
+        too: if it is created later, the output of the run may change.
+        """
+        pass
+
+    def output_written(self, lpp, output_fname, size):
+        r"""
+        Called after the preprocessor wrote `size` bytes of processed LaTeX
+        code to the output file `output_fname` (relative to the output
+        directory), or to a string or stream if `output_fname` is `None`.  The
+        size is counted in the encoding of the output file, or in UTF-8 for
+        streams without an encoding.
+        """
+        pass
+
+
+_EVENT_NAMES = [
+    name for name, value in PreprocessorObserver.__dict__.items()
+    if callable(value) and not name.startswith('_')
+]
+
+
+class EventDispatcher:
+    r"""
+    Forwards each event (called as a method with the same signature as in
+    :py:class:`PreprocessorObserver`) to all the given `observers`.
+    """
+    def __init__(self, observers):
+        super().__init__()
+        self.observers = list(observers)
+
+    def scope(self, start_event, end_event, *args):
+        r"""
+        Return a context manager that emits the event `start_event` upon entry
+        and `end_event` upon exit, with the given arguments.
+        """
+        return _EventScope(getattr(self, start_event), getattr(self, end_event), args)
+
+
+def _make_dispatch_method(name):
+    def dispatch(self, *args):
+        for observer in self.observers:
+            getattr(observer, name)(*args)
+    dispatch.__name__ = name
+    dispatch.__doc__ = "Forward the {} event to all observers.".format(name)
+    return dispatch
+
+for _name in _EVENT_NAMES:
+    setattr(EventDispatcher, _name, _make_dispatch_method(_name))
+del _name
+
+
+class _EventScope:
+    __slots__ = ('start', 'end', 'args')
+
+    def __init__(self, start, end, args):
+        self.start = start
+        self.end = end
+        self.args = args
+
+    def __enter__(self):
+        self.start(*self.args)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end(*self.args)
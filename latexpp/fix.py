@@ -11,6 +11,10 @@ logger = logging.getLogger(__name__)
 
 from pylatexenc import latexwalker
 
+from ._lpp_parsing import (
+    node_name_key, triggers_to_name_keys, LatexVerbatimSpliceNode
+)
+
 try:
     from pylatexenc.latexnodes import LatexWalkerParseError
     from pylatexenc.latexnodes import nodes as latexnodes_nodes
@@ -28,6 +32,52 @@ class DontFixThisNode(Exception):
     pass
 
 
+def _ensure_macro_node_maybe_post_space(newnodelist, j):
+    # Assumes that newnodelist[j] is a macro node
+
+    n = newnodelist[j]
+    n2 = newnodelist[j+1]
+
+    # The only problematic situations are if the macro name is alpha and it
+    # is followed by a chars node that starts with an ASCII letter
+    if n.macroname[-1:] not in string.ascii_letters:
+        return
+    if n2.isNodeType(latexwalker.LatexCharsNode):
+        n2chars = n2.chars
+    elif n2.isNodeType(LatexVerbatimSpliceNode):
+        n2chars = n2.latex
+    else:
+        return
+    if n2chars[0:1] not in string.ascii_letters:
+        return
+
+    if n.nodeargd and n.nodeargd.argnlist:
+        # the macro invocation has arguments
+
+        for j in range(len(n.nodeargd.argnlist)):
+            nla = n.nodeargd.argnlist[-1-j]
+            if nla is None:
+                continue
+            elif nla.isNodeType(latexwalker.LatexMacroNode):
+                # last argument is bare macro.  Add macro_post_space *to the
+                # argument macro node* (if we add it to n.macro_post_space,
+                # the space will appear before the macro args)
+                if not nla.macro_post_space:
+                    nla.macro_post_space = ' '
+                    # all ok, done
+                    return
+            else:
+                # no need for any protection, there is a non-bare-macro
+                # argument at the end of the specified arguments.
+                return
+
+    # no args (or empty arg list), so make sure the macro has post_space
+    if not n.macro_post_space:
+        n.macro_post_space = ' ' # nothing -> single space
+
+    return
+
+
 class BaseFix:
     r"""
     Base class for defining specific `latexpp` fixes.
@@ -137,6 +187,117 @@ class BaseFix:
         """
         return None
 
+    def triggers(self):
+        r"""
+        Return a description of which nodes :py:meth:`fix_node()` might act upon.
+        This information is used to skip calling :py:meth:`fix_node()` on
+        irrelevant nodes, including when the preprocessor runs several fixes in
+        a single walk through the document (see
+        :py:attr:`latexpp.preprocessor.LatexPreprocessor.fuse_fixes`).
+
+        Return `None` if :py:meth:`fix_node()` needs to inspect all nodes.
+        Otherwise, return a dict with any of the keys 'macros', 'environments',
+        and 'specials' holding lists of macro names, environment names, and
+        specials characters, respectively, and optionally the key 'comments'
+        set to `True` if comment nodes are relevant.  :py:meth:`fix_node()` is
+        then only guaranteed to be called for the nodes matching one of these
+        names.
+
+        When triggers are declared, :py:meth:`preprocess()` also skips entire
+        subtrees of the document that contain none of these names.  (The latex
+        walker records which names appear in each subtree when it creates the
+        nodes, see :ref:`implementation-notes-pylatexenc`.)
+
+        This method is called once, after :py:meth:`initialize()`.
+
+        The default implementation returns `None`.  Reimplement this method if
+        your fix only acts on a known set of macros or environments.
+        """
+        return None
+
+    def handlers(self):
+        r"""
+        Return a mapping of the macros, environments, etc. that this fix acts
+        upon, to the methods that should be called to transform them.  This is
+        an alternative to reimplementing :py:meth:`fix_node()` and testing the
+        node type and name yourself.
+
+        Return `None` (the default) if you reimplement :py:meth:`fix_node()`
+        instead.  Otherwise, return a dict with any of the keys 'macros',
+        'environments' and 'specials', each holding a dict of ``{name:
+        handler}``, and optionally the key 'comments' holding a handler for
+        comment nodes.  For instance::
+
+          class MyFix(BaseFix):
+            def handlers(self):
+              return dict(macros={'textbf': self.fix_textbf,
+                                  'textit': self.fix_textit})
+
+            def fix_textbf(self, n, **kwargs):
+              return r'{\bfseries ' + self.preprocess_arg_latex(n, 0) + '}'
+
+            def fix_textit(self, n, **kwargs):
+              return r'{\itshape ' + self.preprocess_arg_latex(n, 0) + '}'
+
+        Each handler is called exactly like :py:meth:`fix_node()` would be, with
+        the node as first argument and the same keyword arguments, and should
+        return the same kind of values.  The handlers are looked up in a
+        dictionary for each node, and no Python-level call is made at all for
+        nodes that have no handler.  (The default implementation of
+        :py:meth:`fix_node()` dispatches to the handlers.)
+
+        This method is called once, after :py:meth:`initialize()`.  There is no
+        need to reimplement :py:meth:`triggers()` if you reimplement this
+        method.
+        """
+        return None
+
+    def _get_handler_map(self):
+        # Return a dict {name-key: handler} compiled from handlers(), or None.
+        # Computed once.
+        try:
+            return self._basefix_handler_map
+        except AttributeError:
+            pass
+        h = self.handlers()
+        handler_map = None
+        if h is not None:
+            handler_map = {}
+            for what in ('macros', 'environments', 'specials'):
+                handler_map.update( ((what, name), handler)
+                                    for name, handler in h.get(what, {}).items() )
+            if h.get('comments', None) is not None:
+                handler_map[('comments', True)] = h['comments']
+        self._basefix_handler_map = handler_map
+        return handler_map
+
+    def _get_fix_node_dispatch(self):
+        # Return the handler map if nodes should be dispatched directly to the
+        # handlers rather than calling fix_node().
+        if type(self).fix_node is not BaseFix.fix_node:
+            return None
+        return self._get_handler_map()
+
+    def _get_trigger_keys(self):
+        # Return the frozenset of summary keys associated with our triggers(),
+        # or None if we need to see all nodes.  Computed once.
+        try:
+            return self._basefix_trigger_keys
+        except AttributeError:
+            pass
+        if type(self).fix_nodelist is not BaseFix.fix_nodelist:
+            # fix_nodelist() needs to see all node lists
+            keys = None
+        elif type(self).fix_node is BaseFix.fix_node:
+            # fix_node() is not reimplemented, we act on those nodes for which
+            # we have handlers (if any)
+            keys = frozenset(self._get_handler_map() or ())
+        else:
+            t = self.triggers()
+            keys = triggers_to_name_keys(t) if t is not None else None
+        self._basefix_trigger_keys = keys
+        return keys
+
     def finalize(self):
         """
         Method that is called after all fixes have finished processing their
@@ -150,6 +311,40 @@ class BaseFix:
         pass
 
 
+    def incremental_state(self):
+        r"""
+        Return a snapshot of the information that this fix accumulates while it
+        walks through the document, such as a counter of the figures seen so
+        far or the list of labels collected so far.  Incremental runs (see
+        :py:mod:`latexpp.incremental`) take a snapshot at the beginning and at
+        the end of the output of each ``\input`` file, to find out whether
+        processing a modified file on its own affects the rest of the document.
+
+        Snapshots are compared with ``==`` and stored with :py:mod:`pickle`.
+        They must not share any mutable objects with the fix.  Return an empty
+        tuple ``()`` if the fix processes each part of the document
+        independently of all the other parts.  For a
+        :py:class:`BaseMultiStageFix`, the snapshot covers the information of
+        all stages.
+
+        The default implementation returns `None`, meaning that the fix does
+        not support incremental runs.  The whole document is then always
+        processed.  `None` is therefore never a valid snapshot.
+        """
+        return None
+
+    def set_incremental_state(self, state):
+        r"""
+        Restore the information that this fix accumulated while walking through
+        the document from the snapshot `state` returned by
+        :py:meth:`incremental_state()`.
+
+        The default implementation does nothing, which is all that's needed
+        for fixes whose snapshots are empty.
+        """
+        pass
+
+
     def add_preamble(self):
         """
         Fixes can add arbitrary code to the LaTeX preamble by subclassing this
@@ -157,6 +352,12 @@ class BaseFix:
         default implementation returns `None`, which means that no additional
         preamble definitions are requested.
 
+        This method may also return a node or a list of nodes, which are
+        inserted in the preamble as they are.  In particular, return an opaque
+        node created with ``self.lpp.nodes.verbatim(latex_code)`` to have the
+        definitions copied to the output verbatim, without being parsed nor
+        processed by any fixes.
+
         Currently, the preamble definitions are included from the start, before
         running all the fixes and they are processed as part of the document
         with all the relevant fixes.  [Don't count on this behavior, it doesn't
@@ -174,140 +375,42 @@ class BaseFix:
 
         This function is what someone should call to get a full processed
         version of `nodelist`.  This method takes care of descending into child
-        nodes and applying the fixes recursively by calling `preprocess()` on
-        children nodes.
+        nodes and applying the fixes to them, as if by calling `preprocess()` on
+        the children nodes.  The tree is walked using an explicit stack rather
+        than by recursion, so deeply nested documents do not hit Python's
+        recursion limit.  (If a subclass reimplements `preprocess()` or
+        :py:meth:`preprocess_child_nodes()`, these methods do get called for
+        the child nodes.)
+
+        If no node was replaced, then `nodelist` itself is returned (child nodes
+        might have been modified in place, though).  Callers must therefore not
+        modify the returned list in place unless they own `nodelist`.
 
         Don't subclass this, rather, you should subclass
         :py:meth:`fix_nodelist()` or :py:meth:`fix_node()`.
         """
 
-        newnodelist = self.fix_nodelist(nodelist)
-
-        # Only continue preprocessing children nodes if fix_nodelist() returned
-        # `None`.  The rule is that if fix_node() or fix_nodelist() return
-        # something non-None, they are responsible for calling
-        # preprocess_latex() or preprocess_children() on all child nodes.
-        if isinstance(newnodelist, (LatexNodeList, list)):
-            return newnodelist
-        if isinstance(newnodelist, str):
-            # re-parse with latexwalker
-            ps = None
-            if nodelist:
-                ps = nodelist[0].parsing_state
-            try:
-                return self.parse_nodes(newnodelist, parsing_state=ps)
-            except LatexWalkerParseError as e:
-                if hasattr(nodelist, 'latex_walker') and hasattr(nodelist, 'pos'):
-                    latex_walker = nodelist.latex_walker
-                    pos = nodelist.pos
-                    logger.error(
-                        "Error {}, near ‘{}’ ".format(
-                            latex_walker.format_pos(pos),
-                            nodelist.to_latex()
-                        )
-                    )
-                raise
-        if newnodelist is not None:
-            raise ValueError("{}.fix_nodelist() did not return a string or node list"
-                             .format(self.fix_name()))
-
-        # Continue processing with fix_node()
-        newnodelist = []
-        for j, n in enumerate(nodelist):
-
-            if n is None:
-                continue
-
-            # call fix_node()
-            try:
-                nn = self.fix_node(
-                    n,
-                    # newnodelist here (already preprocessed)
-                    prev_node=(newnodelist[-1] if len(newnodelist) else None),
-                    # nodelist here (not yet preprocessed)
-                    next_node=(nodelist[j+1] if j+1<len(nodelist) else None)
-                )
-            except DontFixThisNode:
-                nn = None
-            if nn is None:
-                # keep this node as it is; make sure child nodes are
-                # preprocessed.
-                self.preprocess_child_nodes(n)
-                newnodelist.append(n)
-                continue
-
-            if isinstance(nn, str):
-                # if it is a str then we need to re-parse output into nodes
-                try:
-                    nn = self.parse_nodes(nn, parsing_state=n.parsing_state)
-                except LatexWalkerParseError as e:
-                    if hasattr(nodelist, 'latex_walker') and hasattr(nodelist, 'pos'):
-                        latex_walker = nodelist.latex_walker
-                        pos = nodelist.pos
-                        logger.error(
-                            "Error {}, near ‘{}’ ".format(
-                                latex_walker.format_pos(pos),
-                                nodelist.to_latex()
-                            )
-                        )
-                    raise
-                # fall through case is list ->
-            if isinstance(nn, (LatexNodeList, list)):
-                # add new nodes
-                newnodelist.extend(nn)
-                continue
-
-            newnodelist.append(nn)
-
-        # make sure in the newnodelist that macro nodes are always protected by
-        # a post-space, e.g., avoid a situation where a macro replacement \a ->
-        # \b removed the post-space and glues the macro invokation to a
-        # subsequent string.
-        for j in range(len(newnodelist)-1):
-            if newnodelist[j].isNodeType(latexwalker.LatexMacroNode):
-                self._ensure_macro_node_maybe_post_space(newnodelist, j)
-
-        return newnodelist
+        return self._get_traversal().preprocess(nodelist)
+
+    def _get_traversal(self):
+        # The engine that walks the node tree for us, using an explicit stack
+        # rather than recursion (see latexpp._lpp_traversal).  If observers
+        # are registered with the preprocessor, we use a version of the engine
+        # that reports what it does; otherwise the walk isn't instrumented.
+        # Segment markers are reported to the preprocessor's segment recorder,
+        # if there is one (see latexpp.incremental).
+        events = getattr(self.lpp, '_events', None)
+        segments = getattr(self.lpp, 'segment_recorder', None)
+        traversal = getattr(self, '_basefix_traversal', None)
+        if traversal is None or traversal.events is not events \
+           or traversal.segments is not segments:
+            from ._lpp_traversal import make_fix_traversal
+            traversal = make_fix_traversal(self, events, segments)
+            self._basefix_traversal = traversal
+        return traversal
 
     def _ensure_macro_node_maybe_post_space(self, newnodelist, j):
-        # Assumes that newnodelist[j] is a macro node
-
-        n = newnodelist[j]
-        n2 = newnodelist[j+1]
-
-        # The only problematic situations are if the macro name is alpha and it
-        # is followed by a chars node that starts with an ASCII letter
-        if n.macroname[-1:] not in string.ascii_letters:
-            return
-        if not n2.isNodeType(latexwalker.LatexCharsNode) \
-           or n2.chars[0:1] not in string.ascii_letters:
-            return
-
-        if n.nodeargd and n.nodeargd.argnlist:
-            # the macro invocation has arguments
-
-            for j in range(len(n.nodeargd.argnlist)):
-                nla = n.nodeargd.argnlist[-1-j]
-                if nla is None:
-                    continue
-                elif nla.isNodeType(latexwalker.LatexMacroNode):
-                    # last argument is bare macro.  Add macro_post_space *to the
-                    # argument macro node* (if we add it to n.macro_post_space,
-                    # the space will appear before the macro args)
-                    if not nla.macro_post_space:
-                        nla.macro_post_space = ' '
-                        # all ok, done
-                        return
-                else:
-                    # no need for any protection, there is a non-bare-macro
-                    # argument at the end of the specified arguments.
-                    return
-
-        # no args (or empty arg list), so make sure the macro has post_space
-        if not n.macro_post_space:
-            n.macro_post_space = ' ' # nothing -> single space
-
-        return
+        _ensure_macro_node_maybe_post_space(newnodelist, j)
 
 
     def preprocess_child_nodes(self, node):
@@ -320,95 +423,29 @@ class BaseFix:
         This method does not return anything interesting.
         """
 
-        n = node
-
-        if n.isNodeType(latexwalker.LatexGroupNode):
-            n.nodelist = self.preprocess(n.nodelist)
-
-        if n.isNodeType(latexwalker.LatexMacroNode):
-            if n.nodeargd is not None and n.nodeargd.argnlist is not None:
-                for j in range(len(n.nodeargd.argnlist)):
-                    n.nodeargd.argnlist[j] = \
-                        self._call_preprocess_argnode(n.nodeargd.argnlist[j])
-
-        if n.isNodeType(latexwalker.LatexEnvironmentNode):
-            if n.nodeargd is not None and n.nodeargd.argnlist is not None:
-                for j in range(len(n.nodeargd.argnlist)):
-                    n.nodeargd.argnlist[j] = \
-                        self._call_preprocess_argnode(n.nodeargd.argnlist[j])
-
-            n.nodelist = self.preprocess(n.nodelist)
-
-        if n.isNodeType(latexwalker.LatexSpecialsNode):
-            if n.nodeargd is not None and n.nodeargd.argnlist is not None:
-                for j in range(len(n.nodeargd.argnlist)):
-                    n.nodeargd.argnlist[j] = \
-                        self._call_preprocess_argnode(n.nodeargd.argnlist[j])
-
-        if n.isNodeType(latexwalker.LatexMathNode):
-            n.nodelist = self.preprocess(n.nodelist)
+        self._get_traversal().preprocess_child_nodes(node)
 
 
     def parse_nodes(self, s, parsing_state):
         """
         Parses the given string `s` with an appropriate `LatexWalker` to get a node
-        list again, using the given `parsing_state`.
+        list again, using the given `parsing_state`.  Parsing results are
+        memoized by the preprocessor (see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.parse_fragment()`).
 
         Returns the node list.  Raises
         :py:exc:`pylatexenc.latexwalker.LatexWalkerParseError` if there was a
         parse error.
         """
         try:
-            lw = self.lpp.make_latex_walker(s)
-            nodes, _, _ = lw.get_latex_nodes(
-                parsing_state=lw.make_parsing_state(**parsing_state.get_fields())
-            )
-            return nodes
+            return self.lpp.parse_fragment(s, parsing_state)
         except latexwalker.LatexWalkerParseError as e:
             logger.error("Error re-parsing intermediate latex code:\n%r\n%s",
                          s, e)
             raise
 
     def _call_preprocess_argnode(self, node):
-
-        if node is None:
-            return None
-
-        try:
-            newnode = self.fix_node(node, is_single_token_arg=True)
-        except DontFixThisNode:
-            newnode = None
-        if newnode is None:
-            newnode = node
-
-        if isinstance(newnode, str):
-            # re-parse with latexwalker etc.
-            newnode = self.parse_nodes(newnode, node.parsing_state)
-            # fall through to list case ->
-
-        if isinstance(newnode, (LatexNodeList, list)):
-            nx = newnode
-            # by default, ensure the contents are enclosed in curly braces to
-            # make sure the syntax of the resulting LaTeX code isn't changed
-            # (e.g., replacing ‘\rhostate’ by ‘\hat\rho’ in ‘\frac\rhostate{2}’
-            # should give ‘\frac{\hat\rho}{2}’, not ‘\frac\hat\rho{2}’.  Only
-            # omit the extra '{' delimiters if the node itself contains a single
-            # element which is a group node.
-            delimiters = ('{', '}')
-            if len(nx) == 1 and nx[0].isNodeType(latexwalker.LatexGroupNode):
-                delimiters = ('', '')
-            newnode = node.parsing_state.lpp_latex_walker.make_node(
-                latexwalker.LatexGroupNode,
-                nodelist=nx,
-                delimiters=delimiters,
-                parsing_state=node.parsing_state,
-                pos=None, len=None
-            )
-
-        if newnode.isNodeType(latexwalker.LatexGroupNode):
-            newnode.nodelist = self.preprocess(newnode.nodelist)
-
-        return newnode
+        return self._get_traversal().preprocess_argnode(node)
 
 
     def fix_nodelist(self, nodelist):
@@ -466,7 +503,11 @@ class BaseFix:
           resulting nodes are used as a replacement of the original `node`.
 
         - return a node instance or a node list: The node(s) are used in the
-          place of the original `node`.
+          place of the original `node`.  To insert LaTeX code in the output
+          exactly as is, without having it parsed and processed by any further
+          fixes, return an opaque node created with
+          ``self.lpp.nodes.verbatim(latex_code)`` (see
+          :py:meth:`latexpp.node_builder.LatexNodesBuilder.verbatim()`).
 
         If this method returns a valid replacement for the given `node`, i.e.,
         anything that is not `None`, then *this method is responsible for
@@ -503,7 +544,16 @@ class BaseFix:
         
            Subclasses are strongly advised to accept `**kwargs` to accommodate
            future hints that might be introduced.
+
+        The default implementation calls the relevant handler declared in
+        :py:meth:`handlers()`, if any, and otherwise returns `None`.
         """
+        handler_map = self._get_handler_map()
+        if handler_map:
+            handler = handler_map.get(node_name_key(node), None)
+            if handler is not None:
+                return handler(node, is_single_token_arg=is_single_token_arg,
+                               prev_node=prev_node, next_node=next_node)
         return None
 
 
@@ -610,6 +660,17 @@ class BaseFix:
         """
         return self.preprocess_contents_latex(self.node_get_arg(n, argn))
 
+    def preprocess_arg_node(self, n, argn):
+        r"""
+        Return the `argn`-th argument node of `n` (see :py:meth:`node_get_arg()`)
+        after having preprocessed it with the present fix, in the same way as
+        arguments are preprocessed by :py:meth:`preprocess_child_nodes()`.  The
+        result is a single node (or `None` if the argument is absent) that can
+        be used as an argument of a new node, see
+        :py:class:`latexpp.node_builder.LatexNodesBuilder`.
+        """
+        return self._call_preprocess_argnode(self.node_get_arg(n, argn))
+
 
 
 
@@ -763,9 +824,16 @@ class BaseMultiStageFix(BaseFix):
         newnodelist = nodelist
         for stage in self._fix_stages:
             logger.debug("%s: running stage ‘%s’", self.fix_name(), stage.stage_name())
-            stage.stage_start()
-            newnodelist = stage.preprocess(newnodelist)
-            stage.stage_finish()
+            events = getattr(stage.lpp, '_events', None)
+            if events is None:
+                stage.stage_start()
+                newnodelist = stage.preprocess(newnodelist)
+                stage.stage_finish()
+                continue
+            with events.scope('stage_start', 'stage_end', stage.lpp, self, stage):
+                stage.stage_start()
+                newnodelist = stage.preprocess(newnodelist)
+                stage.stage_finish()
 
         return newnodelist
 
@@ -80,6 +80,9 @@ class CreateArchive(BaseFix):
         self.use_date = use_date
         self.archive_type = archive_type
 
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
 
     def finalize(self, **kwargs):
         # all set, we can create the archive
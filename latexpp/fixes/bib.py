@@ -4,7 +4,6 @@ import logging
 logger = logging.getLogger(__name__)
 
 from pylatexenc.macrospec import MacroSpec
-from pylatexenc.latexwalker import LatexMacroNode
 
 from latexpp.fix import BaseFix
 
@@ -29,7 +28,8 @@ class CopyAndInputBbl(BaseFix):
       name.
 
     - `eval_input`: Directly paste the BBL file contents into the TeX file
-      rather than issuing a ``\input{XXX.bbl}`` directive.
+      rather than issuing a ``\input{XXX.bbl}`` directive.  The contents are
+      pasted verbatim; they are not processed by any further fixes.
     """
 
     def __init__(self, bblname=None, outbblname=None, eval_input=False):
@@ -44,40 +44,49 @@ class CopyAndInputBbl(BaseFix):
             MacroSpec('bibliography', '{'),
         ])
 
-    def fix_node(self, n, **kwargs):
-
-        if n.isNodeType(LatexMacroNode) and n.macroname == 'bibliographystyle':
-            # remove \bibliographystyle{} command
-            return ''
-
-        if n.isNodeType(LatexMacroNode) and n.macroname == 'bibliography':
-
-            if self.bblname:
-                bblname = self.bblname
-            else:
-                bblname = re.sub(r'(\.(la)?tex)$', '', self.lpp.main_doc_fname) + '.bbl'
-            if self.outbblname:
-                outbblname = self.outbblname
-            else:
-                outbblname = re.sub(r'(\.(la)?tex)$', '', self.lpp.main_doc_output_fname) \
-                    + '.bbl'
-
-            self.lpp.check_autofile_up_to_date(bblname)
-
-            # input BBL contents in any case at least to check for nonascii chars
-            with self.lpp.open_file(bblname) as f:
-                bbl_contents = f.read()
-            # check for nonascii chars
-            check_for_nonascii(bbl_contents, what='BBL file {}'.format(bblname))
-
-            if self.eval_input:
-                return bbl_contents
-            else:
-                # copy BBL file
-                self.lpp.copy_file(bblname, outbblname)
-                return r'\input{%s}'%(outbblname)
-
-        return None
+    def handlers(self):
+        return dict(macros={
+            'bibliographystyle': self.fix_bibliographystyle,
+            'bibliography': self.fix_bibliography,
+        })
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
+    def fix_bibliographystyle(self, n, **kwargs):
+        # remove \bibliographystyle{} command
+        return []
+
+    def fix_bibliography(self, n, **kwargs):
+
+        if self.bblname:
+            bblname = self.bblname
+        else:
+            bblname = re.sub(r'(\.(la)?tex)$', '', self.lpp.main_doc_fname) + '.bbl'
+        if self.outbblname:
+            outbblname = self.outbblname
+        else:
+            outbblname = re.sub(r'(\.(la)?tex)$', '', self.lpp.main_doc_output_fname) \
+                + '.bbl'
+
+        self.lpp.check_autofile_up_to_date(bblname)
+
+        # input BBL contents in any case at least to check for nonascii chars
+        with self.lpp.open_file(bblname) as f:
+            bbl_contents = f.read()
+        # check for nonascii chars
+        check_for_nonascii(bbl_contents, what='BBL file {}'.format(bblname))
+
+        if self.eval_input:
+            # paste the contents as is, subsequent fixes have no business
+            # looking into the bibliography
+            return self.lpp.nodes.verbatim(bbl_contents,
+                                           parsing_state=n.parsing_state)
+        else:
+            # copy BBL file
+            self.lpp.copy_file(bblname, outbblname)
+            return self.lpp.nodes.macro('input', [outbblname],
+                                        parsing_state=n.parsing_state)
 
 def check_for_nonascii(x, what):
     cna = next( (ord(c) for c in x if ord(c) >= 127),
@@ -115,6 +124,8 @@ class ApplyAliases(BaseFix):
 
         self._bibaliases = {}
         self._bibaliases.update(aliases)
+        # (alias, target) of the bibalias commands encountered so far
+        self._bibalias_defs_seen = []
 
         self.bibalias_defs_search_files = bibalias_defs_search_files
 
@@ -141,46 +152,69 @@ class ApplyAliases(BaseFix):
     def specs(self, **kwargs):
         return dict(macros=[MacroSpec(self.bibaliascmd, '{{')])
 
-    def fix_node(self, n, **kwargs):
-        if n.isNodeType(LatexMacroNode):
-            if n.macroname == self.bibaliascmd:
-                if not n.nodeargd or not n.nodeargd.argnlist \
-                   or len(n.nodeargd.argnlist) != 2:
-                    logger.warning(r"No arguments or invalid arguments to \bibalias "
-                                   "command: %s",
-                                   n.to_latex())
-                    return None
-
-                alias = self.preprocess_arg_latex(n, 0).strip()
-                target = self.preprocess_arg_latex(n, 1).strip()
-                logger.debug("Defined bibalias %s -> %s", alias, target)
-                self._bibaliases[alias] = target
-                self._update_bibaliases()
-                return [] # remove bibalias command from input
-
-            if n.macroname in self.cite_macros:
-                if n.nodeargd is None or n.nodeargd.argspec is None \
-                   or n.nodeargd.argnlist is None:
-                    logger.warning(r"Ignoring invalid citation command: %s", n.to_latex())
-                    return None
-
-                citargno = n.nodeargd.argspec.find('{')
-                ncitarg = n.nodeargd.argnlist[citargno]
-                citargnew = self._replace_aliases(
-                    self._preprocess_citation_string(ncitarg)
-                )
-
-                s = '\\'+n.macroname \
-                    + ''.join(self.preprocess_latex(n.nodeargd.argnlist[:citargno])) \
-                    + '{'+citargnew+'}' \
-                    + ''.join(self.preprocess_latex(n.nodeargd.argnlist[citargno+1:]))
-
-                #print("*** replaced in cite cmd: ", s)
-
-                return s
-                
-
-        return None
+    def handlers(self):
+        handlers = { m: self.fix_cite for m in self.cite_macros }
+        handlers[self.bibaliascmd] = self.fix_bibalias
+        return dict(macros=handlers)
+
+    def preprocess(self, nodelist):
+        # only citations and \bibalias commands matter, have the document's
+        # node index find them (in document order) instead of walking through
+        # the whole document
+        index = self.lpp.node_index
+        if index is not None and index.apply_handlers(self, nodelist):
+            return nodelist
+        return super().preprocess(nodelist)
+
+    def fix_bibalias(self, n, **kwargs):
+        if not n.nodeargd or not n.nodeargd.argnlist \
+           or len(n.nodeargd.argnlist) != 2:
+            logger.warning(r"No arguments or invalid arguments to \bibalias "
+                           "command: %s",
+                           n.to_latex())
+            return None
+
+        alias = self.preprocess_arg_latex(n, 0).strip()
+        target = self.preprocess_arg_latex(n, 1).strip()
+        logger.debug("Defined bibalias %s -> %s", alias, target)
+        self._bibaliases[alias] = target
+        self._bibalias_defs_seen.append( (alias, target) )
+        self._update_bibaliases()
+        return [] # remove bibalias command from input
+
+    def incremental_state(self):
+        # the bibalias commands encountered so far tell which part of the
+        # document defines which alias
+        return (tuple(sorted(self._bibaliases.items())),
+                tuple(self._bibalias_defs_seen))
+
+    def set_incremental_state(self, state):
+        bibaliases, bibalias_defs_seen = state
+        self._bibaliases = dict(bibaliases)
+        self._bibalias_defs_seen = list(bibalias_defs_seen)
+        self._update_bibaliases()
+
+    def fix_cite(self, n, **kwargs):
+        if n.nodeargd is None or n.nodeargd.argspec is None \
+           or n.nodeargd.argnlist is None:
+            logger.warning(r"Ignoring invalid citation command: %s", n.to_latex())
+            return None
+
+        citargno = n.nodeargd.argspec.find('{')
+        ncitarg = n.nodeargd.argnlist[citargno]
+        citargnew = self._replace_aliases(
+            self._preprocess_citation_string(ncitarg)
+        )
+
+        args = [
+            self.lpp.nodes.group(citargnew, parsing_state=n.parsing_state)
+            if j == citargno else self.preprocess_arg_node(n, j)
+            for j in range(len(n.nodeargd.argnlist))
+        ]
+
+        return self.lpp.nodes.macro(n.macroname, args,
+                                    argspec=n.nodeargd.argspec,
+                                    parsing_state=n.parsing_state)
 
     def _update_bibaliases(self):
         self._rx_pattern = re.compile(
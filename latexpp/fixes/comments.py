@@ -21,31 +21,35 @@ class RemoveComments(BaseFix):
         self.leave_percent = leave_percent
         self.collapse = collapse
 
-    def fix_node(self, n, prev_node=None, **kwargs):
-
-        if n.isNodeType(LatexCommentNode):
-            if n.comment.startswith('%!lpp'):
-                # DO NOT remove LPP pragmas -- they will be needed by other fixes.
-                return None
-
-            if self.leave_percent:
-                # sys.stderr.write("Ignoring comment: '%s'\n"% node.comment)
-                if self.collapse and prev_node \
-                   and prev_node.isNodeType(LatexCommentNode):
-                    # previous node is already a comment, ignore this one. But update
-                    # previous node's post_space
-                    prev_node.comment_post_space = n.comment_post_space
-                    return []
-                return "%"+n.comment_post_space
-            else:
-                if prev_node is not None and prev_node.isNodeType(LatexMacroNode):
-                    if not prev_node.macro_post_space and \
-                       (not prev_node.nodeargd or not prev_node.nodeargd.argnlist
-                        or all((not a) for a in prev_node.nodeargd.argnlist)):
-                        # macro has neither post-space nor any arguments, so add
-                        # space to ensure LaTeX code stays valid
-                        prev_node.macro_post_space = ' '
-                    
-                return [] # remove entirely.
-
-        return None
+    def handlers(self):
+        return dict(comments=self.fix_comment)
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
+    def fix_comment(self, n, prev_node=None, **kwargs):
+
+        if n.comment.startswith('%!lpp'):
+            # DO NOT remove LPP pragmas -- they will be needed by other fixes.
+            return None
+
+        if self.leave_percent:
+            # sys.stderr.write("Ignoring comment: '%s'\n"% node.comment)
+            if self.collapse and prev_node \
+               and prev_node.isNodeType(LatexCommentNode):
+                # previous node is already a comment, ignore this one. But update
+                # previous node's post_space
+                prev_node.comment_post_space = n.comment_post_space
+                return []
+            return self.lpp.nodes.comment('', comment_post_space=n.comment_post_space,
+                                          parsing_state=n.parsing_state)
+        else:
+            if prev_node is not None and prev_node.isNodeType(LatexMacroNode):
+                if not prev_node.macro_post_space and \
+                   (not prev_node.nodeargd or not prev_node.nodeargd.argnlist
+                    or all((not a) for a in prev_node.nodeargd.argnlist)):
+                    # macro has neither post-space nor any arguments, so add
+                    # space to ensure LaTeX code stays valid
+                    prev_node.macro_post_space = ' '
+
+            return [] # remove entirely.
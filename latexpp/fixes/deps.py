@@ -56,3 +56,5 @@ class CopyFiles(BaseFix):
                 fn_from, fn_to = fn, fn
             self.lpp.copy_file(fn_from, fn_to)
 
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
@@ -1,8 +1,6 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from pylatexenc.latexwalker import LatexEnvironmentNode
-
 from latexpp.fix import BaseFix
 
 
@@ -26,32 +24,45 @@ class InsertPrePost(BaseFix):
 
       - `post_contents` is arbitrary LaTeX code to insert at the end of the
         environment body, for each environment encountered whose name is in
-        `environmentnames`.
+        `environmentnames`;
+
+      - `verbatim`: if `True`, then `pre_contents` and `post_contents` are
+        inserted exactly as they are, without being parsed or processed by
+        any fixes.  By default they are parsed as LaTeX code.
     """
-    def __init__(self, environmentnames=None, pre_contents=None, post_contents=None):
+    def __init__(self, environmentnames=None, pre_contents=None, post_contents=None,
+                 verbatim=False):
         super().__init__()
         self.environmentnames = list(environmentnames) if environmentnames else []
         self.pre_contents = pre_contents
         self.post_contents = post_contents
+        self.verbatim = verbatim
+
+    def handlers(self):
+        return dict(environments={e: self.fix_environment
+                                  for e in self.environmentnames})
 
-    def fix_node(self, n, **kwargs):
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
 
-        if n.isNodeType(LatexEnvironmentNode) \
-           and n.environmentname in self.environmentnames:
+    def fix_environment(self, n, **kwargs):
 
-            # process the children nodes, including environment arguments etc.
-            self.preprocess_child_nodes(n)
+        # process the children nodes, including environment arguments etc.
+        self.preprocess_child_nodes(n)
 
-            # insert pre-/post- content to body
-            if self.pre_contents is not None:
-                # insert the pre- content
-                pre_nodes = self.parse_nodes(self.pre_contents, n.parsing_state)
-                n.nodelist[:0] = pre_nodes
-            if self.post_contents is not None:
-                # insert the post- content
-                post_nodes = self.parse_nodes(self.post_contents, n.parsing_state)
-                n.nodelist[len(n.nodelist):] = post_nodes
+        # insert pre-/post- content to body
+        if self.pre_contents is not None:
+            # insert the pre- content
+            pre_nodes = self._make_contents_nodes(self.pre_contents, n.parsing_state)
+            n.nodelist[:0] = pre_nodes
+        if self.post_contents is not None:
+            # insert the post- content
+            post_nodes = self._make_contents_nodes(self.post_contents, n.parsing_state)
+            n.nodelist[len(n.nodelist):] = post_nodes
 
-            return n
+        return n
 
-        return None
+    def _make_contents_nodes(self, contents, parsing_state):
+        if self.verbatim:
+            return [ self.lpp.nodes.verbatim(contents, parsing_state=parsing_state) ]
+        return self.parse_nodes(contents, parsing_state)
@@ -4,7 +4,6 @@ import os.path as os_path # allow tests to monkey-patch this
 import logging
 logger = logging.getLogger(__name__)
 
-from pylatexenc.latexwalker import LatexMacroNode
 #from pylatexenc.latexencode import unicode_to_latex
 
 from latexpp.fix import BaseFix
@@ -65,62 +64,79 @@ class CopyAndRenameFigs(BaseFix):
         self.lplx_files_to_finalize = []
 
 
-    def fix_node(self, n, **kwargs):
-
-        if n.isNodeType(LatexMacroNode) and n.macroname == 'includegraphics':
-            # note, argspec is '[{'
-
-            # find file and copy it
-            orig_fig_name = self.preprocess_arg_latex(n, 1)
-            orig_fig_name = os_path.join(self.graphicspath, orig_fig_name)
-            for e in self.exts:
-                if os_path.exists(orig_fig_name+e):
-                    orig_fig_name = orig_fig_name+e
-                    break
-            else:
-                logger.warning("File not found: %s. Tried extensions %r",
-                               orig_fig_name, self.exts)
-                return None # keep the node as it is
-            
-            if '.' in orig_fig_name:
-                orig_fig_basename, orig_fig_ext = orig_fig_name.rsplit('.', maxsplit=1)
-                orig_fig_basename = os_path.basename(orig_fig_basename)
-                orig_fig_ext = '.'+orig_fig_ext
-            else:
-                orig_fig_basename, orig_fig_ext = os_path.basename(orig_fig_name), ''
-
-            figoutname = self.fig_rename.format(
-                fig_counter=self.fig_counter,
-                fig_ext=orig_fig_ext,
+    def handlers(self):
+        return dict(macros={'includegraphics': self.fix_includegraphics})
+
+    def preprocess(self, nodelist):
+        # only the \includegraphics commands matter, have the document's node
+        # index find them instead of walking through the whole document
+        index = self.lpp.node_index
+        if index is not None and index.apply_handlers(self, nodelist):
+            return nodelist
+        return super().preprocess(nodelist)
+
+    def incremental_state(self):
+        return (self.fig_counter, tuple(self.lplx_files_to_finalize))
+
+    def set_incremental_state(self, state):
+        fig_counter, lplx_files_to_finalize = state
+        self.fig_counter = fig_counter
+        self.lplx_files_to_finalize = list(lplx_files_to_finalize)
+
+    def fix_includegraphics(self, n, **kwargs):
+        # note, argspec is '[{'
+
+        # find file and copy it
+        orig_fig_name = self.preprocess_arg_latex(n, 1)
+        orig_fig_name = os_path.join(self.graphicspath, orig_fig_name)
+        for e in self.exts:
+            fname = orig_fig_name+e
+            if self.lpp.note_file_probe(fname, os_path.exists(fname)):
+                orig_fig_name = fname
+                break
+        else:
+            logger.warning("File not found: %s. Tried extensions %r",
+                           orig_fig_name, self.exts)
+            return None # keep the node as it is
+
+        if '.' in orig_fig_name:
+            orig_fig_basename, orig_fig_ext = orig_fig_name.rsplit('.', maxsplit=1)
+            orig_fig_basename = os_path.basename(orig_fig_basename)
+            orig_fig_ext = '.'+orig_fig_ext
+        else:
+            orig_fig_basename, orig_fig_ext = os_path.basename(orig_fig_name), ''
+
+        figoutname = self.fig_rename.format(
+            fig_counter=self.fig_counter,
+            fig_ext=orig_fig_ext,
+            orig_fig_name=orig_fig_name,
+            orig_fig_basename=orig_fig_basename,
+            orig_fig_ext=orig_fig_ext
+        )
+
+        self.lpp.copy_file(orig_fig_name, figoutname)
+
+        if orig_fig_ext in self.post_processors:
+            pp_fn = self.post_processors[orig_fig_ext]
+            pp_fn(
+                node=n,
                 orig_fig_name=orig_fig_name,
                 orig_fig_basename=orig_fig_basename,
-                orig_fig_ext=orig_fig_ext
+                orig_fig_ext=orig_fig_ext,
+                figoutname=figoutname,
             )
 
-            self.lpp.copy_file(orig_fig_name, figoutname)
-
-            if orig_fig_ext in self.post_processors:
-                pp_fn = self.post_processors[orig_fig_ext]
-                pp_fn(
-                    node=n,
-                    orig_fig_name=orig_fig_name,
-                    orig_fig_basename=orig_fig_basename,
-                    orig_fig_ext=orig_fig_ext,
-                    figoutname=figoutname,
-                )
-
-            # increment fig counter
-            self.fig_counter += 1
-
-            # don't use unicode_to_latex(figoutname) because actually we would
-            # like to keep the underscores as is, \includegraphics handles it I
-            # think
-            return (
-                r'\includegraphics' + self.preprocess_latex(self.node_get_arg(n, 0)) + \
-                '{' + figoutname + '}'
-            )
+        # increment fig counter
+        self.fig_counter += 1
 
-        return None
+        # don't use unicode_to_latex(figoutname) because actually we would
+        # like to keep the underscores as is, \includegraphics handles it I
+        # think
+        return self.lpp.nodes.macro(
+            'includegraphics',
+            [ self.preprocess_arg_node(n, 0), figoutname ],
+            parsing_state=n.parsing_state,
+        )
 
 
     def do_postprocess_lplx(self, node, orig_fig_name, figoutname, **kwargs):
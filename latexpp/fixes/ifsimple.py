@@ -60,7 +60,7 @@ class ApplyIf(BaseFix):
                     self.ifnames['if'+ifbasename] = False
                     self.ifswitchnames[ifbasename+'true'] = ('if'+ifbasename, True)
                     self.ifswitchnames[ifbasename+'false'] = ('if'+ifbasename, False)
-                    logger.debug(r"new conditional: ‘\if{}’".format(ifbasename))
+                    logger.debug(r"new conditional: ‘\if%s’", ifbasename)
 
                 # drop the 'newif' node itself.
                 pos += 1
@@ -71,8 +71,11 @@ class ApplyIf(BaseFix):
                 try:
                     poselse, posfi = self.find_matching_elsefi(nodelist, pos+1)
                 except ValueError as e:
-                    logger.warning(r"Can't find matching ‘\else’/‘\fi’ for ‘\{}’: {!r}: {}"
-                                   .format(n.macroname, n, e))
+                    logger.warning(r"Can't find matching ‘\else’/‘\fi’ for ‘\%s’: %r: %s",
+                                   n.macroname, n, e)
+                    # keep the node as it is
+                    newnodelist.append(n)
+                    pos += 1
                     continue
 
                 if self.ifnames[n.macroname]:
@@ -131,19 +134,19 @@ class ApplyIf(BaseFix):
 
 def get_newif_ifbasename(n):
     if not n.nodeargd or not n.nodeargd.argnlist or len(n.nodeargd.argnlist) < 1:
-        logger.warning(r"Cannot parse ‘\newif’ declaration, no argument: {!r}".format(n))
+        logger.warning(r"Cannot parse ‘\newif’ declaration, no argument: %r", n)
         return None
                     
     narg = n.nodeargd.argnlist[0]
     if not narg.isNodeType(LatexMacroNode):
         logger.warning(r"Cannot parse ‘\newif’ declaration, expected single "
-                       r"macro argument: {!r}".format(n))
+                       r"macro argument: %r", n)
         return None
 
     ifname = narg.macroname
     if not ifname.startswith('if'):
         logger.warning(r"Cannot parse ‘\newif’ declaration, new \"if\" name "
-                       r"does not begin with ‘if’: {!r}".format(n))
+                       r"does not begin with ‘if’: %r", n)
         return None
 
     return ifname[2:]
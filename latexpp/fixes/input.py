@@ -4,7 +4,6 @@ import os.path as os_path # allow tests to monkey-patch this
 import logging
 logger = logging.getLogger(__name__)
 
-from pylatexenc.latexwalker import LatexMacroNode
 
 from latexpp.fix import BaseFix
 
@@ -40,47 +39,75 @@ class EvalInput(BaseFix):
         super().__init__()
         self.usepackage = usepackage
 
-    def fix_node(self, n, **kwargs):
+    def handlers(self):
+        handlers = {'input': self.fix_input, 'include': self.fix_input}
+        if self.usepackage:
+            handlers['usepackage'] = self.fix_usepackage
+        return dict(macros=handlers)
 
-        if n.isNodeType(LatexMacroNode) and n.macroname in ('input', 'include'):
-        
-            if not n.nodeargd.argnlist:
-                logger.warning(r"Invalid \input/\include directive: ‘%s’, skipping.",
-                               n.to_latex())
-                return None
+    def fix_input(self, n, **kwargs):
 
-            infname = self.preprocess_arg_latex(n, 0)
+        if not n.nodeargd.argnlist:
+            logger.warning(r"Invalid \input/\include directive: ‘%s’, skipping.",
+                           n.to_latex())
+            return None
 
-            return self.do_input(n, infname, input_exts)
+        infname = self.preprocess_arg_latex(n, 0)
 
-        if (self.usepackage is not None
-            and self.usepackage
-            and n.isNodeType(LatexMacroNode)
-            and n.macroname == 'usepackage'):
-            #
-            # pick up the usepackage argument
-            pkgname = self.preprocess_arg_latex(n, 1) # remember, there's an optional arg
-            
-            if pkgname in self.usepackage:
-                return self.do_input(n, pkgname,
-                                     exts=['', '.sty'])
+        recorder = self.lpp.segment_recorder
+        if recorder is not None and recorder.is_segment(n):
+            # the output of this file is recorded separately, so that a later
+            # incremental run can process the file again on its own (see
+            # latexpp.incremental)
+            with recorder.segment(self, n, infname) as segment:
+                return segment.wrap_nodes(self.do_input(n, infname, input_exts))
+
+        return self.do_input(n, infname, input_exts)
+
+    def fix_usepackage(self, n, **kwargs):
+
+        # pick up the usepackage argument
+        pkgname = self.preprocess_arg_latex(n, 1) # remember, there's an optional arg
+
+        if pkgname in self.usepackage:
+            return self.do_input(n, pkgname,
+                                 exts=['', '.sty'])
 
         return None
 
 
     def do_input(self, n, infname, exts):
 
+        return self.input_file(infname, macroname=n.macroname, exts=exts)
+
+    def input_file(self, infname, *, macroname='input', exts=input_exts):
+        r"""
+        Return the nodes that replace the directive ``\<macroname>{infname}``,
+        i.e., the contents of the file `infname` (tried with each of the
+        extensions `exts` in turn) processed by this fix.  Returns `None` if
+        the file could not be found.
+        """
+
         logger.info("Input ‘%s’", infname)
 
         for e in exts:
             # FIXME: resolve path relative to main document source
-            if os_path.exists(infname+e):
-                infname = infname+e
+            fname = infname+e
+            if self.lpp.note_file_probe(fname, os_path.exists(fname)):
+                infname = fname
                 break
         else:
             logger.warning("File not found: ‘%s’. Tried extensions %r", infname, exts)
             return None # keep the node as it is
 
+        events = self.lpp._events
+        if events is None:
+            return self._do_input_file(macroname, infname)
+        with events.scope('file_start', 'file_end', self.lpp, infname):
+            return self._do_input_file(macroname, infname)
+
+    def _do_input_file(self, macroname, infname):
+
         # open that file and go through it, too
 
         infdata = self._read_file_contents(infname)
@@ -96,12 +123,12 @@ class EvalInput(BaseFix):
 
         # for \include, we need to issue \clearpage.  See
         # https://tex.stackexchange.com/a/32058/32188
-        if n.macroname == 'include':
+        if macroname == 'include':
             infdata = r'\clearpage' + '\n' + infdata
 
         # for \usepackage, surround the contents with '\makeatletter
         # .. \makeatother' and remove '\ProvidesPackage'
-        if n.macroname == 'usepackage':
+        if macroname == 'usepackage':
             infdata = re.sub(r'\\ProvidesPackage\s*\{[^}]+\}\s*(\[(\{[^}]*\}|[^\]]*)\])?',
                              '', infdata)
             infdata = r'\makeatletter' + '\n' + infdata + r'\makeatother' + '\n'
@@ -115,7 +142,7 @@ class EvalInput(BaseFix):
                 e.input_source = 'file ‘{}’'.format(infname)
             raise
 
-        nodes = self.preprocess( lw.get_latex_nodes()[0] )
+        nodes = self.preprocess( self.lpp.parse_nodes(lw) )
         return nodes # replace the input node by the content of the input file
 
         #lw = self.lpp.make_latex_walker(infdata)
@@ -127,6 +154,9 @@ class EvalInput(BaseFix):
         with self.lpp.open_file(infname) as f:
             return f.read()
 
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
 
 
 class CopyInputDeps(BaseFix):
@@ -135,31 +165,34 @@ class CopyInputDeps(BaseFix):
     directory, and run the full collection of fixes on them.
     """
 
-    def fix_node(self, n, **kwargs):
+    def handlers(self):
+        return dict(macros={'input': self.fix_input, 'include': self.fix_input})
 
-        if n.isNodeType(LatexMacroNode) and n.macroname in ('input', 'include'):
-        
-            if not n.nodeargd.argnlist:
-                logger.warning(r"Invalid \input/\include directive: ‘%s’, skipping.",
-                               n.to_latex())
-                return None
+    def fix_input(self, n, **kwargs):
 
-            infname = self.preprocess_arg_latex(n, 0)
+        if not n.nodeargd.argnlist:
+            logger.warning(r"Invalid \input/\include directive: ‘%s’, skipping.",
+                           n.to_latex())
+            return None
 
-            for e in input_exts:
-                if os_path.exists(infname+e):
-                    infname = infname+e
-                    break
-            else:
-                logger.warning("File not found: ‘%s’. Tried extensions %r", infname, input_exts)
-                return None # keep the node as it is
+        infname = self.preprocess_arg_latex(n, 0)
 
-            logger.info("Preprocessing ‘%s’", infname)
+        for e in input_exts:
+            fname = infname+e
+            if self.lpp.note_file_probe(fname, os_path.exists(fname)):
+                infname = fname
+                break
+        else:
+            logger.warning("File not found: ‘%s’. Tried extensions %r", infname, input_exts)
+            return None # keep the node as it is
 
-            # copy file to output while running our whole selection of fixes on
-            # it!  Recurse into a full instantiation of lpp.execute_file().
-            self.lpp.execute_file(infname, output_fname=infname)
+        logger.info("Preprocessing ‘%s’", infname)
 
-            return None # don't change the \input directive
+        # copy file to output while running our whole selection of fixes on
+        # it!  Recurse into a full instantiation of lpp.execute_file().
+        self.lpp.execute_file(infname, output_fname=infname)
 
-        return None
+        return None # don't change the \input directive
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
@@ -111,7 +111,8 @@ class RenameLabels(BaseMultiStageFix):
 
         self.renamed_labels = {} # oldname: newname
         
-        self.add_stage(self.CollectLabels(self))
+        self.collect_labels_stage = self.CollectLabels(self)
+        self.add_stage(self.collect_labels_stage)
         self.add_stage(self.ReplaceRefs(self))
 
 
@@ -126,6 +127,22 @@ class RenameLabels(BaseMultiStageFix):
         #all_macros = list(all_macros); logger.debug("Macros = %r", all_macros)
         return dict(macros=all_macros)
 
+    def incremental_state(self):
+        collect = self.collect_labels_stage
+        return (
+            tuple(collect.collected_labels),
+            tuple(collect.phfthm_hack_collected_proof_labels),
+            tuple(self.renamed_labels.items()),
+        )
+
+    def set_incremental_state(self, state):
+        collected_labels, phfthm_hack_collected_proof_labels, renamed_labels = state
+        collect = self.collect_labels_stage
+        collect.collected_labels = list(collected_labels)
+        collect.phfthm_hack_collected_proof_labels = \
+            list(phfthm_hack_collected_proof_labels)
+        self.renamed_labels = dict(renamed_labels)
+
 
     class CollectLabels(BaseMultiStageFix.Stage):
         def __init__(self, parent_fix, **kwargs):
@@ -133,40 +150,69 @@ class RenameLabels(BaseMultiStageFix):
             self.collected_labels = []
             self.phfthm_hack_collected_proof_labels = []
 
-        def fix_node(self, n, **kwargs):
+        def preprocess(self, nodelist):
+            symbols = self.lpp.symbols
+            if symbols.root is not nodelist \
+               or self.lpp.segment_recorder is not None:
+                # not the document being processed, walk through it ourselves.
+                # Also walk through it when recording the labels collected
+                # at the boundaries of each \input file (see
+                # latexpp.incremental).
+                return super().preprocess(nodelist)
+
+            # the labels of the document are in the preprocessor's symbol
+            # tables, no need to scan the document
+            pf = self.parent_fix
+            for entry in symbols.labels:
+                if entry.node.macroname in pf.labelcmds:
+                    self._collect_label(entry.name)
+            if pf.hack_phfthm_proofs:
+                for occ in self.lpp.node_index.find(environments=['proof']):
+                    self.fix_proof(occ.node)
+            return nodelist
+
+        def handlers(self):
+            pf = self.parent_fix
+            handlers = dict(macros={m: self.fix_label for m in pf.labelcmds})
+            if pf.hack_phfthm_proofs:
+                handlers['environments'] = {'proof': self.fix_proof}
+            return handlers
+
+        def fix_label(self, n, **kwargs):
 
             pf = self.parent_fix
 
-            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname in pf.labelcmds:
-                labelname = n.macroname
-                label_args = pf.labelcmds[labelname]['label_args']
+            labelname = n.macroname
+            label_args = pf.labelcmds[labelname]['label_args']
+
+            for lblarg in label_args:
+                if n.nodeargd is not None and len(n.nodeargd.argnlist) >= lblarg:
+                    # collect argument as a label
+                    self._collect_label(self.preprocess_arg_latex(n, lblarg))
+
+        def _collect_label(self, labelname):
+            if labelname in self.collected_labels:
+                logger.warning("Duplicate label encountered ‘%s’", labelname)
+            else:
+                self.collected_labels.append( labelname )
 
-                for lblarg in label_args:
-                    if n.nodeargd is not None and len(n.nodeargd.argnlist) >= lblarg:
-                        # collect argument as a label
-                        labelname = self.preprocess_arg_latex(n, lblarg)
-                        if labelname in self.collected_labels:
-                            logger.warning("Duplicate label encountered ‘%s’", labelname)
-                        else:
-                            self.collected_labels.append( labelname )
+        def fix_proof(self, n, **kwargs):
+
+            pf = self.parent_fix
 
             # pick out the proof label, if applicable, to register the
             # `proof:XXX` label for replacement as well.  The user can then
             # do stuff like ``The proof of \cref{thm:XXX} can be found on
             # page \cpageref{proof:thm:XXX}``.
-            if pf.hack_phfthm_proofs and n.isNodeType(latexwalker.LatexEnvironmentNode) \
-               and n.environmentname == 'proof':
-
-                if n.nodeargd.argnlist and len(n.nodeargd.argnlist) and n.nodeargd.argnlist[0]:
-                    proofarg = pf.arg_to_latex(n.nodeargd.argnlist[0]).strip()
-                    proofthmlabel = None
-                    if proofarg.startswith('**'):
-                        proofthmlabel = proofarg[2:]
-                    elif proofarg.startswith('*'):
-                        proofthmlabel = proofarg[1:]
-                    if proofthmlabel:
-                        self.phfthm_hack_collected_proof_labels.append(proofthmlabel)
-            
+            if n.nodeargd.argnlist and len(n.nodeargd.argnlist) and n.nodeargd.argnlist[0]:
+                proofarg = pf.arg_to_latex(n.nodeargd.argnlist[0]).strip()
+                proofthmlabel = None
+                if proofarg.startswith('**'):
+                    proofthmlabel = proofarg[2:]
+                elif proofarg.startswith('*'):
+                    proofthmlabel = proofarg[1:]
+                if proofthmlabel:
+                    self.phfthm_hack_collected_proof_labels.append(proofthmlabel)
 
         def stage_finish(self):
             # rename all labels
@@ -211,37 +257,46 @@ class RenameLabels(BaseMultiStageFix):
                 if argi_n is not None and argi_n.isNodeType(latexwalker.LatexGroupNode):
                     # use same "group" delimiters as before
                     delims = argi_n.delimiters
-                n.nodeargd.argnlist[arg_i] = n.parsing_state.lpp_latex_walker.make_node(
-                    latexwalker.LatexGroupNode,
-                    nodelist=[n.parsing_state.lpp_latex_walker.make_node(
-                        latexwalker.LatexCharsNode,
-                        chars=newlblarg,
-                        parsing_state=n.parsing_state,
-                        pos=None, len=None,
-                    )],
+                n.nodeargd.argnlist[arg_i] = self.lpp.nodes.group(
+                    newlblarg,
                     delimiters=delims,
                     parsing_state=n.parsing_state,
-                    pos=None, len=None
                 )
 
-        def fix_node(self, n, **kwargs):
+        def preprocess(self, nodelist):
+            # only label and reference commands matter, have the document's
+            # node index find them instead of walking through the whole
+            # document
+            index = self.lpp.node_index
+            if index is not None and index.apply_handlers(self, nodelist):
+                return nodelist
+            return super().preprocess(nodelist)
+
+        def handlers(self):
             pf = self.parent_fix
-            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname in pf.refcmds:
+            handlers = dict(macros={m: self.fix_ref_or_label
+                                    for m in list(pf.refcmds) + list(pf.labelcmds)})
+            if pf.hack_phfthm_proofs:
+                handlers['environments'] = {'proof': self.fix_proof}
+            return handlers
+
+        def fix_ref_or_label(self, n, **kwargs):
+            pf = self.parent_fix
+            if n.macroname in pf.refcmds:
                 refname = n.macroname
                 label_args = pf.refcmds[refname]['label_args']
                 self.preprocess_child_nodes(n)
                 self.replace_node_args(n, label_args)
-            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname in pf.labelcmds:
+            if n.macroname in pf.labelcmds:
                 labelname = n.macroname
                 label_args = pf.labelcmds[labelname]['label_args']
                 self.preprocess_child_nodes(n)
                 self.replace_node_args(n, label_args)
 
-            if pf.hack_phfthm_proofs and n.isNodeType(latexwalker.LatexEnvironmentNode) \
-               and n.environmentname == 'proof':
-                self.preprocess_child_nodes(n)
-                self.replace_node_args(n, [0], preserve_prefixes=('**','*',))
-            
+        def fix_proof(self, n, **kwargs):
+            self.preprocess_child_nodes(n)
+            self.replace_node_args(n, [0], preserve_prefixes=('**','*',))
+
 
     def arg_to_latex(self, n):
         if n is None:
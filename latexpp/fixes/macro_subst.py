@@ -105,13 +105,13 @@ class Subst(BaseFix):
     def specs(self, **kwargs):
         return dict(**self.helper.get_specs())
 
-    def fix_node(self, n, **kwargs):
+    def handlers(self):
+        return self.helper.get_handlers(self.fix_subst)
 
-        c = self.helper.get_node_cfg(n)
-        if c is not None:
-            return self.helper.eval_subst(
-                c, n,
-                node_contents_latex=self.preprocess_contents_latex
-            )
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
+    def fix_subst(self, n, **kwargs):
 
-        return None
+        c = self.helper.get_node_cfg(n)
+        return self.helper.eval_subst_nodes(c, n, fix=self)
@@ -34,6 +34,9 @@ class ApplyPoorMan(BaseFix):
     def __init__(self):
         super().__init__()
 
+    def triggers(self):
+        return dict()
+
     def fix_node(self, n, **kwargs):
         return None
 
@@ -47,7 +50,7 @@ class ApplyPoorMan(BaseFix):
         self.lpp.check_autofile_up_to_date(sedfn)
 
         replacements = []
-        with open(sedfn) as sedf:
+        with self.lpp.open_file(sedfn) as sedf:
             for sedline in sedf:
                 sedline = sedline.strip()
                 if sedline:
@@ -38,6 +38,9 @@ class Expand(BaseFix):
             SpecialsSpec('`', args_parser=PhfParenSpecialsArgsParser())
         ])
 
+    def triggers(self):
+        return dict(specials=['`'])
+
     def fix_node(self, n, **kwargs):
 
         if n.isNodeType(latexwalker.LatexSpecialsNode) and n.specials_chars == '`':
@@ -185,6 +185,9 @@ class ExpandQitObjects(BaseFix):
             )
         )
 
+    def triggers(self):
+        return dict(macros=list(_fixed_repl.keys()) + list(self.qitobjs.keys()))
+
     def qitargspec(self, t):
         return {
             "IdentProc": "`[[{",
@@ -836,6 +839,9 @@ class ExpandMacros(BaseFix):
         # get specs from substitution helper
         return dict(**self.substitution_helper.get_specs())
 
+    def triggers(self):
+        return self.substitution_helper.get_triggers()
+
     def add_preamble(self):
         preamble = ""
         if self.llanglefrommnsymbolfonts:
@@ -966,19 +972,19 @@ class ExpandMacros(BaseFix):
                                delimsize=delimsize,
                                close_delim=delims_pc[1]%delimchars[1],
                                **self.subst_space)
-                return self.substitution_helper.eval_subst(
+                return self.substitution_helper.eval_subst_nodes(
                     c,
                     n,
-                    node_contents_latex=self.preprocess_contents_latex,
+                    fix=self,
                     argoffset=3,
                     context=context,
                     arg_filters=_arg_filters,
                 )
 
-            return self.substitution_helper.eval_subst(
+            return self.substitution_helper.eval_subst_nodes(
                 c,
                 n,
-                node_contents_latex=self.preprocess_contents_latex,
+                fix=self,
                 arg_filters=_arg_filters,
             )
                 
@@ -30,6 +30,9 @@ class Expand(BaseFix):
         self.use_shared_counter = use_shared_counter
         self.define_thmheading = define_thmheading
 
+    def triggers(self):
+        return dict(macros=['noproofref'], environments=list(self.proofenvs.keys()))
+
     def add_preamble(self):
 
         p = [ ]
@@ -1,4 +1,6 @@
 
+import os.path
+
 from latexpp.fix import BaseFix
 
 
@@ -9,15 +11,35 @@ class AddPreamble(BaseFix):
     Arguments:
 
       - `preamble`: the additional code to include before ``\begin{document}``.
+
+      - `fromfile`: the name of a file whose contents are included before
+        ``\begin{document}`` (after `preamble`, if both are specified).
+
+      - `verbatim`: if `True`, then the code is copied to the output exactly as
+        is, without being parsed or processed by any fixes.  By default, the
+        added code is processed by all fixes like the rest of the document.
     """
-    def __init__(self, preamble=None, fromfile=None):
+    def __init__(self, preamble=None, fromfile=None, verbatim=False):
         super().__init__()
         self.preamble = preamble
-        if fromfile:
-            with open(fromfile) as f:
-                if self.preamble and self.preamble[-1:] != "\n":
-                    self.preamble += "\n"
-                self.preamble += f.read()
+        self.verbatim = verbatim
+        # resolve relative to the current directory, as before; the file is
+        # read in initialize() through the preprocessor so that the read is
+        # reported to observers (e.g., in the run's manifest)
+        self.fromfile = os.path.abspath(fromfile) if fromfile else None
+
+    def initialize(self):
+        if self.fromfile:
+            with self.lpp.open_file(self.fromfile) as f:
+                contents = f.read()
+            if self.preamble and self.preamble[-1:] != "\n":
+                self.preamble += "\n"
+            self.preamble = (self.preamble or '') + contents
 
     def add_preamble(self, **kwargs):
+        if self.verbatim and self.preamble:
+            return self.lpp.nodes.verbatim(self.preamble)
         return self.preamble
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
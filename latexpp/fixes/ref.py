@@ -13,7 +13,7 @@ from pylatexenc import latexwalker
 
 from latexpp.fix import BaseFix
 
-from .usepackage import node_get_usepackage # for detecting \usepackage{cleveref}
+from .usepackage import node_get_usepackage, usepackage_handlers # for detecting \usepackage{cleveref}
 
 
 # Note this _REFCMDS object is also used in the fix ./labels.py
@@ -232,8 +232,16 @@ class ExpandRefs(BaseFix):
 
         #logger.debug("".join([n.to_latex() for n in nodelist]))
 
-        # there is no reason newnodelist should differ from nodelist, BTW
-        newnodelist = super().preprocess(nodelist)
+        symbols = self.lpp.symbols
+        if symbols.root is nodelist:
+            # the reference commands of the document are in the preprocessor's
+            # symbol tables, no need to walk through the document
+            for n in symbols.refs.nodes():
+                self._collect_ref_cmd(n)
+            newnodelist = nodelist
+        else:
+            # there is no reason newnodelist should differ from nodelist, BTW
+            newnodelist = super().preprocess(nodelist)
 
         #logger.debug("".join([n.to_latex() for n in newnodelist]))
 
@@ -244,15 +252,21 @@ class ExpandRefs(BaseFix):
         
         self.stage = "replace-crefs"
 
+        index = self.lpp.node_index
+        if index is not None and index.apply_handlers(self, newnodelist):
+            # the document's node index finds the reference commands for us,
+            # no need to walk through the document
+            return newnodelist
+
         return super().preprocess(newnodelist)
 
     def _get_doc_preamble(self, doc_nodelist):
         #
         # Use original, unmodifed doc preamble.  So we have sections removed by
-        # %%!lpp skip pragmas, etc. -- it's just safer
+        # %%!lpp skip pragmas, etc. -- it's just safer.  (The preprocessor
+        # keeps the contents of the main file, so we don't read it again.)
         #
-        with self.lpp.open_file(self.lpp.main_doc_fname) as f:
-            full_raw_doc_contents = f.read()
+        full_raw_doc_contents = self.lpp.symbols.main_doc_source()
 
         # Minor caveat -- \begin{document} must be in the main latex file (but
         # we can probably ignore the rare edge cases).
@@ -279,35 +293,48 @@ class ExpandRefs(BaseFix):
         return "".join([n.to_latex() for n in preamblelist])
 
 
-    def fix_node(self, n, **kwargs):
+    def handlers(self):
+        macros = {}
+        if self.remove_usepackage_cleveref:
+            macros.update(usepackage_handlers(self.fix_usepackage)['macros'])
+        for reftype in self.ref_types:
+            for macroname in self.cmd_macros[reftype]:
+                macros[macroname] = self.fix_ref_cmd
+        return dict(macros=macros)
+
+    def fix_ref_cmd(self, n, **kwargs):
         if self.stage == "collect-refs":
 
-            if n.isNodeType(latexwalker.LatexMacroNode):
-                for reftype in self.ref_types:
-                    if n.macroname in self.cmd_macros[reftype]:
-                        if self._check_prefix(reftype, n):
-                            self.collected_cmds[reftype].append(n.to_latex())
+            self._collect_ref_cmd(n)
 
         elif self.stage == "replace-crefs":
 
-            if n.isNodeType(latexwalker.LatexMacroNode):
-                if self.remove_usepackage_cleveref:
-                    if node_get_usepackage(n, self) == 'cleveref':
-                        return [] # remove this macro invocation
-
-                for reftype in self.ref_types:
-                    if n.macroname in self.cmd_macros[reftype]:
-                        ltx = n.to_latex()
-                        if ltx not in self.resolved_cmds[reftype]:
-                            # probably not the requested prefix
-                            return None
-                        return self.resolved_cmds[reftype][ltx]
+            for reftype in self.ref_types:
+                if n.macroname in self.cmd_macros[reftype]:
+                    ltx = n.to_latex()
+                    if ltx not in self.resolved_cmds[reftype]:
+                        # probably not the requested prefix
+                        return None
+                    return self.resolved_cmds[reftype][ltx]
 
         else:
             raise RuntimeError("Invalid self.stage = {}".format(self.stage))
 
         return None # keep node as is & descend into children
 
+    def _collect_ref_cmd(self, n):
+        for reftype in self.ref_types:
+            if n.macroname in self.cmd_macros[reftype]:
+                if self._check_prefix(reftype, n):
+                    self.collected_cmds[reftype].append(n.to_latex())
+
+    def fix_usepackage(self, n, **kwargs):
+        if self.stage == "replace-crefs":
+            if node_get_usepackage(n, self) == 'cleveref':
+                return [] # remove this macro invocation
+
+        return None
+
 
     def _check_prefix(self, reftype, n):
         if n.nodeargd is None or n.nodeargd.argnlist is None:
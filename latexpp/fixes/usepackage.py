@@ -21,6 +21,14 @@ def node_get_usepackage(n, fix):
         return fix.preprocess_arg_latex(n, 1).strip()
     return None
 
+def usepackage_handlers(handler):
+    """
+    Return a suitable value for :py:meth:`latexpp.fix.BaseFix.handlers()` for
+    fixes that only act on nodes recognized by :py:func:`node_get_usepackage()`,
+    routing all these nodes to `handler`.
+    """
+    return dict(macros={"usepackage": handler, "RequirePackage": handler})
+
 
 class RemovePkgs(BaseFix):
     r"""
@@ -41,7 +49,7 @@ class RemovePkgs(BaseFix):
         super().__init__()
         self.pkglist = set(pkglist)
 
-    def fix_node(self, n, **kwargs):
+    def fix_usepackage(self, n, **kwargs):
 
         pkgname = node_get_usepackage(n, self)
         if pkgname is not None and pkgname in self.pkglist:
@@ -55,6 +63,12 @@ class RemovePkgs(BaseFix):
             "macros": [std_macro("RequirePackage", True, 1)]
         }
 
+    def handlers(self):
+        return usepackage_handlers(self.fix_usepackage)
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
 
 class CopyLocalPkgs(BaseFix):
     r"""
@@ -98,12 +112,12 @@ class CopyLocalPkgs(BaseFix):
         else:
             self.subpp = None
 
-    def fix_node(self, n, **kwargs):
+    def fix_usepackage(self, n, **kwargs):
 
         pkgname = node_get_usepackage(n, self)
         if pkgname is not None and pkgname not in self.blacklist:
             pkgnamesty = pkgname + '.sty'
-            if os_path.exists(pkgnamesty):
+            if self.lpp.note_file_probe(pkgnamesty, os_path.exists(pkgnamesty)):
                 self.lpp.copy_file(pkgnamesty, destfname=pkgnamesty)
                 if self.recursive:
                     with self.subpp.open_file(pkgnamesty) as f:
@@ -124,6 +138,12 @@ class CopyLocalPkgs(BaseFix):
             "macros": [std_macro("RequirePackage", True, 1)]
         }
 
+    def handlers(self):
+        return usepackage_handlers(self.fix_usepackage)
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
+
     def finalize(self):
         if self.finalized:
             return
@@ -184,12 +204,12 @@ class InputLocalPkgs(BaseFix):
 
         self.subpp.initialize()
 
-    def fix_node(self, n, **kwargs):
+    def fix_usepackage(self, n, **kwargs):
 
         pkgname = node_get_usepackage(n, self)
         if pkgname is not None and pkgname in self.packages:
             pkgnamesty = pkgname + '.sty'
-            if os_path.exists(pkgnamesty):
+            if self.lpp.note_file_probe(pkgnamesty, os_path.exists(pkgnamesty)):
                 logger.debug("Processing input package ‘%s’", pkgnamesty)
                 with self.lpp.open_file(pkgnamesty) as f:
                     pkgcontents = f.read()
@@ -210,3 +230,9 @@ class InputLocalPkgs(BaseFix):
         return {
             "macros": [std_macro("RequirePackage", True, 1)]
         }
+
+    def handlers(self):
+        return usepackage_handlers(self.fix_usepackage)
+
+    def incremental_state(self):
+        return () # nothing is accumulated, see latexpp.incremental
@@ -0,0 +1,715 @@
+r"""
+Incremental runs: when only some ``\input`` files of the main document
+changed since the last run, process only these files again and splice their
+new output into the previous output, instead of processing the whole
+document.
+
+With the :py:class:`latexpp.fixes.input.EvalInput` fix, the output is a
+concatenation of pieces of processed code that come from many source files.
+An incremental run (:py:class:`IncrementalBuild`, or the ``latexpp
+--incremental`` option) records, for each ``\input`` or ``\include``
+directive at the top level of the main document or of its ``document``
+environment (each *segment*):
+
+- the part of the output that replaced the directive;
+
+- the source files that were read, copied or looked for while processing the
+  segment (those read outside of any segment, e.g. the main document itself
+  or a ``.bbl`` file copied in the preamble, are global);
+
+- a snapshot of the state of each fix at the beginning and at the end of the
+  segment (see :py:meth:`latexpp.fix.BaseFix.incremental_state()`), e.g. the
+  labels collected so far by :py:class:`latexpp.fixes.labels.RenameLabels`,
+  the figure counter of :py:class:`latexpp.fixes.figures.CopyAndRenameFigs`,
+  or the aliases defined by :py:class:`latexpp.fixes.bib.ApplyAliases`.
+
+along with a manifest of the run (see :py:mod:`latexpp.manifest`).  On the
+next run, if only files that belong to segments changed, each of these
+segments is processed again on its own: the fixes that come after the
+`EvalInput` fix are given back the state they had at the beginning of the
+segment, and must end up in the state they had at the end of the segment.
+The new output of the segments is then spliced into the previous output.
+
+The whole document is processed instead if
+
+- the configuration, the fixes, the versions of `latexpp` or `pylatexenc` or
+  a global file changed, or an output file was modified (see
+  :py:meth:`latexpp.manifest.RunManifest.check()`);
+
+- processing a segment changed the state of a fix at the end of the segment,
+  i.e., the change may affect the rest of the document (for instance, a label
+  or a figure was added);
+
+- some fix does not support incremental runs (see
+  :py:meth:`latexpp.fix.BaseFix.incremental_state()`); in that case nothing
+  is recorded at all.
+
+In an incremental run, the nodes between the segment markers are processed as
+node lists of their own (see
+:py:class:`latexpp._lpp_traversal.SegmentTrackingMixin`), so that a segment
+processed on its own gives the same output as in the run that recorded it.
+Fixes are not fused (see
+:py:attr:`latexpp.preprocessor.LatexPreprocessor.fuse_fixes`).
+
+Use an :py:class:`IncrementalBuild` like this::
+
+  build = IncrementalBuild(lpp, 'build.incremental.pickle', config_hash=...)
+  build.start()
+  lpp.initialize()
+  build.execute_main()   # instead of lpp.execute_main()
+  lpp.finalize()
+  build.stop()
+  build.save()
+
+.. warning::
+
+   The record of a run is stored with :py:mod:`pickle`, and loading it can run
+   arbitrary code.  Only use record files that no untrusted user can write to.
+"""
+
+import os
+import os.path
+import re
+import pickle
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+from pylatexenc import latexwalker
+
+from .fix import BaseMultiStageFix
+from .events import PreprocessorObserver
+from ._lpp_parsing import LatexSegmentMarkerNode
+from .manifest import ManifestRecorder, hash_file, _base_dir, _relpath
+
+
+# bump this whenever the format of the record changes
+RECORD_FORMAT = 1
+
+_rx_segment_sentinel = re.compile('\x00lpp-segment:(\\d+):(begin|end)\x00')
+
+
+class Segment:
+    r"""
+    The record of the ``\input`` directive number `index` of the main
+    document (see :py:mod:`latexpp.incremental`).
+
+    .. py:attribute:: macroname
+
+       The name of the directive, ``'input'`` or ``'include'``.
+
+    .. py:attribute:: infname
+
+       The file name given to the directive.
+
+    .. py:attribute:: fix_index
+
+       The index, in the preprocessor's list of fixes, of the
+       :py:class:`~latexpp.fixes.input.EvalInput` fix that evaluated the
+       directive.
+
+    .. py:attribute:: files
+
+       The set of the source files that were read, copied or looked for while
+       processing the segment, relative to the directory of the record file.
+
+    .. py:attribute:: states
+
+       The snapshots of the states of the fixes, as a dictionary ``{(fix
+       index, stage index, kind): state}``, where `kind` is ``'begin'`` or
+       ``'end'`` and the stage index is `None` for fixes that are not
+       multi-stage fixes.
+
+    .. py:attribute:: span
+
+       The ``(start, end)`` positions of the output of the segment in the
+       output of the main document (without the heading comment), or `None`
+       if it isn't known.
+
+    .. py:attribute:: reusable
+
+       Whether the segment can be processed on its own in a later run, i.e.,
+       whether its span and all the snapshots of the fixes that come after
+       :py:attr:`fix_index` are known.
+    """
+    def __init__(self, index, macroname, infname, fix_index):
+        super().__init__()
+        self.index = index
+        self.macroname = macroname
+        self.infname = infname
+        self.fix_index = fix_index
+        self.files = set()
+        self.states = {}
+        self.span = None
+        self.reusable = False
+
+    def __repr__(self):
+        return "<{} #{} \\{}{{{}}}>".format(self.__class__.__name__, self.index,
+                                           self.macroname, self.infname)
+
+
+class SegmentRecorder(PreprocessorObserver):
+    r"""
+    Records the segments of the main document processed by the preprocessor
+    `lpp` (see :py:mod:`latexpp.incremental`).  The recorder is set as the
+    preprocessor's :py:attr:`~latexpp.preprocessor.LatexPreprocessor.segment_recorder`
+    and registered as an observer, to attribute the files that are read to
+    the segment being processed.  File names are stored relative to the
+    directory of `record_fname`.
+
+    The preprocessor calls :py:meth:`start_document()`,
+    :py:meth:`find_segments()` and :py:meth:`end_document()` when it
+    processes the main document, the
+    :py:class:`~latexpp.fixes.input.EvalInput` fix surrounds the nodes of
+    each segment with markers (see :py:meth:`is_segment()` and
+    :py:meth:`segment()`), and the walks of the fixes through the document
+    report the markers to :py:meth:`marker_reached()`.
+
+    .. py:attribute:: segments
+
+       The list of the :py:class:`Segment` instances of the main document.
+
+    .. py:attribute:: global_files
+
+       The set of the source files that were read, copied or looked for
+       outside of any segment.
+
+    .. py:attribute:: output_text
+
+       The output of the main document, without the heading comment, once
+       it has been written.
+
+    .. py:attribute:: current
+
+       The segment being processed, to which files that are read are
+       attributed, or `None`.
+    """
+    def __init__(self, lpp, record_fname):
+        super().__init__()
+        self.lpp = lpp
+        self.base_dir = _base_dir(record_fname)
+
+        self.segments = []
+        self.global_files = set()
+        self.output_text = None
+        self.current = None
+
+        # the \input nodes whose output is recorded, {id(node): node}
+        self._segment_nodes = None
+        # {id(fix or stage): (fix index, stage index)}
+        self._fix_locations = None
+
+    def start_document(self):
+        r"""
+        Called by the preprocessor when it starts processing the main document.
+        """
+        self._segment_nodes = {}
+
+    def find_segments(self, nodelist):
+        r"""
+        Called by the preprocessor with the nodes of the main document, before
+        any fix runs.  Picks the ``\input`` and ``\include`` directives at the
+        top level of the document or of its ``document`` environment.
+        """
+        if self._segment_nodes is None or self._segment_nodes:
+            # not the main document, or already done
+            return
+        for n in nodelist:
+            if n is None:
+                continue
+            if n.isNodeType(latexwalker.LatexEnvironmentNode) \
+               and n.environmentname == 'document':
+                for nn in n.nodelist:
+                    self._add_segment_node(nn)
+            else:
+                self._add_segment_node(n)
+
+    def _add_segment_node(self, n):
+        if n is not None and n.isNodeType(latexwalker.LatexMacroNode) \
+           and n.macroname in ('input', 'include'):
+            self._segment_nodes[id(n)] = n
+
+    def is_segment(self, n):
+        r"""
+        Return `True` if the output of the ``\input`` node `n` should be
+        recorded as a segment.
+        """
+        return bool(self._segment_nodes) and id(n) in self._segment_nodes
+
+    @contextlib.contextmanager
+    def segment(self, fix, n, infname):
+        r"""
+        Context manager for evaluating the ``\input`` node `n`, with file name
+        `infname`, by the fix `fix`.  Yields a helper object whose method
+        `wrap_nodes(nodes)` returns the replacement nodes `nodes` surrounded
+        by the markers of the segment (or `None` if `nodes` is `None`).
+        """
+        del self._segment_nodes[id(n)]
+        segment = Segment(len(self.segments), n.macroname, infname,
+                          self._locate_fix(fix)[0])
+        self.segments.append(segment)
+        self.current = segment
+        try:
+            yield _SegmentNodesWrapper(segment, n.parsing_state)
+        finally:
+            self.current = None
+
+    def marker_reached(self, fix, marker):
+        r"""
+        Called by the walk of the fix (or stage) `fix` through the document
+        when it reaches a segment marker.  Takes a snapshot of the state of
+        the fix.
+        """
+        segment = self.segments[marker.segment]
+        self.current = segment if marker.kind == 'begin' else None
+        k, s = self._locate_fix(fix)
+        if k is None:
+            # a built-in fix, e.g. for pragmas
+            return
+        segment.states[(k, s, marker.kind)] = \
+            self.lpp.fixes[k].incremental_state()
+
+    def end_document(self, text):
+        r"""
+        Called by the preprocessor with the output `text` of the main document,
+        without the heading comment.  Removes the segment markers, notes the
+        positions of the segments, and returns the resulting output.
+        """
+        self._segment_nodes = None
+
+        pieces = []
+        spans = {}
+        duplicates = set()
+        pos = 0
+        length = 0
+        for m in _rx_segment_sentinel.finditer(text):
+            pieces.append(text[pos:m.start()])
+            length += m.start() - pos
+            pos = m.end()
+            i, kind = int(m.group(1)), m.group(2)
+            span = spans.setdefault(i, [None, None])
+            if span[kind == 'end'] is not None:
+                duplicates.add(i)
+            span[kind == 'end'] = length
+        pieces.append(text[pos:])
+        self.output_text = ''.join(pieces)
+
+        # segments must be complete and must not overlap
+        last_end = 0
+        for i, (start, end) in sorted(spans.items(),
+                                      key=lambda x: (x[1][0] is None, x[1][0])):
+            if i in duplicates or start is None or end is None \
+               or start < last_end or end < start or i >= len(self.segments):
+                logger.debug("Can't locate the output of segment #%d", i)
+                continue
+            self.segments[i].span = (start, end)
+            last_end = end
+
+        return self.output_text
+
+    def check_segments(self):
+        r"""
+        Determine which segments are reusable (see :py:attr:`Segment.reusable`).
+        """
+        fixes = self.lpp.fixes
+        for segment in self.segments:
+            segment.reusable = segment.span is not None and all(
+                (k, s, kind) in segment.states
+                for k in range(segment.fix_index+1, len(fixes))
+                for s, stage in fix_stages(fixes[k])
+                for kind in ('begin', 'end')
+            )
+
+    def _locate_fix(self, fix):
+        if self._fix_locations is None:
+            self._fix_locations = {}
+            for k, f in enumerate(self.lpp.fixes):
+                for s, stage in fix_stages(f):
+                    self._fix_locations[id(stage)] = (k, s)
+        return self._fix_locations.get(id(fix), (None, None))
+
+    def _add_file(self, lpp, fname):
+        relname = _relpath(lpp._resolve_source_fname(fname), self.base_dir)
+        if self.current is not None:
+            self.current.files.add(relname)
+        else:
+            self.global_files.add(relname)
+
+    #
+    # PreprocessorObserver events
+    #
+
+    def file_read(self, lpp, fname):
+        self._add_file(lpp, fname)
+
+    def file_copied(self, lpp, source, destfname):
+        self._add_file(lpp, source)
+
+    def file_probed(self, lpp, fname, exists):
+        self._add_file(lpp, fname)
+
+
+class _SegmentNodesWrapper:
+    def __init__(self, segment, parsing_state):
+        super().__init__()
+        self.segment = segment
+        self.parsing_state = parsing_state
+
+    def wrap_nodes(self, nodes):
+        if nodes is None:
+            return None
+        i = self.segment.index
+        return [ LatexSegmentMarkerNode(i, 'begin', parsing_state=self.parsing_state) ] \
+            + list(nodes) \
+            + [ LatexSegmentMarkerNode(i, 'end', parsing_state=self.parsing_state) ]
+
+
+def fix_stages(fix):
+    r"""
+    Return a list of tuples ``(stage index, stage)`` for the fix `fix`: its
+    stages for a :py:class:`latexpp.fix.BaseMultiStageFix`, otherwise the
+    single tuple ``(None, fix)``.
+    """
+    if isinstance(fix, BaseMultiStageFix):
+        return list(enumerate(fix._fix_stages))
+    return [ (None, fix) ]
+
+
+def fix_supports_incremental(fix):
+    r"""
+    Return `True` if the fix `fix` supports incremental runs (see
+    :py:meth:`latexpp.fix.BaseFix.incremental_state()`).
+    """
+    return fix.incremental_state() is not None
+
+
+class IncrementalRecord:
+    r"""
+    What an incremental run records for the next one (see
+    :py:mod:`latexpp.incremental`).
+
+    .. py:attribute:: manifest
+
+       The :py:class:`latexpp.manifest.RunManifest` of the run.  Its file
+       names are relative to the directory of the record file.
+
+    .. py:attribute:: output_fname
+
+       The name of the main document's output file, relative to the output
+       directory.
+
+    .. py:attribute:: output_text
+
+       The output of the main document, without the heading comment.
+
+    .. py:attribute:: segments
+
+       The list of :py:class:`Segment` instances.
+
+    .. py:attribute:: global_files
+
+       The set of the source files that don't belong to any segment.
+
+    .. py:attribute:: final_states
+
+       The snapshots of the states of all fixes once the main document was
+       processed, restored before the fixes are finalized.
+
+    .. py:attribute:: output_files
+
+       The files written to the output directory (see
+       :py:attr:`latexpp.preprocessor.LatexPreprocessor.output_files`).
+    """
+    def __init__(self, *, manifest, output_fname, output_text, segments,
+                 global_files, final_states, output_files):
+        super().__init__()
+        self.manifest = manifest
+        self.output_fname = output_fname
+        self.output_text = output_text
+        self.segments = list(segments)
+        self.global_files = set(global_files)
+        self.final_states = list(final_states)
+        self.output_files = list(output_files)
+
+    def save(self, fname):
+        r"""
+        Save the record to the file `fname`.
+        """
+        tmpfname = fname + '.tmp'
+        with open(tmpfname, 'wb') as f:
+            pickle.dump((RECORD_FORMAT, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        r"""
+        Load a record saved with :py:meth:`save()`.  Returns `None` if the file
+        doesn't exist or isn't a valid record.
+        """
+        try:
+            with open(fname, 'rb') as f:
+                fmt, record = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+                ValueError, TypeError) as e:
+            logger.warning("Ignoring invalid incremental run record ‘%s’: %s",
+                           fname, e)
+            return None
+        if fmt != RECORD_FORMAT or not isinstance(record, cls):
+            logger.warning("Ignoring incremental run record ‘%s’ in an "
+                           "unsupported format", fname)
+            return None
+        return record
+
+
+class _CannotSplice(Exception):
+    pass
+
+
+class IncrementalBuild:
+    r"""
+    Process the main document of the preprocessor `lpp` incrementally (see
+    :py:mod:`latexpp.incremental`), using the record of the previous run
+    stored in the file `record_fname`.  The `config_hash` is the hash of the
+    run's configuration (see :py:func:`latexpp.manifest.hash_config()`).
+
+    Call :py:meth:`start()` after installing the fixes but before calling the
+    preprocessor's :py:meth:`~latexpp.preprocessor.LatexPreprocessor.initialize()`,
+    call :py:meth:`execute_main()` instead of the preprocessor's
+    :py:meth:`~latexpp.preprocessor.LatexPreprocessor.execute_main()`, and
+    call :py:meth:`stop()` and :py:meth:`save()` after the preprocessor's
+    :py:meth:`~latexpp.preprocessor.LatexPreprocessor.finalize()`.
+
+    .. py:attribute:: spliced
+
+       After :py:meth:`execute_main()`, the list of the segments that were
+       processed again and spliced into the previous output, or `None` if
+       the whole document was processed.
+    """
+    def __init__(self, lpp, record_fname, *, config_hash):
+        super().__init__()
+        self.lpp = lpp
+        self.record_fname = record_fname
+        self.base_dir = _base_dir(record_fname)
+        self.config_hash = config_hash
+
+        self.segment_recorder = None
+        self.manifest_recorder = None
+        self.spliced = None
+
+        # the record of this run, see save()
+        self._record = None
+        # hashes of the files that were not read again in this run
+        self._known_hashes = {}
+
+    def start(self):
+        r"""
+        Check that all fixes support incremental runs and start recording.
+        """
+        lpp = self.lpp
+        unsupported = [ fix.fix_name() for fix in lpp.fixes
+                        if not fix_supports_incremental(fix) ]
+        if unsupported:
+            logger.warning("Fix(es) %s do not support incremental runs, "
+                           "processing the whole document",
+                           ", ".join(unsupported))
+            return
+        self.segment_recorder = SegmentRecorder(lpp, self.record_fname)
+        lpp.segment_recorder = self.segment_recorder
+        lpp.add_observer(self.segment_recorder)
+        self.manifest_recorder = ManifestRecorder(lpp, self.record_fname)
+        self.manifest_recorder.start()
+
+    def stop(self):
+        r"""
+        Stop recording.
+        """
+        if self.segment_recorder is None:
+            return
+        self.manifest_recorder.stop()
+        self.lpp.remove_observer(self.segment_recorder)
+        self.lpp.segment_recorder = None
+
+    def execute_main(self):
+        r"""
+        Process the main document: process only the segments whose files
+        changed and splice their output into the previous output, if
+        possible, otherwise process the whole document.
+        """
+        lpp = self.lpp
+        if self.segment_recorder is None:
+            lpp.execute_main()
+            return
+
+        initial_states = self._get_fix_states()
+        initial_output_files = list(lpp.output_files)
+
+        record = IncrementalRecord.load(self.record_fname)
+        if record is None:
+            reasons = ["no record of a previous run"]
+        else:
+            # remove the stale record, in case the run fails
+            os.remove(self.record_fname)
+            reasons, segments = self._check_record(record)
+        if not reasons:
+            try:
+                self._splice(record, segments)
+                return
+            except _CannotSplice as e:
+                reasons = [ str(e) ]
+            # start over
+            for fix, state in zip(lpp.fixes, initial_states):
+                fix.set_incremental_state(state)
+            lpp.output_files[:] = initial_output_files
+            self.segment_recorder.current = None
+
+        logger.info("Processing the whole document: %s", "; ".join(reasons))
+        lpp.execute_main()
+
+        recorder = self.segment_recorder
+        recorder.check_segments()
+        self._record = IncrementalRecord(
+            manifest=None,
+            output_fname=lpp.main_doc_output_fname,
+            output_text=recorder.output_text,
+            segments=recorder.segments,
+            global_files=recorder.global_files,
+            final_states=self._get_fix_states(),
+            output_files=(),
+        )
+
+    def save(self):
+        r"""
+        Save the record of the run to the record file.  Call this after the
+        preprocessor's :py:meth:`~latexpp.preprocessor.LatexPreprocessor.finalize()`.
+        """
+        record = self._record
+        if record is None:
+            return
+        record.output_files = list(self.lpp.output_files)
+
+        files = set(record.global_files)
+        for segment in record.segments:
+            files |= segment.files
+        hashes = dict(self._known_hashes)
+        hashes.update(self.manifest_recorder.files)
+        self.manifest_recorder.files = {
+            fname: (hashes[fname] if fname in hashes
+                    else hash_file(os.path.join(self.base_dir, fname)))
+            for fname in sorted(files)
+        }
+        record.manifest = self.manifest_recorder.get_manifest(self.config_hash)
+
+        record.save(self.record_fname)
+        logger.debug("Wrote incremental run record to %s", self.record_fname)
+
+    def _get_fix_states(self):
+        return [ fix.incremental_state() for fix in self.lpp.fixes ]
+
+    def _check_record(self, record):
+        # Returns (reasons, segments): the reasons why the whole document needs
+        # to be processed, and the segments to process again otherwise.
+        lpp = self.lpp
+        manifest = record.manifest
+        reasons = manifest.check(self.record_fname, config_hash=self.config_hash,
+                                 output_dir=lpp.output_dir, files=False)
+        if reasons:
+            return reasons, None
+        if record.output_fname != lpp.main_doc_output_fname \
+           or len(record.final_states) != len(lpp.fixes):
+            return ["configuration changed"], None
+
+        segments = {}
+        for fname in manifest.changed_files(self.record_fname):
+            if fname in record.global_files:
+                return ["file ‘{}’ changed".format(fname)], None
+            found = False
+            for segment in record.segments:
+                if fname not in segment.files:
+                    continue
+                if not segment.reusable:
+                    return ["file ‘{}’ changed".format(fname)], None
+                segments[segment.index] = segment
+                found = True
+            if not found:
+                return ["file ‘{}’ changed".format(fname)], None
+
+        return [], [ segments[i] for i in sorted(segments) ]
+
+    def _splice(self, record, segments):
+        lpp = self.lpp
+
+        new_texts = {}
+        for segment in segments:
+            logger.info("Processing ‘%s’ again", segment.infname)
+            new_texts[segment.index] = self._process_segment(segment)
+
+        # splice the new output of the segments into the previous output
+        text = record.output_text
+        pieces = []
+        pos = 0
+        length = 0
+        for segment in sorted((s for s in record.segments if s.span is not None),
+                              key=lambda s: s.span[0]):
+            start, end = segment.span
+            pieces.append(text[pos:start])
+            length += start - pos
+            s = new_texts.get(segment.index, text[start:end])
+            pieces.append(s)
+            segment.span = (length, length + len(s))
+            length += len(s)
+            pos = end
+        pieces.append(text[pos:])
+        output_text = ''.join(pieces)
+
+        for fix, state in zip(lpp.fixes, record.final_states):
+            fix.set_incremental_state(state)
+        lpp.output_files += [ fname for fname in record.output_files
+                              if fname not in lpp.output_files ]
+
+        if output_text != text:
+            output_fname = record.output_fname
+            with open(os.path.join(lpp.output_dir, output_fname), 'w') as f:
+                lpp._write_processed_by_heading(f, False)
+                f.write(output_text)
+        else:
+            logger.info("Output of the main document is unchanged")
+
+        self.spliced = segments
+        self._known_hashes = dict(record.manifest.files)
+        record.output_text = output_text
+        self._record = record
+
+    def _process_segment(self, segment):
+        # process the segment on its own, starting from the fixes' states at
+        # the beginning of the segment, and return its new output
+        lpp = self.lpp
+        recorder = self.segment_recorder
+
+        segment.files = set()
+        recorder.current = segment
+        try:
+            fix = lpp.fixes[segment.fix_index]
+            with lpp._fix_scope([fix]):
+                nodes = fix.input_file(segment.infname, macroname=segment.macroname)
+            if nodes is None:
+                raise _CannotSplice("file ‘{}’ not found".format(segment.infname))
+
+            for k in range(segment.fix_index+1, len(lpp.fixes)):
+                fix = lpp.fixes[k]
+                with lpp._fix_scope([fix]):
+                    for s, stage in fix_stages(fix):
+                        fix.set_incremental_state(segment.states[(k, s, 'begin')])
+                        nodes = stage.preprocess(nodes)
+                        if fix.incremental_state() != segment.states[(k, s, 'end')]:
+                            raise _CannotSplice(
+                                "changes in ‘{}’ affect the rest of the document "
+                                "(fix {})".format(segment.infname, fix.fix_name())
+                            )
+        finally:
+            recorder.current = None
+
+        lw = lpp.make_latex_walker('')
+        return lw.nodelist_to_latex(nodes)
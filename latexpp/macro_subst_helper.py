@@ -28,13 +28,20 @@ substitutions with custom replacement strings.
 """
 
 
+import re
 import logging
 logger = logging.getLogger(__name__)
 
 from pylatexenc.macrospec import MacroSpec, EnvironmentSpec, MacroStandardArgsParser
-from pylatexenc.latexwalker import LatexMacroNode, LatexEnvironmentNode
+from pylatexenc.latexwalker import (
+    LatexMacroNode, LatexEnvironmentNode, LatexGroupNode, LatexCharsNode,
+    LatexWalkerParseError
+)
 
-from latexpp import fixes
+from latexpp.fix import DontFixThisNode, LatexNodeList
+from latexpp._lpp_parsing import (
+    copy_nodes, update_node_state, parsing_state_key, latex_context_version
+)
 
 
 class MacroSubstHelper:
@@ -42,6 +49,9 @@ class MacroSubstHelper:
     Helper class that provides common functionality for fixes that replace
     certain macro invocations by a custom replacement string.
 
+    The replacement strings are compiled when the helper is constructed (see
+    :py:meth:`eval_subst_nodes()`).
+
     TODO: Document me. ....
     """
     def __init__(self,
@@ -58,6 +68,11 @@ class MacroSubstHelper:
 
         self.context = context # additional fields provided to repl text
 
+        # compiled replacement strings
+        self._templates = {}
+        for meinfo in list(self.macros.values()) + list(self.environments.values()):
+            self._get_template(self._cfg_argspec_repl(meinfo)[1])
+
     def get_specs(self):
         r"""
         Return the specs that we need to declare to the latex walker
@@ -78,6 +93,28 @@ class MacroSubstHelper:
             ]
         )
 
+    def get_triggers(self):
+        r"""
+        Return the names of the macros and environments that we handle, in a
+        form suitable as a return value for
+        :py:meth:`latexpp.fix.BaseFix.triggers()`.
+        """
+        return dict(
+            macros=list(self.macros.keys()),
+            environments=list(self.environments.keys()),
+        )
+
+    def get_handlers(self, handler):
+        r"""
+        Return a mapping that routes all the macros and environments that we
+        handle to the callable `handler`, in a form suitable as a return value
+        for :py:meth:`latexpp.fix.BaseFix.handlers()`.
+        """
+        return dict(
+            macros={m: handler for m in self.macros},
+            environments={e: handler for e in self.environments},
+        )
+
     def _cfg_argspec_repl(self, meinfo):
         if isinstance(meinfo, str):
             return '', meinfo
@@ -141,7 +178,9 @@ class MacroSubstHelper:
         used to transform child nodes (argument nodes) to LaTeX code.  If you're
         calling this from a fix class (:py:class:`latexpp.fixes.BaseFix`
         subclass) then you should most probably specify
-        ``node_contents_latex=self.preprocess_contents_latex`` here.
+        ``node_contents_latex=self.preprocess_contents_latex`` here.  (Better
+        yet, use :py:meth:`eval_subst_nodes()`.)  The callable is only called
+        for the arguments that are actually used in the replacement string.
 
         If `argoffset` is nonzero, then the first `argoffset` arguments are skipped
         and the arguments `argoffset+1, argoffset+2, ...` are exposed to the
@@ -168,48 +207,104 @@ class MacroSubstHelper:
 
         argspec, repl = self._cfg_argspec_repl(c)
 
-        # TODO: use a lazy dictionary that will only evaluate the values if the
-        # placeholder is actually used.
-            
-        q = _LazySubstDict(self.context)
+        self._check_node_args(argspec, n)
+
+        args = _SubstArgs(n, argoffset, node_contents_latex=node_contents_latex)
+
+        return self._format_repl(repl, argspec, n, args, context, arg_filters)
+
+    def eval_subst_nodes(self, c, n, *, fix, argoffset=0, context={},
+                         arg_filters=None):
+        r"""
+        Same as :py:meth:`eval_subst()`, but directly build the nodes of the
+        replacement, avoiding the need to reparse the replacement string.  The
+        return value is suitable as a return value for
+        :py:meth:`latexpp.fix.BaseFix.fix_node()`.
+
+        The argument `fix` is the fix instance that is calling us; its
+        :py:meth:`~latexpp.fix.BaseFix.preprocess()` method is applied to the
+        macro arguments (and environment body) that are used in the
+        replacement.  Arguments that are not used in the replacement string are
+        not preprocessed.  The other arguments are the same as for
+        :py:meth:`eval_subst()`.
+
+        The replacement string `repl` is parsed into nodes once (for each
+        parsing state, see
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.parse_fragment()`),
+        with placeholder macros where the arguments should go.  Each
+        replacement is then obtained by inserting the preprocessed argument
+        nodes in place of the placeholders in a copy of these nodes.  This is only possible if each
+        argument placeholder stands on its own in the replacement string, e.g.,
+        in ``\lvert{%(1)s}\rangle``.  In other cases, such as
+        ``\chapter%(1)s{%(2)s}`` where the argument is glued to a macro name or
+        would be parsed as a macro argument, this method falls back to
+        returning the replacement string as computed by :py:meth:`eval_subst()`.
+        """
+
+        argspec, repl = self._cfg_argspec_repl(c)
+
+        self._check_node_args(argspec, n)
+
+        args = _SubstArgs(n, argoffset, fix=fix)
+
+        template = self._get_template(repl)
+        if template.pieces is not None:
+            q = self._make_subst_dict(argspec, n, args, context, arg_filters)
+            nodes = template.instantiate(n, args, q, fix)
+            if nodes is not None:
+                return nodes
+
+        return self._format_repl(repl, argspec, n, args, context, arg_filters)
 
+    def _check_node_args(self, argspec, n):
         if argspec and (n.nodeargd is None or n.nodeargd.argnlist is None):
             logger.debug("Node arguments were not set, skipping replacement: %r", n)
-            raise fixes.DontFixThisNode
+            raise DontFixThisNode
 
-        if n.nodeargd and n.nodeargd.argnlist:
-            for k, nn in enumerate(n.nodeargd.argnlist[argoffset:]):
-                if nn is None:
-                    arg_contents = ''
-                else:
-                    arg_contents = node_contents_latex(nn)
-
-                q[str(1+k)] = arg_contents
-
-                if arg_filters:
-                    for filterkey, filterfn in arg_filters.items():
-                        q.register_fn(
-                            str(1+k)+'.'+filterkey,
-                            filterfn,
-                            dict(
-                                argspec=argspec[k],
-                                arg_index=k,
-                                arg_number=1+k,
-                                node=nn,
-                                arg_contents=arg_contents,
-                            ),
-                            allow_args=True,
-                        )
-                            
+    def _get_template(self, repl):
+        template = self._templates.get(repl, None)
+        if template is None:
+            template = _SubstTemplate(repl)
+            self._templates[repl] = template
+        return template
+
+    def _make_subst_dict(self, argspec, n, args, context, arg_filters):
+
+        q = _LazySubstDict(self.context)
+
+        for k in range(args.num_args):
+            key = str(1+k)
+            q.set_lazy(key, lambda key=key: args.latex(key))
+
+            if arg_filters:
+                for filterkey, filterfn in arg_filters.items():
+                    q.register_fn(
+                        key+'.'+filterkey,
+                        filterfn,
+                        lambda k=k, key=key: dict(
+                            argspec=argspec[k],
+                            arg_index=k,
+                            arg_number=1+k,
+                            node=args.source(key),
+                            arg_contents=args.latex(key),
+                        ),
+                        allow_args=True,
+                    )
 
         if n.isNodeType(LatexMacroNode):
             q.update(macroname=n.macroname)
         if n.isNodeType(LatexEnvironmentNode):
-            q.update(environmentname=n.environmentname,
-                     body=node_contents_latex(n.nodelist))
-        
+            q.update(environmentname=n.environmentname)
+            q.set_lazy('body', lambda: args.latex('body'))
+
         q.update(context)
 
+        return q
+
+    def _format_repl(self, repl, argspec, n, args, context, arg_filters):
+
+        q = self._make_subst_dict(argspec, n, args, context, arg_filters)
+
         try:
             text = repl % q
         except KeyError as e:
@@ -224,21 +319,347 @@ class MacroSubstHelper:
                 n)
             )
             raise
-                
 
         #logger.debug(" -- Performing substitution {} -> {}".format(n.to_latex(), text))
         return text
 
 
 
+class _SubstArgs:
+    # The arguments (and environment body) of the node being replaced, which
+    # are preprocessed only when they are requested.  Keys are '1', '2',
+    # ... for arguments and 'body' for the environment body.
+
+    def __init__(self, n, argoffset, *, fix=None, node_contents_latex=None):
+        self.n = n
+        self.fix = fix
+        self.node_contents_latex = node_contents_latex
+
+        self.argnlist = []
+        if n.nodeargd and n.nodeargd.argnlist:
+            self.argnlist = n.nodeargd.argnlist[argoffset:]
+        self.num_args = len(self.argnlist)
+
+        self._nodes = {}
+        self._latex = {}
+
+    def has(self, key):
+        if key == 'body':
+            return self.n.isNodeType(LatexEnvironmentNode)
+        return key.isdigit() and 1 <= int(key) <= self.num_args
+
+    def source(self, key):
+        # the original argument node or environment body
+        if key == 'body':
+            return self.n.nodelist
+        return self.argnlist[int(key)-1]
+
+    def nodes(self, key):
+        # preprocessed contents of the argument, as a node list.  Don't modify
+        # this list, use copy_nodes() if you need several copies.
+        if key not in self._nodes:
+            self._nodes[key] = self._preprocess_contents_nodes(self.source(key))
+        return self._nodes[key]
+
+    def latex(self, key):
+        # preprocessed contents of the argument, as latex code
+        if key not in self._latex:
+            if self.node_contents_latex is not None:
+                s = self.node_contents_latex(self.source(key))
+            else:
+                s = "".join(nn.to_latex() for nn in self.nodes(key))
+            self._latex[key] = s
+        return self._latex[key]
+
+    def _preprocess_contents_nodes(self, x):
+        # same as BaseFix.preprocess_contents_latex(), but returns the nodes
+        if x is None:
+            return []
+        if isinstance(x, (LatexNodeList, list)):
+            return list(self.fix.preprocess(x))
+        if x.isNodeType(LatexGroupNode):
+            return [ nn2
+                     for nn in x.nodelist if nn is not None
+                     for nn2 in self._preprocess_single_node(nn) ]
+        return self._preprocess_single_node(x)
+
+    def _preprocess_single_node(self, nn):
+        return list(self.fix.preprocess(
+            nn.latex_walker.make_nodelist([nn], parsing_state=nn.parsing_state)
+        ))
+
+
+
+_rx_subst_placeholder = re.compile(r'%(?:(?P<percent>%)|\((?P<key>[^)]*)\)s)')
+
+def _slot_marker_name(j):
+    # name of the placeholder macro for the j-th argument slot (letters only)
+    letters = ''
+    while True:
+        j, r = divmod(j, 26)
+        letters += chr(ord('a')+r)
+        if not j:
+            break
+    return 'lppsubstslot' + letters
+
+
+class _SubstTemplate:
+    # A replacement string compiled into a list of pieces `(key, text)`, where
+    # `key` is `None` for literal text or the placeholder key.  Placeholders for
+    # arguments and the environment body are "slots" that are filled with
+    # nodes; other placeholders are formatted as strings.  If the replacement
+    # string uses formatting other than '%(key)s' and '%%', then `pieces` is
+    # `None` and the replacement string can only be used with string
+    # formatting.
+    #
+    # For each parsing state (and each value of the string placeholders), the
+    # replacement string is parsed once into literal nodes, with placeholder
+    # macros in the slots (see _CompiledSubst).  Each replacement is a copy of
+    # these nodes, with the argument nodes spliced in at the slots.  If a slot
+    # can't be isolated as a node of its own (e.g., in '\chapter%(1)s' where
+    # the argument would be glued to the macro name, or in '\frac%(1)s{2}'
+    # where it would be parsed as a macro argument), instantiate() returns
+    # `None` and the caller falls back to string formatting.
+
+    def __init__(self, repl):
+        self.repl = repl
+
+        pieces = []
+        pos = 0
+        while True:
+            i = repl.find('%', pos)
+            if i < 0:
+                pieces.append( (None, repl[pos:]) )
+                break
+            m = _rx_subst_placeholder.match(repl, i)
+            if m is None:
+                pieces = None
+                break
+            pieces.append( (None, repl[pos:i]) )
+            if m.group('percent'):
+                pieces.append( (None, '%') )
+            else:
+                pieces.append( (m.group('key'), None) )
+            pos = m.end()
+
+        self.pieces = pieces
+
+        # (parsing state key, latex context version, text) -> _CompiledSubst,
+        # or None if the slots can't be isolated
+        self._compiled = {}
+
+    def instantiate(self, n, args, q, fix):
+        # Return the replacement nodes, or None if the slots cannot be filled
+        # with nodes
+
+        slots = {}
+        text = []
+        for key, lit in self.pieces:
+            if key is None:
+                text.append(lit)
+            elif key == 'body' or key.isdigit():
+                if not args.has(key):
+                    return None
+                marker = _slot_marker_name(len(slots))
+                slots[marker] = key
+                text.append('\\' + marker)
+            else:
+                try:
+                    text.append('%s' % (q[key],))
+                except KeyError:
+                    return None
+        text = "".join(text)
+
+        if not slots:
+            return text
+
+        compiled = self._get_compiled(text, slots, n.parsing_state, fix.lpp)
+        if compiled is None:
+            return None
+        return compiled.instantiate(args)
+
+    def _get_compiled(self, text, slots, parsing_state, lpp):
+        cache_key = None
+        pskey = parsing_state_key(parsing_state)
+        if pskey is not None:
+            latex_context = parsing_state.latex_context
+            cache_key = (
+                pskey,
+                latex_context_version(latex_context)
+                if latex_context is not None else None,
+                text
+            )
+            try:
+                return self._compiled[cache_key]
+            except KeyError:
+                pass
+
+        try:
+            nodes = lpp.parse_fragment(text, parsing_state)
+        except LatexWalkerParseError:
+            compiled = None
+        else:
+            found = _find_slot_markers(nodes, slots)
+            if found is None or len(found) != len(slots):
+                compiled = None
+            else:
+                compiled = _CompiledSubst(nodes, [
+                    (path, j, slots[marker])
+                    for marker, (path, j) in found.items()
+                ])
+
+        if cache_key is not None and len(self._compiled) < _MAX_COMPILED_SUBST:
+            self._compiled[cache_key] = compiled
+        return compiled
+
+# don't keep more compiled versions of a replacement string than this (there
+# is one per parsing state and per value of the placeholders that are formatted
+# as strings)
+_MAX_COMPILED_SUBST = 256
+
+
+class _CompiledSubst:
+    # The nodes of a replacement string, with placeholder macros in the slots.
+    # `slots` is a list of `(path, j, key)`, meaning that the placeholder for
+    # the argument `key` is the `j`-th node of the node list found by
+    # following `path` from the top-level node list (see _find_slot_markers()).
+    # The nodes are never modified, instantiate() works on a copy.
+
+    def __init__(self, nodes, slots):
+        self.nodes = nodes
+        self.slots = slots
+
+    def instantiate(self, args):
+        # Return the replacement nodes with the given arguments, or None if the
+        # arguments can't be moved to where the slots are
+
+        nodes = copy_nodes(self.nodes)
+
+        # locate the slots in our copy, and group them by the node list that
+        # contains them
+        containers = {}
+        for path, j, key in self.slots:
+            owner, nodelist, ancestors = _follow_slot_path(nodes, path)
+            marker = nodelist[j]
+            # make sure we don't move the argument nodes to a different math
+            # mode
+            ps = getattr(args.source(key), 'parsing_state', None)
+            if ps is not None and \
+               bool(ps.in_math_mode) != bool(marker.parsing_state.in_math_mode):
+                return None
+            containers.setdefault(id(nodelist), (owner, nodelist, ancestors, {}))[3][j] = key
+
+        used_keys = set()
+        update_nodes = {}
+        for owner, nodelist, ancestors, keys_at in containers.values():
+            newnodelist = []
+            for j, nn in enumerate(nodelist):
+                if j not in keys_at:
+                    newnodelist.append(nn)
+                    continue
+                key = keys_at[j]
+                argnodes = args.nodes(key)
+                if key in used_keys:
+                    argnodes = copy_nodes(argnodes)
+                else:
+                    argnodes = list(argnodes)
+                used_keys.add(key)
+                newnodelist += argnodes
+                if nn.macro_post_space:
+                    newnodelist.append(nn.latex_walker.make_node(
+                        LatexCharsNode,
+                        chars=nn.macro_post_space,
+                        parsing_state=nn.parsing_state,
+                        pos=None, pos_end=None,
+                    ))
+            if owner is None:
+                nodes = newnodelist
+            else:
+                owner.nodelist = newnodelist
+            for depth, a in enumerate(ancestors):
+                update_nodes[id(a)] = (depth, a)
+
+        # update the information attached to the nodes that contained the
+        # placeholders, deepest first
+        for depth, a in sorted(update_nodes.values(), key=lambda x: -x[0]):
+            update_node_state(a)
+
+        return nodes
+
+
+def _find_slot_markers(nodes, markers):
+    # Find the placeholder macros in the node tree.  Returns a dictionary
+    # {marker: (path, index)}, where `path` leads to the node list that
+    # contains the placeholder at position `index` (see _follow_slot_path()).
+    # Returns `None` if a placeholder appears more than once, is parsed as a
+    # macro argument or might be glued to a preceding macro name.
+
+    found = {}
+
+    stack = [ (nodes, (), True) ]
+    while stack:
+        nodelist, path, can_splice = stack.pop()
+        for j, nn in enumerate(nodelist):
+            if nn is None:
+                continue
+
+            if nn.isNodeType(LatexMacroNode) and nn.macroname in markers:
+                if not can_splice or nn.macroname in found \
+                   or (nn.nodeargd is not None and nn.nodeargd.argnlist):
+                    return None
+                if j > 0 and nodelist[j-1] is not None \
+                   and nodelist[j-1].isNodeType(LatexMacroNode) \
+                   and nodelist[j-1].to_latex()[-1:].isalpha():
+                    return None
+                found[nn.macroname] = (path, j)
+                continue
+
+            if getattr(nn, 'nodeargd', None) is not None and nn.nodeargd.argnlist:
+                for k, a in enumerate(nn.nodeargd.argnlist):
+                    if a is not None:
+                        stack.append( ([a], path + ((j, k),), False) )
+            if getattr(nn, 'nodelist', None) is not None:
+                stack.append( (nn.nodelist, path + ((j, None),), True) )
+
+    return found
+
+
+def _follow_slot_path(nodes, path):
+    # Follow the `path` returned by _find_slot_markers() in the node list
+    # `nodes`.  Each step `(j, k)` of the path goes into the `j`-th node of the
+    # current node list, and then into its `k`-th argument (as a node list
+    # with a single node) or into its `nodelist` if `k` is `None`.  Returns
+    # `(owner, nodelist, ancestors)`, where `owner` is the node whose
+    # `nodelist` we end up in (or `None` for the top-level node list) and
+    # `ancestors` lists the nodes we went through.
+    owner = None
+    nodelist = nodes
+    ancestors = []
+    for j, k in path:
+        nn = nodelist[j]
+        ancestors.append(nn)
+        if k is None:
+            owner = nn
+            nodelist = nn.nodelist
+        else:
+            owner = None
+            nodelist = [ nn.nodeargd.argnlist[k] ]
+    return owner, nodelist, ancestors
+
+
+
 class _LazySubstDict:
     def __init__(self, d):
         self.d = dict(d)
+        self.lazy = {}
         self.fns = []
 
     def update(self, *args, **kwargs):
         self.d.update(*args, **kwargs)
 
+    def set_lazy(self, key, valuefn):
+        self.lazy[key] = valuefn
+
     def register_fn(self, keyfn, filterfn, argsfn, allow_args=True):
         self.fns.append( (keyfn, filterfn, argsfn, allow_args) )
 
@@ -249,6 +670,11 @@ class _LazySubstDict:
         if key in self.d:
             return self.d[key]
 
+        if key in self.lazy:
+            value = self.lazy.pop(key)()
+            self.d[key] = value
+            return value
+
         for keyfn, filterfn, argsfn, allow_args in self.fns:
             if key == keyfn:
                 substarg = None
@@ -257,9 +683,11 @@ class _LazySubstDict:
             else:
                 continue
 
-            kwargs = dict(argsfn)
+            kwargs = dict(argsfn())
             if substarg is not None:
                 kwargs['substarg'] = substarg
             return filterfn(**kwargs)
-            
-        
+
+    def __repr__(self):
+        return '{}({!r}, lazy={!r})'.format(self.__class__.__name__, self.d,
+                                            sorted(self.lazy))
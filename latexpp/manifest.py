@@ -0,0 +1,362 @@
+r"""
+Module that records a manifest of a `latexpp` run, to find out later whether
+running `latexpp` again would produce the same output.
+
+A :py:class:`RunManifest` lists:
+
+- every source file the run read: the main document, the files processed
+  with :py:meth:`latexpp.preprocessor.LatexPreprocessor.execute_file()`
+  (e.g. ``\input`` files), and the files read with
+  :py:meth:`~latexpp.preprocessor.LatexPreprocessor.open_file()` or copied with
+  :py:meth:`~latexpp.preprocessor.LatexPreprocessor.copy_file()` by the fixes
+  (e.g. ``.sty`` packages, ``.aux`` and ``.bbl`` files, figures, files with
+  ``\bibalias`` definitions);
+
+- the source file of the module of each fix that ran, which identifies the
+  version of the fix;
+
+- a hash of the configuration of the run (see :py:func:`hash_config()`);
+
+- the versions of `latexpp` and `pylatexenc`;
+
+- the files written to the output directory.
+
+Each file is listed with the SHA-256 hash of its contents, and source files
+are stored relative to the directory of the manifest file.  The run is up to
+date (see :py:meth:`RunManifest.check()`) if all these are unchanged and the
+output files are still present with the same contents.
+
+Use a :py:class:`ManifestRecorder` to record the manifest of a run::
+
+  recorder = ManifestRecorder(lpp, 'build.manifest.json')
+  recorder.start()
+  lpp.initialize()
+  lpp.execute_main()
+  lpp.finalize()
+  recorder.stop()
+  recorder.get_manifest(config_hash).save('build.manifest.json')
+
+The ``latexpp`` command does this with the ``--manifest FILE`` option, and
+``--if-changed`` exits immediately without touching the output directory if
+the manifest shows that the output is up to date.
+"""
+
+import os
+import os.path
+import sys
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+from . import __version__ as latexpp_version_str
+from .events import PreprocessorObserver
+
+
+MANIFEST_FORMAT = 1
+
+
+def hash_file(fname):
+    r"""
+    Return the hexadecimal SHA-256 hash of the contents of the file `fname`, or
+    `None` if the file can't be read.
+    """
+    h = hashlib.sha256()
+    try:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def hash_config(lppconfig, **settings):
+    r"""
+    Return a hash of the configuration data `lppconfig` (as loaded from a
+    `lppconfig.yml` file) and of any further `settings` that determine the
+    output (e.g., the input and output file names given on the command line).
+    """
+    data = json.dumps({'lppconfig': lppconfig, 'settings': settings},
+                      sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def get_environment():
+    r"""
+    Return a dictionary with the versions of `latexpp` and `pylatexenc`.
+    """
+    try:
+        from pylatexenc.version import version_str as pylatexenc_version_str
+    except ImportError:
+        pylatexenc_version_str = None
+    return {
+        'latexpp': latexpp_version_str,
+        'pylatexenc': pylatexenc_version_str,
+    }
+
+
+class RunManifest:
+    r"""
+    The manifest of a `latexpp` run (see :py:mod:`latexpp.manifest`).
+
+    .. py:attribute:: files
+
+       A dictionary ``{file name: hash}`` of the source files that were read,
+       with file names relative to the manifest's directory.  Files that a fix
+       looked for but did not find have a `None` hash.
+
+    .. py:attribute:: fixes
+
+       A dictionary ``{fix class name: {'file': module file name, 'hash':
+       hash}}`` identifying the code of each fix that ran.
+
+    .. py:attribute:: config_hash
+
+       The hash of the configuration (see :py:func:`hash_config()`).
+
+    .. py:attribute:: environment
+
+       The versions of `latexpp` and `pylatexenc` (see
+       :py:func:`get_environment()`).
+
+    .. py:attribute:: output_dir
+
+       The output directory, relative to the manifest's directory.
+
+    .. py:attribute:: outputs
+
+       A dictionary ``{file name: hash}`` of the files written to the output
+       directory, with file names relative to the output directory.
+    """
+    def __init__(self, *, files, fixes, config_hash, environment, output_dir, outputs):
+        super().__init__()
+        self.files = dict(files)
+        self.fixes = dict(fixes)
+        self.config_hash = config_hash
+        self.environment = dict(environment)
+        self.output_dir = output_dir
+        self.outputs = dict(outputs)
+
+    def to_json(self):
+        r"""
+        Return a JSON-serializable dictionary of the manifest.
+        """
+        return {
+            'format': MANIFEST_FORMAT,
+            'environment': self.environment,
+            'config_hash': self.config_hash,
+            'fixes': self.fixes,
+            'files': self.files,
+            'output_dir': self.output_dir,
+            'outputs': self.outputs,
+        }
+
+    @classmethod
+    def from_json(cls, d):
+        r"""
+        Create a :py:class:`RunManifest` from a dictionary as returned by
+        :py:meth:`to_json()`.
+        """
+        if d.get('format', None) != MANIFEST_FORMAT:
+            raise ValueError("Unsupported manifest format: {!r}".format(d.get('format', None)))
+        return cls(files=d['files'], fixes=d['fixes'], config_hash=d['config_hash'],
+                   environment=d['environment'], output_dir=d['output_dir'],
+                   outputs=d['outputs'])
+
+    def save(self, fname):
+        r"""
+        Save the manifest to the JSON file `fname`.  Write the manifest to the
+        location it was recorded for (see :py:class:`ManifestRecorder`), since
+        file names are relative to the manifest's directory.
+        """
+        tmpfname = fname + '.tmp'
+        with open(tmpfname, 'w') as f:
+            json.dump(self.to_json(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.replace(tmpfname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        r"""
+        Load a manifest saved with :py:meth:`save()`.  Returns `None` if the
+        file doesn't exist or isn't a valid manifest.
+        """
+        try:
+            with open(fname) as f:
+                return cls.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring invalid manifest file ‘%s’: %s", fname, e)
+            return None
+
+    def check(self, manifest_fname, *, config_hash, output_dir, files=True):
+        r"""
+        Check whether the run recorded in this manifest is up to date, i.e.,
+        whether running `latexpp` again with the configuration hash
+        `config_hash` and output directory `output_dir` would produce the
+        same output as the recorded run.  The manifest was loaded from
+        `manifest_fname`, relative to which file names are resolved.
+
+        Returns a list of reasons why the run is not up to date (an empty list
+        if it is up to date).  Stops at the first few reasons found.  If
+        `files` is `False`, changes of the source files are not checked (see
+        :py:meth:`changed_files()`).
+        """
+        base_dir = _base_dir(manifest_fname)
+        reasons = []
+
+        if self.environment != get_environment():
+            reasons.append("latexpp or pylatexenc version changed")
+        if self.config_hash != config_hash:
+            reasons.append("configuration changed")
+        if self.output_dir != _relpath(output_dir, base_dir):
+            reasons.append("output directory changed")
+        if reasons:
+            return reasons
+
+        for fixname, info in sorted(self.fixes.items()):
+            if hash_file(os.path.join(base_dir, info['file'])) != info['hash']:
+                reasons.append("code of fix {} changed".format(fixname))
+                return reasons
+
+        if files:
+            for fname in self.changed_files(manifest_fname):
+                reasons.append("file ‘{}’ changed".format(fname))
+                return reasons
+
+        for fname, h in sorted(self.outputs.items()):
+            if hash_file(os.path.join(output_dir, fname)) != h:
+                reasons.append("output file ‘{}’ is missing or was modified".format(fname))
+                return reasons
+
+        return reasons
+
+    def changed_files(self, manifest_fname):
+        r"""
+        Return the sorted list of the source files that changed since the run
+        recorded in this manifest, including the files that were not found
+        then but exist now, and vice versa.  The manifest was loaded from
+        `manifest_fname`, relative to which file names are resolved.
+        """
+        base_dir = _base_dir(manifest_fname)
+        return [ fname for fname, h in sorted(self.files.items())
+                 if hash_file(os.path.join(base_dir, fname)) != h ]
+
+
+class ManifestRecorder(PreprocessorObserver):
+    r"""
+    Records the files read by the preprocessor `lpp` (and its
+    sub-preprocessors) and the fixes that ran, to create a
+    :py:class:`RunManifest` of the run.  File names are stored relative to
+    the directory of `manifest_fname`, the file the manifest will be saved
+    to.
+
+    Call :py:meth:`start()` before running the preprocessor and
+    :py:meth:`stop()` afterwards, then create the manifest with
+    :py:meth:`get_manifest()`.
+    """
+    def __init__(self, lpp, manifest_fname):
+        super().__init__()
+        self.lpp = lpp
+        self.base_dir = _base_dir(manifest_fname)
+
+        # {file name relative to base_dir: hash}
+        self.files = {}
+        self.fixes = {}
+
+    def start(self):
+        r"""
+        Start observing the preprocessor.
+        """
+        self.lpp.add_observer(self)
+
+    def stop(self):
+        r"""
+        Stop observing the preprocessor.
+        """
+        self.lpp.remove_observer(self)
+
+    def add_file(self, lpp, fname):
+        r"""
+        Add the source file `fname` (resolved like the preprocessor `lpp`
+        resolves source file names) to the list of files read by the run.
+        """
+        path = lpp._resolve_source_fname(fname)
+        relname = _relpath(path, self.base_dir)
+        if relname not in self.files:
+            self.files[relname] = hash_file(path)
+
+    def add_fix(self, fix):
+        r"""
+        Add the code of the fix instance `fix` to the manifest.
+        """
+        cls = type(fix)
+        name = cls.__module__ + '.' + cls.__qualname__
+        if name in self.fixes:
+            return
+        module = sys.modules.get(cls.__module__, None)
+        modfile = getattr(module, '__file__', None)
+        if not modfile:
+            logger.debug("Can't locate the code of fix %s", name)
+            return
+        self.fixes[name] = {
+            'file': _relpath(modfile, self.base_dir),
+            'hash': hash_file(modfile),
+        }
+
+    def get_manifest(self, config_hash):
+        r"""
+        Return the :py:class:`RunManifest` of the recorded run.  The
+        `config_hash` is the hash of the run's configuration (see
+        :py:func:`hash_config()`).  Call this after the preprocessor's
+        :py:meth:`~latexpp.preprocessor.LatexPreprocessor.finalize()`, so that
+        all output files are known.
+        """
+        output_dir = self.lpp.output_dir
+        outputs = {}
+        for fname in self.lpp.output_files:
+            if fname not in outputs:
+                outputs[fname] = hash_file(os.path.join(output_dir, fname))
+        for fix in self.lpp.fixes:
+            self.add_fix(fix)
+        return RunManifest(
+            files=self.files,
+            fixes=self.fixes,
+            config_hash=config_hash,
+            environment=get_environment(),
+            output_dir=_relpath(output_dir, self.base_dir),
+            outputs=outputs,
+        )
+
+    #
+    # PreprocessorObserver events
+    #
+
+    def file_read(self, lpp, fname):
+        self.add_file(lpp, fname)
+
+    def file_copied(self, lpp, source, destfname):
+        self.add_file(lpp, source)
+
+    def file_probed(self, lpp, fname, exists):
+        # files that were looked for but not found are recorded with a `None`
+        # hash, so that the run is out of date if they are created
+        self.add_file(lpp, fname)
+
+    def fix_start(self, lpp, fixes, name):
+        for fix in fixes:
+            self.add_fix(fix)
+
+
+def _base_dir(manifest_fname):
+    return os.path.dirname(os.path.abspath(manifest_fname))
+
+def _relpath(path, base_dir):
+    path = os.path.abspath(path)
+    try:
+        return os.path.relpath(path, base_dir)
+    except ValueError: # e.g. on another drive on Windows
+        return path
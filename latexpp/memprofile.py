@@ -0,0 +1,411 @@
+r"""
+Module that measures how much memory each fix, each run of a sub-preprocessor
+and each processed input file costs, using Python's :py:mod:`tracemalloc`
+module.
+
+The :py:class:`MemoryProfiler` observes the preprocessor (see
+:py:mod:`latexpp.events`) and takes memory measurements at the start and at
+the end of each of the following scopes:
+
+- each processed input file (named ``<file NAME>``, see
+  :py:meth:`latexpp.preprocessor.LatexPreprocessor.execute_file()`);
+
+- each run of all fixes of a preprocessor on a document (``<preprocess>``, or
+  ``<sub-preprocessor>`` for a sub-preprocessor);
+
+- each fix (or group of fused fixes).
+
+For each scope, it reports the peak memory usage above the memory in use when
+the scope was entered (`peak_delta`), the memory that was still allocated
+when the scope was left (`retained_delta`), and the source lines that
+allocated the most memory that was retained.  Scopes are nested, and the
+memory allocated in a scope counts towards all enclosing scopes.
+
+The peak and retained memory are cheap to measure.  The allocation sites are
+found by comparing :py:mod:`tracemalloc` snapshots, which is expensive on
+large documents; they are recorded for input files, sub-preprocessor runs and
+fixes only (the ``<preprocess>`` run of the main preprocessor is covered by
+its input file).
+"""
+
+import fnmatch
+import linecache
+import tracemalloc
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .events import PreprocessorObserver
+
+
+class MemoryScopeStats:
+    r"""
+    The memory statistics recorded for one scope (see :py:mod:`latexpp.memprofile`).
+
+    .. py:attribute:: name
+
+       A descriptive name of the scope, which includes the names of the
+       enclosing scopes, as in ``'<file main.tex> / <preprocess> /
+       latexpp.fixes.input.EvalInput'``.
+
+    .. py:attribute:: path
+
+       The tuple of names of the enclosing scopes, ending with this scope's
+       own name.
+
+    .. py:attribute:: calls
+
+       How many times the scope was entered.
+
+    .. py:attribute:: peak_delta
+
+       The largest peak memory usage (in bytes) over all calls, relative to
+       the memory in use when the scope was entered.
+
+    .. py:attribute:: retained_delta
+
+       The total change in memory usage (in bytes) between entering and
+       leaving the scope, summed over all calls.  A positive value is memory
+       the scope allocated and didn't free.
+
+    .. py:attribute:: top_sites
+
+       A dictionary ``{'file.py:lineno': size_diff}`` of the change in memory
+       allocated by each source line, summed over all calls (only the lines
+       with the largest changes in each call are recorded).  Empty if the
+       allocation sites are not recorded for this scope.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = tuple(path)
+        self.name = ' / '.join(self.path)
+        self.calls = 0
+        self.peak_delta = 0
+        self.retained_delta = 0
+        self.top_sites = {}
+
+    def get_top_sites(self, limit=10):
+        r"""
+        Return a list of ``(site, size_diff)`` tuples for the `limit` sites
+        that retained the most memory.
+        """
+        sites = sorted(self.top_sites.items(), key=lambda x: x[1], reverse=True)
+        return sites[:limit]
+
+    def to_json(self, top_sites_limit=10):
+        r"""
+        Return a dictionary of all statistics that can be serialized to JSON.
+        """
+        return {
+            'name': self.name,
+            'path': list(self.path),
+            'calls': self.calls,
+            'peak_delta': self.peak_delta,
+            'retained_delta': self.retained_delta,
+            'top_sites': [ {'site': site, 'size_diff': size_diff}
+                           for site, size_diff in self.get_top_sites(top_sites_limit) ],
+        }
+
+    def __repr__(self):
+        return "{}({!r}, peak_delta={!r}, retained_delta={!r})".format(
+            self.__class__.__name__, self.name, self.peak_delta, self.retained_delta
+        )
+
+
+class _OpenScope:
+    __slots__ = ('stats', 'start_current', 'peak', 'sites', 'sites_size',
+                 'next_sites')
+
+    def __init__(self, stats, start_current, sites, sites_size):
+        self.stats = stats
+        self.start_current = start_current
+        # peak memory in use during this scope, so far
+        self.peak = start_current
+        # memory allocated by each source line at the start of this scope (or
+        # None if we don't record sites), and the memory that this dictionary
+        # takes
+        self.sites = sites
+        self.sites_size = sites_size
+        # (sites, sites_size) at the end of the last nested scope, which
+        # serve as the start of the next nested scope
+        self.next_sites = None
+
+
+class MemoryProfiler(PreprocessorObserver):
+    r"""
+    Records :py:class:`MemoryScopeStats` for the preprocessor `lpp`, for which
+    the profiler registers itself as an observer.  Call :py:meth:`start()`
+    before running the preprocessor and :py:meth:`stop()` afterwards.
+
+    Arguments:
+
+    - `snapshots`: if `True` (the default), take a :py:mod:`tracemalloc`
+      snapshot at the start and at the end of each input file,
+      sub-preprocessor run and fix to determine the top allocation sites.
+      Snapshots are expensive on large documents; set `snapshots=False` to
+      only measure the memory deltas.
+
+    - `top_sites`: the number of allocation sites recorded for each call of
+      a scope.
+
+    - `nframes`: the number of frames :py:mod:`tracemalloc` stores for each
+      allocation, if the profiler starts tracing.
+
+    The snapshot taken at the end of a scope also serves as the start of the
+    next scope within the same enclosing scope (e.g., of the next fix), and
+    the snapshot taken at the start of a scope serves as the start of its
+    first nested scope.  The few allocations that the enclosing scope makes in
+    between are thus attributed to the sites of the next nested scope, too.
+
+    The peak memory usage of a scope is measured exactly on Python 3.9 and
+    later (where :py:func:`tracemalloc.reset_peak()` is available).  On older
+    versions, it is only known if the peak memory usage of the process
+    increased within the scope, otherwise the retained memory is reported.
+    """
+    def __init__(self, lpp, *, snapshots=True, top_sites=10, nframes=1):
+        super().__init__()
+        self.lpp = lpp
+        self.snapshots = snapshots
+        self.top_sites = top_sites
+        self.nframes = nframes
+
+        # path -> MemoryScopeStats, in the order in which the scopes were
+        # first entered
+        self.entries = {}
+        self._stack = []
+        self._started_tracing = False
+
+        # allocation sites in these files are not reported
+        self._excluded_files = [
+            tracemalloc.__file__,
+            linecache.__file__,
+            __file__,
+            '<frozen importlib._bootstrap>',
+            '<frozen importlib._bootstrap_external>',
+            '<unknown>',
+        ]
+
+    def start(self):
+        r"""
+        Start tracing memory allocations (if :py:mod:`tracemalloc` isn't
+        tracing already) and start observing the preprocessor.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+            self._started_tracing = True
+        self.lpp.add_observer(self)
+
+    def stop(self):
+        r"""
+        Stop observing the preprocessor, and stop tracing memory allocations if
+        :py:meth:`start()` started it.
+        """
+        self.lpp.remove_observer(self)
+        while self._stack:
+            # an exception interrupted the run
+            self._pop()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def get_stats(self):
+        r"""
+        Return a list of all the recorded :py:class:`MemoryScopeStats`.
+        """
+        return list(self.entries.values())
+
+    def to_json(self):
+        r"""
+        Return all recorded statistics as a JSON-serializable list.
+        """
+        return [ e.to_json(self.top_sites) for e in self.entries.values() ]
+
+    def format_table(self, sort_by='peak_delta'):
+        r"""
+        Return a summary table of the recorded statistics as a string, sorted
+        by decreasing `sort_by` (the name of a :py:class:`MemoryScopeStats`
+        attribute), with the top allocation site of each scope.
+        """
+        entries = sorted(self.entries.values(),
+                         key=lambda e: getattr(e, sort_by), reverse=True)
+        header = ('scope', 'calls', 'peak', 'retained', 'top site')
+        rows = []
+        for e in entries:
+            sites = e.get_top_sites(1)
+            rows.append(
+                (e.name, str(e.calls), _format_size(e.peak_delta),
+                 _format_size(e.retained_delta),
+                 '{} ({})'.format(sites[0][0], _format_size(sites[0][1]))
+                 if sites else '')
+            )
+        widths = [ max(len(r[k]) for r in [header] + rows)
+                   for k in range(len(header)) ]
+        lines = []
+        for r in [header] + rows:
+            lines.append(
+                '  '.join( (r[k].rjust(widths[k]) if k in (1, 2, 3) else r[k].ljust(widths[k]))
+                           for k in range(len(r)) ).rstrip()
+            )
+        lines.insert(1, '-' * len(lines[0]))
+        return '\n'.join(lines)
+
+    #
+    # PreprocessorObserver events
+    #
+
+    def file_start(self, lpp, fname):
+        self._push('<file {}>'.format(fname), True)
+
+    def file_end(self, lpp, fname):
+        self._pop()
+
+    def preprocess_start(self, lpp):
+        if lpp.parent_preprocessor is not None:
+            self._push('<sub-preprocessor>', True)
+        else:
+            self._push('<preprocess>', False)
+
+    def preprocess_end(self, lpp):
+        self._pop()
+
+    def fix_start(self, lpp, fixes, name):
+        self._push(name, True)
+
+    def fix_end(self, lpp, fixes, name):
+        self._pop()
+
+    #
+    # Measurements
+    #
+
+    def _get_entry(self, path):
+        entry = self.entries.get(path, None)
+        if entry is None:
+            entry = MemoryScopeStats(path)
+            self.entries[path] = entry
+        return entry
+
+    def _fold_peak(self):
+        # record the peak memory usage since the last reset in the innermost
+        # open scope (it is passed on to the enclosing scopes in _pop())
+        if self._stack:
+            _, peak = tracemalloc.get_traced_memory()
+            scope = self._stack[-1]
+            if peak > scope.peak:
+                scope.peak = peak
+
+    def _push(self, name, with_sites):
+        if self._stack:
+            outer = self._stack[-1]
+            path = outer.stats.path + (name,)
+        else:
+            outer = None
+            path = (name,)
+        entry = self._get_entry(path)
+        entry.calls += 1
+
+        self._fold_peak()
+        next_sites = None
+        if outer is not None:
+            next_sites, outer.next_sites = outer.next_sites, None
+        sites = None
+        sites_size = 0
+        if self.snapshots and with_sites:
+            if next_sites is not None:
+                # the previous scope at this level just ended (or the enclosing
+                # scope just started), start from its sites
+                sites, sites_size = next_sites
+            else:
+                before, _ = tracemalloc.get_traced_memory()
+                sites = self._take_sites()
+                current, _ = tracemalloc.get_traced_memory()
+                sites_size = max(current - before, 0)
+        next_sites = None
+        current, _ = tracemalloc.get_traced_memory()
+        _reset_peak()
+        scope = _OpenScope(entry, current, sites, sites_size)
+        if sites is not None:
+            # our first nested scope starts from our own sites (which were
+            # there before we started, so they don't count for its sizes)
+            scope.next_sites = (sites, 0)
+        self._stack.append(scope)
+
+    def _pop(self):
+        self._fold_peak()
+        scope = self._stack.pop()
+        entry = scope.stats
+        # the sites kept for our next nested scope weren't there at the start
+        scope.next_sites = None
+        current, _ = tracemalloc.get_traced_memory()
+
+        retained = current - scope.start_current
+        entry.retained_delta += retained
+        if _reset_peak is _no_reset_peak and scope.peak <= scope.start_current:
+            # we can't tell the peak within this scope
+            peak = retained
+        else:
+            peak = scope.peak - scope.start_current
+        entry.peak_delta = max(entry.peak_delta, peak)
+
+        if scope.sites is not None:
+            sites = self._take_sites()
+            sites_size = max(tracemalloc.get_traced_memory()[0] - current, 0)
+            start_sites = scope.sites
+            scope.sites = None
+            diffs = [ (site, size - start_sites.get(site, 0))
+                      for site, size in sites.items() ]
+            diffs.extend( (site, -size) for site, size in start_sites.items()
+                          if site not in sites )
+            diffs.sort(key=lambda x: abs(x[1]), reverse=True)
+            for (filename, lineno), size_diff in diffs[:self.top_sites]:
+                if size_diff == 0:
+                    continue
+                site = '{}:{}'.format(filename, lineno)
+                entry.top_sites[site] = entry.top_sites.get(site, 0) + size_diff
+            del start_sites, diffs
+            if self._stack:
+                # keep our final sites as the start of the next scope
+                self._stack[-1].next_sites = (sites, sites_size)
+            del sites
+
+        if self._stack:
+            # pass on our peak to the enclosing scope, without the memory taken
+            # by our own sites
+            outer = self._stack[-1]
+            outer.peak = max(outer.peak, scope.peak - scope.sites_size)
+        _reset_peak()
+
+    def _take_sites(self):
+        # return a dictionary {(filename, lineno): size} of the memory that is
+        # currently allocated by each source line
+        sites = {}
+        excluded = {}
+        for stat in tracemalloc.take_snapshot().statistics('lineno'):
+            frame = stat.traceback[0]
+            # (filtering the statistics is much faster than filtering the
+            # snapshot's traces, of which there are many more)
+            is_excluded = excluded.get(frame.filename, None)
+            if is_excluded is None:
+                is_excluded = any(fnmatch.fnmatch(frame.filename, pattern)
+                                  for pattern in self._excluded_files)
+                excluded[frame.filename] = is_excluded
+            if not is_excluded:
+                sites[(frame.filename, frame.lineno)] = stat.size
+        return sites
+
+
+def _no_reset_peak():
+    pass
+
+_reset_peak = getattr(tracemalloc, 'reset_peak', _no_reset_peak)
+
+
+def _format_size(size):
+    sign = '-' if size < 0 else ''
+    size = abs(size)
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{}{:.0f} {}'.format(sign, size, unit) if unit == 'B' \
+                else '{}{:.1f} {}'.format(sign, size, unit)
+        size /= 1024
+    return '{}{:.1f} GiB'.format(sign, size)
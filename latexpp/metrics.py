@@ -0,0 +1,318 @@
+r"""
+Module that records how much time and work each fix costs when processing a
+document, to find out which fixes are expensive.
+"""
+
+import os.path
+import time
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .events import PreprocessorObserver
+
+
+class FixMetrics:
+    r"""
+    The metrics recorded for one fix (or one stage of a multi-stage fix, one
+    group of fused fixes, or one processing step of the preprocessor itself,
+    such as parsing the input or writing the output).
+
+    .. py:attribute:: name
+
+       A descriptive name, e.g., ``'latexpp.fixes.input.EvalInput'``.  For
+       fixes run by a sub-preprocessor, or for the stages of a multi-stage
+       fix, the name is prefixed by the name of the fix within which they run,
+       as in ``'latexpp.fixes.regional_fix.Apply / latexpp.fixes.comments.RemoveComments'``.
+
+    .. py:attribute:: path
+
+       The tuple of names of the enclosing fixes, ending with this fix's own
+       name.
+
+    .. py:attribute:: calls
+
+       How many times the fix was run (e.g., once per processed file).
+
+    .. py:attribute:: wall_time
+    .. py:attribute:: cpu_time
+
+       Total time spent running this fix in seconds, including time spent in
+       nested fixes.
+
+    .. py:attribute:: self_wall_time
+    .. py:attribute:: self_cpu_time
+
+       Same, excluding the time spent in nested fixes.
+
+    .. py:attribute:: nodes_visited
+
+       Number of nodes the fix examined while walking the document tree.
+
+    .. py:attribute:: nodes_replaced
+
+       Number of nodes the fix replaced (or modified in place).
+
+    .. py:attribute:: reparses
+    .. py:attribute:: reparse_bytes
+
+       Number of LaTeX code fragments returned by the fix that had to be
+       parsed again, and their total size in bytes (encoded in UTF-8).
+
+    .. py:attribute:: files_copied
+    .. py:attribute:: bytes_copied
+
+       Number of files copied to the output directory and their total size.
+
+    .. py:attribute:: bytes_written
+
+       Number of bytes of processed LaTeX code written to output files, in the
+       encoding of each file.
+    """
+
+    counter_fields = (
+        'nodes_visited', 'nodes_replaced',
+        'reparses', 'reparse_bytes',
+        'files_copied', 'bytes_copied', 'bytes_written',
+    )
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = tuple(path)
+        self.name = ' / '.join(self.path)
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.self_wall_time = 0.0
+        self.self_cpu_time = 0.0
+        for fld in self.counter_fields:
+            setattr(self, fld, 0)
+
+    def to_json(self):
+        r"""
+        Return a dictionary of all metrics that can be serialized to JSON.
+        """
+        d = {
+            'name': self.name,
+            'path': list(self.path),
+            'calls': self.calls,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'self_wall_time': self.self_wall_time,
+            'self_cpu_time': self.self_cpu_time,
+        }
+        for fld in self.counter_fields:
+            d[fld] = getattr(self, fld)
+        return d
+
+    def __repr__(self):
+        return "{}({!r}, calls={!r}, wall_time={:.3f})".format(
+            self.__class__.__name__, self.name, self.calls, self.wall_time
+        )
+
+
+class _Measure:
+    # Context manager returned by MetricsRecorder.measure()
+
+    __slots__ = ('recorder', 'name')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        return self.recorder._push(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder._pop()
+
+
+class MetricsRecorder(PreprocessorObserver):
+    r"""
+    Collects :py:class:`FixMetrics` while the preprocessor runs.  Assign an
+    instance to :py:attr:`latexpp.preprocessor.LatexPreprocessor.metrics` to
+    enable the recording of metrics (the preprocessor doesn't record anything
+    if that attribute is `None`, which is the default).  The recorder is a
+    :py:class:`latexpp.events.PreprocessorObserver` which computes the metrics
+    from the preprocessor's events, so it also records the metrics of
+    sub-preprocessors.
+
+    Metrics are attributed to the innermost fix that is running, see
+    :py:meth:`measure()`.  Work that is done outside of any fix is attributed
+    to an entry named ``'<other>'``.
+    """
+    def __init__(self):
+        super().__init__()
+        # path -> FixMetrics, in the order in which the fixes were first run
+        self.entries = {}
+        # stack of [entry, wall_t0, cpu_t0, children_wall, children_cpu]
+        self._stack = []
+        self._other = None
+
+    def measure(self, name):
+        r"""
+        Return a context manager that measures the time spent in the fix (or
+        processing step) `name` within the current fix, and to which all
+        counts are attributed while it is active::
+
+          with metrics.measure(fix.fix_name()):
+              newnodelist = fix.preprocess(nodelist)
+        """
+        return _Measure(self, name)
+
+    def current(self):
+        r"""
+        Return the :py:class:`FixMetrics` instance of the innermost fix that is
+        running.
+        """
+        if self._stack:
+            return self._stack[-1][0]
+        if self._other is None:
+            self._other = self._get_entry( ('<other>',) )
+        return self._other
+
+    def current_path(self):
+        r"""
+        Return the :py:attr:`FixMetrics.path` of the innermost fix that is
+        running, or an empty tuple if no fix is running.  This method may be
+        called from another thread (e.g., by :py:class:`latexpp.profiler.Profiler`).
+        """
+        stack = self._stack
+        try:
+            return stack[-1][0].path
+        except IndexError:
+            return ()
+
+    def add(self, field, amount=1):
+        r"""
+        Add `amount` to the counter `field` (one of
+        :py:attr:`FixMetrics.counter_fields`) of the current fix.
+        """
+        entry = self.current()
+        setattr(entry, field, getattr(entry, field) + amount)
+
+    #
+    # PreprocessorObserver events
+    #
+
+    def fix_start(self, lpp, fixes, name):
+        self._push(name)
+
+    def fix_end(self, lpp, fixes, name):
+        self._pop()
+
+    def stage_start(self, lpp, fix, stage):
+        self._push(stage.stage_name())
+
+    def stage_end(self, lpp, fix, stage):
+        self._pop()
+
+    def step_start(self, lpp, name):
+        self._push(name)
+
+    def step_end(self, lpp, name):
+        self._pop()
+
+    def nodes_visited(self, lpp, fix, count):
+        self.current().nodes_visited += count
+
+    def node_replaced(self, lpp, fix, node, replacement):
+        self.current().nodes_replaced += 1
+
+    def reparse(self, lpp, latex):
+        entry = self.current()
+        entry.reparses += 1
+        entry.reparse_bytes += len(latex.encode('utf-8', 'replace'))
+
+    def file_copied(self, lpp, source, destfname):
+        entry = self.current()
+        entry.files_copied += 1
+        try:
+            entry.bytes_copied += os.path.getsize(lpp._resolve_source_fname(source))
+        except OSError:
+            pass
+
+    def output_written(self, lpp, output_fname, size):
+        self.current().bytes_written += size
+
+    def get_metrics(self):
+        r"""
+        Return a list of all the recorded :py:class:`FixMetrics` instances.
+        """
+        return list(self.entries.values())
+
+    def to_json(self):
+        r"""
+        Return all recorded metrics as a JSON-serializable dictionary.
+        """
+        return {
+            'fixes': [ m.to_json() for m in self.entries.values() ],
+        }
+
+    def dump_json(self, f):
+        r"""
+        Write the recorded metrics in JSON format to the file object `f`.
+        """
+        json.dump(self.to_json(), f, indent=2)
+        f.write('\n')
+
+    def format_table(self, sort_by='self_wall_time'):
+        r"""
+        Return a summary table of the recorded metrics as a string, sorted by
+        decreasing `sort_by` (the name of a :py:class:`FixMetrics` attribute).
+        """
+        metrics = sorted(self.entries.values(),
+                         key=lambda m: getattr(m, sort_by), reverse=True)
+        header = ('fix', 'calls', 'wall', 'self wall', 'self cpu',
+                  'visited', 'replaced', 'reparses', 'reparse B',
+                  'copied', 'copied B', 'written B')
+        rows = [
+            (m.name, str(m.calls),
+             '{:.3f}'.format(m.wall_time),
+             '{:.3f}'.format(m.self_wall_time),
+             '{:.3f}'.format(m.self_cpu_time),
+             str(m.nodes_visited), str(m.nodes_replaced),
+             str(m.reparses), str(m.reparse_bytes),
+             str(m.files_copied), str(m.bytes_copied), str(m.bytes_written))
+            for m in metrics
+        ]
+        widths = [ max(len(r[k]) for r in [header] + rows)
+                   for k in range(len(header)) ]
+        lines = []
+        for r in [header] + rows:
+            lines.append(
+                '  '.join( (r[k].ljust(widths[k]) if k == 0 else r[k].rjust(widths[k]))
+                           for k in range(len(r)) ).rstrip()
+            )
+        lines.insert(1, '-' * len(lines[0]))
+        return '\n'.join(lines)
+
+    def _get_entry(self, path):
+        entry = self.entries.get(path, None)
+        if entry is None:
+            entry = FixMetrics(path)
+            self.entries[path] = entry
+        return entry
+
+    def _push(self, name):
+        if self._stack:
+            path = self._stack[-1][0].path + (name,)
+        else:
+            path = (name,)
+        entry = self._get_entry(path)
+        entry.calls += 1
+        self._stack.append([entry, time.perf_counter(), time.process_time(), 0.0, 0.0])
+        return entry
+
+    def _pop(self):
+        entry, wall_t0, cpu_t0, children_wall, children_cpu = self._stack.pop()
+        wall = time.perf_counter() - wall_t0
+        cpu = time.process_time() - cpu_t0
+        entry.wall_time += wall
+        entry.cpu_time += cpu
+        entry.self_wall_time += wall - children_wall
+        entry.self_cpu_time += cpu - children_cpu
+        if self._stack:
+            self._stack[-1][3] += wall
+            self._stack[-1][4] += cpu
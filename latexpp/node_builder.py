@@ -0,0 +1,171 @@
+r"""
+Module that provides a helper to create new nodes directly, without having to
+write and reparse LaTeX code.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pylatexenc import latexwalker, macrospec
+
+from ._lpp_parsing import LatexVerbatimSpliceNode
+
+
+class LatexNodesBuilder:
+    r"""
+    Create new nodes that can be returned by fixes (e.g. by
+    :py:meth:`latexpp.fix.BaseFix.fix_node()`) instead of a string of LaTeX
+    code, which would have to be reparsed.  An instance is available to fixes
+    as ``self.lpp.nodes`` (see
+    :py:attr:`latexpp.preprocessor.LatexPreprocessor.nodes`).  For instance::
+
+      class MyFix(fixes.BaseFix):
+        def fix_node(self, n, **kwargs):
+          if n.isNodeType(LatexMacroNode) and n.macroname == 'includegraphics':
+            # replace by \includegraphics[<preprocessed options>]{fig-01.pdf}
+            return self.lpp.nodes.macro(
+              'includegraphics',
+              [ self.preprocess_arg_node(n, 0), 'fig-01.pdf' ],
+              parsing_state=n.parsing_state,
+            )
+
+    The nodes are created by our custom latex walker, so they support
+    `to_latex()` and everything else that fixes can expect from nodes (see
+    :ref:`implementation-notes-pylatexenc`).
+
+    All methods accept a `parsing_state` keyword argument, which should
+    usually be the parsing state of the node that is being replaced.  If
+    `parsing_state` is `None`, the default parsing state of our latex walker is
+    used.
+
+    Wherever child nodes are expected, you may also specify a string; it is
+    included as a chars node as is, without being parsed as LaTeX code.  So
+    strings should only be used for plain text, such as file names or labels.
+    """
+    def __init__(self, lpp):
+        super().__init__()
+        self.lpp = lpp
+        self._default_parsing_state = None
+
+    def chars(self, chars, *, parsing_state=None):
+        r"""
+        Create a chars node with the given text `chars`.
+        """
+        return self._make_node(latexwalker.LatexCharsNode, parsing_state,
+                               chars=chars)
+
+    def comment(self, comment, *, comment_post_space='', parsing_state=None):
+        r"""
+        Create a comment node; `comment` is the text of the comment without the
+        leading percent sign.
+        """
+        return self._make_node(latexwalker.LatexCommentNode, parsing_state,
+                               comment=comment,
+                               comment_post_space=comment_post_space)
+
+    def group(self, nodelist=(), *, delimiters=('{', '}'), parsing_state=None):
+        r"""
+        Create a group node with the given contents (a node, a list of nodes or
+        strings, or a string) delimited by `delimiters`.
+        """
+        return self._make_node(latexwalker.LatexGroupNode, parsing_state,
+                               nodelist=self._make_nodes(nodelist, parsing_state),
+                               delimiters=delimiters)
+
+    def macro(self, macroname, args=(), *, argspec=None, macro_post_space='',
+              parsing_state=None):
+        r"""
+        Create a macro node for the macro ``\macroname`` (without the backslash)
+        with the given arguments.
+
+        Each argument in `args` is a node (usually a group node, including its
+        delimiters), `None` (for an optional argument that is not present), a
+        string or a list of nodes (which is placed in a group delimited by
+        braces).  The `argspec` is determined from the arguments if it is not
+        specified.
+        """
+        return self._make_node(latexwalker.LatexMacroNode, parsing_state,
+                               macroname=macroname,
+                               nodeargd=self._make_nodeargd(args, argspec,
+                                                            parsing_state),
+                               macro_post_space=macro_post_space)
+
+    def environment(self, environmentname, nodelist=(), args=(), *, argspec=None,
+                    parsing_state=None):
+        r"""
+        Create an environment node ``\begin{environmentname}...`` with the given
+        body `nodelist` and arguments `args` (see :py:meth:`macro()`).
+        """
+        return self._make_node(latexwalker.LatexEnvironmentNode, parsing_state,
+                               environmentname=environmentname,
+                               nodelist=self._make_nodes(nodelist, parsing_state),
+                               nodeargd=self._make_nodeargd(args, argspec,
+                                                            parsing_state))
+
+    def verbatim(self, latex, *, parsing_state=None):
+        r"""
+        Create an opaque node that inserts the LaTeX code `latex` in the output
+        exactly as is (see
+        :py:class:`~latexpp._lpp_parsing.LatexVerbatimSpliceNode`).  The code is
+        not parsed, and no fix will ever see what's inside it.
+        """
+        return self._make_node(LatexVerbatimSpliceNode, parsing_state,
+                               latex=latex)
+
+    def nodelist(self, nodes, *, parsing_state=None):
+        r"""
+        Create a node list object with the given nodes (or strings).
+        """
+        parsing_state = self._get_parsing_state(parsing_state)
+        return parsing_state.lpp_latex_walker.make_nodelist(
+            self._make_nodes(nodes, parsing_state),
+            parsing_state=parsing_state,
+        )
+
+    def _get_parsing_state(self, parsing_state):
+        if parsing_state is not None:
+            return parsing_state
+        if self._default_parsing_state is None:
+            lw = self.lpp.make_latex_walker('')
+            self._default_parsing_state = lw.make_parsing_state()
+        return self._default_parsing_state
+
+    def _make_node(self, node_class, parsing_state, **kwargs):
+        parsing_state = self._get_parsing_state(parsing_state)
+        return parsing_state.lpp_latex_walker.make_node(
+            node_class,
+            parsing_state=parsing_state,
+            pos=None, pos_end=None,
+            **kwargs
+        )
+
+    def _make_nodes(self, nodes, parsing_state):
+        if isinstance(nodes, str):
+            return [ self.chars(nodes, parsing_state=parsing_state) ]
+        if isinstance(nodes, latexwalker.LatexNode):
+            return [ nodes ]
+        return [
+            self.chars(nn, parsing_state=parsing_state) if isinstance(nn, str) else nn
+            for nn in nodes
+            if nn is not None
+        ]
+
+    def _make_nodeargd(self, args, argspec, parsing_state):
+        argnlist = [
+            self.group(a, parsing_state=parsing_state)
+            if isinstance(a, (str, list)) else a
+            for a in args
+        ]
+        if argspec is None:
+            argspec = ''.join( _guess_argspec_char(a) for a in argnlist )
+        return macrospec.ParsedMacroArgs(argspec=argspec, argnlist=argnlist)
+
+
+def _guess_argspec_char(a):
+    if a is None:
+        return '['
+    if a.isNodeType(latexwalker.LatexGroupNode) and a.delimiters[0] == '[':
+        return '['
+    if a.isNodeType(latexwalker.LatexCharsNode) and a.chars == '*':
+        return '*'
+    return '{'
@@ -0,0 +1,532 @@
+r"""
+Module that provides an index of where macros, environments and specials
+appear in the document, so that fixes that only care about a few of them can
+find them without walking the whole document tree.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pylatexenc import latexwalker
+
+from .fix import LatexNodeList, DontFixThisNode, _ensure_macro_node_maybe_post_space
+from ._lpp_parsing import (
+    node_name_key, node_subtree_names, triggers_to_name_keys, node_changed,
+    update_node_state, _generation_counter
+)
+
+
+class NodeOccurrence:
+    r"""
+    Describes where a node appears in the document tree.  Instances are
+    returned by :py:meth:`NodeIndex.find()`.
+
+    .. py:attribute:: node
+
+       The node itself.
+
+    .. py:attribute:: container
+
+       The list in which the node appears, i.e., ``owner.nodelist``,
+       ``owner.nodeargd.argnlist``, or the document's top-level node list.
+
+    .. py:attribute:: slot
+
+       The index of the node in `container`.
+
+    .. py:attribute:: owner
+
+       The node to which `container` belongs, or `None` if `container` is the
+       document's top-level node list.
+    """
+
+    __slots__ = ('node', 'container', 'slot', 'owner', '_key', '_epoch')
+
+    def __init__(self, node, container, slot, owner, key, epoch):
+        super().__init__()
+        self.node = node
+        self.container = container
+        self.slot = slot
+        self.owner = owner
+        self._key = key
+        self._epoch = epoch
+
+    def is_argument(self):
+        r"""
+        Return `True` if the node is a macro argument, i.e., if `container` is
+        the `argnlist` of the owner's parsed arguments.
+        """
+        return self.owner is not None \
+            and self.container is not getattr(self.owner, 'nodelist', None)
+
+    def __repr__(self):
+        return "{}(node={!r}, slot={!r}, owner={!r})".format(
+            self.__class__.__name__, self.node, self.slot, self.owner
+        )
+
+
+class NodeIndex:
+    r"""
+    An index of all the macro, environment and specials nodes of a document,
+    by name, along with their location in the document tree (see
+    :py:class:`NodeOccurrence`).  An instance is available to fixes as
+    ``self.lpp.node_index`` while the preprocessor runs the fixes (see
+    :py:attr:`latexpp.preprocessor.LatexPreprocessor.node_index`).
+
+    Fixes that only act on a few macros which can appear anywhere in the
+    document can use the index instead of walking the document tree.  For
+    instance, a fix can reimplement :py:meth:`latexpp.fix.BaseFix.preprocess()`
+    as follows::
+
+      class MyFix(BaseFix):
+        def preprocess(self, nodelist):
+          index = self.lpp.node_index
+          for occ in index.find(macros=['includegraphics']):
+            index.replace(occ, self.lpp.nodes.macro(
+              'includegraphics',
+              [ self.preprocess_arg_node(occ.node, 0), 'fig-01.pdf' ],
+              parsing_state=occ.node.parsing_state,
+            ))
+          return nodelist
+
+    The index keeps track of changes to the document tree: whenever it is
+    queried, the parts of the tree that were modified since its last update
+    (as recorded by the modification tracking of our latex walker's nodes, see
+    :ref:`implementation-notes-pylatexenc`) are indexed again.  The cost of a
+    query is thus proportional to the number of matches and to the size of
+    the node lists that were modified, not to the size of the document.
+    Replace nodes with :py:meth:`replace()`, which keeps the node tree's
+    modification tracking and the index up to date.  Fixes that declare their
+    work with :py:meth:`latexpp.fix.BaseFix.handlers()` can simply have the
+    index call their handlers, see :py:meth:`apply_handlers()`.
+
+    The index is built lazily, for each name when it is first looked for: the
+    first query for a name walks through those parts of the document whose
+    summary of names (see :py:func:`latexpp._lpp_parsing.node_subtree_names()`)
+    contains it, and skips the other subtrees.  The `lpp` argument is the
+    preprocessor instance (used to parse replacement strings), and `root` is
+    the document's top-level node list (see :py:meth:`set_root()`).
+    """
+    def __init__(self, lpp=None, root=None):
+        super().__init__()
+        self.lpp = lpp
+        self.root = None
+
+        # name key (see node_name_key()) -> { id(node): NodeOccurrence }
+        self._by_name = {}
+        # id(node) -> NodeOccurrence, for all nodes that are named or that can
+        # have child nodes
+        self._occurrences = {}
+        # incremented at each update of the index
+        self._epoch = 0
+        # nodes whose modification generation is larger than this were
+        # modified since the last update
+        self._built_gen = None
+        self._root_changed = True
+        # rebuild from scratch when the index accumulates too many stale
+        # entries
+        self._full_build_size = 0
+        # the name keys of the nodes that are indexed so far (the index is
+        # built for each name when it is first looked for)
+        self._indexed_keys = frozenset()
+
+        if root is not None:
+            self.set_root(root)
+
+    def set_root(self, root):
+        r"""
+        Set the document's top-level node list.  The preprocessor calls this
+        method before running each fix.
+        """
+        if root is not self.root:
+            self.root = root
+            self._root_changed = True
+
+    def find(self, macros=(), environments=(), specials=(), *,
+             in_document_order=False):
+        r"""
+        Return a list of :py:class:`NodeOccurrence` instances for all the
+        macros, environments and specials with the given names that are
+        currently in the document.  The occurrences are in no particular order,
+        unless `in_document_order` is `True`.  (A node comes before the nodes
+        in its arguments and contents in document order.)
+
+        The occurrences remain valid as long as the document tree isn't
+        modified in the corresponding node lists, except via
+        :py:meth:`replace()`.
+        """
+        keys = triggers_to_name_keys(dict(macros=macros,
+                                          environments=environments,
+                                          specials=specials))
+        self._update(keys)
+        result = self._find_keys(keys)
+        if in_document_order:
+            result.sort(key=self._document_position)
+        return result
+
+    def is_attached(self, occ):
+        r"""
+        Return `True` if the node of the occurrence `occ` is still part of the
+        document, i.e., if neither the node nor any node that contains it was
+        replaced since `occ` was returned by :py:meth:`find()`.
+        """
+        return self._is_attached(occ)
+
+    def apply_handlers(self, fix, nodelist):
+        r"""
+        Call the handlers of the fix `fix` (see
+        :py:meth:`latexpp.fix.BaseFix.handlers()`) on all the nodes of the
+        document that they act upon, in document order, instead of walking
+        through the whole document.  Nodes for which the handler returns a
+        replacement are replaced (see :py:meth:`replace()`); nodes that the
+        handler modified in place are marked as modified.  As in
+        :py:meth:`latexpp.fix.BaseFix.preprocess()`, the nodes inside a node
+        that was replaced are not visited, and the replacement nodes are not
+        processed any further.
+
+        The index can only stand in for a walk through the whole document.
+        This method does nothing and returns `False` if `nodelist` is not the
+        document's node list (see :py:meth:`set_root()`), or if the
+        preprocessor records the state of the fixes at the boundaries of each
+        ``\input`` file (see :py:mod:`latexpp.incremental`), which requires a
+        walk.  Otherwise, it returns `True`.  A fix can thus reimplement
+        :py:meth:`latexpp.fix.BaseFix.preprocess()` as follows::
+
+          def preprocess(self, nodelist):
+            index = self.lpp.node_index
+            if index is not None and index.apply_handlers(self, nodelist):
+              return nodelist
+            return super().preprocess(nodelist)
+
+        Comment handlers are not supported.
+        """
+        if nodelist is not self.root \
+           or getattr(self.lpp, 'segment_recorder', None) is not None:
+            return False
+
+        handler_map = fix._get_handler_map() or {}
+        if ('comments', True) in handler_map:
+            raise ValueError("NodeIndex.apply_handlers(): comment handlers are "
+                             "not supported")
+
+        events = getattr(self.lpp, '_events', None)
+
+        self._update(handler_map)
+        occs = self._find_keys(handler_map)
+        occs.sort(key=self._document_position)
+        for occ in occs:
+            if not self._is_attached(occ):
+                # inside a node that was replaced
+                continue
+            node = occ.node
+            handler = handler_map.get(node_name_key(node), None)
+            if handler is None:
+                # the node was renamed in place by an earlier handler
+                continue
+            try:
+                if occ.is_argument():
+                    nn = handler(node, is_single_token_arg=True)
+                else:
+                    slot = occ.slot
+                    container = occ.container
+                    nn = handler(
+                        node,
+                        prev_node=(container[slot-1] if slot > 0 else None),
+                        next_node=(container[slot+1] if slot+1 < len(container)
+                                   else None),
+                    )
+            except DontFixThisNode:
+                nn = None
+            if nn is not None:
+                if events is not None:
+                    events.node_replaced(self.lpp, fix, node, nn)
+                self.replace(occ, nn)
+                continue
+            # the handler might have modified the node in place
+            built_gen = self._built_gen
+            update_node_state(node)
+            if _node_changed_since(node, built_gen):
+                self._root_changed = True
+                # nodes that were inside the node might have been replaced
+                self._epoch += 1
+                self._mark_owners_changed(occ.owner, node_subtree_names(node))
+        return True
+
+    def _find_keys(self, keys):
+        result = []
+        for key in keys:
+            occs = self._by_name.get(key, None)
+            if not occs:
+                continue
+            stale = []
+            for nid, occ in occs.items():
+                if self._is_attached(occ):
+                    result.append(occ)
+                else:
+                    stale.append(nid)
+            for nid in stale:
+                del occs[nid]
+                self._occurrences.pop(nid, None)
+        return result
+
+    def _document_position(self, occ):
+        # A sort key giving the position of the node in the document: the
+        # path of (container number, slot) from the root, where macro
+        # arguments come before the contents of a node (cf. _child_containers())
+        path = []
+        while True:
+            owner = occ.owner
+            if owner is None:
+                path.append( (0, occ.slot) )
+                break
+            path.append( (1 if occ.container is getattr(owner, 'nodelist', None) else 0,
+                          occ.slot) )
+            occ = self._occurrences.get(id(owner), None)
+            if occ is None:
+                break
+        path.reverse()
+        return path
+
+    def replace(self, occ, new):
+        r"""
+        Replace the node at the location given by the occurrence `occ` (as
+        returned by :py:meth:`find()`) by `new`, which can be a node, a list of
+        nodes, or a string of LaTeX code that is parsed (like the return value
+        of :py:meth:`latexpp.fix.BaseFix.fix_node()`).  If the node is a macro
+        argument, then a list of nodes is placed in a group delimited by
+        braces.
+
+        The new nodes are not processed any further (call
+        :py:meth:`latexpp.fix.BaseFix.preprocess()` on them yourself if
+        needed).  The nodes that contain the replaced node are marked as
+        modified.
+        """
+        node = occ.node
+        container = occ.container
+        slot = occ.slot
+        if slot >= len(container) or container[slot] is not node:
+            # earlier replacements in the same list might have shifted the node
+            slot = next( (j for j, n in enumerate(container) if n is node), None )
+            if slot is None:
+                raise ValueError("Node to be replaced is no longer at its indexed "
+                                 "location: {!r}".format(node))
+
+        if isinstance(new, str):
+            new = self.lpp.parse_fragment(new, node.parsing_state)
+
+        if occ.is_argument():
+            if isinstance(new, (LatexNodeList, list)):
+                delimiters = ('{', '}')
+                if len(new) == 1 and new[0].isNodeType(latexwalker.LatexGroupNode):
+                    delimiters = ('', '')
+                new = node.parsing_state.lpp_latex_walker.make_node(
+                    latexwalker.LatexGroupNode,
+                    nodelist=new,
+                    delimiters=delimiters,
+                    parsing_state=node.parsing_state,
+                    pos=None, pos_end=None
+                )
+            update_node_state(new)
+            container[slot] = new
+            newnodes = [ new ]
+        else:
+            if isinstance(new, (LatexNodeList, list)):
+                newnodes = [ nn for nn in new if nn is not None ]
+            else:
+                newnodes = [ new ]
+            for nn in newnodes:
+                update_node_state(nn)
+            container[slot:slot+1] = newnodes
+            # same post-space protection as in BaseFix.preprocess()
+            for j in range(max(slot-1, 0), min(slot+len(newnodes), len(container)-1)):
+                if container[j].isNodeType(latexwalker.LatexMacroNode):
+                    _ensure_macro_node_maybe_post_space(container, j)
+
+            if len(newnodes) != 1:
+                # the following nodes in the same list have moved
+                occurrences = self._occurrences
+                for j in range(slot+len(newnodes), len(container)):
+                    n = container[j]
+                    nocc = occurrences.get(id(n), None)
+                    if nocc is not None and nocc.node is n \
+                       and nocc.container is container:
+                        nocc.slot = j
+
+        self._forget(node)
+        # entries in the replaced subtree are no longer valid, make sure the
+        # next query (and is_attached()) revalidates everything it returns
+        self._root_changed = True
+        self._epoch += 1
+
+        # mark the containing nodes as modified, and add the names that appear
+        # in the new nodes to their summaries (a summary may be a superset of
+        # the names in the subtree, so there is no need to recompute it from
+        # all the children)
+        newnames = set()
+        for nn in newnodes:
+            names = node_subtree_names(nn)
+            if names is None:
+                newnames = None
+                break
+            newnames.update(names)
+        self._mark_owners_changed(occ.owner, newnames)
+
+    def _mark_owners_changed(self, owner, newnames):
+        # mark `owner` and the nodes that contain it as modified, and add
+        # `newnames` (or unknown names if `None`) to their summaries
+        while owner is not None:
+            node_changed(owner)
+            names = node_subtree_names(owner)
+            if names is not None:
+                if newnames is None:
+                    owner._lpp_names = None
+                elif not newnames.issubset(names):
+                    owner._lpp_names = names.union(newnames)
+            owner_occ = self._occurrences.get(id(owner), None)
+            if owner_occ is None or owner_occ.node is not owner:
+                break
+            owner = owner_occ.owner
+
+    def _forget(self, node):
+        occ = self._occurrences.pop(id(node), None)
+        if occ is None or occ._key is None:
+            return
+        occs = self._by_name.get(occ._key, None)
+        if occs is not None:
+            occs.pop(id(node), None)
+
+    def _is_attached(self, occ):
+        # Check that the node is still in the document tree, by following its
+        # chain of owners up to a node that was reached from the root during
+        # the last update of the index.
+        epoch = self._epoch
+        while occ._epoch != epoch:
+            container = occ.container
+            if occ.slot >= len(container) or container[occ.slot] is not occ.node:
+                return False
+            owner = occ.owner
+            if owner is None:
+                return container is self.root
+            if not _owns(owner, container):
+                return False
+            occ = self._occurrences.get(id(owner), None)
+            if occ is None or occ.node is not owner:
+                return False
+        return True
+
+    def _update(self, keys):
+        # Make sure that the nodes with the name keys `keys` are indexed: index
+        # the parts of the tree that changed since the last update, and walk
+        # through the tree for keys that weren't indexed so far.  Only the
+        # subtrees whose summary of names (see node_subtree_names()) contains
+        # an indexed key are visited.
+
+        if self.root is None:
+            raise RuntimeError("NodeIndex: no document node list was set")
+
+        new_keys = frozenset(keys) - self._indexed_keys
+
+        built_gen = self._built_gen
+        if not new_keys and built_gen is not None and not self._root_changed \
+           and not any(n is not None and _node_changed_since(n, built_gen)
+                       for n in self.root):
+            # nothing changed
+            return
+
+        if built_gen is not None \
+           and len(self._occurrences) > 2 * self._full_build_size + 1000:
+            # too many stale entries have accumulated, start afresh
+            built_gen = None
+
+        if built_gen is None:
+            self._by_name = {}
+            self._occurrences = {}
+            new_keys = new_keys | self._indexed_keys
+            self._indexed_keys = frozenset()
+
+        self._epoch += 1
+        # modifications made from now on have a larger generation number
+        self._built_gen = next(_generation_counter)
+        self._root_changed = False
+
+        if self._indexed_keys:
+            # re-index what changed
+            self._index_walk(self._indexed_keys, built_gen)
+        if new_keys:
+            # index everything for the new keys
+            self._index_walk(new_keys, None)
+            self._indexed_keys = self._indexed_keys | new_keys
+            self._full_build_size = len(self._occurrences)
+
+    def _index_walk(self, keys, built_gen):
+        # Walk through the tree and index the nodes with the given name keys,
+        # along with the nodes that contain them.  If `built_gen` is not None,
+        # only descend into nodes that changed since that generation.
+        epoch = self._epoch
+        occurrences = self._occurrences
+        by_name = self._by_name
+
+        # stack of (owner, containers) to (re-)index
+        stack = [ (None, (self.root,)) ]
+        while stack:
+            owner, containers = stack.pop()
+            for container in containers:
+                for slot, n in enumerate(container):
+                    if n is None:
+                        continue
+                    names = node_subtree_names(n)
+                    if names is not None and names.isdisjoint(keys):
+                        # nothing of interest in this subtree
+                        continue
+                    if not hasattr(n, 'nodelist') and not hasattr(n, 'nodeargd'):
+                        # leaf node without a name (chars, comments, ...)
+                        continue
+                    occ = occurrences.get(id(n), None)
+                    if occ is None or occ.node is not n:
+                        key = node_name_key(n)
+                        occ = NodeOccurrence(n, container, slot, owner, key, epoch)
+                        occurrences[id(n)] = occ
+                        if key is not None:
+                            by_name.setdefault(key, {})[id(n)] = occ
+                        descend = True
+                    else:
+                        occ.container = container
+                        occ.slot = slot
+                        occ.owner = owner
+                        occ._epoch = epoch
+                        descend = (built_gen is None
+                                   or _node_changed_since(n, built_gen))
+                        if descend:
+                            key = node_name_key(n)
+                            if key != occ._key:
+                                # the node was renamed
+                                if occ._key is not None:
+                                    by_name.get(occ._key, {}).pop(id(n), None)
+                                if key is not None:
+                                    by_name.setdefault(key, {})[id(n)] = occ
+                                occ._key = key
+                    if descend:
+                        child_containers = _child_containers(n)
+                        if child_containers:
+                            stack.append( (n, child_containers) )
+
+
+def _node_changed_since(n, gen):
+    ngen = getattr(n, '_lpp_gen', None)
+    return ngen is None or ngen > gen
+
+def _child_containers(n):
+    containers = []
+    nodeargd = getattr(n, 'nodeargd', None)
+    if nodeargd is not None and getattr(nodeargd, 'argnlist', None):
+        containers.append(nodeargd.argnlist)
+    nodelist = getattr(n, 'nodelist', None)
+    if nodelist:
+        containers.append(nodelist)
+    return containers
+
+def _owns(owner, container):
+    if getattr(owner, 'nodelist', None) is container:
+        return True
+    nodeargd = getattr(owner, 'nodeargd', None)
+    return nodeargd is not None and getattr(nodeargd, 'argnlist', None) is container
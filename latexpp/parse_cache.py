@@ -0,0 +1,516 @@
+r"""
+Persistent, content-addressed cache of parsed documents.
+
+Parsing is often the most expensive step of a `latexpp` run, and it is
+repeated for the main document and for each input file on every run even if
+nothing changed.  A :py:class:`PersistentParseCache` stores the node trees
+obtained by parsing a file in a directory on disk, and returns them on later
+runs instead of parsing the file again.
+
+Entries are keyed by:
+
+- a hash of the parsed LaTeX code (and of the position parsing starts at);
+
+- a fingerprint of the latex context database that the code is parsed with,
+  which includes the macro, environment and specials specs of all installed
+  fixes (see :py:meth:`latexpp.fix.BaseFix.specs()`);
+
+- the versions of `pylatexenc`, `latexpp` and Python.
+
+so that an entry is only used if parsing the code again would produce the
+same nodes.
+
+The node trees are serialized with :py:mod:`pickle` and compressed with
+:py:mod:`zlib`.  Objects that the nodes share with the latex walker that
+parsed them (the walker itself, the parsed string, the latex context
+database and the macro, environment and specials specs that it contains) are
+stored as references, which are resolved against the latex walker of the new
+run when an entry is loaded.
+
+Some documents can't be stored, because parsing them creates objects that
+can't be serialized.  This is the case, for instance, of documents that
+define macros with ``\newcommand`` when the
+:py:class:`latexpp.fixes.newcommand.Expand` fix is installed (the parser then
+creates specs for the new macros).  The cache remembers these documents and
+parses them on each run, while the other documents (e.g., the ``\input``
+files) are still loaded from the cache.
+
+The cache directory is bounded in size: when it grows above `max_size`, the
+least recently used entries are removed.  Several `latexpp` processes can use
+the same cache directory concurrently.  Entries are written to a temporary
+file which is then renamed into place, so readers never see partially
+written entries, and writers hold an exclusive lock on the cache directory
+(on systems that provide :py:func:`fcntl.flock()`) while they add entries
+and evict old ones.
+
+.. warning::
+
+   Loading an entry unpickles it, which can run arbitrary code.  Only use a
+   cache directory that no untrusted user can write to.
+"""
+
+import os
+import os.path
+import sys
+import io
+import zlib
+import pickle
+import hashlib
+import types
+import tempfile
+import weakref
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError: # e.g. on Windows
+    fcntl = None
+
+from pylatexenc import latexwalker
+
+from . import __version__ as latexpp_version_str
+from ._lpp_parsing import (
+    _lpp_node_classes, latex_context_version, renew_node_generations,
+)
+
+
+# bump this whenever the format of the entries changes
+_CACHE_FORMAT = 1
+
+_ENTRY_MAGIC = b'LPPC' + str(_CACHE_FORMAT).encode('ascii') + b'\n'
+# contents of the entry of a document whose nodes can't be stored
+_UNCACHEABLE_ENTRY = _ENTRY_MAGIC + b'-'
+_UNCACHEABLE = object()
+_ENTRY_SUFFIX = '.lppc'
+
+# a cache directory may grow to this size (in bytes) by default
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+_node_classes_by_name = {
+    cls.__name__: lppcls for cls, lppcls in _lpp_node_classes.items()
+}
+_node_class_names = {
+    id(lppcls): ('class', cls.__name__) for cls, lppcls in _lpp_node_classes.items()
+}
+
+
+def get_default_cache_dir():
+    r"""
+    Return the default cache directory, ``latexpp/parse`` in the user's cache
+    directory (``$XDG_CACHE_HOME``, or ``~/.cache``).
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME', '') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'latexpp', 'parse')
+
+
+def latex_context_fingerprint(latex_context):
+    r"""
+    Return a string that identifies the macro, environment and specials specs
+    defined in the given latex context database.  Two latex contexts with the
+    same fingerprint parse LaTeX code in the same way.
+
+    The specs are described by their class and by the values of their
+    attributes, recursively, including the arguments parsers that they refer
+    to, rather than by their `repr()`, which need not show their whole
+    configuration.
+    """
+    h = hashlib.sha256()
+    def add(x):
+        h.update(_describe(x).encode('utf-8'))
+        h.update(b'\0')
+    d = latex_context.d
+    for cat in latex_context.category_list:
+        add(cat)
+        specs = d[cat]
+        if not isinstance(specs, dict):
+            continue
+        for what in ('macros', 'environments', 'specials'):
+            for name, spec in sorted(specs.get(what, {}).items(), key=lambda x: x[0]):
+                add( (what, name, spec) )
+    for what in ('unknown_macro_spec', 'unknown_environment_spec',
+                 'unknown_specials_spec'):
+        add( (what, getattr(latex_context, what, None)) )
+    return h.hexdigest()
+
+
+# objects that specs might refer to but that don't determine how code is
+# parsed (or that lead to whole documents); only their class is described
+_opaque_types = tuple(
+    t for t in (getattr(latexwalker, 'LatexNode', None),
+                getattr(latexwalker, 'LatexWalker', None),
+                getattr(latexwalker, 'ParsingState', None))
+    if t is not None
+)
+
+# how deep _describe() goes into the attributes of objects
+_DESCRIBE_MAX_DEPTH = 12
+
+def _describe(x, depth=0, seen=None):
+    r"""
+    Return a string that describes the object `x` by its type and its value:
+    the items of containers and the attributes of other objects are
+    described recursively, and functions are described by their qualified
+    name and their code.  Memory addresses never appear in the result.
+    """
+    if seen is None:
+        seen = set()
+
+    if x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+        return repr(x)
+    if isinstance(x, type):
+        return 'class:{}.{}'.format(x.__module__, x.__qualname__)
+    if isinstance(x, types.MethodType):
+        return 'method:{}.{}'.format(_describe(x.__func__, depth, seen),
+                                     _describe(x.__self__, depth, seen))
+    if isinstance(x, (types.FunctionType, types.BuiltinFunctionType)):
+        code = getattr(x, '__code__', None)
+        return 'function:{}.{}:{}'.format(
+            getattr(x, '__module__', None), getattr(x, '__qualname__', None),
+            hashlib.sha256(code.co_code).hexdigest() if code is not None else '',
+        )
+
+    clsname = _describe(type(x))
+    if isinstance(x, _opaque_types) or depth >= _DESCRIBE_MAX_DEPTH:
+        return clsname
+    if id(x) in seen:
+        return clsname + '<cycle>'
+    seen.add(id(x))
+    try:
+        depth += 1
+        if isinstance(x, (list, tuple)):
+            items = [ _describe(y, depth, seen) for y in x ]
+        elif isinstance(x, (set, frozenset)):
+            items = sorted( _describe(y, depth, seen) for y in x )
+        elif isinstance(x, dict):
+            items = sorted( _describe(k, depth, seen) + ':' + _describe(v, depth, seen)
+                            for k, v in x.items() )
+        else:
+            fields = dict(getattr(x, '__dict__', {}))
+            for cls in type(x).__mro__:
+                slots = getattr(cls, '__slots__', ())
+                if isinstance(slots, str):
+                    slots = (slots,)
+                for slot in slots:
+                    if slot not in fields and hasattr(x, slot):
+                        fields[slot] = getattr(x, slot)
+            items = [ '{}={}'.format(k, _describe(v, depth, seen))
+                      for k, v in sorted(fields.items())
+                      if k != '__weakref__' ]
+        return '{}({})'.format(clsname, ','.join(items))
+    finally:
+        seen.discard(id(x))
+
+
+class _ContextRefs:
+    # The objects of a latex context database that are stored as references
+    # in the cache entries, and the fingerprint of the database
+    def __init__(self, latex_context):
+        self.version = latex_context_version(latex_context)
+        self.fingerprint = latex_context_fingerprint(latex_context)
+        self.spec_refs = {}
+        for kind, iter_specs, get_spec, attr in (
+                ('macro', latex_context.iter_macro_specs,
+                 latex_context.get_macro_spec, 'macroname'),
+                ('environment', latex_context.iter_environment_specs,
+                 latex_context.get_environment_spec, 'environmentname'),
+                ('specials', latex_context.iter_specials_specs,
+                 latex_context.get_specials_spec, 'specials_chars'),
+        ):
+            for spec in iter_specs():
+                name = getattr(spec, attr)
+                if get_spec(name) is spec: # not overridden by another category
+                    self.spec_refs[id(spec)] = (kind, name)
+            unknown = getattr(latex_context, 'unknown_{}_spec'.format(kind), None)
+            if unknown is not None:
+                self.spec_refs[id(unknown)] = (kind + '-unknown',)
+
+
+class _NodesPickler(pickle.Pickler):
+    def __init__(self, file, lw, refs):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.lw = lw
+        self.latex_context = lw.lpp.latex_context
+        self.refs = refs
+
+    def persistent_id(self, obj):
+        if obj is self.lw:
+            return ('latex_walker',)
+        if obj is self.lw.s:
+            return ('s',)
+        if obj is self.latex_context:
+            return ('latex_context',)
+        if obj is self.lw.lpp:
+            return ('lpp',)
+        ref = self.refs.spec_refs.get(id(obj), None)
+        if ref is None:
+            ref = _node_class_names.get(id(obj), None)
+        return ref
+
+
+class _NodesUnpickler(pickle.Unpickler):
+    def __init__(self, file, lw):
+        super().__init__(file)
+        self.lw = lw
+        self.latex_context = lw.lpp.latex_context
+
+    def persistent_load(self, pid):
+        what = pid[0]
+        if what == 'latex_walker':
+            return self.lw
+        if what == 's':
+            return self.lw.s
+        if what == 'latex_context':
+            return self.latex_context
+        if what == 'lpp':
+            return self.lw.lpp
+        if what == 'class':
+            return _node_classes_by_name[pid[1]]
+        ctx = self.latex_context
+        if what.endswith('-unknown'):
+            spec = getattr(ctx, 'unknown_{}_spec'.format(what[:-len('-unknown')]))
+        elif what == 'macro':
+            spec = ctx.get_macro_spec(pid[1])
+        elif what == 'environment':
+            spec = ctx.get_environment_spec(pid[1])
+        elif what == 'specials':
+            spec = ctx.get_specials_spec(pid[1])
+        else:
+            spec = None
+        if spec is None:
+            raise pickle.UnpicklingError("Can't resolve reference {!r}".format(pid))
+        return spec
+
+
+class PersistentParseCache:
+    r"""
+    Cache of parsed documents in the directory `directory` (created if
+    necessary; see :py:mod:`latexpp.parse_cache`).
+
+    - `max_size` is the maximum total size of the cache entries, in bytes.
+      When it is exceeded, the least recently used entries are removed.
+
+    - `compress_level` is the :py:mod:`zlib` compression level of the
+      entries.
+
+    Attributes `hits`, `misses`, `stores` and `evictions` count the documents
+    that were loaded from the cache, the documents that had to be parsed, the
+    entries that were written and the entries that were removed to limit the
+    size of the cache.
+
+    Set the `persistent_parse_cache` attribute of a
+    :py:class:`latexpp.preprocessor.LatexPreprocessor` to an instance of this
+    class to use it.
+    """
+    def __init__(self, directory=None, *, max_size=DEFAULT_MAX_SIZE, compress_level=6):
+        super().__init__()
+        if directory is None:
+            directory = get_default_cache_dir()
+        self.directory = directory
+        self.max_size = max_size
+        self.compress_level = compress_level
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        # latex context -> _ContextRefs
+        self._context_refs = weakref.WeakKeyDictionary()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_nodes(self, lw, pos, parse_fn):
+        r"""
+        Return the node list obtained by parsing the string of the latex walker
+        `lw` (created by
+        :py:meth:`latexpp.preprocessor.LatexPreprocessor.make_latex_walker()`)
+        starting at position `pos`.  If it is not in the cache,
+        `parse_fn(lw, pos)` is called to parse it, and the result is stored in
+        the cache.
+        """
+        refs = self._get_context_refs(lw.lpp.latex_context)
+        key = self._make_key(lw, pos, refs)
+
+        nodelist = self._load(key, lw)
+        if nodelist is _UNCACHEABLE:
+            self.misses += 1
+            return parse_fn(lw, pos)
+        if nodelist is not None:
+            self.hits += 1
+            return nodelist
+
+        self.misses += 1
+        nodelist = parse_fn(lw, pos)
+        self._store(key, lw, refs, nodelist)
+        return nodelist
+
+    def clear(self):
+        r"""
+        Remove all entries from the cache directory.
+        """
+        with self._lock():
+            for path, _, _ in self._list_entries():
+                _remove_file(path)
+
+    def total_size(self):
+        r"""
+        Return the total size of all cache entries, in bytes.
+        """
+        return sum(size for _, size, _ in self._list_entries())
+
+    def _get_context_refs(self, latex_context):
+        refs = self._context_refs.get(latex_context, None)
+        if refs is None or refs.version != latex_context_version(latex_context):
+            refs = _ContextRefs(latex_context)
+            self._context_refs[latex_context] = refs
+        return refs
+
+    def _make_key(self, lw, pos, refs):
+        h = hashlib.sha256()
+        for x in (str(_CACHE_FORMAT), latexpp_version_str, _get_pylatexenc_version(),
+                  '{}.{}'.format(*sys.version_info[:2]),
+                  type(lw).__module__ + '.' + type(lw).__qualname__,
+                  refs.fingerprint, str(pos)):
+            h.update(x.encode('utf-8'))
+            h.update(b'\0')
+        h.update(lw.s.encode('utf-8', errors='surrogatepass'))
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + _ENTRY_SUFFIX)
+
+    def _load(self, key, lw):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data == _UNCACHEABLE_ENTRY:
+            self._touch(path)
+            return _UNCACHEABLE
+        try:
+            if not data.startswith(_ENTRY_MAGIC):
+                raise ValueError("invalid cache entry header")
+            data = zlib.decompress(data[len(_ENTRY_MAGIC):])
+            nodelist = _NodesUnpickler(io.BytesIO(data), lw).load()
+        except Exception as e:
+            logger.debug("Ignoring invalid parse cache entry %s: %s", path, e)
+            _remove_file(path)
+            return None
+        renew_node_generations(nodelist)
+        self._touch(path)
+        logger.debug("Loaded parsed nodes from cache entry %s", path)
+        return nodelist
+
+    def _touch(self, path):
+        # mark the entry as most recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _store(self, key, lw, refs, nodelist):
+        buf = io.BytesIO()
+        try:
+            _NodesPickler(buf, lw, refs).dump(nodelist)
+        except (pickle.PicklingError, TypeError, AttributeError, RecursionError) as e:
+            # remember not to try again
+            logger.debug("Can't store parsed nodes in the parse cache: %s", e)
+            data = _UNCACHEABLE_ENTRY
+        else:
+            data = _ENTRY_MAGIC + zlib.compress(buf.getvalue(), self.compress_level)
+        del buf
+
+        path = self._entry_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            with self._lock():
+                os.makedirs(dirname, exist_ok=True)
+                fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmpname, path)
+                except BaseException:
+                    _remove_file(tmpname)
+                    raise
+                self.stores += 1
+                self._evict(keep=path)
+        except OSError as e:
+            logger.warning("Can't write to the parse cache %s: %s", self.directory, e)
+
+    def _evict(self, keep=None):
+        # must be called with the lock held.  Never evict the entry `keep` that
+        # was just written (mtimes might not be fine-grained enough to tell)
+        entries = self._list_entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+        entries.sort(key=lambda e: e[2])
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            if _remove_file(path):
+                self.evictions += 1
+                logger.debug("Evicted parse cache entry %s", path)
+            total -= size
+
+    def _list_entries(self):
+        # list of (path, size, mtime) of all entries
+        entries = []
+        try:
+            subdirs = os.scandir(self.directory)
+        except OSError:
+            return entries
+        with subdirs:
+            for sub in subdirs:
+                if not sub.is_dir():
+                    continue
+                try:
+                    with os.scandir(sub.path) as it:
+                        for e in it:
+                            if not e.name.endswith(_ENTRY_SUFFIX):
+                                continue
+                            try:
+                                st = e.stat()
+                            except OSError:
+                                continue # removed by another process
+                            entries.append( (e.path, st.st_size, st.st_mtime) )
+                except OSError:
+                    continue
+        return entries
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _get_pylatexenc_version():
+    try:
+        from pylatexenc.version import version_str
+    except ImportError:
+        return ''
+    return version_str
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
@@ -61,11 +61,15 @@ class PragmaFix(BaseFix):
         Reimplemented from :py:class:`latexpp.fix.BaseFix`.  Subclasses should
         generally not reimplement this.
         """
-        newnodelist = list(nodelist)
-
-        for n in newnodelist:
+        for n in nodelist:
             self.preprocess_child_nodes(n)
 
+        if not any(self._maybe_pragma(n) for n in nodelist):
+            # nothing to do at this level, don't copy the list
+            return nodelist
+
+        newnodelist = list(nodelist)
+
         self._do_pragmas(newnodelist)
 
         return newnodelist
@@ -199,6 +203,12 @@ class PragmaFix(BaseFix):
         return
 
 
+    def _maybe_pragma(self, node):
+        # quick check whether node might be a pragma, see _parse_pragma()
+        return node is not None \
+            and node.isNodeType(latexwalker.LatexCommentNode) \
+            and rx_lpp_pragma.match(node.comment) is not None
+
     def _parse_pragma(self, node):
         if not node:
             return None
@@ -3,11 +3,13 @@ This module provides the main preprocessor engine.
 """
 
 import sys
+import io
 import os
 import os.path
 import shutil
 #import re
 import datetime
+import contextlib
 import importlib
 
 import logging
@@ -26,7 +28,12 @@ from .fixes.builtin.skip import SkipPragma
 
 
 
-from ._lpp_parsing import _LPPLatexWalker #, LatexCodeRecomposer, _LPPParsingState
+from ._lpp_parsing import _LPPLatexWalker, FragmentParseCache, parsing_state_key #, LatexCodeRecomposer, _LPPParsingState
+from ._lpp_fused import FusedFixRunner, split_fix_groups
+from .node_builder import LatexNodesBuilder
+from .node_index import NodeIndex
+from .symbols import DocumentSymbols
+from .events import EventDispatcher
 
 
 
@@ -41,6 +48,37 @@ _PROCESSED_BY_HEADING = r"""
 % See https://github.com/phfaist/latexpp
 """.lstrip()
 
+# size (in characters) of the chunks in which output is written to files
+_OUTPUT_CHUNK_SIZE = 65536
+
+
+class _ChunkedWriter:
+    # Collect small pieces of output and write them to `stream` in chunks of
+    # about `chunk_size` characters.  If `encoding` is given, `total_bytes`
+    # counts the size of the written output in that encoding.
+    def __init__(self, stream, chunk_size=None, encoding=None):
+        self.stream = stream
+        self.chunk_size = chunk_size if chunk_size is not None else _OUTPUT_CHUNK_SIZE
+        self.encoding = encoding
+        self.pieces = []
+        self.size = 0
+        self.total_bytes = 0
+
+    def write(self, x):
+        self.pieces.append(x)
+        self.size += len(x)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            chunk = ''.join(self.pieces)
+            self.stream.write(chunk)
+            if self.encoding is not None:
+                self.total_bytes += len(chunk.encode(self.encoding, 'replace'))
+            self.pieces = []
+            self.size = 0
+
 
 class _TemporarilySetSysPath:
     def __init__(self, dir):
@@ -90,8 +128,8 @@ class LatexPreprocessor:
     friends) are called.
 
     The actual processing is performed by calling one of
-    :py:meth:`execute_main()`, :py:meth:`execute_file()`, or
-    :py:meth:`execute_string()`.  These parse the corresponding LaTeX code into
+    :py:meth:`execute_main()`, :py:meth:`execute_file()`,
+    :py:meth:`execute_string()`, or :py:meth:`execute_stream()`.  These parse the corresponding LaTeX code into
     nodes and runs all fixes.
 
     After calling the `execute_*()` methods as required, you should call
@@ -113,6 +151,73 @@ class LatexPreprocessor:
        This attribute is used for sub-preprocessors.  See
        :py:meth:`create_subpreprocessor()`.
 
+    .. py:attribute:: fuse_fixes
+
+       If set to `True` (the default is `False`), then consecutive fixes that
+       only act through :py:meth:`latexpp.fix.BaseFix.fix_node()` are applied
+       together in a single walk through the document instead of each fix
+       walking the full document separately.  The result is the same for the
+       built-in fixes, but fixes that inspect the `prev_node` or `next_node`
+       given to their `fix_node()` might see these nodes in a different state
+       (see :py:mod:`latexpp._lpp_fused`).  Fixes that need to see the whole
+       document (e.g., multi-stage fixes or pragma fixes) are still run
+       separately.  See also
+       :py:meth:`latexpp.fix.BaseFix.triggers()`.  Set this attribute before
+       calling :py:meth:`initialize()`.  Fixes are not fused when a
+       :py:attr:`segment_recorder` is set.
+
+    .. py:attribute:: nodes
+
+       A :py:class:`latexpp.node_builder.LatexNodesBuilder` instance that fixes
+       can use to create new nodes directly, rather than returning LaTeX code
+       that needs to be parsed again.
+
+    .. py:attribute:: node_index
+
+       While the fixes are being run by :py:meth:`preprocess()`, this is a
+       :py:class:`latexpp.node_index.NodeIndex` instance that fixes can use to
+       find all occurrences of given macros or environments in the document
+       without walking the whole document tree.  It is `None` otherwise.
+
+    .. py:attribute:: symbols
+
+       A :py:class:`latexpp.symbols.DocumentSymbols` instance that provides
+       tables of the labels, references, citations, packages, etc. of the
+       document that is being processed, which fixes can use instead of
+       scanning the document themselves.  The tables are only available while
+       the fixes are being run by :py:meth:`preprocess()`.
+
+    .. py:attribute:: parse_cache
+
+       A :py:class:`latexpp._lpp_parsing.FragmentParseCache` instance that
+       memoizes the parsing of LaTeX code fragments returned by fixes (see
+       :py:meth:`parse_fragment()`).  Its `hits` and `misses` attributes count
+       how often a parse could be avoided.  Set `parse_cache.maxsize` to change
+       the number of cached fragments (zero disables the cache).
+
+    .. py:attribute:: persistent_parse_cache
+
+       Set this attribute to a :py:class:`latexpp.parse_cache.PersistentParseCache`
+       instance to store the parsed nodes of the documents on disk and reuse
+       them in later runs when the documents didn't change (see
+       :py:mod:`latexpp.parse_cache`).  Sub-preprocessors share the cache of
+       their parent.  The default, `None`, parses the documents on each run.
+
+    .. py:attribute:: metrics
+
+       Set this attribute to a :py:class:`latexpp.metrics.MetricsRecorder`
+       instance to record the time spent in each fix and other per-fix metrics
+       (see :py:mod:`latexpp.metrics`).  The recorder is registered as an
+       observer (see :py:meth:`add_observer()`).  Sub-preprocessors share the
+       recorder of their parent.  The default, `None`, records nothing.
+
+    .. py:attribute:: segment_recorder
+
+       A :py:class:`latexpp.incremental.SegmentRecorder` instance that records
+       the output of each ``\input`` file of the main document separately, for
+       incremental runs (see :py:mod:`latexpp.incremental`), or `None` (the
+       default).  Set this attribute before calling :py:meth:`initialize()`.
+
     Methods:
     """
     def __init__(self, *,
@@ -157,6 +262,93 @@ class LatexPreprocessor:
         # set to non-None if this is a sub-preprocessor of a main preprocessor
         self.parent_preprocessor = None
 
+        # apply fix_node()-only fixes together in a single document walk
+        self.fuse_fixes = False
+        self._fix_groups = None
+
+        # memoized parsing of replacement latex code returned by fixes
+        self.parse_cache = FragmentParseCache()
+        # parsing states used to parse replacement latex code, shared by all
+        # fragments parsed with equivalent states (see _do_parse_fragment())
+        self._fragment_parsing_states = {}
+
+        # parsed documents stored on disk across runs (see
+        # latexpp.parse_cache)
+        self.persistent_parse_cache = None
+
+        # helper for fixes to create new nodes
+        self.nodes = LatexNodesBuilder(self)
+
+        # index of macro & environment occurrences in the document being
+        # processed (see preprocess())
+        self.node_index = None
+
+        # symbol tables (labels, refs, etc.) of the document being processed
+        self.symbols = DocumentSymbols(self)
+
+        # observers of preprocessing events (see add_observer()).  The
+        # dispatcher is None when there are no observers, in which case no
+        # events are emitted at all.
+        self._observers = []
+        self._event_dispatcher = None
+
+        # per-fix metrics recorder (a latexpp.metrics.MetricsRecorder), or None
+        self._metrics = None
+
+        # records the output of each \input file of the main document (a
+        # latexpp.incremental.SegmentRecorder), or None
+        self.segment_recorder = None
+
+    def add_observer(self, observer):
+        r"""
+        Register `observer`, a :py:class:`latexpp.events.PreprocessorObserver`
+        instance, to be notified of the events of this preprocessor and of all
+        its sub-preprocessors (see :py:mod:`latexpp.events`).  Observers of a
+        sub-preprocessor are registered with its root preprocessor.
+        """
+        root = self._root_preprocessor()
+        root._observers.append(observer)
+        root._event_dispatcher = EventDispatcher(root._observers)
+
+    def remove_observer(self, observer):
+        r"""
+        Unregister an observer that was registered with :py:meth:`add_observer()`.
+        """
+        root = self._root_preprocessor()
+        root._observers.remove(observer)
+        if root._observers:
+            root._event_dispatcher = EventDispatcher(root._observers)
+        else:
+            root._event_dispatcher = None
+
+    @property
+    def _events(self):
+        # The object to which events should be sent (a
+        # latexpp.events.EventDispatcher), or None if nobody is listening.
+        # Check this once per file/fix/node list, never per node.
+        return self._root_preprocessor()._event_dispatcher
+
+    def _root_preprocessor(self):
+        pp = self
+        while pp.parent_preprocessor is not None:
+            pp = pp.parent_preprocessor
+        return pp
+
+    @property
+    def metrics(self):
+        return self._root_preprocessor()._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        root = self._root_preprocessor()
+        if metrics is root._metrics:
+            return
+        if root._metrics is not None:
+            root.remove_observer(root._metrics)
+        root._metrics = metrics
+        if metrics is not None:
+            root.add_observer(metrics)
+
 
     def install_fix(self, fix, *, prepend=False):
         r"""
@@ -244,6 +436,18 @@ class LatexPreprocessor:
                     **specs
                 )
 
+        # the fixes' specs changed the latex context
+        self.parse_cache.clear()
+
+        if self.fuse_fixes and self.segment_recorder is None:
+            self._fix_groups = []
+            for is_fused, fixes in split_fix_groups(self.fixes):
+                if is_fused and len(fixes) > 1:
+                    self._fix_groups.append( (fixes, FusedFixRunner(fixes)) )
+                else:
+                    self._fix_groups += [ ([fix], fix) for fix in fixes ]
+        else:
+            self._fix_groups = [ ([fix], fix) for fix in self.fixes ]
 
         self.initialized = True
 
@@ -261,6 +465,13 @@ class LatexPreprocessor:
         for fix in self.fixes:
             fix.finalize()
 
+        logger.debug("fragment parse cache: %d hits, %d misses",
+                     self.parse_cache.hits, self.parse_cache.misses)
+        if self.persistent_parse_cache is not None and not self.parent_preprocessor:
+            logger.debug("persistent parse cache: %d hits, %d misses",
+                         self.persistent_parse_cache.hits,
+                         self.persistent_parse_cache.misses)
+
         if self.parent_preprocessor:
             # report other new files
             self.parent_preprocessor.output_files += self.output_files
@@ -319,17 +530,72 @@ class LatexPreprocessor:
         Unless `omit_processed_by` is set to `True`, the output file will start
         with a brief comment stating that it was the result of preprocessing by
         *latexpp*.
+
+        The output is written to the file in chunks as it is being recomposed
+        from the processed nodes, without assembling the full output in memory
+        first.
         """
 
+        events = self._events
+        if events is None:
+            self._execute_file(fname, output_fname=output_fname,
+                               omit_processed_by=omit_processed_by)
+            return
+        with events.scope('file_start', 'file_end', self, fname):
+            self._execute_file(fname, output_fname=output_fname,
+                               omit_processed_by=omit_processed_by)
+
+    def _execute_file(self, fname, *, output_fname, omit_processed_by):
+
+        events = self._events
+        if events is not None:
+            events.file_read(self, fname)
+
         with open(self._resolve_source_fname(fname), 'r') as f:
             s = f.read()
 
-        outdata = self.execute_string(s, input_source='file ‘{}’'.format(fname))
+        if fname == self.main_doc_fname:
+            # fixes that need the original main document can get it from here
+            # without reading the file again
+            self.symbols.set_main_doc_source(s)
+
+        recorder = self.segment_recorder
+        if recorder is not None and fname == self.main_doc_fname:
+            # record the output of each \input file of the main document
+            # separately (see latexpp.incremental)
+            recorder.start_document()
+        else:
+            recorder = None
+
+        lw, newnodelist = self._parse_and_preprocess(
+            s,
+            input_source='file ‘{}’'.format(fname)
+        )
+
+        # don't keep a reference to the full input string here, the latex
+        # walker has it if it still needs it
+        del s
 
         self.register_output_file(output_fname)
 
+        # input files may live in subdirectories (e.g. \input{chapters/intro})
+        destdn = os.path.dirname(output_fname)
+        if destdn:
+            self._do_ensure_destdir(os.path.join(self.output_dir, destdn), destdn)
+
         with open(os.path.join(self.output_dir, output_fname), 'w') as f:
-            f.write(outdata)
+            if recorder is None:
+                self._write_output(lw, newnodelist, f,
+                                   omit_processed_by=omit_processed_by,
+                                   output_fname=output_fname)
+                return
+            # the segment markers are written out as sentinel strings, which
+            # the recorder removes after having noted their positions
+            buf = io.StringIO()
+            self._write_output(lw, newnodelist, buf, omit_processed_by=True,
+                               output_fname=output_fname)
+            self._write_processed_by_heading(f, omit_processed_by)
+            f.write(recorder.end_document(buf.getvalue()))
 
     def execute_string(self, s, *, pos=0, input_source=None, omit_processed_by=False):
         r"""
@@ -343,14 +609,35 @@ class LatexPreprocessor:
         with a brief comment stating that it was the result of preprocessing by
         *latexpp*.
         """
+        sink = io.StringIO()
+        self.execute_stream(s, sink, pos=pos, input_source=input_source,
+                            omit_processed_by=omit_processed_by)
+        return sink.getvalue()
 
-        if self.omit_processed_by:
-            omit_processed_by = True
+    def execute_stream(self, s, stream, *, pos=0, input_source=None,
+                       omit_processed_by=False):
+        r"""
+        Same as :py:meth:`execute_string()`, but instead of returning the
+        preprocessed LaTeX code, write it to `stream` (any object with a
+        `write()` method accepting strings, e.g., a file opened in text mode).
+        The output is written in chunks as it is being recomposed.
+        """
+        lw, newnodelist = self._parse_and_preprocess(s, pos=pos,
+                                                     input_source=input_source)
+        self._write_output(lw, newnodelist, stream,
+                           omit_processed_by=omit_processed_by)
+
+    def _parse_and_preprocess(self, s, *, pos=0, input_source=None):
 
         lw = self.make_latex_walker(s)
-        
+
+        events = self._events
         try:
-            (nodelist, pos, len_) = lw.get_latex_nodes(pos=pos)
+            if events is None:
+                nodelist = self.parse_nodes(lw, pos)
+            else:
+                with events.scope('step_start', 'step_end', self, '<parse>'):
+                    nodelist = self.parse_nodes(lw, pos)
         except latexwalker.LatexWalkerParseError as e:
             if input_source and not e.input_source:
                 e.input_source = input_source
@@ -358,18 +645,57 @@ class LatexPreprocessor:
 
         newnodelist = self.preprocess(nodelist)
 
-        newstr = ''.join(n.to_latex() for n in newnodelist)
-        
-        if not omit_processed_by:
-            return (
-                _PROCESSED_BY_HEADING.format(
-                    version=__version__,
-                    today=get_datetime_now_tzaware().strftime("%a, %d-%b-%Y %H:%M:%S %Z%z")
-                )
-                + newstr
-            )
+        return lw, newnodelist
 
-        return newstr
+    def parse_nodes(self, lw, pos=0):
+        r"""
+        Parse the string of the latex walker `lw` (see
+        :py:meth:`make_latex_walker()`) starting at position `pos`, and return
+        the resulting node list.  Unlike calling `lw.get_latex_nodes()`
+        directly, this reuses the nodes stored in the
+        :py:attr:`persistent_parse_cache`, if there is one.
+        """
+        cache = self.persistent_parse_cache
+        if cache is not None:
+            return cache.get_nodes(lw, pos, self._do_parse_nodes)
+        return self._do_parse_nodes(lw, pos)
+
+    def _do_parse_nodes(self, lw, pos):
+        (nodelist, pos, len_) = lw.get_latex_nodes(pos=pos)
+        return nodelist
+
+    def _write_output(self, lw, newnodelist, stream, *, omit_processed_by,
+                      output_fname=None):
+
+        self._write_processed_by_heading(stream, omit_processed_by)
+
+        events = self._events
+        if events is None:
+            writer = _ChunkedWriter(stream)
+            lw.write_nodes(newnodelist, writer.write)
+            writer.flush()
+            return
+        # count bytes in the encoding of the output file (string buffers
+        # don't have one, count them in UTF-8)
+        writer = _ChunkedWriter(stream,
+                                encoding=getattr(stream, 'encoding', None) or 'utf-8')
+        with events.scope('step_start', 'step_end', self, '<output>'):
+            lw.write_nodes(newnodelist, writer.write)
+            writer.flush()
+            events.output_written(self, output_fname, writer.total_bytes)
+
+
+    def _write_processed_by_heading(self, stream, omit_processed_by):
+
+        if self.omit_processed_by or omit_processed_by:
+            return
+
+        stream.write(
+            _PROCESSED_BY_HEADING.format(
+                version=__version__,
+                today=get_datetime_now_tzaware().strftime("%a, %d-%b-%Y %H:%M:%S %Z%z")
+            )
+        )
 
 
     def preprocess(self, nodelist):
@@ -380,6 +706,14 @@ class LatexPreprocessor:
         if not self.initialized:
             raise RuntimeError("You forgot to call LatexPreprocessor.initialize()")
 
+        events = self._events
+        if events is None:
+            return self._preprocess(nodelist)
+        with events.scope('preprocess_start', 'preprocess_end', self):
+            return self._preprocess(nodelist)
+
+    def _preprocess(self, nodelist):
+
         newnodelist = list(nodelist)
 
         #
@@ -387,7 +721,8 @@ class LatexPreprocessor:
         #
         skip_pragma_fix = SkipPragma()
         skip_pragma_fix.set_lpp(self)
-        newnodelist = skip_pragma_fix.preprocess(newnodelist)
+        with self._fix_scope([skip_pragma_fix]):
+            newnodelist = skip_pragma_fix.preprocess(newnodelist)
 
         #
         # do add_preamble if necessary
@@ -396,30 +731,53 @@ class LatexPreprocessor:
             n = newnodelist[j]
             if n is not None and n.isNodeType(latexwalker.LatexEnvironmentNode) \
                and n.environmentname == 'document':
-                # here is where we should insert preamble instructions.
-                add_preamble = ''
+                # here is where we should insert preamble instructions.  Fixes
+                # may return strings, which are parsed, or nodes (e.g. opaque
+                # verbatim splice nodes), which are inserted as they are.
+                add_preamble = [ self.add_preamble_comment_start ]
+                have_preamble = False
                 for fix in self.fixes:
                     p = fix.add_preamble()
-                    if p:
-                        add_preamble += p
-
-                if not add_preamble.strip():
+                    if not p:
+                        continue
+                    if isinstance(p, str):
+                        if p.strip():
+                            have_preamble = True
+                        if isinstance(add_preamble[-1], str):
+                            add_preamble[-1] += p
+                        else:
+                            add_preamble.append(p)
+                        continue
+                    have_preamble = True
+                    if isinstance(p, latexwalker.LatexNode):
+                        add_preamble.append(p)
+                    else:
+                        add_preamble.extend(p)
+
+                if not have_preamble:
                     # no preamble to add, all ok
                     break
 
-                add_preamble = self.add_preamble_comment_start + add_preamble  + \
-                    self.add_preamble_comment_end
+                if isinstance(add_preamble[-1], str):
+                    add_preamble[-1] += self.add_preamble_comment_end
+                else:
+                    add_preamble.append(self.add_preamble_comment_end)
 
                 # and insert preamble before document. TODO: mark nodes with
                 # "lpp_ignore" to inhibit further processing; see TODO below.
 
-                try:
-                    lw = self.make_latex_walker(add_preamble)
-                    preamble_nodes = lw.get_latex_nodes()[0]
-                except latexwalker.LatexWalkerParseError as e:
-                    logger.error("Internal error: can't parse latex code that "
-                                 "fixes want to include:\n%r\n%s", s, e)
-                    raise
+                preamble_nodes = []
+                for p in add_preamble:
+                    if not isinstance(p, str):
+                        preamble_nodes.append(p)
+                        continue
+                    try:
+                        lw = self.make_latex_walker(p)
+                        preamble_nodes += lw.get_latex_nodes()[0]
+                    except latexwalker.LatexWalkerParseError as e:
+                        logger.error("Internal error: can't parse latex code that "
+                                     "fixes want to include:\n%r\n%s", p, e)
+                        raise
 
                 newnodelist[j:j] = preamble_nodes
 
@@ -436,20 +794,45 @@ class LatexPreprocessor:
         # passing only chunks at a time to fix.preprocess of contiguous nodes
         # that do not have lpp_ignore set.
 
-        for fix in self.fixes:
+        # the \input directives whose output is recorded separately (see
+        # latexpp.incremental)
+        if self.segment_recorder is not None:
+            self.segment_recorder.find_segments(newnodelist)
+
+        # the index is built lazily, when a fix first uses it
+        self.node_index = NodeIndex(self)
+
+        for fixes, runner in self._fix_groups:
+            fix_names = ", ".join(fix.fix_name() for fix in fixes)
             if self.parent_preprocessor is not None:
-                logger.debug("*** [sub-preprocessor] Fix: %s", fix.fix_name())
+                logger.debug("*** [sub-preprocessor] Fix: %s", fix_names)
             else:
-                logger.info("*** Fix %s", fix.fix_name())
-            newnodelist = fix.preprocess(newnodelist)
+                logger.info("*** Fix %s", fix_names)
+            self.node_index.set_root(newnodelist)
+            self.symbols.set_root(newnodelist)
+            with self._fix_scope(fixes):
+                newnodelist = runner.preprocess(newnodelist)
+
+        self.node_index = None
+        self.symbols.set_root(None)
 
         # check that all LPP pragmas were consumed & report those remaining
         report_pragma_fix = ReportRemainingPragmas()
         report_pragma_fix.set_lpp(self)
-        report_pragma_fix.preprocess(newnodelist)
+        with self._fix_scope([report_pragma_fix]):
+            report_pragma_fix.preprocess(newnodelist)
 
         return newnodelist
 
+    def _fix_scope(self, fixes):
+        # emit the fix_start/fix_end events around running the given fixes, if
+        # anyone is listening
+        events = self._events
+        if events is None:
+            return contextlib.nullcontext()
+        name = " + ".join(fix.fix_name() for fix in fixes)
+        return events.scope('fix_start', 'fix_end', self, fixes, name)
+
 
     # def nodelist_to_latex(self, nodelist):
     #     result = ''.join(self.node_to_latex(n) if n else '' for n in nodelist)
@@ -491,6 +874,47 @@ class LatexPreprocessor:
 
 
 
+    def parse_fragment(self, s, parsing_state):
+        r"""
+        Parse the LaTeX code fragment `s` using the given `parsing_state` (e.g.,
+        the parsing state of a node that is being replaced by this code) and
+        return the resulting node list.
+
+        Parsing results are memoized in :py:attr:`parse_cache`.  The returned
+        nodes are always a fresh copy that the caller may modify freely.
+
+        Raises :py:exc:`pylatexenc.latexwalker.LatexWalkerParseError` if there
+        was a parse error.
+        """
+        events = self._events
+        if events is not None:
+            events.reparse(self, s)
+        return self.parse_cache.get_nodes(s, parsing_state, self._do_parse_fragment)
+
+    def _do_parse_fragment(self, s, parsing_state):
+        lw = self.make_latex_walker(s)
+        nodes, _, _ = lw.get_latex_nodes(
+            parsing_state=self._get_fragment_parsing_state(lw, parsing_state)
+        )
+        return nodes
+
+    def _get_fragment_parsing_state(self, lw, parsing_state):
+        # Parsing states are not modified once created, so the nodes of all
+        # fragments parsed with equivalent parsing states can share a single
+        # one instead of each getting a new copy.  The key includes the latex
+        # walker of the original parsing state (the `lpp_latex_walker` field).
+        key = parsing_state_key(parsing_state)
+        if key is not None:
+            key = (getattr(parsing_state, 'lpp_latex_walker', None), key)
+            ps = self._fragment_parsing_states.get(key, None)
+            if ps is not None:
+                return ps
+        ps = lw.make_parsing_state(**parsing_state.get_fields())
+        if key is not None:
+            self._fragment_parsing_states[key] = ps
+        return ps
+
+
     def create_subpreprocessor(self, *, lppconfig_fixes=None):
         """
         Create a sub-preprocessor (or child preprocessor) of this preprocessor.
@@ -509,6 +933,8 @@ class LatexPreprocessor:
                                main_doc_fname=self.main_doc_fname,
                                main_doc_output_fname=self.main_doc_output_fname)
         pp.parent_preprocessor = self
+        pp.fuse_fixes = self.fuse_fixes
+        pp.persistent_parse_cache = self.persistent_parse_cache
         if lppconfig_fixes:
             pp.install_fixes_from_config(lppconfig_fixes)
         return pp
@@ -541,7 +967,8 @@ class LatexPreprocessor:
 
         autotexfile_resolved = self._resolve_source_fname(autotexfile)
 
-        if not os.path.isfile(autotexfile_resolved):
+        if not self.note_file_probe(autotexfile,
+                                    os.path.isfile(autotexfile_resolved)):
             raise ValueError(
                 "File {} does not exist. Please run {} on the main document first."
                 .format(autotexfile, what_to_run)
@@ -589,9 +1016,32 @@ class LatexPreprocessor:
                     os.path.join(self.display_output_dir, destfname if destfname else ''))
         self._do_ensure_destdir(destdir, destdn)
         self._do_copy_file(self._resolve_source_fname(source), dest)
-        
+
+        events = self._events
+        if events is not None:
+            events.file_copied(self, source, destfname)
+
         self.register_output_file(destfname)
 
+    def note_file_probe(self, fname, exists):
+        r"""
+        Fixes that check whether a source file `fname` exists, e.g., to try
+        several possible file extensions, should report the result `exists` of
+        each check with this method, including when the file was not found.
+        This informs the observers of the preprocessor (see
+        :py:meth:`latexpp.events.PreprocessorObserver.file_probed()`) that the
+        output depends on whether the file exists.
+
+        Returns `exists`, so that a check can be written as::
+
+          if self.lpp.note_file_probe(fname, os_path.exists(fname)):
+              ...
+        """
+        events = self._events
+        if events is not None:
+            events.file_probed(self, fname, exists)
+        return exists
+
     def open_file(self, fname, **kwargs):
         """
         Open the file `fname` for reading and return a handle to the open file.
@@ -600,6 +1050,9 @@ class LatexPreprocessor:
         (Use this function instead of ``open()`` directly so that the fixes can
         be integrated more easily in the tests with mock inputs.)
         """
+        events = self._events
+        if events is not None:
+            events.file_read(self, fname)
         return open(self._resolve_source_fname(fname), **kwargs)
 
 
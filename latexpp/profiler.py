@@ -0,0 +1,135 @@
+r"""
+Module that profiles a `latexpp` run, attributing the time spent to the fixes
+(and stages of multi-stage fixes) that are running.
+
+The :py:class:`Profiler` runs Python's :py:mod:`cProfile` deterministic
+profiler, whose results are saved in a ``.prof`` file (which can be inspected
+with :py:mod:`pstats`, `snakeviz`, etc.), together with a sampling profiler
+thread that periodically records the call stack of the thread that runs the
+preprocessor.  The samples are saved in the "collapsed stack" text format
+understood by flamegraph tools (e.g. `flamegraph.pl` or `speedscope`), with
+one line per distinct stack::
+
+  latexpp.fixes.labels.RenameLabels;CollectLabels;main (__main__.py:163);... 12
+
+The first frames of each stack are the names of the fix and stage that were
+running when the sample was taken (see
+:py:meth:`latexpp.metrics.MetricsRecorder.current_path()`), followed by the
+Python call stack.
+"""
+
+import os.path
+import sys
+import cProfile
+import threading
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .metrics import MetricsRecorder
+
+
+class Profiler:
+    r"""
+    Profile the preprocessor `lpp` between calls to :py:meth:`start()` and
+    :py:meth:`stop()`.  Both methods must be called from the thread that runs
+    the preprocessor.  Then save the results with :py:meth:`write()`.
+
+    The running fixes are determined with the preprocessor's metrics recorder
+    (:py:attr:`latexpp.preprocessor.LatexPreprocessor.metrics`); if it doesn't
+    have one, a :py:class:`latexpp.metrics.MetricsRecorder` is installed.
+
+    Arguments:
+
+    - `interval`: the time between two samples of the sampling profiler, in
+      seconds.
+
+    - `use_cprofile`: whether to run :py:mod:`cProfile` as well (if `False`,
+      :py:meth:`write()` doesn't write a ``.prof`` file).
+    """
+    def __init__(self, lpp, *, interval=0.001, use_cprofile=True):
+        super().__init__()
+        self.lpp = lpp
+        self.interval = interval
+        self.use_cprofile = use_cprofile
+
+        if self.lpp.metrics is None:
+            self.lpp.metrics = MetricsRecorder()
+
+        # (tags..., frames...) -> number of samples
+        self.samples = collections.Counter()
+
+        self._cprofile = None
+        self._thread = None
+        self._stop_event = None
+        self._target_thread_id = None
+        self._code_labels = {}
+
+    def start(self):
+        r"""
+        Start profiling the current thread.
+        """
+        self._target_thread_id = threading.get_ident()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sampling_loop,
+                                        name='latexpp-profiler', daemon=True)
+        self._thread.start()
+        if self.use_cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        r"""
+        Stop profiling.
+        """
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def write(self, output_prefix):
+        r"""
+        Write the profiling results to the files ``<output_prefix>.prof``
+        (the :py:mod:`cProfile` statistics, unless `use_cprofile=False`) and
+        ``<output_prefix>.collapsed`` (the collapsed stacks of the samples).
+        """
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(output_prefix + '.prof')
+        with open(output_prefix + '.collapsed', 'w') as f:
+            self.write_collapsed(f)
+
+    def write_collapsed(self, f):
+        r"""
+        Write the collapsed stacks of the samples to the text stream `f`.
+        """
+        for stack, count in sorted(self.samples.items()):
+            f.write('{} {}\n'.format(';'.join(stack), count))
+
+    def _sampling_loop(self):
+        metrics = self.lpp.metrics
+        target_thread_id = self._target_thread_id
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(target_thread_id, None)
+            if frame is None:
+                continue
+            tags = metrics.current_path() or ('<no fix>',)
+            frames = []
+            while frame is not None:
+                frames.append(self._code_label(frame.f_code))
+                frame = frame.f_back
+            frames.reverse()
+            self.samples[tags + tuple(frames)] += 1
+
+    def _code_label(self, code):
+        label = self._code_labels.get(code, None)
+        if label is None:
+            label = '{} ({}:{})'.format(code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+            # ';' separates frames in the collapsed format
+            label = label.replace(';', ':')
+            self._code_labels[code] = label
+        return label
@@ -0,0 +1,359 @@
+r"""
+Module that collects the labels, references, citations, packages and other
+declarations of a document in a single walk through the document tree, so
+that fixes that need them don't have to scan the document themselves.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pylatexenc import latexwalker
+
+from ._lpp_parsing import (
+    node_subtree_names, triggers_to_name_keys, _generation_counter
+)
+from .node_index import _node_changed_since
+from .fixes.ref import _REFCMDS, _REFCMDS_ref_types
+
+
+def _refs_macros():
+    return { m: reftype
+             for reftype in _REFCMDS_ref_types
+             for m in _REFCMDS[reftype] }
+
+def _cites_macros():
+    return dict.fromkeys(list(_REFCMDS['bib']) + ['citenum'])
+
+
+# table name -> { macroname: value for the entries' `value` attribute }
+_SYMBOL_MACROS = {
+    'labels': dict.fromkeys(['label', 'bibitem']),
+    'refs': _refs_macros(),
+    'cites': _cites_macros(),
+    'packages': dict.fromkeys(['usepackage', 'RequirePackage']),
+    'bibaliases': dict.fromkeys(['bibalias']),
+    'newcommands': dict.fromkeys(['newcommand', 'renewcommand', 'providecommand',
+                                  'newenvironment', 'renewenvironment']),
+}
+
+
+class SymbolEntry:
+    r"""
+    An entry of a :py:class:`SymbolTable`.
+
+    .. py:attribute:: name
+
+       The symbol, e.g., the label name, the citation key, or the package name.
+
+    .. py:attribute:: value
+
+       Additional information that depends on the table: the reference type
+       (e.g. ``'ref'`` or ``'cleveref'``, see
+       :py:class:`latexpp.fixes.ref.ExpandRefs`) for references, the package
+       options (or `None`) for packages, and the alias target for bib aliases.
+       Otherwise, `None`.
+
+    .. py:attribute:: node
+
+       The macro node in which the symbol appears (several entries share the
+       same node for, e.g., ``\cite{key1,key2}``).
+    """
+
+    __slots__ = ('name', 'value', 'node')
+
+    def __init__(self, name, value, node):
+        super().__init__()
+        self.name = name
+        self.value = value
+        self.node = node
+
+    def __repr__(self):
+        return "{}(name={!r}, value={!r}, node={!r})".format(
+            self.__class__.__name__, self.name, self.value, self.node
+        )
+
+
+class SymbolTable:
+    r"""
+    A table of :py:class:`SymbolEntry` objects, in the order in which they
+    appear in the document.  Iterating over the table yields all the entries;
+    ``name in table`` tests whether there is an entry with the given name.
+    """
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+        self._by_name = {}
+        self._nodes = []
+
+    def _add_node(self, node):
+        self._nodes.append(node)
+
+    def _add(self, entry):
+        self.entries.append(entry)
+        self._by_name.setdefault(entry.name, []).append(entry)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        r"""
+        Return the list of entries with the given name (possibly empty).
+        """
+        return list(self._by_name.get(name, ()))
+
+    def names(self):
+        r"""
+        Return the list of distinct names in the table, in the order in which
+        they first appear in the document.
+        """
+        return list(self._by_name)
+
+    def nodes(self):
+        r"""
+        Return the list of the macro nodes of the table's commands, in document
+        order.  This includes the nodes that don't provide any entry, e.g.,
+        because their arguments weren't parsed or are empty.
+        """
+        return list(self._nodes)
+
+
+class DocumentSymbols:
+    r"""
+    Symbol tables of the document that is being processed.  An instance is
+    available to fixes as ``self.lpp.symbols`` (see
+    :py:attr:`latexpp.preprocessor.LatexPreprocessor.symbols`).
+
+    The tables are the following attributes, each of which is a
+    :py:class:`SymbolTable`:
+
+    - `labels` --- ``\label{name}`` and ``\bibitem{name}``;
+
+    - `refs` --- the labels referred to by reference commands such as
+      ``\ref``, ``\eqref`` or ``\cref`` (one entry per label);
+
+    - `cites` --- the keys of citation commands such as ``\cite`` or
+      ``\citet`` (one entry per key);
+
+    - `packages` --- the packages loaded with ``\usepackage`` or
+      ``\RequirePackage`` (one entry per package);
+
+    - `bibaliases` --- aliases defined with ``\bibalias{alias}{target}``;
+
+    - `newcommands` --- the names of the macros and environments defined with
+      ``\newcommand``, ``\newenvironment`` and friends (macro names without
+      the backslash).
+
+    All tables are filled in a single walk through the document when one of
+    them is first accessed.  They are recomputed, again lazily, when the
+    document tree changes, i.e., when the preprocessor moves on to the next fix
+    or when a fix modified the document (as recorded by the modification
+    tracking of our latex walker's nodes, see
+    :ref:`implementation-notes-pylatexenc`).  Call :py:meth:`invalidate()` if
+    you modified the document in some other way.  (Fixes that the preprocessor
+    runs together in a single walk through the document, see
+    :py:attr:`latexpp.preprocessor.LatexPreprocessor.fuse_fixes`, might not
+    see the changes made by each other in the tables.)
+
+    Symbols are only recorded if the corresponding macro arguments were
+    parsed and are not empty (:py:meth:`SymbolTable.nodes()` returns all the
+    macro nodes of the table's commands, though).  Arguments that contain LaTeX macros are recorded as their LaTeX
+    code, as they appear in the document.
+    """
+    def __init__(self, lpp=None):
+        super().__init__()
+        self.lpp = lpp
+        self.root = None
+
+        self._macros = {}
+        for table_name, macros in _SYMBOL_MACROS.items():
+            for macroname, value in macros.items():
+                self._macros[macroname] = (table_name, value)
+        self._keys = triggers_to_name_keys(dict(macros=self._macros))
+
+        self._tables = None
+        self._built_gen = None
+
+        self._main_doc_source = None
+
+    def set_root(self, root):
+        r"""
+        Set the document's top-level node list (or `None`).  The preprocessor
+        calls this method before running each fix.
+        """
+        if root is not self.root:
+            self.root = root
+            self.invalidate()
+
+    def invalidate(self):
+        r"""
+        Discard the tables, so that they are computed again when they are next
+        accessed.
+        """
+        self._tables = None
+        self._built_gen = None
+
+    @property
+    def labels(self):
+        return self._get_tables()['labels']
+
+    @property
+    def refs(self):
+        return self._get_tables()['refs']
+
+    @property
+    def cites(self):
+        return self._get_tables()['cites']
+
+    @property
+    def packages(self):
+        return self._get_tables()['packages']
+
+    @property
+    def bibaliases(self):
+        return self._get_tables()['bibaliases']
+
+    @property
+    def newcommands(self):
+        return self._get_tables()['newcommands']
+
+    def main_doc_source(self):
+        r"""
+        Return the contents of the main document file (see
+        :py:attr:`latexpp.preprocessor.LatexPreprocessor.main_doc_fname`), as
+        it was read from disk, before any processing.  The file is read at
+        most once, and not at all if the preprocessor already read it to
+        process it.
+        """
+        parent = getattr(self.lpp, 'parent_preprocessor', None)
+        if parent is not None:
+            return parent.symbols.main_doc_source()
+        if self._main_doc_source is None:
+            with self.lpp.open_file(self.lpp.main_doc_fname) as f:
+                self._main_doc_source = f.read()
+        return self._main_doc_source
+
+    def set_main_doc_source(self, s):
+        r"""
+        Provide the contents of the main document file, to be returned by
+        :py:meth:`main_doc_source()`.
+        """
+        self._main_doc_source = s
+
+    def _get_tables(self):
+        if self.root is None:
+            raise RuntimeError("DocumentSymbols: no document node list was set")
+        if self._tables is not None \
+           and not any(n is not None and _node_changed_since(n, self._built_gen)
+                       for n in self.root):
+            return self._tables
+        # modifications made from now on have a larger generation number
+        self._built_gen = next(_generation_counter)
+        self._tables = self._scan()
+        return self._tables
+
+    def _scan(self):
+        # Walk through the document once, in document order, skipping the
+        # subtrees that don't contain any of the macros we are looking for.
+        tables = { table_name: SymbolTable() for table_name in _SYMBOL_MACROS }
+        macros = self._macros
+        keys = self._keys
+
+        stack = [ iter(self.root) ]
+        while stack:
+            n = next(stack[-1], StopIteration)
+            if n is StopIteration:
+                stack.pop()
+                continue
+            if n is None:
+                continue
+            names = node_subtree_names(n)
+            if names is not None and keys.isdisjoint(names):
+                continue
+            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname in macros:
+                table_name, value = macros[n.macroname]
+                tables[table_name]._add_node(n)
+                for name, entry_value in _get_symbols(table_name, n):
+                    if entry_value is None:
+                        entry_value = value
+                    tables[table_name]._add(SymbolEntry(name, entry_value, n))
+            children = _child_nodes(n)
+            if children:
+                stack.append(iter(children))
+
+        return tables
+
+
+def _child_nodes(n):
+    children = []
+    nodeargd = getattr(n, 'nodeargd', None)
+    if nodeargd is not None and getattr(nodeargd, 'argnlist', None):
+        children += nodeargd.argnlist
+    nodelist = getattr(n, 'nodelist', None)
+    if nodelist:
+        children += nodelist
+    return children
+
+def _mandatory_args(n):
+    nodeargd = n.nodeargd
+    if nodeargd is None or not getattr(nodeargd, 'argnlist', None) \
+       or not getattr(nodeargd, 'argspec', None):
+        return []
+    return [ a for c, a in zip(nodeargd.argspec, nodeargd.argnlist)
+             if c == '{' and a is not None ]
+
+def _optional_arg(n):
+    for c, a in zip(n.nodeargd.argspec, n.nodeargd.argnlist):
+        if c == '[' and a is not None:
+            return _arg_text(a)
+    return None
+
+def _arg_text(a):
+    if a.isNodeType(latexwalker.LatexGroupNode):
+        return ''.join(nn.to_latex() for nn in a.nodelist
+                       if nn is not None
+                       and not nn.isNodeType(latexwalker.LatexCommentNode)).strip()
+    return a.to_latex().strip()
+
+def _split_names(s):
+    return [ x.strip() for x in s.split(',') if x.strip() ]
+
+def _get_symbols(table_name, n):
+    # Return a list of (name, value) for the given node; value=None means the
+    # table's default value for this macro.
+    if table_name == 'newcommands':
+        # our newcommand.Expand fix's parser records the defined macro
+        nodeargd = n.nodeargd
+        spec = getattr(nodeargd, 'new_defined_macrospec', None)
+        if spec is not None:
+            return [ (spec.macroname, None) ]
+        spec = getattr(nodeargd, 'new_defined_environmentspec', None)
+        if spec is not None:
+            return [ (spec.environmentname, None) ]
+    args = _mandatory_args(n)
+    if not args:
+        return []
+    if table_name == 'labels':
+        return [ (_arg_text(args[0]), None) ]
+    if table_name == 'refs':
+        return [ (name, None) for a in args for name in _split_names(_arg_text(a)) ]
+    if table_name == 'cites':
+        return [ (name, None) for name in _split_names(_arg_text(args[0])) ]
+    if table_name == 'packages':
+        options = _optional_arg(n)
+        return [ (name, options) for name in _split_names(_arg_text(args[0])) ]
+    if table_name == 'bibaliases':
+        if len(args) < 2:
+            return []
+        return [ (_arg_text(args[0]), _arg_text(args[1])) ]
+    if table_name == 'newcommands':
+        name = _arg_text(args[0])
+        if name.startswith('\\'):
+            name = name[1:]
+        return [ (name, None) ]
+    return []
@@ -44,7 +44,7 @@ class MockLPP(preprocessor.LatexPreprocessor):
         return s
 
 
-    def execute_file(self, fname, *, output_fname):
+    def _execute_file(self, fname, *, output_fname, omit_processed_by=False):
 
         s = self.mock_files[fname]
 
@@ -145,10 +145,10 @@ def nodelist_to_d(nodelist, use_line_numbers=False, use_detailed_position=False)
             return x
 
 
-        def _add_pos(d, pos, len_):
+        def _add_pos(d, parsing_state, pos, len_):
             if use_line_numbers:
                 lineno, colno = \
-                    n.parsing_state.lpp_latex_walker.pos_to_lineno_colno(pos)
+                    parsing_state.lpp_latex_walker.pos_to_lineno_colno(pos)
 
                 d['lineno'] = lineno
 
@@ -160,10 +160,20 @@ def nodelist_to_d(nodelist, use_line_numbers=False, use_detailed_position=False)
         # we already tested for 'list', so this condition never evals to true
         # if we're running w/ pylatexenc 2
         if isinstance(x, LatexNodeList):
+            # Fixes return either the parsed node list object (if they didn't
+            # replace any node) or a plain list.  Both are represented by the
+            # list of their nodes, along with the position of the node list
+            # object if positions are requested.
+            nodes = [get_obj(y) for y in x.nodelist]
+            if not use_line_numbers:
+                return nodes
             d = {
-                'nodelist': x.nodelist,
+                'nodelist': nodes,
             }
-            _add_pos(d, x.pos, x.len)
+            len_ = None
+            if x.pos is not None and x.pos_end is not None:
+                len_ = x.pos_end - x.pos
+            _add_pos(d, x.parsing_state, x.pos, len_)
             return d
 
         if isinstance(x, latexwalker.LatexNode):
@@ -181,7 +191,7 @@ def nodelist_to_d(nodelist, use_line_numbers=False, use_detailed_position=False)
 
                 d[fld] = n.__dict__[fld]
 
-            _add_pos(d, n.pos, n.len)
+            _add_pos(d, n.parsing_state, n.pos, n.len)
 
             return get_obj(d)
 
@@ -0,0 +1,184 @@
+import unittest
+import os
+import os.path
+import io
+import tempfile
+import contextlib
+
+import helpers
+
+from latexpp.bench.corpus import generate_corpus
+from latexpp.bench import workloads, scaling, memory, baseline
+from latexpp.bench.__main__ import main as bench_main
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_deterministic(self):
+        c1 = generate_corpus(1000, seed=3)
+        c2 = generate_corpus(1000, seed=3)
+        self.assertEqual(c1.files, c2.files)
+        self.assertEqual(c1.binary_files, c2.binary_files)
+        self.assertNotEqual(c1.files, generate_corpus(1000, seed=4).files)
+
+    def test_size(self):
+        for n in (200, 1000, 5000):
+            c = generate_corpus(n)
+            self.assertGreaterEqual(c.num_lines, n * 0.95)
+            self.assertLessEqual(c.num_lines, n * 1.05)
+
+    def test_contents(self):
+        c = generate_corpus(3000)
+        self.assertIn('macros.tex', c.files)
+        self.assertTrue(any(f.startswith('figures/') for f in c.binary_files))
+        s = c.flatten()
+        self.assertNotIn(r'\input{chapters', s)
+        for piece in (r'\newcommand', r'\bibalias', r'\ifdraft', r'\label{eq:',
+                      r'\cref{', r'\includegraphics', '%%!lpp regional-fix',
+                      '%%!lpp skip'):
+            self.assertIn(piece, s)
+
+
+class TestWorkloads(unittest.TestCase):
+
+    def test_get_benchmarks(self):
+        names = [ b.name for b in workloads.get_benchmarks() ]
+        self.assertEqual(names[:2], ['parse', 'serialize'])
+        self.assertIn('fix:labels.RenameLabels', names)
+        self.assertIn('cli', names)
+
+        names = [ b.name for b in workloads.get_benchmarks(['fix:input.*', 'parse']) ]
+        self.assertEqual(names, ['fix:input.EvalInput', 'fix:input.CopyInputDeps',
+                                 'parse'])
+        with self.assertRaises(ValueError):
+            workloads.get_benchmarks(['nonexistent'])
+
+    def test_run(self):
+        benchmarks = workloads.get_benchmarks(
+            ['parse', 'serialize', 'fix:labels.RenameLabels', 'fix:input.*',
+             'fix:figures.CopyAndRenameFigs', 'cli']
+        )
+        with workloads.BenchProject(generate_corpus(300)) as project:
+            directory = project.directory
+            results = list(workloads.run_benchmarks(project, benchmarks, repeat=2))
+        self.assertFalse(os.path.exists(directory))
+
+        self.assertEqual([ r.name for r in results ], [ b.name for b in benchmarks ])
+        for r in results:
+            self.assertEqual(len(r.times), 2)
+            self.assertGreater(r.best, 0)
+            self.assertLessEqual(r.best, r.median)
+            self.assertEqual(r.to_json()['name'], r.name)
+
+
+class TestScaling(unittest.TestCase):
+
+    def test_exponents(self):
+        c = scaling.ScalingCurve('x', [(100, 1.0), (1000, 10.0), (10000, 1000.0)])
+        self.assertEqual([ round(e, 6) for e in c.exponents() ], [1.0, 2.0])
+        self.assertAlmostEqual(c.overall_exponent(), 1.5)
+        self.assertTrue(c.is_superlinear())
+        self.assertFalse(c.is_superlinear(max_exponent=1.6))
+
+        c = scaling.ScalingCurve('y', [(100, 1.0), (1000, 10.5)])
+        self.assertFalse(c.is_superlinear())
+
+    def test_measure(self):
+        curves = scaling.measure_scaling(['fix:comments.RemoveComments'], [100, 400],
+                                         repeat=1)
+        self.assertEqual(len(curves), 1)
+        self.assertEqual(len(curves[0].points), 2)
+        self.assertIn('fix:comments.RemoveComments', scaling.format_curves(curves))
+
+
+class TestMemory(unittest.TestCase):
+
+    def test_measure(self):
+        m = memory.measure_corpus_node_memory(500)
+        self.assertGreater(m.num_nodes, 1000)
+        self.assertGreater(m.bytes_per_node, 0)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'doc.tex')
+            with open(fname, 'w') as f:
+                f.write(r"""Hello \emph{world} and $x^{2}$.""")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(memory.main(['--file', fname]), 0)
+            self.assertIn('bytes per node', out.getvalue())
+            self.assertEqual(os.listdir(tmpdir), ['doc.tex'])
+
+
+def _results(**times):
+    return baseline.Baseline(
+        [ workloads.BenchmarkResult(name, t, 1000) for name, t in times.items() ],
+        settings={'num_lines': 1000},
+        environment={'pylatexenc': '3.0a1'},
+    )
+
+class TestBaseline(unittest.TestCase):
+
+    def test_compare(self):
+        base = _results(
+            slower=[1.0, 1.01, 0.99, 1.0, 1.02],
+            faster=[1.0, 1.01, 0.99, 1.0, 1.02],
+            noisy=[1.0, 2.0, 0.5, 1.5, 1.0],
+            same=[1.0, 1.01, 0.99, 1.0, 1.02],
+            gone=[1.0],
+        )
+        cur = _results(
+            slower=[1.5, 1.51, 1.49, 1.5, 1.52],
+            faster=[0.5, 0.51, 0.49, 0.5, 0.52],
+            noisy=[1.3, 2.5, 0.8, 1.4, 1.2],
+            same=[1.02, 1.01, 0.99, 1.03, 1.02],
+            added=[1.0],
+        )
+        cur.environment['pylatexenc'] = '3.0a2'
+
+        c = { x.name: x for x in baseline.compare_results(base, cur, threshold=10) }
+        self.assertEqual(
+            { name: x.status for name, x in c.items() },
+            {'slower': 'regression', 'faster': 'improvement', 'noisy': 'unchanged',
+             'same': 'unchanged', 'gone': 'missing', 'added': 'new'}
+        )
+        self.assertAlmostEqual(c['slower'].percent_change, 50.0)
+        self.assertFalse(c['noisy'].significant)
+
+        self.assertEqual(baseline.format_environment_changes(base, cur),
+                         ['environment pylatexenc: 3.0a1 -> 3.0a2'])
+        self.assertIn('regression', baseline.format_comparisons(list(c.values())))
+
+    def test_save_load(self):
+        base = _results(parse=[0.5, 0.6])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'baseline.json')
+            base.save(fname)
+            loaded = baseline.Baseline.load(fname)
+        self.assertEqual(loaded.to_json(), base.to_json())
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bfname = os.path.join(tmpdir, 'baseline.json')
+            cfname = os.path.join(tmpdir, 'current.json')
+            _results(parse=[1.0, 1.0, 1.0]).save(bfname)
+            _results(parse=[1.05, 1.04, 1.05]).save(cfname)
+
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(bench_main(['--compare', bfname, '--current', cfname]), 0)
+                _results(parse=[1.5, 1.5, 1.6]).save(cfname)
+                self.assertEqual(bench_main(['--compare', bfname, '--current', cfname]), 1)
+            self.assertIn('regressed', out.getvalue())
+
+            # run a real benchmark and save it
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(bench_main(['--lines', '100', '--repeat', '1',
+                                             '--benchmarks', 'serialize',
+                                             '-o', cfname]), 0)
+            self.assertEqual([ r.name for r in baseline.Baseline.load(cfname).results ],
+                             ['serialize'])
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,110 @@
+import unittest
+import unittest.mock
+import os
+import os.path
+import json
+import tempfile
+
+import helpers
+
+from latexpp.__main__ import main
+from latexpp.fixes import input as input_fix, usepackage, figures
+
+
+_LPPCONFIG = r"""
+fname: 'main.tex'
+output_fname: 'main.tex'
+fixes:
+  - 'latexpp.fixes.input.EvalInput'
+  - 'latexpp.fixes.usepackage.CopyLocalPkgs'
+  - 'latexpp.fixes.figures.CopyAndRenameFigs'
+"""
+
+
+class TestDependencies(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        # latexpp is run from the document's directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        # other tests replace the fixes' os_path modules with mock versions
+        for mod in (input_fix, usepackage, figures):
+            patcher = unittest.mock.patch.object(mod, 'os_path', os.path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self._write('main.tex', r"""\documentclass{article}
+\usepackage{amsmath}
+\usepackage{my pkg}
+\begin{document}
+\input{chap}
+\includegraphics{figs/plot}
+\end{document}
+""")
+        self._write('chap.tex', "Chapter text.\n")
+        self._write('my pkg.sty', "\\ProvidesPackage{my pkg}\n")
+        os.mkdir('figs')
+        self._write('figs/plot.png', "PNG")
+        self._write('lppconfig.yml', _LPPCONFIG)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write(self, fname, contents):
+        with open(os.path.join(self.dir, fname), 'w') as f:
+            f.write(contents)
+
+    def test_json(self):
+
+        main(['-o', 'out', '--depfile-json', 'deps.json'], omit_processed_by=True)
+
+        with open('deps.json') as f:
+            deps = json.load(f)
+
+        self.assertEqual(
+            sorted(deps['inputs']),
+            ['chap.tex', 'figs/plot.png', 'lppconfig.yml', 'main.tex', 'my pkg.sty']
+        )
+        # files looked up with other extensions, and packages that are not
+        # available locally
+        self.assertEqual(
+            sorted(deps['missing']),
+            ['amsmath.sty', 'chap', 'figs/plot', 'figs/plot.lplx', 'figs/plot.pdf']
+        )
+        self.assertEqual(
+            sorted(deps['targets']),
+            ['out/fig-01.png', 'out/main.tex', 'out/my pkg.sty']
+        )
+
+    def test_makefile(self):
+
+        main(['-o', 'out', '--depfile', 'out.d'], omit_processed_by=True)
+
+        with open('out.d') as f:
+            depfile = f.read()
+
+        self.assertEqual(depfile, r"""out/fig-01.png out/main.tex out/my\ pkg.sty: \
+ lppconfig.yml \
+ main.tex \
+ chap.tex \
+ my\ pkg.sty \
+ figs/plot.png \
+ . \
+ figs
+
+lppconfig.yml:
+
+main.tex:
+
+chap.tex:
+
+my\ pkg.sty:
+
+figs/plot.png:
+""")
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,139 @@
+import unittest
+
+import helpers
+
+from latexpp.fixes import macro_subst, labels, regional_fix, ifsimple
+from latexpp.events import PreprocessorObserver
+from latexpp import _lpp_traversal
+
+
+class RecordingObserver(PreprocessorObserver):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def fix_start(self, lpp, fixes, name):
+        self.events.append( ('fix_start', name) )
+
+    def fix_end(self, lpp, fixes, name):
+        self.events.append( ('fix_end', name) )
+
+    def stage_start(self, lpp, fix, stage):
+        self.events.append( ('stage_start', stage.stage_name()) )
+
+    def stage_end(self, lpp, fix, stage):
+        self.events.append( ('stage_end', stage.stage_name()) )
+
+    def step_start(self, lpp, name):
+        self.events.append( ('step_start', name) )
+
+    def step_end(self, lpp, name):
+        self.events.append( ('step_end', name) )
+
+    def node_replaced(self, lpp, fix, node, replacement):
+        self.events.append( ('node_replaced', fix.fix_name(), node.to_latex()) )
+
+    def reparse(self, lpp, latex):
+        self.events.append( ('reparse', latex) )
+
+    def output_written(self, lpp, output_fname, size):
+        self.events.append( ('output_written', output_fname, size) )
+
+
+class TestEvents(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def test_event_sequence(self):
+
+        lpp = helpers.MockLPP()
+        obs = RecordingObserver()
+        lpp.add_observer(obs)
+        lpp.install_fix(macro_subst.Subst(macros={'a': r'\textbf{A}'}))
+        lpp.install_fix(labels.RenameLabels(label_rename_fmt='L%(n)d'))
+
+        result = lpp.execute(r"""\a{} \label{x}""")
+        self.assertEqual(result, r"""\textbf{A}{} \label{L0}""")
+
+        skip = 'latexpp.fixes.builtin.skip.SkipPragma'
+        report = 'latexpp.fixes.builtin.remaining_pragmas.ReportRemainingPragmas'
+        subst = 'latexpp.fixes.macro_subst.Subst'
+        rl = 'latexpp.fixes.labels.RenameLabels'
+        self.assertEqual(
+            obs.events,
+            [
+                ('step_start', '<parse>'),
+                ('step_end', '<parse>'),
+                ('fix_start', skip),
+                ('fix_end', skip),
+                ('fix_start', subst),
+                ('node_replaced', subst, r'\a'),
+                ('reparse', r'\textbf{A}'),
+                ('fix_end', subst),
+                ('fix_start', rl),
+                ('stage_start', 'CollectLabels'),
+                ('stage_end', 'CollectLabels'),
+                ('stage_start', 'ReplaceRefs'),
+                ('stage_end', 'ReplaceRefs'),
+                ('fix_end', rl),
+                ('fix_start', report),
+                ('fix_end', report),
+                ('step_start', '<output>'),
+                ('output_written', None, len(result)),
+                ('step_end', '<output>'),
+            ]
+        )
+
+    def test_subpreprocessor(self):
+
+        lpp = helpers.MockLPP()
+        obs = RecordingObserver()
+        lpp.add_observer(obs)
+        lpp.install_fix(regional_fix.Apply(
+            region='R',
+            fixes=[{'name': 'latexpp.fixes.macro_subst.Subst',
+                    'config': {'macros': {'foo': 'B'}}}]
+        ))
+
+        lpp.execute(r"""\foo
+%%!lpp regional-fix R {
+\foo
+%%!lpp }
+""")
+
+        self.assertIn(('node_replaced', 'latexpp.fixes.macro_subst.Subst', '\\foo\n'),
+                      obs.events)
+
+    def test_remove_observer(self):
+
+        lpp = helpers.MockLPP()
+        obs = RecordingObserver()
+        lpp.add_observer(obs)
+        lpp.remove_observer(obs)
+        fix = macro_subst.Subst(macros={'a': 'A'})
+        lpp.install_fix(fix)
+
+        self.assertIsNone(lpp._events)
+        self.assertEqual(lpp.execute(r"""\a"""), "A")
+        self.assertEqual(obs.events, [])
+        # the document walk isn't instrumented
+        self.assertIs(type(fix._get_traversal()), _lpp_traversal.FixTraversal)
+
+
+class TestIfSimpleLogging(unittest.TestCase):
+
+    def test_unmatched_if(self):
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(ifsimple.ApplyIf())
+
+        with self.assertLogs('latexpp.fixes.ifsimple', level='WARNING') as cm:
+            result = lpp.execute(r"""\iftrue A""")
+        self.assertEqual(result, r"""\iftrue A""")
+        self.assertIn(r"Can't find matching ‘\else’/‘\fi’ for ‘\iftrue’", cm.output[0])
+
+
+if __name__ == '__main__':
+    helpers.test_main()
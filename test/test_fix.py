@@ -7,6 +7,7 @@ from pylatexenc import latexwalker
 
 
 from latexpp.fix import BaseFix, BaseMultiStageFix
+from latexpp._lpp_parsing import node_is_unmodified
 
 
 class TestBaseFix(unittest.TestCase):
@@ -421,9 +422,305 @@ I left four newlines here.  Let's see if they get preserved.
         newlatex = ''.join(n.to_latex() for n in newnodelist)
 
         self.assertEqual(newlatex, latex)
-        
 
+    def test_preprocess_copy_on_write(self):
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'beta': self.fix_beta})
+            def fix_beta(self, n, **kwargs):
+                # replacement macro without post-space
+                return self.lpp.nodes.macro('gamma', parsing_state=n.parsing_state)
+
+        lpp = helpers.MockLPP()
+        myfix = MyFix()
+        lpp.install_fix( myfix )
+
+        # no replacement -> same list objects are returned
+        lw = lpp.make_latex_walker(r"""Hello {world \emph{x}}""")
+        nodelist = lw.get_latex_nodes()[0]
+        group_nodelist = nodelist[1].nodelist
+        self.assertIs(myfix.preprocess(nodelist), nodelist)
+        self.assertIs(nodelist[1].nodelist, group_nodelist)
+        self.assertTrue(node_is_unmodified(nodelist[1]))
+
+        # replacement in a child list -> only that list is copied
+        lw = lpp.make_latex_walker(r"""A {\alpha\beta x} B""")
+        nodelist = lw.get_latex_nodes()[0]
+        group_nodelist = nodelist[1].nodelist
+        newnodelist = myfix.preprocess(nodelist)
+        self.assertIs(newnodelist, nodelist)
+        self.assertIsNot(nodelist[1].nodelist, group_nodelist)
+        self.assertEqual(
+            ''.join(n.to_latex() for n in newnodelist),
+            r"""A {\alpha\gamma x} B"""
+        )
+
+    def test_preprocess_deep_nesting(self):
+
+        class MyFix(BaseFix):
+            # inspects all nodes (no triggers)
+            def fix_node(self, n, **kwargs):
+                if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'x':
+                    return r'\y'
+                return None
+
+        class MyHandlersFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'y': self.fix_y})
+            def fix_y(self, n, **kwargs):
+                return self.lpp.nodes.macro('z', parsing_state=n.parsing_state)
+
+        lpp = helpers.MockLPP()
+        myfix = MyFix()
+        lpp.install_fix( myfix )
+        myhandlersfix = MyHandlersFix()
+        lpp.install_fix( myhandlersfix )
+
+        # groups, macro arguments and environments nested way beyond Python's
+        # recursion limit
+        depth = 30000
+        b = lpp.nodes
+        node = b.macro('x')
+        for k in range(depth):
+            if k % 3 == 0:
+                node = b.group([node, 'a'])
+            elif k % 3 == 1:
+                node = b.macro('textbf', [[node]])
+            else:
+                node = b.environment('center', [node])
+        nodelist = b.nodelist([node])
+
+        def expected(inner):
+            pre, post = [], []
+            for k in range(depth):
+                if k % 3 == 0:
+                    pre.append('{'); post.append('a}')
+                elif k % 3 == 1:
+                    pre.append(r'\textbf{'); post.append('}')
+                else:
+                    pre.append(r'\begin{center}'); post.append(r'\end{center}')
+            return ''.join(reversed(pre)) + inner + ''.join(post)
+
+        newnodelist = myfix.preprocess(nodelist)
+        self.assertEqual(newnodelist.to_latex(), expected(r'\y '))
+
+        newnodelist = myhandlersfix.preprocess(newnodelist)
+        self.assertEqual(newnodelist.to_latex(), expected(r'\z '))
+
+    def test_subtree_names(self):
+
+        lpp = helpers.MockLPP()
+        lw = lpp.make_latex_walker(
+            r"""Hello \emph{world \textbf{X}} % comment
+\begin{center}$a$~b\end{center}"""
+        )
+        nodelist = lw.get_latex_nodes()[0]
+
+        self.assertEqual(
+            nodelist._lpp_names,
+            frozenset([('macros', 'emph'), ('macros', 'textbf'), ('comments', True),
+                       ('environments', 'center'), ('specials', '~')])
+        )
+        self.assertEqual(
+            nodelist[1]._lpp_names,
+            frozenset([('macros', 'emph'), ('macros', 'textbf')])
+        )
+        self.assertEqual(nodelist[0]._lpp_names, frozenset())
+
+    def test_preprocess_triggers(self):
+
+        seen_nodes = []
+
+        class MyAbcFix(BaseFix):
+            def triggers(self):
+                return dict(macros=['abc'])
+            def fix_node(self, n, **kwargs):
+                seen_nodes.append(n)
+                if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'abc':
+                    return r'\textbf{A}'
+                return None
+
+        class MyBoldFix(BaseFix):
+            def triggers(self):
+                return dict(macros=['textbf'])
+            def fix_node(self, n, **kwargs):
+                seen_nodes.append(n)
+                if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'textbf':
+                    return r'\emph{' + self.preprocess_arg_latex(n, 0) + '}'
+                return None
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix( MyAbcFix() )
+        lpp.install_fix( MyBoldFix() )
+
+        self.assertEqual(
+            lpp.execute(r"""Hello \section{\abc}, \emph{world} and {\itshape more}
+\textbf{text \textbf{bold}}"""),
+            r"""Hello \section{\emph{A}}, \emph{world} and {\itshape more}
+\emph{text \emph{bold}}"""
+        )
+
+        # fix_node() is only called on relevant nodes
+        self.assertEqual(
+            [ n.macroname for n in seen_nodes ],
+            [ 'abc', 'textbf', 'textbf', 'textbf' ]
+        )
+
+    def test_preprocess_handlers(self):
+
+        seen = []
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(
+                    macros={'textbf': self.fix_textbf, 'abc': self.fix_abc},
+                    environments={'proof': self.fix_proof},
+                    comments=self.fix_comment,
+                )
+            def fix_textbf(self, n, **kwargs):
+                seen.append(n.macroname)
+                return r'\emph{' + self.preprocess_arg_latex(n, 0) + '}'
+            def fix_abc(self, n, **kwargs):
+                seen.append(n.macroname)
+                return r'\textbf{A}'
+            def fix_proof(self, n, **kwargs):
+                seen.append(n.environmentname)
+                return None
+            def fix_comment(self, n, **kwargs):
+                seen.append('%')
+                return []
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix( MyFix() )
+
+        self.assertEqual(
+            lpp.execute(r"""Hello \section{\abc}, \emph{world} % comment
+\begin{proof}\textbf{text \textbf{bold}}\end{proof}"""),
+            r"""Hello \section{\textbf{A}}, \emph{world} \begin{proof}\emph{text \emph{bold}}\end{proof}"""
+        )
+
+        # handlers are only called on relevant nodes
+        self.assertEqual(
+            seen,
+            [ 'abc', '%', 'proof', 'textbf', 'textbf' ]
+        )
+
+        # the default fix_node() dispatches to the handlers
+        fix = MyFix()
+        lw = helpers.MockLPP().make_latex_walker(r'\textbf{x}\emph{y}')
+        nodes = lw.get_latex_nodes()[0]
+        self.assertEqual(fix.fix_node(nodes[1]), None)
+        self.assertEqual(fix.fix_node(nodes[0]), r'\emph{x}')
+
+    def test_unmodified_nodes_verbatim(self):
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'abc': self.fix_abc})
+            def fix_abc(self, n, **kwargs):
+                return r'\textbf{A}'
+
+        latex = r"""\begin {itemize}  \item  one {two} \end{itemize}
+\section {Title \abc}"""
+
+        lpp = helpers.MockLPP()
+        myfix = MyFix()
+        lpp.install_fix( myfix )
+
+        lw = lpp.make_latex_walker(latex)
+        nodelist = lw.get_latex_nodes()[0]
+        for n in nodelist:
+            self.assertTrue(node_is_unmodified(n))
+
+        newnodelist = myfix.preprocess(nodelist)
+
+        # untouched subtree is emitted verbatim (see spacing in "\begin
+        # {itemize}"), the modified one is recomposed
+        self.assertTrue(node_is_unmodified(newnodelist[0]))
+        self.assertFalse(node_is_unmodified(newnodelist[2]))
+        self.assertEqual(
+            ''.join(n.to_latex() for n in newnodelist),
+            r"""\begin {itemize}  \item  one {two} \end{itemize}
+\section {Title \textbf{A}}"""
+        )
+
+    def test_modified_nodes_invalidate_cache(self):
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'emph': self.fix_emph})
+            def fix_emph(self, n, **kwargs):
+                n.macroname = 'textit'
+                return None
+
+        lpp = helpers.MockLPP()
+        myfix = MyFix()
+        lpp.install_fix( myfix )
+
+        lw = lpp.make_latex_walker(r"""{Hello \emph{world}}""")
+        nodelist = lw.get_latex_nodes()[0]
+
+        group = nodelist[0]
+        self.assertEqual(group.to_latex(), r"""{Hello \emph{world}}""")
+
+        newnodelist = myfix.preprocess(nodelist)
+
+        self.assertIs(newnodelist[0], group)
+        self.assertFalse(node_is_unmodified(group))
+        self.assertEqual(group.to_latex(), r"""{Hello \textit{world}}""")
+        # recomposed latex is cached ...
+        self.assertEqual(group._lpp_latex, r"""{Hello \textit{world}}""")
+        # ... until the node is modified again
+        group.delimiters = ('[', ']')
+        self.assertIsNone(group._lpp_latex)
+        self.assertEqual(group.to_latex(), r"""[Hello \textit{world}]""")
+
+
+
+
+    def test_nodelist_modified_in_place(self):
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(environments={'itemize': self.fix_itemize})
+            def fix_itemize(self, n, **kwargs):
+                group = n.nodelist[1]
+                if self.op == 'del':
+                    del group.nodelist[0]
+                elif self.op == 'delslice':
+                    del group.nodelist[1:]
+                elif self.op == 'pop':
+                    group.nodelist.pop(0)
+                elif self.op == 'remove':
+                    group.nodelist.remove(group.nodelist[0])
+                elif self.op == 'clear':
+                    group.nodelist.clear()
+                elif self.op == 'extend':
+                    group.nodelist.extend(group.nodelist[0:1])
+                return None
 
+        latex = r"""\begin{itemize} {\emph {one}  two} \end{itemize} rest"""
+
+        for op, result in [
+                ('del', r"""\begin{itemize} {  two} \end{itemize} rest"""),
+                ('delslice', r"""\begin{itemize} {\emph {one}} \end{itemize} rest"""),
+                ('pop', r"""\begin{itemize} {  two} \end{itemize} rest"""),
+                ('remove', r"""\begin{itemize} {  two} \end{itemize} rest"""),
+                ('clear', r"""\begin{itemize} {} \end{itemize} rest"""),
+                ('extend', r"""\begin{itemize} {\emph {one}  two\emph {one}} \end{itemize} rest"""),
+        ]:
+            lpp = helpers.MockLPP()
+            myfix = MyFix()
+            myfix.op = op
+            lpp.install_fix( myfix )
+
+            lw = lpp.make_latex_walker(latex)
+            nodelist = lw.get_latex_nodes()[0]
+            newnodelist = myfix.preprocess(nodelist)
+
+            self.assertFalse(node_is_unmodified(newnodelist[0]), op)
+            self.assertEqual(''.join(n.to_latex() for n in newnodelist), result, op)
 
 
 class TestBaseMultiStageFix(unittest.TestCase):
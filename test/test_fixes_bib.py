@@ -38,6 +38,65 @@ Some text~\cite{target1,target3} and see also~\citep{target2}.
 
         self.assertEqual(lpp.copied_files, [('TESTDOC.bbl', '/TESTOUT/TESTMAIN.bbl')])
 
+    def test_alias_defined_later(self):
+
+        # aliases apply from the point where they are defined on, in document
+        # order
+        latex = r"""\begin{document}
+See~\cite{alias1}.
+\bibalias{alias1}{target1}
+And~\cite{alias1}.
+\end{document}
+"""
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix( bib.ApplyAliases() )
+
+        self.assertEqual(
+            lpp.execute(latex),
+            r"""\begin{document}
+See~\cite{alias1}.
+
+And~\cite{target1}.
+\end{document}
+"""
+        )
+
+
+class TestCopyAndInputBbl(unittest.TestCase):
+
+    def test_eval_input(self):
+        
+        latex = r"""
+\bibalias{alias1}{target1}
+\begin{document}
+Some text~\cite{alias1}.
+\bibliography{mybib1}
+\end{document}
+"""
+
+        bbl = r"""\begin{thebibliography}{1}
+\bibitem{alias1} A. Uthor, \emph{Title}, \cite{alias1} % {unbalanced
+\end{thebibliography}"""
+
+        lpp = helpers.MockLPP( mock_files={ 'TESTDOC.bbl': bbl } )
+        lpp.install_fix( bib.CopyAndInputBbl(eval_input=True) )
+        lpp.install_fix( bib.ApplyAliases() )
+
+        # bbl contents are pasted verbatim, not processed by further fixes
+        self.assertEqual(
+            lpp.execute(latex),
+            r"""
+
+\begin{document}
+Some text~\cite{target1}.
+""" + bbl + r"""
+\end{document}
+"""
+        )
+
+        self.assertEqual(lpp.copied_files, [])
+
 
 
 
@@ -3,7 +3,7 @@ import unittest
 
 import helpers
 
-from latexpp.fixes import environment_contents
+from latexpp.fixes import environment_contents, macro_subst
 
 class TestInsertPrePost(unittest.TestCase):
 
@@ -70,6 +70,33 @@ Hello world.
 """
         )
 
+    def test_verbatim(self):
+        
+        lpp = helpers.MockLPP()
+        lpp.install_fix(
+            environment_contents.InsertPrePost(
+                environmentnames=['proof'],
+                post_contents=r'\qed',
+                verbatim=True,
+            )
+        )
+        lpp.install_fix(
+            macro_subst.Subst(macros={'qed': r'\blacksquare'})
+        )
+
+        self.assertEqual(
+            lpp.execute(r"""
+\begin{proof}
+  Proof of this and that, \qed.
+\end{proof}
+"""),
+            r"""
+\begin{proof}
+  Proof of this and that, \blacksquare.
+\qed\end{proof}
+"""
+        )
+
 
 
 
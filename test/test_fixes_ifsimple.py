@@ -3,7 +3,7 @@ import unittest
 
 import helpers
 
-from latexpp.fixes import ifsimple
+from latexpp.fixes import ifsimple, comments
 
 class TestApplyIf(unittest.TestCase):
 
@@ -132,6 +132,41 @@ A is TRUE!"""
 """
         )
 
+    def test_unmatched_if(self):
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(ifsimple.ApplyIf())
+
+        # the \iftrue without a matching \fi is kept as it is
+        with self.assertLogs('latexpp.fixes.ifsimple', level='WARNING'):
+            result = lpp.execute(r"""
+A \iffalse B\fi{} C \iftrue D
+""")
+        self.assertEqual(
+            result,
+            r"""
+A {} C \iftrue D
+"""
+        )
+
+    def test_macro_post_space(self):
+        # the chars that replace the \if construct must not be glued to the
+        # preceding macro, also when a later fix doesn't change anything there
+        for more_fixes in ([], [comments.RemoveComments]):
+            for s, result in (
+                    (r"""\newif\ifdraft\draftfalse
+\linewidth\ifdraft draft\else final\fi""", r"""\linewidth final"""),
+                    (r"""\newif\ifdraft\draftfalse
+\abc\def\ifdraft draft\else final\fi""", r"""\abc\def final"""),
+            ):
+                lpp = helpers.MockLPP()
+                lpp.install_fix(ifsimple.ApplyIf())
+                for fixcls in more_fixes:
+                    lpp.install_fix(fixcls())
+
+                self.assertEqual(lpp.execute(s), result)
+
+
 
 
 
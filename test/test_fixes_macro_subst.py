@@ -64,6 +64,95 @@ Hello guys.  Just testin': \textbf{ABC}.
             r"""\lvert{\hat\rho}\rangle"""
         )
 
+    def test_nodes_same_as_string(self):
+
+        macros = {
+            'ket': dict(argspec='{', repl=r'\lvert{%(1)s}\rangle'),
+            'op': dict(argspec='{{', repl=r'\lvert %(1)s\rangle\langle %(2)s\rvert'),
+            'twice': dict(argspec='{', repl=r'(%(1)s, %(1)s)'),
+            'glued': dict(argspec='{', repl=r'\alpha%(1)s'),
+            'inarg': dict(argspec='{', repl=r'\frac%(1)s{2}'),
+            'name': dict(argspec='{', repl=r'\%(macroname)s{%(1)s}'),
+            'rhostate': r'\hat\rho',
+        }
+        latex = r"""\ket{\rhostate} and \op{a \rhostate}{\ket{b}}, $\twice{\ket x}$,
+\glued{x} \inarg{1} \inarg{\rhostate} \name{n} \ket{}"""
+
+        class StringSubst(macro_subst.Subst):
+            def fix_subst(self, n, **kwargs):
+                return self.helper.eval_subst(
+                    self.helper.get_node_cfg(n), n,
+                    node_contents_latex=self.preprocess_contents_latex
+                )
+
+        result = []
+        for cls in (macro_subst.Subst, StringSubst):
+            lpp = helpers.MockLPP()
+            lpp.install_fix(cls(macros=macros))
+            result.append(lpp.execute(latex))
+
+        self.assertEqual(result[0], result[1])
+        self.assertEqual(
+            result[0],
+            r"""\lvert{\hat\rho}\rangle and \lvert a \hat\rho\rangle\langle \lvert{b}\rangle\rvert, $(\lvert{x}\rangle, \lvert{x}\rangle)$,
+\alphax \frac1{2} \frac\hat\rho{2} \name{n} \lvert{}\rangle"""
+        )
+
+    def test_lazy_args(self):
+
+        seen = []
+
+        class MySubst(macro_subst.Subst):
+            def fix_subst(self, n, **kwargs):
+                seen.append(n.macroname)
+                return super().fix_subst(n, **kwargs)
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(MySubst(
+            macros={
+                'second': dict(argspec='{{', repl=r'\textbf{%(2)s}'),
+                'abc': r'ABC',
+            },
+        ))
+
+        self.assertEqual(
+            lpp.execute(r"""\second{\abc}{\abc\abc}"""),
+            r"""\textbf{ABCABC}"""
+        )
+        # first argument was never preprocessed
+        self.assertEqual(seen, ['second', 'abc', 'abc'])
+
+    def test_template_parsed_once(self):
+
+        parsed = []
+
+        lpp = helpers.MockLPP()
+        parse_fragment = lpp.parse_fragment
+        def counting_parse_fragment(s, parsing_state):
+            parsed.append(s)
+            return parse_fragment(s, parsing_state)
+        lpp.parse_fragment = counting_parse_fragment
+
+        lpp.install_fix(macro_subst.Subst(
+            macros={
+                'ket': dict(argspec='{', repl=r'\lvert{%(1)s}\rangle'),
+                'pair': dict(argspec='{', repl=r'\left(\textbf{%(1)s}, %(1)s\right)'),
+            },
+        ))
+
+        self.assertEqual(
+            lpp.execute(r"""\ket{a} \ket{\ket{b}} \pair{c} \pair{\ket{d}} $\ket{e}$"""),
+            r"""\lvert{a}\rangle \lvert{\lvert{b}\rangle}\rangle \left(\textbf{c}, c\right) """
+            r"""\left(\textbf{\lvert{d}\rangle}, \lvert{d}\rangle\right) $\lvert{e}\rangle$"""
+        )
+        # each replacement string is parsed once per parsing state (here, in
+        # text mode and in math mode)
+        self.assertEqual(sorted(parsed), sorted([
+            r'\lvert{\lppsubstslota}\rangle',
+            r'\left(\textbf{\lppsubstslota}, \lppsubstslotb\right)',
+            r'\lvert{\lppsubstslota}\rangle',
+        ]))
+
 
 
 
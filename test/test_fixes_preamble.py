@@ -3,7 +3,7 @@ import unittest
 
 import helpers
 
-from latexpp.fixes import preamble
+from latexpp.fixes import preamble, comments
 
 class TestAddPreamble(unittest.TestCase):
 
@@ -49,6 +49,35 @@ Hello world.
 """
         )
 
+    def test_verbatim(self):
+        
+        lpp = helpers.MockLPP()
+        lpp.install_fix( preamble.AddPreamble(preamble=r"""
+\newcommand\hello{Hello}   % keep this comment
+""", verbatim=True) )
+        lpp.install_fix( comments.RemoveComments() )
+
+        self.assertEqual(
+            lpp.execute(r"""
+\documentclass{article}
+\begin{document}
+\hello{} world.  % a comment
+\end{document}
+"""),
+            r"""
+\documentclass{article}
+
+%
+
+\newcommand\hello{Hello}   % keep this comment
+
+%
+\begin{document}
+\hello{} world.  %
+\end{document}
+"""
+        )
+
 
 
 
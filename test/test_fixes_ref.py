@@ -54,6 +54,49 @@ class TestExpandRefs(unittest.TestCase):
         fix = ref.ExpandRefs(only_ref_types=set(['ref', 'ams-eqref']))
         self.assertEqual(set(fix.ref_types), set(['ref', 'ams-eqref']))
 
+    def test_collect_refs(self):
+
+        # the reference commands are collected in document order, including
+        # those with empty or missing arguments.  Doesn't need to run latex.
+
+        collected = []
+
+        class MyExpandRefs(ref.ExpandRefs):
+            def _get_run_ltx_resolved_cmds(self, doc_preamble):
+                collected.append(dict(self.collected_cmds))
+                self.resolved_cmds = {
+                    reftype: { cmd: 'RESOLVED' for cmd in cmds }
+                    for reftype, cmds in self.collected_cmds.items()
+                }
+
+        latex = r"""\documentclass{article}
+\begin{document}
+A~\ref{eq:a}, B~\eqref{eq:b}, C~\ref{}, D~{\ref}, E~\textbf{\ref{eq:a}}.
+\end{document}
+"""
+
+        lpp = helpers.MockLPP()
+        fix = MyExpandRefs(only_ref_types=['ref', 'ams-eqref'])
+        fix._get_doc_preamble = fix._get_doc_preamble_recomposed
+        fix._get_auxfile_contents = lambda: ""
+        lpp.install_fix( fix )
+
+        result = lpp.execute(latex)
+
+        self.assertEqual(
+            collected,
+            [ {'ref': [r'\ref{eq:a}', r'\ref{}', r'\ref', r'\ref{eq:a}'],
+               'ams-eqref': [r'\eqref{eq:b}']} ]
+        )
+        self.assertEqual(
+            result,
+            r"""\documentclass{article}
+\begin{document}
+A~RESOLVED, B~RESOLVED, C~RESOLVED, D~{RESOLVED}, E~\textbf{RESOLVED}.
+\end{document}
+"""
+        )
+
     def test_simple_ref(self):
         
         latex = r"""
@@ -0,0 +1,171 @@
+import unittest
+import unittest.mock
+import os
+import os.path
+import tempfile
+
+import helpers
+
+from latexpp.__main__ import main
+from latexpp.fixes import input as input_fix, usepackage, figures
+
+
+_LPPCONFIG = r"""
+fname: 'main.tex'
+output_fname: 'main.tex'
+fixes:
+  - 'latexpp.fixes.input.EvalInput'
+  - 'latexpp.fixes.comments.RemoveComments'
+  - 'latexpp.fixes.labels.RenameLabels'
+  - 'latexpp.fixes.figures.CopyAndRenameFigs'
+"""
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        # latexpp is run from the document's directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        # other tests replace the fixes' os_path modules with mock versions
+        for mod in (input_fix, usepackage, figures):
+            patcher = unittest.mock.patch.object(mod, 'os_path', os.path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self._write('main.tex', r"""\documentclass{article}
+\begin{document}
+\section{Intro}\label{sec:intro}
+See \ref{sec:a}.
+\input{chapa}
+\input{chapb}
+\end{document}
+""")
+        self._write('chapa.tex', r"""\section{A}\label{sec:a}
+Text A, see \ref{sec:b}. % comment
+\includegraphics{fig1}
+""")
+        self._write('chapb.tex', r"""\section{B}\label{sec:b}
+Text B.
+\includegraphics{fig2}
+""")
+        self._write('fig1.pdf', "PDF1")
+        self._write('fig2.pdf', "PDF2")
+        self._write('lppconfig.yml', _LPPCONFIG)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write(self, fname, contents):
+        with open(os.path.join(self.dir, fname), 'w') as f:
+            f.write(contents)
+
+    def _append(self, fname, contents):
+        with open(os.path.join(self.dir, fname), 'a') as f:
+            f.write(contents)
+
+    def _read(self, fname):
+        with open(os.path.join(self.dir, fname)) as f:
+            return f.read()
+
+    def _run_incremental(self):
+        # returns the log messages of the incremental run
+        with self.assertLogs('latexpp.incremental', level='INFO') as cm:
+            main(['-o', 'out', '--incremental'], omit_processed_by=True)
+        return [ r.getMessage() for r in cm.records ]
+
+    def _check_same_as_full_run(self):
+        main(['-o', 'out_full'], omit_processed_by=True)
+        self.assertEqual(self._read('out/main.tex'), self._read('out_full/main.tex'))
+        self.assertEqual(sorted(os.listdir('out')), sorted(os.listdir('out_full')))
+
+    def test_splice(self):
+
+        messages = self._run_incremental()
+        self.assertEqual(messages, ["Processing the whole document: "
+                                    "no record of a previous run"])
+        self.assertTrue(os.path.exists('out.incremental.pickle'))
+
+        self._write('chapb.tex', r"""\section{B}\label{sec:b}
+Modified text B. % another comment
+\includegraphics{fig2}
+""")
+        messages = self._run_incremental()
+        self.assertEqual(messages, ["Processing ‘chapb’ again"])
+        self.assertIn("Modified text B. %\n", self._read('out/main.tex'))
+        self._check_same_as_full_run()
+
+        # the record was updated
+        self._write('chapa.tex', r"""\section{A}\label{sec:a}
+Modified text A, see \ref{sec:b}.
+\includegraphics{fig1}
+""")
+        messages = self._run_incremental()
+        self.assertEqual(messages, ["Processing ‘chapa’ again"])
+        self.assertIn("Modified text A", self._read('out/main.tex'))
+        self.assertIn("Modified text B", self._read('out/main.tex'))
+        self._check_same_as_full_run()
+
+    def test_new_label(self):
+
+        self._run_incremental()
+
+        self._append('chapa.tex', "\\label{newlabel}\n")
+        messages = self._run_incremental()
+        self.assertEqual(
+            messages,
+            ["Processing ‘chapa’ again",
+             "Processing the whole document: changes in ‘chapa’ affect the "
+             "rest of the document (fix latexpp.fixes.labels.RenameLabels)"]
+        )
+        self._check_same_as_full_run()
+
+    def test_new_figure(self):
+
+        self._run_incremental()
+
+        self._write('fig3.pdf', "PDF3")
+        self._append('chapa.tex', "\\includegraphics{fig3}\n")
+        messages = self._run_incremental()
+        self.assertEqual(
+            messages,
+            ["Processing ‘chapa’ again",
+             "Processing the whole document: changes in ‘chapa’ affect the "
+             "rest of the document (fix latexpp.fixes.figures.CopyAndRenameFigs)"]
+        )
+        self.assertIn("fig-03.pdf", os.listdir('out'))
+        self._check_same_as_full_run()
+
+    def test_global_file_changed(self):
+
+        self._run_incremental()
+
+        self._write('main.tex', self._read('main.tex').replace('Intro', 'Introduction'))
+        messages = self._run_incremental()
+        self.assertEqual(messages, ["Processing the whole document: "
+                                    "file ‘main.tex’ changed"])
+        self._check_same_as_full_run()
+
+    def test_unsupported_fix(self):
+
+        self._write('myfixes.py', r"""
+from latexpp.fix import BaseFix
+
+class NoIncrementalFix(BaseFix):
+    # doesn't implement incremental_state()
+    pass
+""")
+        self._append('lppconfig.yml', "  - 'myfixes.NoIncrementalFix'\n")
+
+        messages = self._run_incremental()
+        self.assertEqual(messages, ["Fix(es) myfixes.NoIncrementalFix do not "
+                                    "support incremental runs, processing the "
+                                    "whole document"])
+        self.assertFalse(os.path.exists('out.incremental.pickle'))
+        self._check_same_as_full_run()
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,190 @@
+import unittest
+
+import helpers
+
+from pylatexenc import latexwalker
+
+from pylatexenc import macrospec
+
+from latexpp._lpp_parsing import LatexCodeRecomposer, FragmentParseCache
+
+
+class TestLatexCodeRecomposer(unittest.TestCase):
+
+    def test_simple(self):
+
+        latex = r"""\begin{itemize}[x] \item Hello {\bfseries world}% comment
+  $a^2$ ~ \end{itemize}"""
+
+        lpp = helpers.MockLPP()
+        lw = lpp.make_latex_walker(latex)
+        nodelist = lw.get_latex_nodes()[0]
+
+        recomposer = LatexCodeRecomposer()
+        # don't use the verbatim source, recompose everything
+        recomposer.use_known_latex = False
+
+        self.assertEqual(recomposer.nodelist_to_latex(nodelist), latex)
+        # instance can be reused
+        self.assertEqual(recomposer.node_to_latex(nodelist[0]), latex)
+
+    def test_deep_nesting(self):
+
+        depth = 20000
+
+        lpp = helpers.MockLPP()
+        lw = lpp.make_latex_walker('')
+        ps = lw.make_parsing_state()
+
+        n = lw.make_node(latexwalker.LatexCharsNode, chars='x',
+                         parsing_state=ps, pos=None, pos_end=None)
+        for j in range(depth):
+            n = lw.make_node(latexwalker.LatexGroupNode, nodelist=[n],
+                             delimiters=('{', '}'),
+                             parsing_state=ps, pos=None, pos_end=None)
+
+        self.assertEqual(n.to_latex(), '{'*depth + 'x' + '}'*depth)
+
+    def test_custom_node_to_latex(self):
+
+        class MyRecomposer(LatexCodeRecomposer):
+            def node_to_latex(self, n):
+                if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'x':
+                    return 'X'
+                return super().node_to_latex(n)
+
+        latex = r"""\textbf{\x{} and {\x}}"""
+
+        lpp = helpers.MockLPP()
+        lw = lpp.make_latex_walker(latex)
+        nodelist = lw.get_latex_nodes()[0]
+
+        self.assertEqual(MyRecomposer().nodelist_to_latex(nodelist),
+                         r"""\textbf{X{} and {X}}""")
+
+
+
+class TestCompactNodes(unittest.TestCase):
+
+    def test_node_attributes(self):
+
+        latex = r"""Hello \textbf{world} $a^{2}$ and $b$."""
+
+        lpp = helpers.MockLPP()
+        lw = lpp.make_latex_walker(latex)
+        nodelist = lw.get_latex_nodes()[0]
+
+        n = nodelist[1]
+        self.assertEqual(n.macroname, 'textbf')
+        # our own information is stored in slots, methods are provided by
+        # the class
+        for attr in ('_lpp_gen', '_lpp_latex', '_lpp_names',
+                     'to_latex', 'latex_verbatim'):
+            self.assertNotIn(attr, n.__dict__)
+        self.assertEqual(n.to_latex(), r"\textbf{world}")
+        self.assertEqual(nodelist.to_latex(), latex)
+
+        # field name tuples are shared between nodes
+        self.assertIs(nodelist[0]._fields, nodelist[4]._fields)
+
+        # equivalent parsing states are shared
+        m1, m2 = nodelist[3], nodelist[5]
+        self.assertTrue(m1.isNodeType(latexwalker.LatexMathNode))
+        self.assertTrue(m2.isNodeType(latexwalker.LatexMathNode))
+        self.assertIs(m1.nodelist[0].parsing_state, m2.nodelist[0].parsing_state)
+
+        n.macroname = 'emph'
+        self.assertEqual(nodelist.to_latex(), r"""Hello \emph{world} $a^{2}$ and $b$.""")
+
+
+
+class TestFragmentParseCache(unittest.TestCase):
+
+    def _setup(self):
+        lpp = helpers.MockLPP()
+        lpp.initialize()
+        lw = lpp.make_latex_walker(r"Hello \textbf{world}")
+        nodelist = lw.get_latex_nodes()[0]
+        return lpp, nodelist[1].parsing_state
+
+    def test_hits_and_copies(self):
+
+        lpp, ps = self._setup()
+
+        nodes1 = lpp.parse_fragment(r"\emph{A} and $x$", ps)
+        nodes2 = lpp.parse_fragment(r"\emph{A} and $x$", ps)
+        lpp.parse_fragment(r"\emph{B}", ps)
+
+        self.assertEqual((lpp.parse_cache.hits, lpp.parse_cache.misses), (1, 2))
+
+        # fresh copies, which can be modified independently
+        self.assertIsNot(nodes1[0], nodes2[0])
+        self.assertIsNot(nodes1[0].nodeargd.argnlist[0],
+                         nodes2[0].nodeargd.argnlist[0])
+        nodes2[0].macroname = 'textit'
+        nodes3 = lpp.parse_fragment(r"\emph{A} and $x$", ps)
+        self.assertEqual(''.join(n.to_latex() for n in nodes2), r"\textit{A} and $x$")
+        self.assertEqual(''.join(n.to_latex() for n in nodes3), r"\emph{A} and $x$")
+        self.assertEqual(nodes3[0].nodeargd.argnlist[0].parsing_state,
+                         nodes1[0].nodeargd.argnlist[0].parsing_state)
+
+    def test_shared_parsing_state(self):
+
+        lpp, ps = self._setup()
+
+        # different fragments, parsed separately (cache misses) with equivalent
+        # parsing states, share a single parsing state
+        nodes1 = lpp.parse_fragment(r"\emph{A} and $x$", ps)
+        nodes2 = lpp.parse_fragment(r"\emph{B}", ps.sub_context())
+        self.assertEqual((lpp.parse_cache.hits, lpp.parse_cache.misses), (0, 2))
+
+        self.assertIsNot(nodes1[0].latex_walker, nodes2[0].latex_walker)
+        self.assertIs(nodes1[0].parsing_state, nodes2[0].parsing_state)
+        self.assertIs(nodes1[0].nodeargd.argnlist[0].parsing_state,
+                      nodes2[0].nodeargd.argnlist[0].parsing_state)
+        self.assertEqual(nodes1[0].parsing_state.get_fields(), ps.get_fields())
+
+    def test_bounded(self):
+
+        lpp, ps = self._setup()
+        lpp.parse_cache.maxsize = 3
+
+        for j in range(10):
+            lpp.parse_fragment(r"\emph{%d}" % (j), ps)
+        self.assertEqual(len(lpp.parse_cache), 3)
+
+        lpp.parse_fragment(r"\emph{9}", ps)
+        lpp.parse_fragment(r"\emph{0}", ps)
+        self.assertEqual((lpp.parse_cache.hits, lpp.parse_cache.misses), (1, 11))
+
+    def test_invalidate_on_context_change(self):
+
+        lpp, ps = self._setup()
+
+        latex_context = macrospec.LatexContextDb()
+        latex_context.set_unknown_macro_spec(macrospec.MacroSpec(''))
+        latex_context.add_context_category(
+            'my-category-1',
+            macros=[ macrospec.MacroSpec('emph', '{') ],
+        )
+        ps = ps.sub_context(latex_context=latex_context)
+
+        nodes = lpp.parse_fragment(r"\mymacro{A}", ps)
+        self.assertEqual(len(nodes), 2)
+        nodes = lpp.parse_fragment(r"\mymacro{A}", ps)
+        self.assertEqual((lpp.parse_cache.hits, lpp.parse_cache.misses), (1, 1))
+
+        latex_context.add_context_category(
+            'my-category-2',
+            macros=[ macrospec.MacroSpec('mymacro', '{') ],
+        )
+
+        nodes = lpp.parse_fragment(r"\mymacro{A}", ps)
+        self.assertEqual((lpp.parse_cache.hits, lpp.parse_cache.misses), (1, 2))
+        self.assertEqual(lpp.parse_cache.invalidations, 1)
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual(nodes[0].nodeargd.argnlist[0].to_latex(), '{A}')
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,151 @@
+import unittest
+import unittest.mock
+import os
+import os.path
+import tempfile
+
+import helpers
+
+from latexpp.__main__ import main
+from latexpp.fixes import input as input_fix, usepackage
+from latexpp.manifest import RunManifest, hash_config
+
+
+_LPPCONFIG = r"""
+fname: 'main.tex'
+output_fname: 'main.tex'
+fixes:
+  - 'latexpp.fixes.input.EvalInput'
+  - 'latexpp.fixes.usepackage.CopyLocalPkgs'
+  - name: 'latexpp.fixes.preamble.AddPreamble'
+    config:
+      fromfile: '{preamble}'
+"""
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        # latexpp is run from the document's directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        # other tests replace the fixes' os_path modules with mock versions
+        for mod in (input_fix, usepackage):
+            patcher = unittest.mock.patch.object(mod, 'os_path', os.path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self._write('main.tex', r"""\documentclass{article}
+\usepackage{mypkg}
+\begin{document}
+\input{chap}
+\end{document}
+""")
+        self._write('chap.tex', "Chapter text.\n")
+        self._write('mypkg.sty', "\\ProvidesPackage{mypkg}\n")
+        self._write('extra-preamble.tex', "\\newcommand\\extra{X}\n")
+        self._write('lppconfig.yml', _LPPCONFIG.format(
+            preamble=os.path.join(self.dir, 'extra-preamble.tex')
+        ))
+        self.output_dir = os.path.join(self.dir, 'out')
+        self.manifest_fname = os.path.join(self.dir, 'out.manifest.json')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write(self, fname, contents):
+        with open(os.path.join(self.dir, fname), 'w') as f:
+            f.write(contents)
+
+    def _read_output(self):
+        with open(os.path.join(self.output_dir, 'main.tex')) as f:
+            return f.read()
+
+    def _run(self, *args):
+        main(['-c', os.path.join(self.dir, 'lppconfig.yml'),
+              '-o', self.output_dir] + list(args),
+             omit_processed_by=True)
+
+    def test_manifest(self):
+
+        self._run('--manifest', self.manifest_fname)
+
+        manifest = RunManifest.load(self.manifest_fname)
+        self.assertEqual(
+            sorted(f for f, h in manifest.files.items() if h is not None),
+            ['chap.tex', 'extra-preamble.tex', 'main.tex', 'mypkg.sty']
+        )
+        # \input{chap} looked for 'chap' before 'chap.tex'
+        self.assertEqual(
+            sorted(f for f, h in manifest.files.items() if h is None),
+            ['chap']
+        )
+        self.assertEqual(sorted(manifest.outputs), ['main.tex', 'mypkg.sty'])
+        self.assertEqual(manifest.output_dir, 'out')
+        self.assertIn('latexpp.fixes.input.EvalInput', manifest.fixes)
+        self.assertTrue(
+            manifest.fixes['latexpp.fixes.input.EvalInput']['file'].endswith('input.py')
+        )
+
+        self.assertIn(r"\newcommand\extra{X}", self._read_output())
+
+        # nothing changed
+        self.assertEqual(
+            manifest.check(self.manifest_fname, config_hash=manifest.config_hash,
+                           output_dir=self.output_dir),
+            []
+        )
+        self.assertEqual(
+            manifest.check(self.manifest_fname, config_hash=hash_config({}),
+                           output_dir=self.output_dir),
+            ['configuration changed']
+        )
+        self._write('mypkg.sty', "\\ProvidesPackage{mypkg}[v2]\n")
+        self.assertEqual(
+            manifest.check(self.manifest_fname, config_hash=manifest.config_hash,
+                           output_dir=self.output_dir),
+            ["file ‘mypkg.sty’ changed"]
+        )
+        self._write('chap', "Takes precedence over chap.tex\n")
+        self.assertEqual(
+            manifest.check(self.manifest_fname, config_hash=manifest.config_hash,
+                           output_dir=self.output_dir),
+            ["file ‘chap’ changed"]
+        )
+
+    def test_if_changed(self):
+
+        self._run('--if-changed')
+        self.assertTrue(os.path.exists(self.manifest_fname))
+        output_main = os.path.join(self.output_dir, 'main.tex')
+
+        def run_and_check_rewritten():
+            os.utime(output_main, (0, 0))
+            self._run('--if-changed')
+            return os.stat(output_main).st_mtime != 0
+
+        # up to date, the output is not touched
+        self.assertFalse(run_and_check_rewritten())
+
+        # an input file changed
+        self._write('chap.tex', "Modified chapter text.\n")
+        self.assertTrue(run_and_check_rewritten())
+        self.assertIn("Modified chapter text.", self._read_output())
+        self.assertFalse(run_and_check_rewritten())
+
+        # the configuration changed
+        with open(os.path.join(self.dir, 'lppconfig.yml'), 'a') as f:
+            f.write("  - 'latexpp.fixes.comments.RemoveComments'\n")
+        self.assertTrue(run_and_check_rewritten())
+        self.assertFalse(run_and_check_rewritten())
+
+        # an output file was removed
+        os.remove(os.path.join(self.output_dir, 'mypkg.sty'))
+        self.assertTrue(run_and_check_rewritten())
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'mypkg.sty')))
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,146 @@
+import unittest
+import unittest.mock
+import json
+
+import helpers
+
+from latexpp.fix import BaseFix
+from latexpp.fixes import regional_fix, labels, input as input_fix
+from latexpp.memprofile import MemoryProfiler
+
+
+class RetainFix(BaseFix):
+    def __init__(self):
+        super().__init__()
+        self.kept = None
+
+    def fix_node(self, n, **kwargs):
+        if n.isNodeType(helpers.latexwalker.LatexMacroNode) and n.macroname == 'retain':
+            self.kept = bytearray(1000000)
+        return None
+
+
+class PeakFix(BaseFix):
+    def fix_node(self, n, **kwargs):
+        if n.isNodeType(helpers.latexwalker.LatexMacroNode) and n.macroname == 'peak':
+            tmp = bytearray(2000000)
+            del tmp
+        return None
+
+
+class TestMemoryProfiler(unittest.TestCase):
+
+    def test_peak_and_retained(self):
+
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = False # measure each fix separately
+        lpp.install_fix(RetainFix())
+        lpp.install_fix(PeakFix())
+
+        memprof = MemoryProfiler(lpp)
+        memprof.start()
+        try:
+            lpp.execute(r"""\retain \peak""")
+        finally:
+            memprof.stop()
+
+        e = { s.name: s for s in memprof.get_stats() }
+
+        retain = e['<preprocess> / test_memprofile.RetainFix']
+        self.assertEqual(retain.calls, 1)
+        self.assertGreaterEqual(retain.retained_delta, 1000000)
+        self.assertLess(retain.retained_delta, 1100000)
+        self.assertTrue(any(site.startswith(__file__.rstrip('c'))
+                            for site, _ in retain.get_top_sites(1)))
+
+        peak = e['<preprocess> / test_memprofile.PeakFix']
+        self.assertGreaterEqual(peak.peak_delta, 2000000)
+        self.assertLess(peak.retained_delta, 100000)
+
+        # enclosing scope sees both
+        pp = e['<preprocess>']
+        self.assertGreaterEqual(pp.peak_delta, 3000000)
+        self.assertGreaterEqual(pp.retained_delta, 1000000)
+
+        d = json.loads(json.dumps(memprof.to_json()))
+        self.assertEqual(len(d), len(e))
+        self.assertIn('PeakFix', memprof.format_table())
+
+    def test_snapshots(self):
+
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = False
+        lpp.install_fix(RetainFix())
+        lpp.install_fix(PeakFix())
+        lpp.install_fix(labels.RenameLabels())
+
+        memprof = MemoryProfiler(lpp)
+        memprof.start()
+        try:
+            with unittest.mock.patch.object(memprof, '_take_sites',
+                                            wraps=memprof._take_sites) as take_sites:
+                lpp.execute(r"""\retain \label{a}\ref{a}""")
+        finally:
+            memprof.stop()
+
+        # five fixes (with the built-in ones), and the snapshot at the end of
+        # a fix is the start of the next one
+        self.assertEqual(take_sites.call_count, 6)
+
+        e = { s.name: s for s in memprof.get_stats() }
+        # no stage scopes, no sites for the main preprocessor run
+        self.assertEqual(set(e), {
+            '<preprocess>',
+            '<preprocess> / latexpp.fixes.builtin.skip.SkipPragma',
+            '<preprocess> / test_memprofile.RetainFix',
+            '<preprocess> / test_memprofile.PeakFix',
+            '<preprocess> / latexpp.fixes.labels.RenameLabels',
+            '<preprocess> / latexpp.fixes.builtin.remaining_pragmas.ReportRemainingPragmas',
+        })
+        self.assertEqual(e['<preprocess>'].top_sites, {})
+        self.assertTrue(e['<preprocess> / test_memprofile.RetainFix'].top_sites)
+
+    def _run(self, lpp, latex):
+        memprof = MemoryProfiler(lpp, snapshots=False)
+        memprof.start()
+        try:
+            lpp.execute(latex)
+        finally:
+            memprof.stop()
+        self.assertIsNone(lpp._events)
+        return set(s.name for s in memprof.get_stats())
+
+    def test_files(self):
+
+        input_fix.os_path = helpers.FakeOsPath(['chapter.tex'])
+        mock_files = { 'chapter.tex': r"""\foo""" }
+
+        lpp = helpers.MockLPP(mock_files=mock_files)
+        lpp.install_fix(input_fix.EvalInput())
+        self.assertIn('<preprocess> / latexpp.fixes.input.EvalInput / <file chapter.tex>',
+                      self._run(lpp, r"""\input{chapter.tex}"""))
+
+        lpp = helpers.MockLPP(mock_files=mock_files)
+        lpp.install_fix(input_fix.CopyInputDeps())
+        self.assertIn('<preprocess> / latexpp.fixes.input.CopyInputDeps / '
+                      '<file chapter.tex> / <preprocess>',
+                      self._run(lpp, r"""\input{chapter.tex}"""))
+
+    def test_subpreprocessors(self):
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(regional_fix.Apply(
+            region='R',
+            fixes=[{'name': 'latexpp.fixes.macro_subst.Subst',
+                    'config': {'macros': {'foo': 'B'}}}]
+        ))
+        self.assertIn('<preprocess> / latexpp.fixes.regional_fix.Apply / '
+                      '<sub-preprocessor> / latexpp.fixes.macro_subst.Subst',
+                      self._run(lpp, r"""%%!lpp regional-fix R {
+\foo
+%%!lpp }
+"""))
+
+
+if __name__ == '__main__':
+    helpers.test_main()
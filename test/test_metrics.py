@@ -0,0 +1,109 @@
+import unittest
+import io
+import json
+
+import helpers
+
+from latexpp.fixes import macro_subst, regional_fix, labels
+from latexpp.metrics import MetricsRecorder
+
+
+class TestMetrics(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def test_per_fix_metrics(self):
+
+        lpp = helpers.MockLPP()
+        lpp.metrics = MetricsRecorder()
+        lpp.install_fix(macro_subst.Subst(macros={'a': r'\textbf{A}'}))
+        lpp.install_fix(labels.RenameLabels(label_rename_fmt='L%(n)d'))
+
+        result = lpp.execute(r"""\a{} \emph{\a} \label{x}\ref{x}""")
+        self.assertEqual(result, r"""\textbf{A}{} \emph{\textbf{A}} \label{L0}\ref{L0}""")
+
+        m = { e.name: e for e in lpp.metrics.get_metrics() }
+
+        self.assertEqual(
+            set(m),
+            set(['<parse>', '<output>',
+                 'latexpp.fixes.builtin.skip.SkipPragma',
+                 'latexpp.fixes.builtin.remaining_pragmas.ReportRemainingPragmas',
+                 'latexpp.fixes.macro_subst.Subst',
+                 'latexpp.fixes.labels.RenameLabels',
+                 'latexpp.fixes.labels.RenameLabels / CollectLabels',
+                 'latexpp.fixes.labels.RenameLabels / ReplaceRefs'])
+        )
+
+        subst = m['latexpp.fixes.macro_subst.Subst']
+        self.assertEqual(subst.calls, 1)
+        self.assertEqual(subst.nodes_replaced, 2)
+        self.assertGreater(subst.nodes_visited, 0)
+        self.assertEqual(subst.reparses, 2)
+        self.assertEqual(subst.reparse_bytes, 2*len(r'\textbf{A}'))
+        self.assertGreaterEqual(subst.wall_time, 0)
+
+        rl = m['latexpp.fixes.labels.RenameLabels']
+        stages_wall = sum(m['latexpp.fixes.labels.RenameLabels / ' + stage].wall_time
+                          for stage in ('CollectLabels', 'ReplaceRefs'))
+        self.assertAlmostEqual(rl.self_wall_time, rl.wall_time - stages_wall)
+
+        self.assertEqual(m['<output>'].bytes_written, len(result))
+
+        d = json.loads(json.dumps(lpp.metrics.to_json()))
+        self.assertEqual(len(d['fixes']), 8)
+
+        table = lpp.metrics.format_table()
+        self.assertIn('latexpp.fixes.macro_subst.Subst', table)
+
+    def test_bytes_non_ascii(self):
+
+        lpp = helpers.MockLPP()
+        lpp.metrics = MetricsRecorder()
+        lpp.install_fix(macro_subst.Subst(macros={'a': r'\textbf{Ä}'}))
+
+        result = lpp.execute(r"""\a{} é""")
+        self.assertEqual(result, r"""\textbf{Ä}{} é""")
+
+        m = { e.name: e for e in lpp.metrics.get_metrics() }
+        self.assertEqual(m['latexpp.fixes.macro_subst.Subst'].reparse_bytes,
+                         len(r'\textbf{Ä}'.encode('utf-8')))
+        self.assertEqual(m['<output>'].bytes_written, len(result.encode('utf-8')))
+        self.assertGreater(m['<output>'].bytes_written, len(result))
+
+    def test_subpreprocessor(self):
+
+        lpp = helpers.MockLPP()
+        lpp.metrics = MetricsRecorder()
+        lpp.install_fix(regional_fix.Apply(
+            region='R',
+            fixes=[{'name': 'latexpp.fixes.macro_subst.Subst',
+                    'config': {'macros': {'foo': 'B'}}}]
+        ))
+
+        self.assertEqual(
+            lpp.execute(r"""\foo
+%%!lpp regional-fix R {
+\foo
+%%!lpp }
+"""),
+            "\\foo\nB"
+        )
+
+        m = { e.name: e for e in lpp.metrics.get_metrics() }
+        sub = m['latexpp.fixes.regional_fix.Apply / latexpp.fixes.macro_subst.Subst']
+        self.assertEqual(sub.calls, 1)
+        self.assertEqual(sub.nodes_replaced, 1)
+
+    def test_disabled(self):
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(macro_subst.Subst(macros={'a': r'\textbf{A}'}))
+        self.assertIsNone(lpp.metrics)
+        self.assertEqual(lpp.execute(r"""\a"""), r"""\textbf{A}""")
+
+
+if __name__ == '__main__':
+    helpers.test_main()
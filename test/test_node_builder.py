@@ -0,0 +1,105 @@
+import unittest
+
+import helpers
+
+from pylatexenc import latexwalker
+
+from latexpp.fix import BaseFix
+
+
+class TestLatexNodesBuilder(unittest.TestCase):
+
+    def test_nodes(self):
+
+        lpp = helpers.MockLPP()
+        b = lpp.nodes
+
+        n = b.macro('includegraphics', [
+            b.group('width=3cm', delimiters=('[', ']')),
+            'fig-01.pdf'
+        ])
+        self.assertEqual(n.to_latex(), r'\includegraphics[width=3cm]{fig-01.pdf}')
+        self.assertEqual(n.nodeargd.argspec, '[{')
+
+        n = b.macro('cite', [None, b.chars('*'), ['a', b.macro('alpha', macro_post_space=' '),
+                                         'b']],
+                    argspec='[*{')
+        self.assertEqual(n.to_latex(), r'\cite*{a\alpha b}')
+
+        n = b.environment('center', ['Hello ', b.comment(' x', comment_post_space='\n'),
+                                     b.chars('world')])
+        self.assertEqual(n.to_latex(),
+                         '\\begin{center}Hello % x\nworld\\end{center}')
+
+        self.assertEqual(b.nodelist(['A', b.group('B')]).to_latex(), 'A{B}')
+
+    def test_fix_returns_nodes(self):
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'textbf': self.fix_textbf})
+            def fix_textbf(self, n, **kwargs):
+                # \textbf{...} -> {\bfseries ...}
+                return self.lpp.nodes.group(
+                    [ self.lpp.nodes.macro('bfseries', macro_post_space=' ',
+                                           parsing_state=n.parsing_state),
+                      *self.preprocess_arg_node(n, 0).nodelist ],
+                    parsing_state=n.parsing_state,
+                )
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(MyFix())
+
+        self.assertEqual(
+            lpp.execute(r"""Hello \textbf{world and \textbf{more}}."""),
+            r"""Hello {\bfseries world and {\bfseries more}}."""
+        )
+        self.assertEqual(lpp.parse_cache.misses, 0)
+
+    def test_verbatim(self):
+
+        seen_nodes = []
+
+        class MyFix(BaseFix):
+            def handlers(self):
+                return dict(macros={'bibhere': self.fix_bibhere})
+            def fix_bibhere(self, n, **kwargs):
+                return self.lpp.nodes.verbatim(r'thebib\textbf{X} % not a comment',
+                                               parsing_state=n.parsing_state)
+
+        class SeeAllFix(BaseFix):
+            # inspects all nodes (no triggers)
+            def fix_node(self, n, **kwargs):
+                seen_nodes.append(n)
+                return None
+
+        class BoldFix(BaseFix):
+            def triggers(self):
+                return dict(macros=['textbf'])
+            def fix_node(self, n, **kwargs):
+                return r'\emph' + self.preprocess_latex(n.nodeargd.argnlist)
+
+        for fuse_fixes in (False, True):
+            del seen_nodes[:]
+
+            lpp = helpers.MockLPP()
+            lpp.fuse_fixes = fuse_fixes
+            lpp.install_fix(MyFix())
+            lpp.install_fix(SeeAllFix())
+            lpp.install_fix(BoldFix())
+
+            self.assertEqual(
+                lpp.execute(r"""A \textbf{B} \relax\bibhere"""),
+                r"""A \emph{B} \relax thebib\textbf{X} % not a comment"""
+            )
+
+            self.assertEqual(
+                [ type(n).__name__ for n in seen_nodes ],
+                [ 'LatexCharsNode', 'LatexMacroNode', 'LatexGroupNode',
+                  'LatexCharsNode', 'LatexCharsNode', 'LatexMacroNode',
+                  'LatexVerbatimSpliceNode' ]
+            )
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,188 @@
+import unittest
+import unittest.mock
+
+import helpers
+
+from pylatexenc import latexwalker
+
+from latexpp.fix import BaseFix
+from latexpp.fixes import macro_subst, bib, labels, figures
+from latexpp import node_index
+from latexpp.node_index import NodeIndex
+
+
+class TestNodeIndex(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def _parse(self, lpp, latex):
+        lw = lpp.make_latex_walker(latex)
+        return list(lw.get_latex_nodes()[0])
+
+    def test_find(self):
+
+        lpp = helpers.MockLPP()
+        nodelist = self._parse(lpp, r"""\ref{a} and
+\begin{center}\textbf{See \ref{b}}, $x_{\ref{c}}$\end{center}""")
+
+        index = NodeIndex(lpp, nodelist)
+
+        occs = index.find(macros=['ref'])
+        self.assertEqual(
+            sorted( occ.node.nodeargd.argnlist[0].to_latex() for occ in occs ),
+            [ '{a}', '{b}', '{c}' ]
+        )
+        for occ in occs:
+            self.assertIs(occ.container[occ.slot], occ.node)
+
+        occ_a, = [ occ for occ in occs if occ.node.pos == 0 ]
+        self.assertIs(occ_a.container, nodelist)
+        self.assertIsNone(occ_a.owner)
+
+        occ_textbf, = index.find(macros=['textbf'])
+        self.assertTrue(occ_textbf.owner.isNodeType(latexwalker.LatexEnvironmentNode))
+        self.assertFalse(occ_textbf.is_argument())
+
+        occ_center, = index.find(environments=['center'])
+        self.assertIs(occ_center.container, nodelist)
+
+        self.assertEqual(index.find(macros=['nonexistent']), [])
+
+    def test_replace(self):
+
+        lpp = helpers.MockLPP()
+        nodelist = self._parse(lpp, r"""\emph{A \x, \x} \frac\x{2} \x""")
+
+        index = NodeIndex(lpp, nodelist)
+
+        occs = index.find(macros=['x'])
+        self.assertEqual(len(occs), 4)
+        for occ in occs:
+            index.replace(occ, r'\y Y')
+
+        self.assertEqual(''.join(n.to_latex() for n in nodelist),
+                         r"""\emph{A \y Y, \y Y} \frac{\y Y}{2} \y Y""")
+
+        self.assertEqual(index.find(macros=['x']), [])
+        self.assertEqual(len(index.find(macros=['y'])), 4)
+
+    def test_tracks_modifications_by_fixes(self):
+
+        lpp = helpers.MockLPP()
+        nodelist = self._parse(lpp, r"""Hello \a and {\b{\a}} and \foo""")
+
+        index = NodeIndex(lpp, nodelist)
+        self.assertEqual(len(index.find(macros=['a'])), 2)
+
+        fix = macro_subst.Subst(macros={'a': r'\textbf{\dd}'})
+        fix.set_lpp(lpp)
+        newnodelist = fix.preprocess(nodelist)
+        index.set_root(newnodelist)
+
+        self.assertEqual(index.find(macros=['a']), [])
+        self.assertEqual(len(index.find(macros=['textbf'])), 2)
+        self.assertEqual(len(index.find(macros=['dd'])), 2)
+        occ_b, = index.find(macros=['b'])
+        self.assertIs(occ_b.container[occ_b.slot], occ_b.node)
+
+        # node modified in place
+        occ_foo, = index.find(macros=['foo'])
+        occ_foo.node.macroname = 'bar'
+        self.assertEqual(index.find(macros=['foo']), [])
+        occ_bar, = index.find(macros=['bar'])
+        self.assertIs(occ_bar.node, occ_foo.node)
+
+    def test_fix_uses_index(self):
+
+        class MyFix(BaseFix):
+            def preprocess(self, nodelist):
+                index = self.lpp.node_index
+                for occ in index.find(macros=['includegraphics']):
+                    index.replace(occ, self.lpp.nodes.macro(
+                        'includegraphics',
+                        [ self.preprocess_arg_node(occ.node, 0), 'fig.pdf' ],
+                        parsing_state=occ.node.parsing_state,
+                    ))
+                return nodelist
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(macro_subst.Subst(macros={'fig': r'\includegraphics[width=1cm]{x}'}))
+        lpp.install_fix(MyFix())
+
+        self.assertEqual(
+            lpp.execute(r"""\begin{document}
+\begin{figure}\fig\caption{A \includegraphics{y.png}}\end{figure}
+\end{document}"""),
+            r"""\begin{document}
+\begin{figure}\includegraphics[width=1cm]{fig.pdf}\caption{A \includegraphics{fig.pdf}}\end{figure}
+\end{document}"""
+        )
+
+    def test_apply_handlers_same_as_walker(self):
+
+        latex = r"""\begin{document}
+\section{Intro}\label{sec:intro}
+See \cite{x,y} and \citet{z}, also Section~\ref{sec:intro} and
+\begin{figure}\includegraphics[width=2cm]{fig/intro}
+\caption{Schema, cf.\ \cite{x} \eqref{eq:a}.}\label{fig:a}\end{figure}
+{\em \begin{equation}\label{eq:a} x = \ref{fig:a} \end{equation}}
+\includegraphics{fig/intro}\bibalias{x}{w}\cite{x}
+\end{document}
+"""
+
+        def run(make_fix, use_index):
+            figures.os_path = helpers.FakeOsPath([ 'fig/intro.png' ])
+            lpp = helpers.MockLPP()
+            lpp.install_fix(make_fix())
+            if use_index:
+                return lpp.execute(latex)
+            with unittest.mock.patch.object(NodeIndex, 'apply_handlers',
+                                            return_value=False):
+                return lpp.execute(latex)
+
+        for make_fix in (
+                lambda: bib.ApplyAliases(aliases={'y': 'yy'}),
+                lambda: labels.RenameLabels(label_rename_fmt='L%(n)d'),
+                lambda: figures.CopyAndRenameFigs(),
+        ):
+            result = run(make_fix, True)
+            self.assertNotEqual(result, latex)
+            self.assertEqual(result, run(make_fix, False))
+
+    def test_apply_handlers_scaling(self):
+
+        # with the index, the work done by a fix depends on the number of
+        # nodes it replaces, not on the size of the document
+
+        def run(num_filler):
+            latex = (
+                r"\begin{document}" "\n"
+                + r"\section{A}\emph{Some} \cite{x} and {\bf \citep{y}}" "\n\n"
+                + (r"Filler text \emph{here} and {\bf there}." "\n\n") * num_filler
+                + r"\end{document}"
+            )
+            lpp = helpers.MockLPP()
+            fix = bib.ApplyAliases(aliases={'x': 'xx', 'y': 'yy'})
+            handler_calls = []
+            fix_cite = fix.fix_cite
+            def counting_fix_cite(n, **kwargs):
+                handler_calls.append(n)
+                return fix_cite(n, **kwargs)
+            fix.fix_cite = counting_fix_cite
+            lpp.install_fix(fix)
+            with unittest.mock.patch.object(
+                    node_index, '_child_containers',
+                    wraps=node_index._child_containers) as child_containers:
+                result = lpp.execute(latex)
+            self.assertIn(r"\cite{xx} and {\bf \citep{yy}}", result)
+            return len(handler_calls), child_containers.call_count
+
+        small = run(20)
+        self.assertEqual(small[0], 2)
+        self.assertEqual(run(2000), small)
+
+
+if __name__ == '__main__':
+    helpers.test_main()
@@ -0,0 +1,174 @@
+import unittest
+import os
+import os.path
+import tempfile
+
+import helpers
+
+from pylatexenc.macrospec import MacroSpec, LatexArgumentsParser
+
+from latexpp.fix import BaseFix
+from latexpp.fixes import macro_subst, newcommand, input as input_fix
+from latexpp.parse_cache import PersistentParseCache
+
+
+class TestPersistentParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.cachedir = self._tmpdir.name
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _run(self, latex, fixes, cache=None, mock_files={}):
+        if cache is None:
+            cache = PersistentParseCache(self.cachedir)
+        lpp = helpers.MockLPP(mock_files=mock_files)
+        lpp.persistent_parse_cache = cache
+        for fix in fixes:
+            lpp.install_fix(fix)
+        return lpp.execute(latex), cache
+
+    def test_reuse(self):
+
+        latex = r"""\section{Intro}\textbf{\a{} and \emph{\a{}}} % comment
+$x = \frac{\a{}}{2}$ \begin{itemize}\item \a{}\end{itemize}"""
+
+        def fixes():
+            return [ macro_subst.Subst(macros={'a': r'\textit{A}'}) ]
+
+        result, cache = self._run(latex, fixes())
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (0, 1, 1))
+
+        # a new run loads the same document from the cache & modifies it
+        # correctly
+        result2, cache2 = self._run(latex, fixes())
+        self.assertEqual((cache2.hits, cache2.misses), (1, 0))
+        self.assertEqual(result2, result)
+        self.assertEqual(
+            result2,
+            r"""\section{Intro}\textbf{\textit{A}{} and \emph{\textit{A}{}}} % comment
+$x = \frac{\textit{A}{}}{2}$ \begin{itemize}\item \textit{A}{}\end{itemize}"""
+        )
+
+        # a different document is parsed
+        _, cache3 = self._run(latex + ' ', fixes())
+        self.assertEqual((cache3.hits, cache3.misses), (0, 1))
+
+    def test_fix_specs_in_key(self):
+
+        latex = r"""\newenvironment{foo}{X}{Y}"""
+
+        _, cache = self._run(latex, [])
+        self.assertEqual(cache.stores, 1)
+
+        # newcommand.Expand has specs for \newenvironment & co., which change
+        # how the document is parsed
+        _, cache = self._run(latex, [ newcommand.Expand() ])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_args_parser_in_key(self):
+
+        # the repr() of these specs is the same, but they parse \foo with a
+        # different number of arguments
+        class MyFix(BaseFix):
+            def __init__(self, argspec):
+                super().__init__()
+                self.argspec = argspec
+            def specs(self):
+                # a spec with a custom arguments parser
+                spec = MacroSpec('foo')
+                spec.arguments_parser = MyArgumentsParser(self.argspec)
+                return dict(macros=[spec])
+
+        class MyArgumentsParser(LatexArgumentsParser):
+            def __repr__(self):
+                return '<MyArgumentsParser>'
+
+        latex = r"""\foo{A}{B}"""
+
+        self.assertEqual(repr(MyFix('{').specs()), repr(MyFix('{{').specs()))
+
+        _, cache = self._run(latex, [ MyFix('{') ])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        _, cache = self._run(latex, [ MyFix('{') ])
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        _, cache = self._run(latex, [ MyFix('{{') ])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_uncacheable(self):
+
+        latex = r"""\newcommand{\x}{X}\x{} and \x{}"""
+
+        def fixes():
+            return [ newcommand.Expand() ]
+
+        result, cache = self._run(latex, fixes())
+        self.assertEqual(result, r"""X{} and X{}""")
+
+        # the nodes could not be stored, the next run parses the document
+        # again without trying to store it
+        result2, cache2 = self._run(latex, fixes())
+        self.assertEqual(result2, result)
+        self.assertEqual((cache2.hits, cache2.misses, cache2.stores), (0, 1, 0))
+
+    def test_input_files(self):
+
+        mock_files = {
+            'chapter.tex': r"""\a{} in the chapter""",
+        }
+        input_fix.os_path = helpers.FakeOsPath(list(mock_files))
+
+        def fixes():
+            return [ input_fix.EvalInput(),
+                     macro_subst.Subst(macros={'a': r'\textbf{A}'}) ]
+
+        latex = r"""\input{chapter.tex} \a{}"""
+        result, cache = self._run(latex, fixes(), mock_files=mock_files)
+        self.assertEqual(result, r"""\textbf{A}{} in the chapter \textbf{A}{}""")
+        self.assertEqual(cache.stores, 2)
+
+        result2, cache2 = self._run(latex, fixes(), mock_files=mock_files)
+        self.assertEqual(result2, result)
+        self.assertEqual((cache2.hits, cache2.misses), (2, 0))
+
+    def test_invalid_entry(self):
+
+        latex = r"""\emph{x}"""
+        _, cache = self._run(latex, [])
+        # corrupt the stored entry
+        (path, _, _), = cache._list_entries()
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+
+        result, cache = self._run(latex, [])
+        self.assertEqual(result, latex)
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (0, 1, 1))
+
+    def test_eviction(self):
+
+        latex = r"""\emph{x} \textbf{y} """
+        cache = PersistentParseCache(self.cachedir)
+        self._run(latex, [], cache=cache)
+        entry_size = cache.total_size()
+
+        cache = PersistentParseCache(self.cachedir, max_size=int(2.5 * entry_size))
+        for k in range(5):
+            self._run(latex + str(k), [], cache=cache)
+            self.assertLessEqual(cache.total_size(), cache.max_size)
+        self.assertEqual(cache.stores, 5)
+        self.assertEqual(len(cache._list_entries()), 2)
+        self.assertEqual(cache.evictions, 4)
+
+        # the most recently used entries are kept
+        _, cache = self._run(latex + '4', [], cache=cache)
+        self.assertEqual(cache.hits, 1)
+
+        cache.clear()
+        self.assertEqual(cache.total_size(), 0)
+
+
+if __name__ == '__main__':
+    helpers.test_main()
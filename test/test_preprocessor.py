@@ -0,0 +1,301 @@
+import unittest
+import os.path
+import tempfile
+import io
+
+import helpers
+
+from pylatexenc import latexwalker
+
+from latexpp.fix import BaseFix, BaseMultiStageFix
+
+from latexpp.fixes import macro_subst, comments, environment_contents
+from latexpp import preprocessor
+
+
+_test_latex = r"""\documentclass{article}
+\begin{document}
+Hello \abc.  % a comment
+% another comment
+\xyz*{Yo \abc} and \frac\rhostate{2} and \ket{\rhostate}.
+\begin{proof}
+  Trivial: $\ket{\phi} = \abc$.  % comment
+\end{proof}
+\begin{equation*}
+  \alpha = \beta \qedhere
+\end{equation*}
+\end{document}
+"""
+
+
+class UpperCaseXyzFix(BaseFix):
+    # inspects all nodes (no triggers)
+    def fix_node(self, n, **kwargs):
+        if n.isNodeType(latexwalker.LatexCharsNode) and 'Yo' in n.chars:
+            return n.chars.replace('Yo', 'YO')
+        return None
+
+class CountQedFix(BaseMultiStageFix):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.add_stage(self.Count(self))
+        self.add_stage(self.Replace(self))
+
+    class Count(BaseMultiStageFix.Stage):
+        def fix_node(self, n, **kwargs):
+            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'qed':
+                self.parent_fix.count += 1
+            return None
+
+    class Replace(BaseMultiStageFix.Stage):
+        def fix_node(self, n, **kwargs):
+            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'qedhere':
+                return r'\numqed{' + str(self.parent_fix.count) + '}'
+            return None
+
+
+def _make_fixes():
+    return [
+        macro_subst.Subst(
+            macros={
+                'abc': r'\textbf{ABC}',
+                'xyz': dict(argspec='*[{', repl=r'\chapter%(1)s{Title: %(3)s}'),
+                'ket': dict(argspec='{', repl=r'\lvert{%(1)s}\rangle'),
+                'rhostate': r'\hat\rho',
+            },
+            environments={
+                'equation*': r'\[%(body)s\]'
+            }
+        ),
+        comments.RemoveComments(leave_percent=False),
+        environment_contents.InsertPrePost(environmentnames=['proof'],
+                                           post_contents=r'\qed'),
+        UpperCaseXyzFix(),
+        CountQedFix(),
+        macro_subst.Subst(
+            macros={
+                'qed': r'\blacksquare',
+            },
+        ),
+    ]
+
+
+class TestFuseFixes(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def _run(self, fuse_fixes):
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = fuse_fixes
+        for fix in _make_fixes():
+            lpp.install_fix(fix)
+        return lpp.execute(_test_latex)
+
+    def test_same_output(self):
+
+        result = self._run(fuse_fixes=False)
+
+        self.assertEqual(
+            result,
+            r"""\documentclass{article}
+\begin{document}
+Hello \textbf{ABC}.  \chapter*{Title: YO \textbf{ABC}} and \frac{\hat\rho}{2} and \lvert{\hat\rho}\rangle.
+\begin{proof}
+  Trivial: $\lvert{\phi}\rangle = \textbf{ABC}$.  \blacksquare\end{proof}
+\[
+  \alpha = \beta \numqed{1}\]
+\end{document}
+"""
+        )
+
+        self.assertEqual(self._run(fuse_fixes=True), result)
+
+    def test_fix_groups(self):
+
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = True
+        for fix in _make_fixes():
+            lpp.install_fix(fix)
+        lpp.initialize()
+
+        self.assertEqual(
+            [ [ fix.__class__.__name__ for fix in fixes ]
+              for fixes, runner in lpp._fix_groups ],
+            [
+                ['Subst', 'RemoveComments', 'InsertPrePost', 'UpperCaseXyzFix'],
+                ['CountQedFix'],
+                ['Subst'],
+            ]
+        )
+
+    def test_triggers_skip_nodes(self):
+
+        seen_nodes = []
+
+        class MyFix(BaseFix):
+            def triggers(self):
+                return dict(macros=['textbf'])
+            def fix_node(self, n, **kwargs):
+                seen_nodes.append(n)
+                return None
+
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = True
+        lpp.install_fix(comments.RemoveComments())
+        lpp.install_fix(MyFix())
+
+        self.assertEqual(
+            lpp.execute(r"""Hello \emph{world} % comment
+and \textbf{bold \textbf{text}}."""),
+            r"""Hello \emph{world} %
+and \textbf{bold \textbf{text}}."""
+        )
+
+        self.assertEqual(
+            [ n.macroname for n in seen_nodes ],
+            [ 'textbf', 'textbf' ]
+        )
+
+
+
+    def test_prev_node(self):
+
+        def run(fuse_fixes):
+
+            seen_prev_nodes = []
+
+            class RecordPrevFix(BaseFix):
+                def triggers(self):
+                    return dict(macros=['bar'])
+                def fix_node(self, n, prev_node=None, **kwargs):
+                    seen_prev_nodes.append(prev_node.to_latex())
+                    return None
+
+            lpp = helpers.MockLPP()
+            lpp.fuse_fixes = fuse_fixes
+            lpp.install_fix(RecordPrevFix())
+            lpp.install_fix(macro_subst.Subst(macros={'foo': 'FOO', 'bar': 'BAR'}))
+            lpp.install_fix(RecordPrevFix())
+
+            result = lpp.execute(r"""\foo\bar and \foo \bar""")
+            self.assertEqual(len(lpp._fix_groups), 1 if fuse_fixes else 3)
+            return result, seen_prev_nodes
+
+        result, seen_prev_nodes = run(fuse_fixes=False)
+        self.assertEqual(result, "FOOBARand FOOBAR")
+        # each fix sees the node that it left in front of the current node
+        # (the second fix never sees \bar since the substitution removed it)
+        self.assertEqual(seen_prev_nodes, [r'\foo', r'\foo '])
+
+        self.assertEqual(run(fuse_fixes=True), (result, seen_prev_nodes))
+
+    def test_deep_nesting(self):
+
+        lpp = helpers.MockLPP()
+        lpp.fuse_fixes = True
+        lpp.install_fix(macro_subst.Subst(macros={'x': r'\y'}))
+        lpp.install_fix(macro_subst.Subst(macros={'y': r'\z'}))
+        lpp.initialize()
+        self.assertEqual(len(lpp._fix_groups), 1)
+
+        # groups and macro arguments nested way beyond Python's recursion limit
+        depth = 30000
+        b = lpp.nodes
+        node = b.macro('x')
+        for k in range(depth):
+            if k % 2 == 0:
+                node = b.group([node, 'a'])
+            else:
+                node = b.macro('textbf', [[node]])
+        nodelist = b.nodelist([node])
+
+        runner = lpp._fix_groups[0][1]
+        newnodelist = runner.preprocess(nodelist)
+
+        pre, post = [], []
+        for k in range(depth):
+            if k % 2 == 0:
+                pre.append('{'); post.append('a}')
+            else:
+                pre.append(r'\textbf{'); post.append('}')
+        self.assertEqual(
+            ''.join(n.to_latex() for n in newnodelist),
+            ''.join(reversed(pre)) + r'\z ' + ''.join(post)
+        )
+
+
+
+class TestExecuteStream(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def test_chunks(self):
+
+        class MyStream:
+            def __init__(self):
+                self.chunks = []
+            def write(self, x):
+                self.chunks.append(x)
+
+        latex = _test_latex * 20
+
+        def _make_lpp():
+            lpp = helpers.MockLPP()
+            for fix in _make_fixes():
+                lpp.install_fix(fix)
+            lpp.initialize()
+            return lpp
+
+        result = _make_lpp().execute_string(latex, omit_processed_by=True)
+
+        lpp = _make_lpp()
+        stream = MyStream()
+        old_chunk_size = preprocessor._OUTPUT_CHUNK_SIZE
+        try:
+            preprocessor._OUTPUT_CHUNK_SIZE = 256
+            lpp.execute_stream(latex, stream, omit_processed_by=True)
+        finally:
+            preprocessor._OUTPUT_CHUNK_SIZE = old_chunk_size
+
+        self.assertEqual(''.join(stream.chunks), result)
+        self.assertGreater(len(stream.chunks), 1)
+        for chunk in stream.chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 256)
+
+    def test_execute_file(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            with open(os.path.join(tmpdir, 'doc.tex'), 'w') as f:
+                f.write(_test_latex)
+
+            lpp = preprocessor.LatexPreprocessor(
+                output_dir=os.path.join(tmpdir, 'out'),
+                main_doc_fname='doc.tex',
+                main_doc_output_fname='main.tex',
+                config_dir=tmpdir,
+            )
+            for fix in _make_fixes():
+                lpp.install_fix(fix)
+            lpp.initialize()
+            lpp.execute_main()
+            lpp.finalize()
+
+            with open(os.path.join(tmpdir, 'out', 'main.tex')) as f:
+                result = f.read()
+
+        self.assertTrue(result.startswith('% Automatically processed by latexpp'))
+
+        lpp2 = helpers.MockLPP()
+        for fix in _make_fixes():
+            lpp2.install_fix(fix)
+        self.assertTrue(result.endswith(lpp2.execute(_test_latex)))
+
+
+if __name__ == '__main__':
+    helpers.test_main()
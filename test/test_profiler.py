@@ -0,0 +1,66 @@
+import unittest
+import io
+import os.path
+import time
+import pstats
+import tempfile
+
+import helpers
+
+from pylatexenc import latexwalker
+
+from latexpp.fix import BaseMultiStageFix
+from latexpp.profiler import Profiler
+
+
+class SlowFix(BaseMultiStageFix):
+    def __init__(self):
+        super().__init__()
+        self.add_stage(self.SlowStage(self))
+
+    class SlowStage(BaseMultiStageFix.Stage):
+        def fix_node(self, n, **kwargs):
+            if n.isNodeType(latexwalker.LatexMacroNode) and n.macroname == 'slow':
+                time.sleep(0.02)
+            return None
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profile(self):
+
+        lpp = helpers.MockLPP()
+        lpp.install_fix(SlowFix())
+
+        profiler = Profiler(lpp, interval=0.001)
+        self.assertIsNotNone(lpp.metrics)
+
+        profiler.start()
+        try:
+            lpp.execute(r"""\slow\slow\slow""")
+        finally:
+            profiler.stop()
+
+        f = io.StringIO()
+        profiler.write_collapsed(f)
+        lines = f.getvalue().splitlines()
+
+        prefix = 'test_profiler.SlowFix;SlowStage;'
+        slow_lines = [ l for l in lines if l.startswith(prefix) ]
+        self.assertTrue(slow_lines)
+        for l in slow_lines:
+            stack, count = l.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('fix_node (test_profiler.py:' in l for l in slow_lines))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_prefix = os.path.join(tmpdir, 'prof')
+            profiler.write(output_prefix)
+            stats = pstats.Stats(output_prefix + '.prof')
+            self.assertTrue(any(func[2] == 'fix_node' for func in stats.stats))
+            with open(output_prefix + '.collapsed') as fc:
+                self.assertEqual(fc.read(), f.getvalue())
+
+
+if __name__ == '__main__':
+    helpers.test_main()
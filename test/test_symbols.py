@@ -0,0 +1,119 @@
+import unittest
+
+import helpers
+
+from latexpp.fix import BaseFix
+from latexpp.fixes import macro_subst, bib
+from latexpp.symbols import DocumentSymbols
+
+
+class TestDocumentSymbols(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def _parse(self, lpp, latex):
+        lw = lpp.make_latex_walker(latex)
+        return list(lw.get_latex_nodes()[0])
+
+    def test_tables(self):
+
+        lpp = helpers.MockLPP()
+        # for the \bibalias macro spec
+        lpp.install_fix(bib.ApplyAliases())
+        lpp.initialize()
+        nodelist = self._parse(lpp, r"""\documentclass{article}
+\usepackage[sort]{natbib}
+\usepackage{amsmath,cleveref}
+\newcommand{\mycmd}[1]{x}
+\bibalias{smith}{Smith2020}
+\begin{document}
+\section{Intro}\label{sec:intro}
+See \cref{sec:intro,eq:a} and \cite[p.~2]{smith,jones}.
+\begin{equation}x\label{eq:a}\end{equation}
+\emph{Also \ref{sec:intro}} \citet{jones}.
+\end{document}
+""")
+
+        symbols = DocumentSymbols(lpp)
+        symbols.set_root(nodelist)
+
+        self.assertEqual(symbols.labels.names(), ['sec:intro', 'eq:a'])
+        self.assertEqual(
+            [ (e.name, e.value) for e in symbols.refs ],
+            [ ('sec:intro', 'cleveref'), ('eq:a', 'cleveref'), ('sec:intro', 'ref') ]
+        )
+        self.assertEqual(len(symbols.refs.nodes()), 2)
+        self.assertEqual(len(symbols.refs.get('sec:intro')), 2)
+        self.assertEqual(symbols.cites.names(), ['smith', 'jones'])
+        self.assertEqual(len(symbols.cites), 3)
+        self.assertEqual(
+            [ (e.name, e.value) for e in symbols.packages ],
+            [ ('natbib', 'sort'), ('amsmath', None), ('cleveref', None) ]
+        )
+        self.assertIn('cleveref', symbols.packages)
+        self.assertNotIn('hyperref', symbols.packages)
+        self.assertEqual([ (e.name, e.value) for e in symbols.bibaliases ],
+                         [ ('smith', 'Smith2020') ])
+        self.assertEqual(symbols.newcommands.names(), ['mycmd'])
+
+    def test_recomputed_after_changes(self):
+
+        lpp = helpers.MockLPP()
+        nodelist = self._parse(lpp, r"""\label{a} {\foo} \emph{\label{b}}""")
+
+        symbols = DocumentSymbols(lpp)
+        symbols.set_root(nodelist)
+
+        labels = symbols.labels
+        self.assertEqual(labels.names(), ['a', 'b'])
+        # nothing changed, same table
+        self.assertIs(symbols.labels, labels)
+
+        fix = macro_subst.Subst(macros={'foo': r'\label{c}'})
+        fix.set_lpp(lpp)
+        newnodelist = fix.preprocess(nodelist)
+        self.assertIs(newnodelist, nodelist) # modified within the group node
+
+        self.assertEqual(symbols.labels.names(), ['a', 'c', 'b'])
+
+    def test_used_by_fixes(self):
+
+        seen = []
+
+        class MyFix(BaseFix):
+            def fix_node(self, n, **kwargs):
+                seen.append(self.lpp.symbols.labels.names())
+                return None
+
+        lpp = helpers.MockLPP()
+        # MyFix must see the document as modified by the first fix
+        lpp.fuse_fixes = False
+        lpp.install_fix(macro_subst.Subst(macros={'mylabel': r'\label{x}'}))
+        lpp.install_fix(MyFix())
+
+        lpp.execute(r"""\label{a}\mylabel""")
+
+        self.assertTrue(seen)
+        for names in seen:
+            self.assertEqual(names, ['a', 'x'])
+        # tables are only available while fixes run
+        with self.assertRaises(RuntimeError):
+            lpp.symbols.labels
+
+    def test_main_doc_source(self):
+
+        lpp = helpers.MockLPP(mock_files={'TESTDOC': r"\documentclass{article}"})
+        self.assertEqual(lpp.symbols.main_doc_source(), r"\documentclass{article}")
+
+        lpp.mock_files['TESTDOC'] = 'changed'
+        # the file is only read once
+        self.assertEqual(lpp.symbols.main_doc_source(), r"\documentclass{article}")
+
+        sublpp = lpp.create_subpreprocessor()
+        self.assertEqual(sublpp.symbols.main_doc_source(), r"\documentclass{article}")
+
+
+if __name__ == '__main__':
+    helpers.test_main()